@@ -983,6 +983,8 @@ class CoreRequestHandler(CoreBaseHandler, RequestHandler):
             page["page"] = chunk.page
             page["per_page"] = chunk.per_page
             page["count"] = chunk.count
+            page["next"] = chunk.next
+            page["prev"] = chunk.prev
             self.finish(page)
             return
         chunk = self._build_json(
@@ -12,7 +12,9 @@ import core4.const
 import core4.util.tool
 
 from core4.api.v1.request.main import CoreRequestHandler
-from core4.util.pager import CorePager
+from core4.queue.history import HISTORY_STATE, floor_period, \
+    history_period
+from core4.util.pager import CorePager, count
 
 dates = ['year', 'month', 'day', 'hour', 'minute', 'second']
 
@@ -44,6 +46,11 @@ class JobHistoryHandler(CoreRequestHandler):
             sort (str): 1 - for ascending sorting,
                         -1 - for descending sorting
                         by default -1 (desc) sorting
+            keyset (bool): use keyset pagination, defaults to ``False``
+            cursor (str): ``next`` or ``prev`` continuation token of keyset
+                pagination
+            count (bool): count records with keyset pagination, defaults to
+                ``True``
 
         Returns:
             data element with list of aggregated job counts For pagination the
@@ -54,6 +61,13 @@ class JobHistoryHandler(CoreRequestHandler):
             - **page** (int): current page (starts counting with ``0``)
             - **page_count** (int): the total number of pages
             - **per_page** (int): the number of elements per page
+            - **next** (str): continuation token of the next page with keyset
+              pagination
+            - **prev** (str): continuation token of the previous page with
+              keyset pagination
+
+            With keyset pagination each record carries the ``_id`` of the
+            event.
 
         Raises:
             401: Unauthorized
@@ -89,15 +103,18 @@ class JobHistoryHandler(CoreRequestHandler):
         if query_filter:
             query.update(query_filter)
 
+        keyset = self.get_argument("keyset", as_type=bool, default=False)
+        cursor = self.get_argument("cursor", as_type=str, default=None)
+
         async def _length(filter):
-            return await coll.count_documents(filter)
+            return await count(coll, filter)
 
         async def _query(skip, limit, filter, sort_by):
             cur = coll.find(
                 filter,
-                projection={"created": 1, "data": 1, "_id": 0}
+                projection={"created": 1, "data": 1, "_id": 1}
             ).sort(
-                [("$natural", sort)]
+                sort_by if keyset or cursor else [("$natural", sort)]
             ).skip(
                 skip
             ).limit(
@@ -108,13 +125,18 @@ class JobHistoryHandler(CoreRequestHandler):
                 total = sum([v for v in doc["data"]["queue"].values()])
                 doc["data"]["queue"]["created"] = doc["created"]
                 doc["data"]["queue"]["total"] = total
+                if keyset or cursor:
+                    doc["data"]["queue"]["_id"] = doc["_id"]
                 ret.append(doc["data"]["queue"])
             return ret
 
         pager = CorePager(per_page=per_page,
                           current_page=current_page,
                           length=_length, query=_query,
-                          filter=query)
+                          filter=query, sort_by=[("_id", sort)],
+                          keyset=keyset, token=cursor,
+                          count=self.get_argument(
+                              "count", as_type=bool, default=True))
         page = await pager.page()
         return self.reply(page)
 
@@ -158,6 +180,12 @@ class QueueHistoryHandler(CoreRequestHandler):
 
     * job state
     * job flags non-stopper, zombie, killed and removed
+
+    The handler reads the coarsest minute, hour or day rollups of
+    ``sys.queue_history`` which satisfy the precision of the requested
+    period, see :mod:`core4.queue.history`. It falls back to the raw
+    ``sys.event`` documents if the precision is finer than a minute or if
+    no rollups exist for the requested period.
     """
     author = "oto"
     title = "queue history"
@@ -227,19 +255,31 @@ class QueueHistoryHandler(CoreRequestHandler):
                                      as_type=datetime.datetime,
                                      default=None)
 
-        coll = self.config.sys.event
-        query = {
-            "channel": core4.const.QUEUE_CHANNEL
-        }
-
         group_by_date_time_period = self._group_by(start_date, end_date)
 
-        query.update(self._between(start_date, end_date))
+        period = history_period(self._precision(start_date, end_date))
+        if period is not None:
+            coll = self.config.sys.queue_history
+            base = {"period": period}
+            query = dict(base)
+            query.update(self._between(floor_period(start_date, period),
+                                       end_date, key="at"))
+            if await coll.find_one(query, projection=["_id"]) is None:
+                period = None
+        if period is None:
+            coll = self.config.sys.event
+            base = {}
+            query = {
+                "channel": core4.const.QUEUE_CHANNEL
+            }
+            query.update(self._between(start_date, end_date))
 
         async def _length(filter):
+            match = dict(base)
+            match.update(filter)
             cur = coll.aggregate([
                 {
-                    "$match": filter
+                    "$match": match
                 },
                 {
                     "$project": {
@@ -271,25 +311,27 @@ class QueueHistoryHandler(CoreRequestHandler):
             pipeline = [
                 {
                     "$match": filter
-                },
-                {
+                }
+            ]
+            if period is not None:
+                # rollups carry queue, created and total
+                pipeline.append({
+                    "$sort": {"created": 1}
+                })
+            else:
+                pipeline.append({
                     "$project": {
                         "_id": 0,
                         "queue": "$data.queue",
                         "created": "$created",
                         "total": {
                             "$sum": [
-                                "$data.queue.pending",
-                                "$data.queue.deferred",
-                                "$data.queue.failed",
-                                "$data.queue.running",
-                                "$data.queue.error",
-                                "$data.queue.inactive",
-                                "$data.queue.killed"
+                                "$data.queue." + s for s in HISTORY_STATE
                             ]
                         }
                     }
-                },
+                })
+            pipeline += [
                 {
                     "$group": {
                         "_id": group_by_date_time_period,
@@ -464,6 +506,27 @@ class QueueHistoryHandler(CoreRequestHandler):
 
         return grouping_id
 
+    def _precision(self, start_date, end_date=None):
+        """
+        Get the configured precision for the period between 2 dates
+
+        Parameters:
+            start_date (datetime): - start date
+            end_date (datetime| None): - end date
+
+        Returns:
+            date/time part to group by, see config ``queue.precision``
+
+        Examples:
+            "hour"
+        """
+        precision_config = self.raw_config.get("queue", {})['precision']
+
+        if not end_date:
+            end_date = datetime.datetime.now()
+
+        return precision_config[self._get_period(start_date, end_date)["delta"]]
+
     def _get_period(self, start, end):
         """
         Calculate delta between 2 dates
@@ -563,13 +626,14 @@ class QueueHistoryHandler(CoreRequestHandler):
        """
         return '$dayOfMonth' if name == 'day' else ("$" + name)
 
-    def _between(self, start_date, end_date=None):
+    def _between(self, start_date, end_date=None, key="created"):
         """
         Build mongoDB query for getting documents for some datetime range
 
         Parameters:
             start_date (str): start date for mongoDB query
             end_date (str| None): end date for mongoDB query
+            key (str): date attribute, defaults to ``created``
 
         Returns:
             mongoDB $match query
@@ -596,13 +660,13 @@ class QueueHistoryHandler(CoreRequestHandler):
 
         """
         match = {
-            "created": {
+            key: {
                 "$gte": start_date
             }
         }
 
         if end_date:
-            match["created"].update({
+            match[key].update({
                 "$lte": end_date
             })
 
@@ -5,6 +5,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import codecs
 import sys
 import traceback
 import pymongo
@@ -20,7 +21,12 @@ import core4.queue.job
 import core4.queue.query
 import core4.util.node
 from core4.api.v1.request.main import CoreRequestHandler
+from core4.queue.archive import CoreArchive
+from core4.queue.dag import GRAPH_PROJECTION, JobGraph, alive_filter
+from core4.queue.dag import dependency_filter, graph_filter, removed_filter
+from core4.queue.history import write_history_async
 from core4.queue.main import CoreQueue
+from core4.queue.stdout import decode_chunk, stdout_tail
 from core4.util.data import json_encode
 from core4.util.pager import CorePager
 
@@ -46,6 +52,8 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
     author = "mra"
     title = "job manager"
     tag = "api jobs"  # idea is to have a FE app; remove api by then
+    #: :func:`.history_key` of the last queue history snapshot written
+    _history = None
 
     def initialize(self):
         self.queue = CoreQueue()
@@ -77,6 +85,12 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
             sort (str): sort field
             order (int): sort direction (``1`` for ascending, ``-1`` for
                          descending)
+            filter (dict): optional mongodb filter
+            keyset (bool): use keyset pagination, defaults to ``False``
+            cursor (str): ``next`` or ``prev`` continuation token of keyset
+                          pagination
+            count (bool): count jobs with keyset pagination, defaults to
+                          ``True``
 
         Returns:
             data element with list of job attributes as dictionaries. For
@@ -87,6 +101,10 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
             - **page**: current page (starts counting with ``0``)
             - **page_count**: the total number of pages
             - **per_page**: the number of elements per page
+            - **next**: continuation token of the next page with keyset
+              pagination
+            - **prev**: continuation token of the previous page with keyset
+              pagination
 
         Raises:
             401: Unauthorized
@@ -231,40 +249,52 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
     async def get_listing(self):
         """
         Retrieve job listing from ``sys.queue``. Only jobs with read/execute
-        access permissions granted to the current user are returned.
+        access permissions granted to the current user are returned. The
+        permissions are applied as a MongoDB filter, see
+        :meth:`.CoreRole.job_filter`, so that filtering, sorting, paging and
+        counting run in the database.
 
         :return: :class:`.PageResult`
         """
 
         per_page = int(self.get_argument("per_page", default=10))
         current_page = int(self.get_argument("page", default=0))
-        query_filter = self.get_argument("filter", default={})
+        query_filter = self.get_argument("filter", as_type=dict, default={})
         sort_by = self.get_argument("sort", default="_id")
         sort_order = self.get_argument("order", default=1)
 
-        data = []
-        async for doc in self.collection("queue").find(query_filter).sort(
-                [(sort_by, int(sort_order))]):
-            if await self.user.has_job_access(doc["name"]):
-                data.append(doc)
+        access = await self.user.job_filter()
+        if access is not None:
+            if query_filter:
+                query_filter = {"$and": [query_filter, access]}
+            else:
+                query_filter = access
 
-        async def _length(*args, **kwargs):
-            return len(data)
+        async def _length(filter):
+            return await self.collection("queue").count_documents(filter)
 
-        async def _query(skip, limit, *args, **kwargs):
-            return data[skip:(skip + limit)]
+        async def _query(skip, limit, filter, sort_by):
+            cur = self.collection("queue").find(filter).sort(
+                sort_by).skip(skip).limit(limit)
+            return await cur.to_list(length=limit)
 
         pager = CorePager(per_page=int(per_page),
                           current_page=int(current_page),
                           length=_length, query=_query,
-                          #sort_by=[sort_by, int(sort_order)],
-                          #filter=query_filter
-        )
+                          sort_by=[(sort_by, int(sort_order))],
+                          filter=query_filter,
+                          keyset=self.get_argument(
+                              "keyset", as_type=bool, default=False),
+                          token=self.get_argument(
+                              "cursor", as_type=str, default=None),
+                          count=self.get_argument(
+                              "count", as_type=bool, default=True))
         return await pager.page()
 
     async def get_detail(self, _id):
         """
-        Retrieve job listing from ``sys.queue`` and ``sys.journal`` using
+        Retrieve job listing from ``sys.queue``, ``sys.journal`` and the
+        archive (see :mod:`core4.queue.archive`) using
         :meth:`.project_job_listing` to select job attributes. Only jobs with
         read/execute access permissions granted to the current user are
         returned.
@@ -280,6 +310,14 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
             doc = await self.collection("journal").find_one(
                 filter={"_id": _id},
                 projection=self.project_job_listing())
+            if not doc:
+                # fallback to archive
+                doc = await CoreArchive().find_one_async(_id)
+                if doc:
+                    projection = self.project_job_listing()
+                    doc = dict((k, v) for k, v in doc.items()
+                               if k in projection)
+                    doc["archived"] = True
             if doc:
                 doc["journal"] = True
         else:
@@ -412,7 +450,7 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
         """
         await self._access_by_id(oid)
         at = core4.util.node.mongo_now()
-        ret =  await self.collection("queue").update_one(
+        doc = await self.collection("queue").find_one_and_update(
             {
                 "_id": oid,
                 attr: None
@@ -421,9 +459,13 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
                 "$set": {
                     attr: at
                 }
-            }
+            },
+            projection=core4.queue.query.SUMMARY_PROJECTION
         )
-        if ret.raw_result["n"] == 1:
+        if doc is not None:
+            await self.update_summary(
+                core4.queue.query.summary_bucket(doc),
+                core4.queue.query.summary_bucket(doc, **{attr: at}))
             self.logger.warning(
                 "flagged job [%s] to %s at [%s]", oid, message, at)
             await self.make_stat(event, str(oid))
@@ -510,9 +552,13 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
                         self.application.container.identifier, _id):
                     ret = await queue.delete_one({"_id": _id})
                     if ret.raw_result["n"] == 1:
+                        await self.update_summary(
+                            src=core4.queue.query.summary_bucket(job))
                         doc = dict([(k, v) for k, v in job.items() if
                                     k in core4.queue.job.ENQUEUE_ARGS])
                         new_job = self.queue.job_factory(job["name"], **doc)
+                        await self.resolve_dependency(
+                            new_job, job.get("wait_for") or [])
                         new_job.__dict__[
                             "attempts_left"] = new_job.__dict__["attempts"]
                         new_job.__dict__[
@@ -522,35 +568,88 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
                         new_doc = new_job.serialise()
                         ret = await queue.insert_one(new_doc)
                         new_doc["_id"] = ret.inserted_id
+                        await self.update_summary(
+                            dst=core4.queue.query.summary_bucket(new_doc))
+                        # dependants wait for the new job
+                        for attr in ("wait_for", "blocked"):
+                            await queue.update_many(
+                                {attr: _id},
+                                update={"$set": {
+                                    attr + ".$": new_doc["_id"]}})
                         self.logger.info(
                             'successfully enqueued [%s] with [%s]',
                             new_job.qual_name(), new_doc["_id"])
                         job["enqueued"]["child_id"] = new_doc["_id"]
                         await self.collection("journal").insert_one(job)
-                        await self.collection("lock").delete_one({"_id": _id})
                         await self.make_stat("restart_stopped", str(_id))
                         return new_doc["_id"]
             raise HTTPError(400, "cannot restart job [%s] in state [%s]", _id,
                             job["state"])
         return None
 
+    async def resolve_dependency(self, job, wait_for=None):
+        """
+        Resolves the job ``dependency`` into job attributes ``wait_for``
+        and ``blocked``. See also :meth:`.CoreQueue.resolve_dependency`.
+
+        :param job: :class:`.CoreJob` object
+        :param wait_for: list of job ``_id`` to wait for instead of the
+                         resolved ``dependency``
+        """
+        queue = self.collection("queue")
+        if wait_for is None:
+            query = dependency_filter(job.dependency)
+            wait_for = []
+            if query is not None:
+                cur = queue.find(query, projection=["_id"]).sort([("_id", 1)])
+                wait_for = [d["_id"] async for d in cur]
+            blocked = list(wait_for)
+        elif wait_for:
+            cur = queue.find(alive_filter(wait_for), projection=["_id"])
+            alive = set([d["_id"] async for d in cur])
+            blocked = [i for i in wait_for if i in alive]
+        else:
+            blocked = []
+        job.__dict__["wait_for"] = list(wait_for)
+        job.__dict__["blocked"] = blocked
+
+    async def settle_blocked(self, doc):
+        """
+        Verifies the ``blocked`` dependencies of the passed job after insert
+        into ``sys.queue``. See also :meth:`.CoreQueue.settle_blocked`.
+
+        :param doc: job document inserted into ``sys.queue``
+        """
+        if not doc.get("blocked"):
+            return
+        cur = self.collection("queue").find(
+            alive_filter(doc["blocked"]), projection=["_id"])
+        alive = set([d["_id"] async for d in cur])
+        gone = [i for i in doc["blocked"] if i not in alive]
+        if not gone:
+            return
+        cur = self.collection("journal").find(
+            removed_filter(gone), projection=["_id"])
+        if [d["_id"] async for d in cur]:
+            await self.remove_job(doc["_id"])
+        else:
+            await self.collection("queue").update_one(
+                {"_id": doc["_id"]},
+                update={"$pull": {"blocked": {"$in": gone}}})
+
     async def lock_job(self, identifier, _id):
         """
-        Reserve the job for exclusive processing utilising collection
-        ``sys.lock``.
+        Reserve the job for exclusive processing. The reservation is embedded
+        in the job's ``locked`` attribute in ``sys.queue``.
 
         :param identifier: to assign to the reservation
         :param _id: job ``_id``
         :return: ``True`` if reservation succeeded, else ``False``
         """
-        try:
-            await self.collection("lock").insert_one(
-                {"_id": _id, "owner": identifier})
-            return True
-        except pymongo.errors.DuplicateKeyError:
-            return False
-        except:
-            raise
+        ret = await self.collection("queue").update_one(
+            {"_id": _id, "locked": None},
+            update={"$set": {"locked": self.queue.make_lock(identifier)}})
+        return ret.modified_count == 1
 
     def who(self):
         """
@@ -568,31 +667,46 @@ class JobHandler(CoreRequestHandler, core4.queue.query.QueryMixin):
 
     async def get_queue_count(self):
         """
-        Retrieves aggregated information about ``sys.queue`` state. This is
-
-        * ``n`` - the number of jobs in the given state
-        * ``state`` - job state
-        * ``flags`` - job flags ``zombie``, ``wall``, ``removed`` and
-          ``killed``
+        Retrieves the number of jobs in ``sys.queue`` by state from
+        ``sys.summary``. See also :meth:`.QueryMixin.get_queue_count`.
 
-        :return: dict
+        :return: dict of state (key) and number of jobs (value)
         """
-        cur = self.collection("queue").aggregate(self.pipeline_queue_count())
+        cur = self.collection("summary").find(
+            {"kind": "count", "n": {"$gt": 0}}, projection=["state", "n"])
         ret = {}
         async for doc in cur:
             ret[doc["state"]] = doc["n"]
         return ret
 
+    async def update_summary(self, src=None, dst=None):
+        """
+        Moves a job from the ``src`` to the ``dst`` bucket in
+        ``sys.summary``. See also :meth:`.CoreQueue.update_summary`.
+
+        :param src: tuple of job ``name``, ``state`` and ``flags`` before the
+                    change, ``None`` for new jobs
+        :param dst: tuple of job ``name``, ``state`` and ``flags`` after the
+                    change, ``None`` for removed jobs
+        """
+        ops = core4.queue.query.summary_ops(src, dst)
+        if ops:
+            await self.collection("summary").bulk_write(ops, ordered=False)
+
     async def make_stat(self, event, _id):
         """
-        Collects current job state counts from ``sys.queue`` and inserts a
+        Collects current job state counts from ``sys.summary`` and inserts a
         record into ``sys.event``. See also :meth:`.CoreQueue.make_stat`.
 
         :param event: to log
         :param _id: job _id
         """
+        queue = await self.get_queue_count()
         self.trigger(name=event, channel=core4.const.QUEUE_CHANNEL,
-                     data={"_id": _id, "queue": await self.get_queue_count()})
+                     data={"_id": _id, "queue": queue})
+        JobHandler._history = await write_history_async(
+            self.collection("queue_history"), core4.util.node.mongo_now(),
+            queue, JobHandler._history)
 
 
 class JobPost(JobHandler):
@@ -627,6 +741,8 @@ class JobPost(JobHandler):
             error_time (int): seconds to wait before job restart after failure
             force (bool): if ``True`` then ignore worker resource limits and
                           launch the job
+            max_cluster (int): maximum number of jobs to run in parallel
+                               across the cluster
             max_parallel (int): maximum number jobs to run in parallel on the
                                 same node
             priority (int): to execute the job with >0 higher and <0 lower
@@ -700,6 +816,11 @@ class JobPost(JobHandler):
                             traceback.format_exception(*exc_info))
         if not await self.user.has_job_exec_access(job.qual_name()):
             raise HTTPError(403)
+        try:
+            self.queue.check_cycle(job)
+        except core4.error.CoreJobCycle as exc:
+            raise HTTPError(400, str(exc))
+        await self.resolve_dependency(job)
         job.__dict__["attempts_left"] = job.__dict__["attempts"]
         job.__dict__["state"] = core4.queue.job.STATE_PENDING
         job.__dict__["enqueued"] = self.who()
@@ -711,6 +832,8 @@ class JobPost(JobHandler):
                             job.qual_name(), job.args)
         job.__dict__["_id"] = ret.inserted_id
         job.__dict__["identifier"] = ret.inserted_id
+        await self.update_summary(dst=core4.queue.query.summary_bucket(doc))
+        await self.settle_blocked(doc)
         self.logger.info(
             'successfully enqueued [%s] with [%s]', job.qual_name(), job._id)
         await self.make_stat("enqueue_job", str(job._id))
@@ -847,6 +970,8 @@ class JobStream(JobPost):
             error_time (int): seconds to wait before job restart after failure
             force (bool): if ``True`` then ignore worker resource limits and
                           launch the job
+            max_cluster (int): maximum number of jobs to run in parallel
+                               across the cluster
             max_parallel (int): maximum number jobs to run in parallel on the
                                 same node
             priority (int): to execute the job with >0 higher and <0 lower
@@ -891,3 +1016,217 @@ class JobStream(JobPost):
         """
         job = await self.enqueue_by_args()
         await self.get(job._id)
+
+
+class JobGraphHandler(JobHandler):
+    """
+    Retrieve the dependency and chain graph of a job.
+    """
+
+    author = "mra"
+    title = "job graph"
+    tag = "api jobs"
+
+    async def get(self, _id=None):
+        """
+        Only jobs with read/execute access permissions granted to the current
+        user can be retrieved.
+
+        Methods:
+            GET /jobs/graph/<_id> - graph of the job's dependencies,
+            dependants, chain predecessors and successors
+
+        Parameters:
+            _id (str): job _id
+            format (str): ``json`` (default) or ``dot`` for Graphviz
+
+        Returns:
+            data element with list of ``nodes`` with job ``_id``, ``name``,
+            ``state``, list of ``blocked`` dependencies, ``journal``,
+            ``removed``, ``killed`` and ``progress``, list of ``edges`` with
+            ``source``, ``target`` and ``kind`` (``dependency``, ``chain``,
+            ``restart``) and the ``truncated`` flag. With ``format=dot`` the
+            graph is returned in Graphviz DOT format.
+
+        Raises:
+            400 Bad Request: failed to parse job _id
+            401 Unauthorized
+            403 Forbidden
+            404 job not found
+
+        Examples:
+            >>> from requests import get
+            >>> rv = get(url + "/jobs/graph/" + _id, headers=h)
+            >>> rv.json()["data"]["edges"]
+            >>> rv = get(url + "/jobs/graph/" + _id + "?format=dot", headers=h)
+            >>> open("graph.dot", "w").write(rv.text)
+        """
+        if _id == "" or _id is None:
+            raise HTTPError(400, "failed to parse job _id: [{}]".format(_id))
+        oid = self.parse_id(_id)
+        await self.get_detail(oid)
+        graph = await self.get_graph(oid)
+        if self.get_argument("format", default="json") == "dot":
+            self.set_header("content-type", "text/vnd.graphviz")
+            self.finish(graph.to_dot())
+        else:
+            self.reply(graph.to_doc())
+
+    async def post(self, _id=None):
+        """
+        Same as ``GET``.
+        """
+        await self.get(_id)
+
+    async def get_graph(self, oid):
+        """
+        Collects the graph of the passed job. See also
+        :meth:`.QueryMixin.get_job_graph`.
+
+        :param oid: job _id
+        :return: :class:`.JobGraph`
+        """
+        graph = JobGraph()
+        frontier = [oid]
+        seen = {oid}
+        while frontier and not graph.truncated:
+            cur = self.collection("queue").find(
+                graph_filter(frontier), projection=GRAPH_PROJECTION)
+            docs = [d async for d in cur]
+            refer = graph.add(docs)
+            found = set([d["_id"] for d in docs])
+            missing = [i for i in frontier if i not in found]
+            if missing:
+                cur = self.collection("journal").find(
+                    {"_id": {"$in": missing}}, projection=GRAPH_PROJECTION)
+                refer += graph.add([d async for d in cur], journal=True)
+            frontier = [i for i in set(refer) if i not in seen]
+            seen.update(frontier)
+        return graph
+
+
+class JobStdout(JobStream):
+    """
+    Page through the job output chunks in ``sys.stdout`` or follow the output
+    of a running job.
+    """
+
+    author = "mra"
+    title = "job output"
+    tag = "api jobs"
+
+    async def get(self, _id=None):
+        """
+        Only jobs with read/execute access permissions granted to the current
+        user can be retrieved.
+
+        Methods:
+            GET /jobs/stdout/<_id> - paginated job output chunks
+
+        Parameters:
+            _id (str): job _id
+            per_page (int): number of chunks per page
+            page (int): requested page (starts counting with ``0``)
+            follow (bool): stream the job output until the job reached a
+                           final state (defaults to ``False``)
+
+        Returns:
+            data element with list of chunks with attributes ``n`` (chunk
+            sequence number), ``offset``, ``size``, ``timestamp`` and the
+            UTF-8 decoded ``data``. With ``follow`` the method returns a JSON
+            stream with job output (event ``stdout``) with the byte ``offset``
+            and ``data``.
+
+        Raises:
+            400 Bad Request: failed to parse job _id
+            401 Unauthorized
+            403 Forbidden
+            404 job not found
+
+        Examples:
+            >>> from requests import get
+            >>> rv = get(url + "/jobs/stdout/" + _id + "?per_page=1", headers=h)
+            >>> print(rv.json()["data"][0]["data"])
+            >>> rv = get(url + "/jobs/stdout/" + _id + "?follow=1", headers=h,
+            >>>          stream=True)
+            >>> for line in rv.iter_lines():
+            >>>     if line:
+            >>>         print(line.decode("utf-8"))
+        """
+        if _id == "" or _id is None:
+            raise HTTPError(400, "failed to parse job _id: [{}]".format(_id))
+        oid = self.parse_id(_id)
+        await self.get_detail(oid)
+        if self.get_argument("follow", as_type=bool, default=False):
+            await self.follow(oid)
+        else:
+            self.reply(await self.get_chunk(oid))
+
+    async def post(self, _id=None):
+        """
+        Same as ``GET``.
+        """
+        await self.get(_id)
+
+    async def get_chunk(self, oid):
+        """
+        Retrieves the requested page of job output chunks.
+
+        :param oid: job _id
+        :return: :class:`.PageResult`
+        """
+        per_page = self.get_argument("per_page", as_type=int, default=10)
+        current_page = self.get_argument("page", as_type=int, default=0)
+
+        async def _length(*args, **kwargs):
+            return await self.collection("stdout").count_documents(
+                {"job_id": oid})
+
+        async def _query(skip, limit, *args, **kwargs):
+            cur = self.collection("stdout").find(
+                {"job_id": oid}).sort([("n", 1)]).skip(skip).limit(limit)
+            data = []
+            async for doc in cur:
+                chunk = decode_chunk(doc)
+                chunk["data"] = chunk["data"].decode("utf-8", errors="replace")
+                data.append(chunk)
+            return data
+
+        pager = CorePager(per_page=per_page, current_page=current_page,
+                          length=_length, query=_query)
+        return await pager.page()
+
+    async def follow(self, oid):
+        """
+        Streams the job output until the job reached a final state. Output
+        written after job completion is streamed with one more cycle of
+        ``worker.stdout_interval`` seconds.
+
+        :param oid: job _id
+        """
+        self.set_header('content-type', 'text/event-stream')
+        self.set_header('cache-control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pos = 0
+        n = 0
+        done = False
+        while True:
+            doc = await self.get_detail(oid)
+            cur = self.collection("stdout").find(
+                {"job_id": oid, "n": {"$gte": n}}).sort([("n", 1)])
+            chunks = [decode_chunk(d) async for d in cur]
+            (data, pos, last) = stdout_tail(chunks, pos)
+            if last is not None:
+                n = last
+            if data:
+                if await self.sse("stdout", {
+                        "offset": pos - len(data),
+                        "data": decoder.decode(data)}):
+                    return
+            if done:
+                await self.sse("close", {})
+                self.finish()
+                return
+            done = doc["journal"] or doc["state"] in STATE_FINAL
+            await gen.sleep(self.config.worker.stdout_interval)
@@ -0,0 +1,97 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Implements :class:`.QueueMetricHandler` to retrieve the queue latency and
+throughput metrics per job name, see :mod:`core4.queue.rollup`.
+"""
+
+import datetime
+
+from tornado.web import HTTPError
+
+import core4.error
+from core4.api.v1.request.main import CoreRequestHandler
+from core4.queue.query import QueryMixin
+
+
+class QueueMetricHandler(CoreRequestHandler, QueryMixin):
+    """
+    Retrieves the waiting time, execution time and throughput of jobs per
+    job name and optional worker and period. Only jobs with read/execute
+    access permissions granted to the current user are returned.
+    """
+    author = "mra"
+    title = "queue metrics"
+    tag = "api jobs"
+
+    async def get(self):
+        """
+        Methods:
+            GET /core4/api/v1/queue/metric
+
+        Parameters:
+            name (list): job qual_names, defaults to all jobs
+            worker (list): worker identifiers, defaults to all workers
+            start (str): start date/time, defaults to one hour before end
+            end (str): end date/time, defaults to now
+            by_worker (bool): aggregate by worker, too, defaults to ``False``
+            period (str): aggregate by ``minute``, ``hour`` or ``day``
+
+        Returns:
+            data element with list of dicts with
+
+            - **name** (str): job qual_name
+            - **worker** (str): worker identifier with ``by_worker``
+            - **period** (str): period with ``period``
+            - **started** (int): number of job starts
+            - **complete**, **deferred**, **failed**, **error**, **killed**,
+              **inactive** (int): number of job executions ending in the
+              respective state
+            - **throughput** (float): number of completed jobs per minute
+            - **wait** (dict): waiting time between ``enqueued.at`` or
+              ``query_at`` and ``started_at`` with count ``n``, ``avg``,
+              ``max``, ``p50``, ``p95`` and ``p99`` in seconds
+            - **runtime** (dict): execution time with count ``n``, ``avg``,
+              ``max``, ``p50``, ``p95`` and ``p99`` in seconds
+
+        Raises:
+            400: Bad Request
+            401: Unauthorized
+            403: Forbidden
+
+        Examples:
+            >>> from requests import get
+            >>> signin = get("http://localhost:5001/core4/api/v1/login?username=admin&password=hans")
+            >>> token = signin.json()["data"]["token"]
+            >>> rv = get("http://localhost:5001/core4/api/v1/queue/metric?period=hour&token=" + token)
+            >>> rv.json()["data"][0]["wait"]
+            {'avg': 0.84, 'max': 4.0, 'n': 120, 'p50': 0.59, 'p95': 2.83, 'p99': 4.0}
+        """
+        kwargs = {
+            "name": self.get_argument("name", as_type=list, default=None),
+            "worker": self.get_argument("worker", as_type=list, default=None),
+            "start": self.get_argument(
+                "start", as_type=datetime.datetime, default=None),
+            "end": self.get_argument(
+                "end", as_type=datetime.datetime, default=None),
+            "by_worker": self.get_argument(
+                "by_worker", as_type=bool, default=False),
+            "period": self.get_argument("period", as_type=str, default=None),
+            "filter": await self.user.job_filter()
+        }
+        try:
+            data = await self.get_queue_metric_async(**kwargs)
+        except core4.error.Core4UsageError as exc:
+            raise HTTPError(400, str(exc))
+        return self.reply(data)
+
+    async def post(self):
+        """
+        Same as :meth:`get`.
+        """
+        return await self.get()
@@ -0,0 +1,220 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements :class:`.RoleCache`, the process-wide cache of the
+role graph used by :meth:`.CoreRole.casc_role` and
+:meth:`.CoreRole.casc_perm`.
+
+The cache keeps the ``name``, ``etag``, ``is_active``, ``role`` and ``perm``
+attributes of all visited roles together with the cascaded roles and
+permissions of each list of assigned roles, see :class:`.RoleGraph`. Missing
+roles are loaded with one query per level of the role hierarchy.
+
+:class:`.CoreApiServer` follows all changes of ``sys.role`` with
+:meth:`.RoleCache.watch` using MongoDB's change stream feature. Changed roles
+and all cascades visiting these roles are dropped from the cache. As long as
+the change stream is open, permission checks are in-memory lookups. Without
+the change stream, e.g. in a worker process, each cascade is verified with
+one query of the ``etag`` of all visited roles before it is used.
+
+The cache further keeps one :class:`.PermMatcher` per set of cascaded
+permissions, see :meth:`.RoleCache.get_matcher`.
+"""
+
+import collections
+
+from core4.api.v1.request.role.matcher import PermMatcher
+from core4.base.main import CoreBase
+
+#: role attributes kept in the cache
+ROLE_ATTRIBUTES = ("name", "etag", "is_active", "role", "perm")
+
+#: cascade of a list of assigned roles with the ``_id`` of all visited roles
+#: (``reach``), the active role documents in the order of traversal
+#: (``role``), their permissions (``perm``) and the name of all visited roles
+#: by ``_id`` (``name``)
+RoleGraph = collections.namedtuple("RoleGraph", "reach role perm name")
+
+
+class RoleCache(CoreBase):
+    """
+    Caches and cascades the role hierarchy of ``sys.role``. All state is kept
+    in class attributes and shared by all instances of the process.
+    """
+
+    doc = {}
+    graph = {}
+    matcher = {}
+    version = 0
+    change_stream = None
+
+    @property
+    def collection(self):
+        """
+        :return: async :class:`.CoreCollection` object to ``sys.role``
+        """
+        return self.config.sys.role.connect_async()
+
+    async def watch(self):
+        """
+        Watches collection ``sys.role`` for any changes and invalidates the
+        cached roles. The cache falls back to ``etag`` verification if the
+        change stream closes.
+        """
+        try:
+            async with self.collection.watch() as RoleCache.change_stream:
+                RoleCache.clear()
+                async for change in RoleCache.change_stream:
+                    if change:
+                        RoleCache.on_change(change)
+        finally:
+            RoleCache.change_stream = None
+            RoleCache.clear()
+
+    @classmethod
+    def on_change(cls, change):
+        """
+        Invalidates the role of the passed change stream document. Changes
+        without a ``documentKey`` (drop, rename, invalidate) clear the cache.
+
+        :param change: change stream document
+        """
+        key = change.get("documentKey")
+        if key is None:
+            cls.clear()
+        else:
+            cls.invalidate(key["_id"])
+
+    @classmethod
+    def invalidate(cls, _id):
+        """
+        Drops the role with the passed ``_id`` and all cascades visiting this
+        role from the cache.
+
+        :param _id: role ``_id``
+        """
+        cls.version += 1
+        cls.doc.pop(_id, None)
+        for key in [k for k, v in cls.graph.items() if _id in v.reach]:
+            cls.graph.pop(key, None)
+
+    @classmethod
+    def clear(cls):
+        """
+        Drops all roles and cascades from the cache.
+        """
+        cls.version += 1
+        cls.doc = {}
+        cls.graph = {}
+        cls.matcher = {}
+
+    @classmethod
+    def get_matcher(cls, perm, size):
+        """
+        Delivers the compiled permissions of the passed permission set. All
+        roles with the same cascaded permissions share one matcher and its
+        result cache.
+
+        :param perm: list of permission str
+        :param size: max. number of cached results of a new matcher
+        :return: :class:`.PermMatcher`
+        """
+        key = frozenset(perm)
+        matcher = cls.matcher.get(key)
+        if matcher is None:
+            matcher = PermMatcher(key, size)
+            cls.matcher[key] = matcher
+        return matcher
+
+    async def cascade(self, _ids):
+        """
+        Cascades the passed assigned roles. Inactive roles and their assigned
+        roles are skipped.
+
+        :param _ids: list of assigned role ``_id``
+        :return: :class:`.RoleGraph`
+        """
+        key = tuple(_ids)
+        graph = RoleCache.graph.get(key)
+        if graph is not None and not await self._verify(graph):
+            graph = None
+        if graph is None:
+            version = RoleCache.version
+            graph = await self._cascade(_ids)
+            if version == RoleCache.version:
+                RoleCache.graph[key] = graph
+        return graph
+
+    async def _verify(self, graph):
+        # internal method used by .cascade to verify the etag of all visited
+        #   roles without change stream
+        if RoleCache.change_stream is not None:
+            return True
+        cur = self.collection.find(
+            {"_id": {"$in": list(graph.reach)}}, projection=["etag"])
+        etag = dict([(d["_id"], d.get("etag"))
+                     for d in await cur.to_list(length=None)])
+        valid = True
+        for _id in graph.reach:
+            doc = RoleCache.doc.get(_id) or {}
+            if doc.get("etag") != etag.get(_id):
+                RoleCache.invalidate(_id)
+                valid = False
+        return valid
+
+    async def _load(self, _ids):
+        # internal method used by ._cascade to retrieve cached and missing
+        #   roles
+        found = dict([(i, RoleCache.doc[i]) for i in _ids
+                      if i in RoleCache.doc])
+        missing = [i for i in _ids if i not in found]
+        if missing:
+            version = RoleCache.version
+            cur = self.collection.find(
+                {"_id": {"$in": missing}}, projection=ROLE_ATTRIBUTES)
+            for doc in await cur.to_list(length=None):
+                found[doc["_id"]] = doc
+                if version == RoleCache.version:
+                    RoleCache.doc[doc["_id"]] = doc
+        return found
+
+    async def _cascade(self, _ids):
+        # internal method used by .cascade to load all roles level by level
+        #   and to traverse the role hierarchy in memory
+        docs = {}
+        reach = set()
+        level = list(_ids)
+        while level:
+            reach.update(level)
+            docs.update(await self._load(level))
+            nxt = []
+            for _id in level:
+                doc = docs.get(_id)
+                if doc is not None and doc.get("is_active"):
+                    nxt += [i for i in doc.get("role") or []
+                            if i not in reach and i not in nxt]
+            level = nxt
+        seen = set()
+        role = []
+        perm = set()
+
+        def traverse(ids):
+            for _id in ids:
+                if _id in seen:
+                    continue
+                seen.add(_id)
+                doc = docs.get(_id)
+                if doc is not None and doc.get("is_active"):
+                    role.append(doc)
+                    perm.update(doc.get("perm") or [])
+                    traverse(doc.get("role") or [])
+
+        traverse(_ids)
+        name = dict([(i, d["name"]) for i, d in docs.items()])
+        return RoleGraph(reach=frozenset(reach),
+                         role=tuple(role), perm=frozenset(perm), name=name)
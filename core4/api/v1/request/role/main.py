@@ -185,6 +185,11 @@ class RoleHandler(CoreRequestHandler):
             sort (str): sort field
             order (int): sort direction (``1`` for ascending, ``-1`` for
                 descending)
+            keyset (bool): use keyset pagination, defaults to ``False``
+            cursor (str): ``next`` or ``prev`` continuation token of keyset
+                pagination
+            count (bool): count roles with keyset pagination, defaults to
+                ``True``
             _id: (str): a given user_id for which to return information or
                 "distinct" to retrieve a list of all distinct rolenames or
                 all userinformation if no _id is given.
@@ -200,6 +205,10 @@ class RoleHandler(CoreRequestHandler):
             - **page** (int): current page (starts counting with ``0``)
             - **page_count** (int): the total number of pages
             - **per_page** (int): the number of elements per page
+            - **next** (str): continuation token of the next page with keyset
+              pagination
+            - **prev** (str): continuation token of the previous page with
+              keyset pagination
 
         Raises:
             400 Bad Request: AttributeError
@@ -519,17 +528,25 @@ class RoleHandler(CoreRequestHandler):
         async def _query(skip, limit, filter, sort_by):
             return await rolemanager.load(skip, limit, filter, sort_by)
 
+        keyset = self.get_argument("keyset", as_type=bool, default=False)
+        cursor = self.get_argument("cursor", as_type=str, default=None)
+        filter = self.get_argument("filter", as_type=str, default="{}")
+        if keyset or cursor:
+            # keyset pagination requires a dict filter
+            filter = await rolemanager.manage_filter(filter)
         pager = CorePager(
             per_page=self.get_argument(
                 "per_page", as_type=int, default=10),
             current_page=self.get_argument(
                 "page", as_type=int, default=0),
-            filter=self.get_argument(
-                "filter", as_type=str, default="{}"),
+            filter=filter,
             sort_by=(self.get_argument("sort", as_type=str, default="_id"),
                      self.get_argument("order", as_type=int, default=1)),
             query=_query,
-            length=_length
+            length=_length,
+            keyset=keyset,
+            token=cursor,
+            count=self.get_argument("count", as_type=bool, default=True)
         )
 
         return await pager.page()
@@ -0,0 +1,135 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements :class:`.PermMatcher`, the compiled permissions of a
+:class:`.CoreRole`.
+
+The ``api://`` and ``job://`` permissions of a role are compiled into one
+regular expression per protocol and access right. The results of all
+verifications are kept in a least recently used cache of ``api.perm_cache``
+entries. Matchers are shared by all roles with the same cascaded
+permissions, see :meth:`.RoleCache.get_matcher`.
+"""
+
+import collections
+import re
+
+from core4.api.v1.request.role.field import JOB_EXECUTION_RIGHT
+from core4.api.v1.request.role.field import JOB_READ_RIGHT
+from core4.const import COP
+
+
+def compile_pattern(patterns):
+    """
+    Compiles the passed qual_name patterns into one regular expression
+    matching at the beginning of the qual_name. If the combined expression
+    does not compile, e.g. due to global inline flags, the patterns are
+    compiled one by one. Invalid patterns never match.
+
+    :param patterns: list of regular expression str
+    :return: list of compiled regular expressions
+    """
+    if not patterns:
+        return []
+    try:
+        return [re.compile("|".join("(?:{})".format(p) for p in patterns))]
+    except re.error:
+        ret = []
+        for p in patterns:
+            try:
+                ret.append(re.compile(p))
+            except re.error:
+                pass
+        return ret
+
+
+class PermMatcher:
+    """
+    Verifies ``api://``, ``job://`` and ``app://client/`` permissions with
+    compiled regular expressions and caches the results.
+    """
+
+    def __init__(self, perm, size=10000):
+        """
+        :param perm: list of permission str
+        :param size: max. number of cached results
+        """
+        self.perm = frozenset(perm)
+        self.is_admin = COP in self.perm
+        self.size = size
+        self.api_perm = []
+        self.job_perm = {JOB_EXECUTION_RIGHT: [], JOB_READ_RIGHT: []}
+        self.client = set()
+        for p in sorted(self.perm):
+            parts = p.split("/")
+            if parts[0] == "api:":
+                self.api_perm.append(parts[-1])
+            elif parts[0] == "job:" and len(parts) > 3:
+                self.job_perm.setdefault(parts[-1].lower(), []).append(
+                    parts[-2])
+            elif (parts[0] == "app:" and len(parts) > 3
+                  and parts[2] == "client"):
+                self.client.add("/".join(parts[3:]))
+        self._api = compile_pattern(self.api_perm)
+        self._job = dict([(k, compile_pattern(v))
+                          for k, v in self.job_perm.items()])
+        self._result = collections.OrderedDict()
+
+    def _cached(self, key, func, *args):
+        # internal method to retrieve and maintain the LRU result cache
+        ret = self._result.get(key)
+        if ret is None:
+            ret = func(*args)
+            self._result[key] = ret
+            if len(self._result) > self.size:
+                self._result.popitem(last=False)
+        else:
+            self._result.move_to_end(key)
+        return ret
+
+    @staticmethod
+    def _match(regex, qual_name):
+        # internal method to match the qual_name against compiled patterns
+        return any(r.match(qual_name) for r in regex)
+
+    def has_api_access(self, qual_name):
+        """
+        :param qual_name: to verify
+        :return: ``True`` if the qual_name matches any ``api://`` permission
+        """
+        if self.is_admin:
+            return True
+        return self._cached(("api", qual_name), self._match, self._api,
+                            qual_name)
+
+    def has_job_access(self, qual_name,
+                       access=(JOB_EXECUTION_RIGHT, JOB_READ_RIGHT)):
+        """
+        :param qual_name: of the job
+        :param access: access rights, defaults to read/execute access
+        :return: ``True`` if the qual_name matches any ``job://`` permission
+                 granting one of the passed access rights
+        """
+        if self.is_admin:
+            return True
+        access = "".join(sorted(set(access)))
+        return self._cached(("job", access, qual_name), self._match_job,
+                            access, qual_name)
+
+    def _match_job(self, access, qual_name):
+        # internal method used by .has_job_access
+        return any(self._match(self._job.get(a, []), qual_name)
+                   for a in access)
+
+    def has_client_access(self, client):
+        """
+        :param client: client name
+        :return: ``True`` if the role has permission
+                 ``app://client/[client-name]``
+        """
+        return self.is_admin or client in self.client
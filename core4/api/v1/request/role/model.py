@@ -14,6 +14,7 @@ import json
 import core4.error
 import core4.util.crypt
 import core4.util.node
+from core4.api.v1.request.role.cache import RoleCache
 from core4.api.v1.request.role.field import *
 from core4.base.main import CoreBase
 
@@ -84,6 +85,8 @@ class CoreRole(CoreBase):
                 raise KeyError("unknown field [{}]".format(field))
         self._role_collection = None
         self._casc_role = None
+        self._graph = None
+        self._matcher = None
 
     @property
     def role_collection(self):
@@ -204,6 +207,11 @@ class CoreRole(CoreBase):
             saved = await self._create()
         else:
             saved = await self._update()
+        if saved:
+            RoleCache.invalidate(self._id)
+            self._casc_role = None
+            self._graph = None
+            self._matcher = None
         # if saved:
         #     self.data["quota"].insert(self.config.sys.quota, self._id)
         return saved
@@ -324,12 +332,14 @@ class CoreRole(CoreBase):
 
         :param skip: number of documents to skip
         :param sort_by: tuple of attribute and sort order (``1`` for ascending,
-                        ``-1`` for descending)
+                        ``-1`` for descending) or list of these tuples
         :param filter: MongoDB query dict
         :param limit: number of records to be retrieved
         :return: :list: resulting documents
         """
         filter = await self.manage_filter(filter)
+        if isinstance(sort_by, list):
+            sort_by = (sort_by,)
 
         cur = self.role_collection.find(filter) \
             .sort(*sort_by) \
@@ -382,40 +392,55 @@ class CoreRole(CoreBase):
             await role.resolve_roles_by_id()
         return role
 
+    async def role_graph(self):
+        """
+        Retrieve the cascade of all roles assigned from the process-wide
+        :class:`.RoleCache`.
+
+        :return: :class:`.RoleGraph`
+        """
+        if self._graph is None:
+            self._graph = await RoleCache().cascade(self.data["role"]._id)
+        return self._graph
+
+    async def perm_matcher(self):
+        """
+        Retrieve the compiled permissions of the role and all roles assigned
+        from the process-wide :class:`.RoleCache`.
+
+        :return: :class:`.PermMatcher`
+        """
+        if self._matcher is None:
+            self._matcher = RoleCache.get_matcher(
+                await self.casc_perm(), self.config.api.perm_cache)
+        return self._matcher
+
     async def casc_perm(self):
         """
         Retrieve combined permissions from all roles assigned.
 
         :return: list of permission str
         """
-        perm = self.perm
-        for role in await self.casc_role():
-            perm += role.perm
-        return sorted(list(set(perm)))
+        graph = await self.role_graph()
+        return sorted(graph.perm.union(self.perm or []))
 
     async def casc_role(self):
         """
         Retrieve combined role names from all roles assigned.
 
-        :return: list of role names (str)
+        :return: list of :class:`.CoreRole`
         """
-
         if self._casc_role is None:
-            seen = []
-
-            async def traverse(_ids, roles):
-                for _id in _ids:
-                    if _id in seen:
-                        continue
-                    seen.append(_id)
-                    role = await self.find_one(_id=_id)
-                    if role.is_active:
-                        roles += [role]
-                        await traverse(role.data["role"]._id, roles)
-
+            graph = await self.role_graph()
             self._casc_role = []
-            await traverse(self.data["role"]._id, self._casc_role)
-
+            for doc in graph.role:
+                role = CoreRole(**doc)
+                field = role.data["role"]
+                field._id = list(doc.get("role") or [])
+                field.name = [graph.name[i] for i in field._id
+                              if i in graph.name]
+                field.value = field.name[:]
+                self._casc_role.append(role)
         return self._casc_role
 
     async def delete(self):
@@ -440,23 +465,43 @@ class CoreRole(CoreBase):
                 "role": self._id
             }
         })
+        RoleCache.clear()
         self.logger.info("deleted role [%s] with _id [%s]", self.name,
                          self._id)
         self._id = None
         self.data["etag"].set(None)
         return True
 
+    async def _job_perm(self, access):
+        # job:// qual_name patterns granting access (r|x)
+        matcher = await self.perm_matcher()
+        ret = []
+        for acc in access:
+            ret += matcher.job_perm.get(acc, [])
+        return ret
+
     async def _job_access(self, qual_name, access):
         # verify access (r|x) to the passed qual_name
+        matcher = await self.perm_matcher()
+        return matcher.has_job_access(qual_name, access)
+
+    async def job_filter(self, access=(JOB_EXECUTION_RIGHT, JOB_READ_RIGHT)):
+        """
+        Compiles the ``job://`` permissions granting read/execute access into
+        a MongoDB filter on the job ``name``. The filter matches the same
+        jobs as :meth:`.has_job_access` with one anchored regular expression
+        of all permitted qual_name patterns.
+
+        :param access: access rights, defaults to read/execute access
+        :return: MongoDB filter dict or ``None`` for admins
+        """
         if await self.is_admin():
-            return True
-        for p in await self.casc_perm():
-            (*proto, qn, acc) = p.split("/")
-            if proto[0] == "job:":
-                if re.match(qn, qual_name):
-                    if acc.lower() in access:
-                        return True
-        return False
+            return None
+        perm = sorted(set(await self._job_perm(access)))
+        if not perm:
+            return {"name": {"$in": []}}
+        return {"name": {"$regex": "^(?:" + "|".join(
+            "(?:{})".format(qn) for qn in perm) + ")"}}
 
     async def has_job_access(self, qual_name):
         """
@@ -482,7 +527,8 @@ class CoreRole(CoreBase):
         """
         :return: ``True`` if the role as a ``perm`` record of ``cop``.
         """
-        return COP in await self.casc_perm()
+        matcher = await self.perm_matcher()
+        return matcher.is_admin
 
     async def has_api_access(self, qual_name):
         """
@@ -492,16 +538,11 @@ class CoreRole(CoreBase):
         :param qual_name: to verify
         :return: bool
         """
-        if await self.is_admin():
+        matcher = await self.perm_matcher()
+        if matcher.has_api_access(qual_name):
+            self.logger.debug("approved api permission [%s] for user [%s]",
+                              qual_name, self.name)
             return True
-        for p in await self.casc_perm():
-            (*proto, qn) = p.split("/")
-            if proto[0] == "api:":
-                if re.match(qn, qual_name):
-                    self.logger.debug(
-                        "approved api permission [%s] for user [%s]",
-                        self.name, qn)
-                    return True
         self.logger.debug("no appropriate api permission found for user [%s]",
                           self.name)
         return False
@@ -513,17 +554,10 @@ class CoreRole(CoreBase):
         :param client: client (str) extracted from the URL
         :return: ``True`` for success, else ``False``
         """
-        if await self.is_admin():
+        matcher = await self.perm_matcher()
+        if matcher.has_client_access(client):
+            self.logger.debug("grant access to client [%s]", client)
             return True
-        for p in await self.casc_perm():
-            parts = p.split("/")
-            if len(parts) > 3:
-                if parts[0] == "app:":
-                    if parts[2] == "client":
-                        if "/".join(parts[3:]) == client:
-                            self.logger.debug("grant access to client [%s]",
-                                              client)
-                            return True
         return False
 
     async def login(self):
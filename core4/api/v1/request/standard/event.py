@@ -14,7 +14,7 @@ from core4.api.v1.request.websocket import CoreWebSocketHandler
 from core4.base.main import CoreBase
 from core4.queue.query import QueryMixin
 from core4.util.data import json_encode, json_decode
-from core4.util.pager import CorePager
+from core4.util.pager import CorePager, count
 
 
 # todo: sticky messages
@@ -37,23 +37,19 @@ class EventWatch(CoreBase):
 
 class QueueWatch(CoreBase, QueryMixin):
     """
-    Continuously queries ``sys.queue`` and forwards to :class:`.EventHandler`
-    using :meth:`on_queue <.EventHandler.on_queue>` method.
+    Continuously queries the job state summary from ``sys.summary`` and
+    forwards to :class:`.EventHandler` using
+    :meth:`on_queue <.EventHandler.on_queue>` method.
     """
 
     stop = False
 
     async def watch(self):
         QueueWatch.stop = False
-        coll = self.config.sys.queue.connect_async()
-        pipeline = self.pipeline_queue_state()
         interval = self.config.event.queue_interval
         while not QueueWatch.stop:
             nxt = gen.sleep(interval)
-            cursor = coll.aggregate(pipeline)
-            data = []
-            async for doc in cursor:
-                data.append(doc)
+            data = await self.get_queue_state_async()
             await EventHandler.on_queue(data)
             await nxt
 
@@ -192,17 +188,22 @@ class EventHandler(CoreWebSocketHandler):
             "author": core4.util.node.get_username(),
             "channel": core4.const.QUEUE_CHANNEL,
         }
-        for waiter, interest in cls.waiters.items():
+        # the summary is masked and encoded once per set of permissions
+        summary = {}
+        message = {}
+        for waiter, interest in list(cls.waiters.items()):
             if core4.const.QUEUE_CHANNEL in interest:
-                data["data"] = []
-                for line in change:
-                    qn = line["name"]
-                    if not await waiter.user.has_api_access(qn):
-                        line["name"] = "UnauthorizedJob"
-                    data["data"].append(line)
+                matcher = await waiter.user.perm_matcher()
+                if matcher not in summary:
+                    summary[matcher] = [
+                        line if matcher.has_api_access(line["name"])
+                        else dict(line, name="UnauthorizedJob")
+                        for line in change]
+                data["data"] = summary[matcher]
                 if data["data"] != waiter.last:
-                    js = json_encode(data)
-                    waiter.write_message(js)
+                    if matcher not in message:
+                        message[matcher] = json_encode(data)
+                    waiter.write_message(message[matcher])
                     waiter.last = data["data"]
 
 
@@ -222,6 +223,11 @@ class EventHistoryHandler(CoreRequestHandler):
             per_page (int): number of events per page
             page (int): requested page (starts counting with ``0``)
             filter (dict): optional mongodb filter
+            keyset (bool): use keyset pagination, defaults to ``False``
+            cursor (str): ``next`` or ``prev`` continuation token of keyset
+                pagination
+            count (bool): count events with keyset pagination, defaults to
+                ``True``
 
         Returns:
             data element with list of events with
@@ -238,6 +244,10 @@ class EventHistoryHandler(CoreRequestHandler):
             - **page** (int): current page (starts counting with ``0``)
             - **page_count** (int): the total number of pages
             - **per_page** (int): the number of elements per page
+            - **next** (str): continuation token of the next page with keyset
+              pagination
+            - **prev** (str): continuation token of the previous page with
+              keyset pagination
 
         Raises:
             401: Unauthorized
@@ -321,8 +331,11 @@ class EventHistoryHandler(CoreRequestHandler):
         if query_filter:
             query.update(query_filter)
 
+        keyset = self.get_argument("keyset", as_type=bool, default=False)
+        cursor = self.get_argument("cursor", as_type=str, default=None)
+
         async def _length(filter):
-            return await coll.count_documents(filter)
+            return await count(coll, filter)
 
         async def _query(skip, limit, filter, sort_by):
             cur = coll.find(
@@ -330,7 +343,7 @@ class EventHistoryHandler(CoreRequestHandler):
                 projection={"created": 1, "data": 1, "_id": 1, "author": 1,
                             "channel": 1}
             ).sort(
-                [("$natural", -1)]
+                sort_by if keyset or cursor else [("$natural", -1)]
             ).skip(
                 skip
             ).limit(
@@ -344,7 +357,10 @@ class EventHistoryHandler(CoreRequestHandler):
         pager = CorePager(per_page=per_page,
                           current_page=current_page,
                           length=_length, query=_query,
-                          filter=query)
+                          filter=query, sort_by=[("_id", -1)],
+                          keyset=keyset, token=cursor,
+                          count=self.get_argument(
+                              "count", as_type=bool, default=True))
         page = await pager.page()
         return self.reply(page)
 
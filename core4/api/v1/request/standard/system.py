@@ -6,6 +6,7 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from core4.api.v1.request.main import CoreRequestHandler
+from core4.queue.metric import format_metric
 from core4.queue.query import QueryMixin
 
 
@@ -15,6 +16,7 @@ class SystemHandler(CoreRequestHandler, QueryMixin):
 
     * alive time of workers, scheduler and app nodes
     * maintenance modes (global and project specific)
+    * cluster-wide semaphores (see :mod:`core4.queue.semaphore`)
     """
     author = "mra"
     title = "system information"
@@ -35,6 +37,9 @@ class SystemHandler(CoreRequestHandler, QueryMixin):
             - **alive** (list): of alive worker, scheduler and app nodes
             - **maintenance** (dict): the global maintenance mode (``True`` or
               ``False``) and the list of projects in maintenance
+            - **semaphore** (list): of cluster-wide semaphores with key
+              ``_id``, ``limit``, number of holders ``n`` and the ``holder``
+              jobs
 
         Raises:
             401: Unauthorized
@@ -67,7 +72,13 @@ class SystemHandler(CoreRequestHandler, QueryMixin):
                 'loop': None,
                 'loop_time': None,
                 'pid': 6474}],
-              'maintenance': {'project': ['client1'], 'system': False}},
+              'maintenance': {'project': ['client1'], 'system': False},
+              'semaphore': [{'_id': 'tag:api',
+                'holder': [{'_id': '5c8547f9ad70717b3aaa0771',
+                  'at': '2019-03-10T17:23:25',
+                  'worker': 'worker@devops'}],
+                'limit': 3,
+                'n': 1}]},
              'message': 'OK',
              'timestamp': '2019-03-10T17:23:31.576754'}
         """
@@ -76,7 +87,8 @@ class SystemHandler(CoreRequestHandler, QueryMixin):
             "maintenance": {
                 "system": await self._maintenance(),
                 "project": await self._project_maintenance()
-            }
+            },
+            "semaphore": await self.get_semaphore_async()
         }
         if self.wants_html():
             return self.render("template/system.html", **doc)
@@ -96,3 +108,54 @@ class SystemHandler(CoreRequestHandler, QueryMixin):
         kwargs["maintenance"] = await self._maintenance()
         kwargs["project"] = await self._project_maintenance()
         return self.render("template/system.card.html", **kwargs)
+
+
+class MetricHandler(CoreRequestHandler, QueryMixin):
+    """
+    Retrieves the main loop timings of workers and schedulers, see
+    :mod:`core4.queue.metric`.
+    """
+    author = "mra"
+    title = "daemon metrics"
+    tag = "info"
+
+    async def get(self):
+        """
+        Methods:
+            GET /system/metrics
+
+        Parameters:
+            content_type (str): ``text`` renders Prometheus text format
+
+        Returns:
+            data element with list of dicts with
+
+            - **_id** (str): the daemon identifier
+            - **kind** (str): worker or scheduler
+            - **metric_at** (str): the date/time of the last publication
+            - **metric** (dict): with the ``interval`` in seconds and the
+              ``step`` and ``mongo`` command histograms with count ``n``,
+              ``sum``, ``max``, ``p50``, ``p95`` and ``p99`` in seconds
+
+            With ``Accept: text/plain`` or ``content_type=text`` the metrics
+            are rendered in Prometheus text exposition format.
+
+        Raises:
+            401: Unauthorized
+            403: Forbidden
+
+        Examples:
+            >>> from requests import get
+            >>> signin = get("http://devops:5001/core4/api/login?username=admin&password=hans")
+            >>> token = signin.json()["data"]["token"]
+            >>> rv = get("http://devops:5001/core4/api/v1/system/metrics?content_type=text&token=" + token)
+            >>> print(rv.text)
+            # HELP core4_step_seconds daemon main loop step duration
+            # TYPE core4_step_seconds summary
+            core4_step_seconds{quantile="0.50",daemon="worker@devops",step="work_jobs"} 0.001542
+            ...
+        """
+        docs = await self.get_metric_async()
+        if self.wants_text():
+            return self.finish(format_metric(docs))
+        return self.reply(docs)
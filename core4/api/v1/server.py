@@ -12,13 +12,18 @@ and provides the following endpoints:
 * ``/core4/api/v1/queue`` - :class:`.QueueHandler`
 * ``/core4/api/v1/jobs`` - :class:`.JobHandler`
 * ``/core4/api/v1/jobs/poll`` - :class:`.JobStream`
+* ``/core4/api/v1/jobs/stdout`` - :class:`.JobStdout`
+* ``/core4/api/v1/jobs/graph`` - :class:`.JobGraphHandler`
 * ``/core4/api/v1/enqueue`` - :class:`.JobPost`
+* ``/core4/api/v1/queue/metric`` - :class:`.QueueMetricHandler`
+* ``/core4/api/v1/system/metrics`` - :class:`.MetricHandler`
 * ``/core4/api/v1/roles`` - :class:`.RoleHandler`
 * ``/core4/api/v1/access`` - :class:`.AcceHandlerr`
 
 Additionally the server creates an endless loop to query collection
 ``sys.event`` continuously with :class:`.EventWatch` to support the
-:class:`.EventHandler`.
+:class:`.EventHandler`, and follows the changes of collection ``sys.role``
+with :meth:`.RoleCache.watch` to invalidate the cached role hierarchy.
 
 Start the server with::
 
@@ -32,7 +37,12 @@ from core4.api.v1.request.queue.history import JobHistoryHandler
 from core4.api.v1.request.queue.history import QueueHistoryHandler
 from core4.api.v1.request.queue.job import JobHandler
 from core4.api.v1.request.queue.job import JobPost
+from core4.api.v1.request.queue.job import JobStdout
+from core4.api.v1.request.queue.job import JobGraphHandler
 from core4.api.v1.request.queue.job import JobStream
+from core4.api.v1.request.queue.metric import QueueMetricHandler
+from core4.api.v1.request.role.cache import RoleCache
+from core4.api.v1.request.standard.system import MetricHandler
 from core4.api.v1.request.standard.system import SystemHandler
 from core4.api.v1.request.role.main import RoleHandler
 from core4.api.v1.request.standard.access import AccessHandler
@@ -85,6 +95,8 @@ class CoreApiServer(CoreApiContainer):
     rules = [
         (r'/jobs/poll', JobStream),
         (r'/jobs/poll/(.*)', JobStream, None, "JobStream"),
+        (r'/jobs/stdout/(.*)', JobStdout, None, "JobStdout"),
+        (r'/jobs/graph/(.*)', JobGraphHandler, None, "JobGraph"),
         (r'/jobs/history', JobHistoryHandler),
         (r'/jobs/history/(.*)', JobHistoryHandler, None, "JobHistory"),
         (r'/jobs/enqueue/?', JobPost),
@@ -92,8 +104,10 @@ class CoreApiServer(CoreApiContainer):
         (r'/jobs/(.*)', JobHandler, None, "JobHandler"),
 
         (r'/queue/history', QueueHistoryHandler),
+        (r'/queue/metric', QueueMetricHandler),
         (r'/queue/history(.*)', QueueHistoryHandler, None, "QueueHistory"),
 
+        (r'/system/metrics/?', MetricHandler),
         (r'/system/?', SystemHandler),
 
         (r'/roles', RoleHandler),
@@ -120,11 +134,17 @@ class CoreApiServer(CoreApiContainer):
         IOLoop.current().add_callback(event.watch)
         queue = QueueWatch()
         IOLoop.current().add_callback(queue.watch)
+        role = RoleCache()
+        IOLoop.current().add_callback(role.watch)
 
     def on_exit(self):
         QueueWatch.stop = True
         if EventWatch.change_stream is not None:
             EventWatch.change_stream.close()
+        if RoleCache.change_stream is not None:
+            RoleCache.change_stream.close()
+            RoleCache.change_stream = None
+            RoleCache.clear()
 
 
 if __name__ == '__main__':
@@ -24,6 +24,8 @@ import tornado.gen
 import tornado.iostream
 import pandas as pd
 
+import core4.error
+
 
 DEFAULT_ALIGN = "left"
 
@@ -119,6 +121,12 @@ class CoreDataTable(CoreBase):
     sort_by (list of dict)
        specifies the sort order with column ``name`` and ``ascending`` (bool)
        property
+    keyset (bool)
+       use keyset pagination, see :class:`.CorePager`
+    cursor (str)
+       ``next`` or ``prev`` continuation token of keyset pagination
+    count (bool)
+       count records with keyset pagination
 
     The ``CoreDataTable`` component is used by :class:`.CoreDataTableRequest``
     to implement endpoints delivering data tables.
@@ -127,7 +135,7 @@ class CoreDataTable(CoreBase):
             self, length, query, column, fixed_header=True, hide_header=False,
             height=None, dense=False, search=True, per_page=10, page=0,
             filter=None, sort_by=None, advanced_options=True, footer=True,
-            info=None, action=None):
+            info=None, action=None, keyset=False, cursor=None, count=True):
         super().__init__()
         self.column = copy.deepcopy(column)
         self.fixed_header = fixed_header
@@ -147,6 +155,7 @@ class CoreDataTable(CoreBase):
         self.footer = footer
         self.info = info
         self.action = action
+        self.keyset = keyset or bool(cursor)
         self.lookup = {}
         # build format lookup and verify that there is only one key
         key = None
@@ -162,9 +171,13 @@ class CoreDataTable(CoreBase):
             sort_by = [(s["name"], 1 if s["ascending"] else -1)
                        for s in sort_by]
         self.sort_by = sort_by
+        # keyset pagination reads the sort key from the raw records
         self.pager = CorePager(
-            length=self._length, query=self._query, current_page=self.page,
-            per_page=self.per_page, filter=self.filter, sort_by=self.sort_by)
+            length=self._length,
+            query=self.query if self.keyset else self._query,
+            current_page=self.page, per_page=self.per_page,
+            filter=self.filter, sort_by=self.sort_by, keyset=self.keyset,
+            token=cursor, count=count)
 
     async def _length(self, filter):
         # wrapper method around pager, see core4.util.pager
@@ -172,35 +185,37 @@ class CoreDataTable(CoreBase):
 
     async def _query(self, skip, limit, filter, sort_by):
         # wrapper method around pager, see core4.util.pager
+        return [self._format(doc)
+                for doc in await self.query(skip, limit, filter, sort_by)]
+
+    def _format(self, doc):
         # this method delivers cell formatting according to the cols definition
-        ret = []
-        for doc in await self.query(skip, limit, filter, sort_by):
-            ndoc = {}
-            for k, v in doc.items():
-                if k in self.lookup:
-                    if isnull(v):
-                        ndoc[k] = "."
+        ndoc = {}
+        for k, v in doc.items():
+            if k in self.lookup:
+                if isnull(v):
+                    ndoc[k] = "."
+                else:
+                    fmt = self.column[self.lookup[k]].get("format", "{}")
+                    if callable(fmt):
+                        ndoc[k] = fmt(v)
                     else:
-                        fmt = self.column[self.lookup[k]].get("format", "{}")
-                        if callable(fmt):
-                            ndoc[k] = fmt(v)
-                        else:
-                            try:
-                                ndoc[k] = fmt.format(v)
-                            except (ValueError, TypeError):
-                                self.logger.error(
-                                    "unsupported format string [%s] at [%s]",
-                                    fmt, k)
-            ret.append(ndoc)
-        return ret
+                        try:
+                            ndoc[k] = fmt.format(v)
+                        except (ValueError, TypeError):
+                            self.logger.error(
+                                "unsupported format string [%s] at [%s]",
+                                fmt, k)
+        return ndoc
 
     async def post(self):
         """
         Delivers the requested page with
         
         * ``paging`` - pagination information, see core4.tool.pager, including
-          attributes ``page_count``, ``page``, ``count``, ``per_page`` and
-          ``total_count``
+          attributes ``page_count``, ``page``, ``count``, ``per_page``,
+          ``total_count`` and the keyset pagination tokens ``next`` and
+          ``prev``
         * ``option`` - data table options including attributes ``fixed_header``,
           ``hide_header``, ``height``, ``dense``, ``search``,
           ``advanced_options``, ``footer`` and ``info``
@@ -212,6 +227,9 @@ class CoreDataTable(CoreBase):
         :return: dict
         """
         page = await self.pager.page()
+        body = page.body
+        if self.keyset:
+            body = [self._format(doc) for doc in body]
         sort_by = [{"name": n, "ascending": a == 1} for n, a in self.sort_by]
         # remove format from response
         column = copy.deepcopy(self.column)
@@ -242,12 +260,14 @@ class CoreDataTable(CoreBase):
                 page=page.page,
                 page_count=page.page_count,
                 total_count=page.total_count,
-                count=page.count
+                count=page.count,
+                next=page.next,
+                prev=page.prev
             ),
             action=self.action,
             column=column,
             sort=sort_by,
-            body=page.body
+            body=body
         )
 
     async def get(self):
@@ -286,6 +306,8 @@ class CoreDataTableRequest(CoreRequestHandler, CoreAbstractMixin):
     * ``page`` - which page to display
     * ``filter`` - query filter (see below for further information)
     * ``sort_by`` - sort order (see below for further information)
+    * ``keyset`` - use keyset pagination (defaults to ``False``, see below for
+      further information)
 
     Define the default values for these attributes as class properties. The
     following attributes set these as request parameters (URL query parameters
@@ -368,6 +390,18 @@ class CoreDataTableRequest(CoreRequestHandler, CoreAbstractMixin):
     :meth:`.query`. To facililtate json parsing the request handler provides a
     helper method :meth:`.convert_filter`.
 
+    **keyset pagination**
+
+    With ``keyset is True`` or request parameter ``keyset`` the table pages
+    with continuation tokens instead of page numbers, see :class:`.CorePager`.
+    Request parameter ``cursor`` passes the ``next`` or ``prev`` token of the
+    ``paging`` attribute and request parameter ``count=false`` skips
+    counting. The ``filter`` is parsed with :meth:`.convert_filter` and must
+    be valid JSON. :meth:`.query` receives the ``filter`` as a dict extended
+    by the keyset condition and ``sort_by`` as a list of tuples with column
+    name and sort order (``1`` or ``-1``) ending with ``_id``. It must return
+    the unformatted records including ``_id`` and all sort columns.
+
     **custom column order and visibility**
 
     The user can change the column order and visibility for all columns where
@@ -437,6 +471,7 @@ class CoreDataTableRequest(CoreRequestHandler, CoreAbstractMixin):
     footer = True
     info = None
     action = None
+    keyset = False
 
     async def _prepare_table(self, save=False, *args, **kwargs):
         await self.initialise_table()
@@ -464,6 +499,14 @@ class CoreDataTableRequest(CoreRequestHandler, CoreAbstractMixin):
                 modified = True
             return ret
 
+        keyset = _get_arg("keyset", bool)
+        cursor = self.get_argument("cursor", as_type=str, default=None)
+        filter = _get_arg("filter", str, keep=False)
+        if keyset or cursor:
+            filter = self.convert_filter(filter) or {}
+            if not isinstance(filter, dict):
+                raise core4.error.ArgumentParsingError(
+                    "keyset pagination requires a JSON filter")
         cdt = CoreDataTable(
             length=self.length,
             query=self.query,
@@ -475,12 +518,15 @@ class CoreDataTableRequest(CoreRequestHandler, CoreAbstractMixin):
             search=self.search,
             per_page=_get_arg("per_page", int, keep=True),
             page=_get_arg("page", int, keep=False),
-            filter=_get_arg("filter", str, keep=False),
+            filter=filter,
             sort_by=_get_arg("sort", list, keep=True),
             advanced_options=self.advanced_options,
             footer=self.footer,
             info=self.info,
-            action=self.action
+            action=self.action,
+            keyset=keyset,
+            cursor=cursor,
+            count=self.get_argument("count", as_type=bool, default=True)
         )
 
         # merge user specs with default column
@@ -539,6 +585,9 @@ class CoreDataTableRequest(CoreRequestHandler, CoreAbstractMixin):
         names = [c["name"] for c in column]
         labels = [c["label"] for c in column]
         pager.per_page = self.per_page * 100
+        if datatable.keyset:
+            pager.token = None
+            pager.count = False
         p = 0
         header = True
         pager._query = self.query
@@ -562,6 +611,10 @@ class CoreDataTableRequest(CoreRequestHandler, CoreAbstractMixin):
             finally:
                 await tornado.gen.sleep(0.000000001)  # 1 nanosecond
             header = False
+            if datatable.keyset:
+                if page.next is None:
+                    break
+                pager.token = page.next
             p += 1
         self.finish()
 
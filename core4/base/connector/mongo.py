@@ -18,6 +18,24 @@ CACHE = {
     "async": {}
 }
 
+#: command listeners of synchronous connections, see :func:`add_listener`
+LISTENER = []
+
+
+def add_listener(listener):
+    """
+    Attaches the passed :class:`pymongo.monitoring.CommandListener` to all
+    synchronous MongoDB connections established hereafter. Cached
+    synchronous connections are dropped so that collections connecting
+    after this call use a new connection with the listener.
+
+    :param listener: :class:`pymongo.monitoring.CommandListener` object
+    """
+    global CACHE
+    if listener not in LISTENER:
+        LISTENER.append(listener)
+        CACHE["sync"] = {}
+
 
 def make_connection(connection):
     """
@@ -48,5 +66,6 @@ def make_connection(connection):
             url, tz_aware=False, connect=False)
     else:
         CACHE[mode][url] = pymongo.MongoClient(
-            url, tz_aware=False, connect=False)
+            url, tz_aware=False, connect=False,
+            event_listeners=list(LISTENER))
     return CACHE[mode][url]
@@ -58,6 +58,13 @@ class CoreJobDeferred(Core4Error):
     """
 
 
+class CoreJobWaiting(CoreJobDeferred):
+    """"
+    This exception is raised if a job waits for its children, see
+    :meth:`.CoreJob.map`.
+    """
+
+
 class CoreJobNotFound(Core4Error):
     """
     This exception is raised if the job is not found.
@@ -70,6 +77,13 @@ class CoreJobExists(Core4Error):
     name/qual_name and job arguments.
     """
 
+
+class CoreJobCycle(Core4Error):
+    """
+    This exception is raised if job ``dependency`` and ``chain`` properties
+    form a cycle.
+    """
+
 class ArgumentParsingError(HTTPError):
     """
     This exception is raised if an error occured while parsing query or body
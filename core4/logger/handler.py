@@ -10,15 +10,26 @@ Implements :class:`.MongoLoggingHandler` to log into MongoDB collection
 ``sys.log`` and :func:`make_record` to customise MongoDB documents representing
 the logging record.
 """
+import collections
 import logging.config
 import os
+import sys
+import threading
 import traceback
 
 import datetime
 import time
 
+import core4.error
+from core4.util.data import json_encode
 from core4.util.tool import Singleton
 
+#: overflow policies of the buffered :class:`.MongoLoggingHandler`
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP = "drop"
+OVERFLOW_SPILL = "spill"
+OVERFLOW = (OVERFLOW_BLOCK, OVERFLOW_DROP, OVERFLOW_SPILL)
+
 
 def make_record(record):
     """
@@ -65,16 +76,60 @@ def make_record(record):
 class MongoLoggingHandler(logging.Handler, metaclass=Singleton):
     """
     This class implements logging into a MongoDB database/collection.
+
+    With a buffer ``size`` of ``0`` each record is inserted synchronously.
+    With a positive ``size`` records are appended to a bounded buffer and a
+    background thread writes them with
+    :meth:`insert_many <pymongo.collection.Collection.insert_many>` as soon
+    as ``batch`` records are waiting or ``interval`` seconds have passed.
+    ``CRITICAL`` records flush the buffer and are written synchronously.
+    Remaining records are written with :meth:`.close` which is called by
+    :func:`logging.shutdown` at process exit.
+
+    If the buffer is full, the ``overflow`` policy applies:
+
+    * ``block`` - wait until the background thread made room
+    * ``drop`` - drop ``DEBUG`` records first, block if there are no
+      ``DEBUG`` records to drop
+    * ``spill`` - append the record as JSON to the local ``spill`` file
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, size=0, batch=500, interval=1.,
+                 overflow=OVERFLOW_BLOCK, spill=None):
         """
         Connects the logging handler with the passed MongoDB connection.
 
         :param connection: :class:`pymongo.collection.Collection` object
+        :param size: maximum number of buffered records, ``0`` to write
+                     synchronously
+        :param batch: number of records to write at once
+        :param interval: maximum number of seconds records are buffered
+        :param overflow: policy if the buffer is full, see :data:`OVERFLOW`
+        :param spill: file name to spill records with ``overflow="spill"``
         """
         super(MongoLoggingHandler, self).__init__()
+        if overflow not in OVERFLOW:
+            raise core4.error.Core4ConfigurationError(
+                "unknown logging overflow policy [{}]".format(overflow))
+        if overflow == OVERFLOW_SPILL and not spill:
+            raise core4.error.Core4ConfigurationError(
+                "logging overflow policy [spill] requires a spill file")
         self._collection = connection
+        self.size = size
+        self.batch = max(1, min(batch, size or batch))
+        self.interval = interval
+        self.overflow = overflow
+        self.spill = spill
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+        self._flush = 0
+        self._inflight = 0
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
 
     def handle(self, record):
         """
@@ -99,4 +154,157 @@ class MongoLoggingHandler(logging.Handler, metaclass=Singleton):
         :param record: the log record (:class:`logging.LogRecord`)
         """
         doc = make_record(record)
-        self._collection.insert_one(doc)
+        if not self.size:
+            self._collection.insert_one(doc)
+        elif record.levelno >= logging.CRITICAL:
+            self.flush()
+            self._write([doc])
+        else:
+            self._put(doc)
+
+    def stats(self):
+        """
+        Returns the buffer state of the handler. This is
+
+        * ``depth`` - the number of records not written, yet
+        * ``written`` - the number of records written by the buffer
+        * ``dropped`` - the number of records dropped due to overflow
+        * ``spilled`` - the number of records spilled due to overflow
+        * ``failed`` - the number of records failed to write
+
+        :return: dict
+        """
+        with self._cond:
+            return {
+                "depth": len(self._buffer) + self._inflight,
+                "written": self.written,
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+                "failed": self.failed
+            }
+
+    def flush(self):
+        """
+        Blocks until all buffered records have been written.
+        """
+        if not self.size:
+            return
+        with self._cond:
+            if self._alive():
+                self._flush += 1
+                self._cond.notify_all()
+                while (self._buffer or self._inflight) and self._alive():
+                    self._cond.wait(self.interval)
+                self._flush -= 1
+                return
+            docs = list(self._buffer)
+            self._buffer.clear()
+        if docs:
+            self._write(docs)
+
+    def close(self):
+        """
+        Stops the background thread and writes all remaining records.
+        """
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+        super(MongoLoggingHandler, self).close()
+
+    def _alive(self):
+        # internal method to check the background thread, threads do not
+        #   survive a fork
+        return self._thread is not None and self._thread.is_alive()
+
+    def _start(self):
+        # internal method to start the background thread, requires ._cond
+        if not self._alive():
+            self._stop = False
+            self._thread = threading.Thread(
+                target=self._run, name="MongoLoggingHandler", daemon=True)
+            self._thread.start()
+
+    def _put(self, doc):
+        # internal method to append the record to the buffer and to apply
+        #   the overflow policy
+        with self._cond:
+            self._start()
+            while len(self._buffer) >= self.size:
+                if self.overflow == OVERFLOW_SPILL:
+                    self._spill(doc)
+                    return
+                if self.overflow == OVERFLOW_DROP:
+                    if doc["levelno"] <= logging.DEBUG:
+                        self.dropped += 1
+                        return
+                    if self._evict():
+                        break
+                self._cond.notify_all()
+                self._cond.wait(self.interval)
+                self._start()
+            self._buffer.append(doc)
+            if len(self._buffer) >= self.batch:
+                self._cond.notify_all()
+
+    def _evict(self):
+        # internal method to drop the oldest DEBUG record, requires ._cond
+        for i, doc in enumerate(self._buffer):
+            if doc["levelno"] <= logging.DEBUG:
+                del self._buffer[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def _spill(self, doc):
+        # internal method to save the record to the local spill file
+        try:
+            with open(self.spill, "a", encoding="utf-8") as fh:
+                fh.write(json_encode(doc) + "\n")
+            self.spilled += 1
+        except Exception:
+            self.dropped += 1
+            self._error()
+
+    def _run(self):
+        # background thread to write buffered records
+        while True:
+            with self._cond:
+                if (len(self._buffer) < self.batch and not self._stop
+                        and not self._flush):
+                    self._cond.wait(self.interval)
+                docs = []
+                while self._buffer and len(docs) < self.batch:
+                    docs.append(self._buffer.popleft())
+                self._inflight = len(docs)
+                if not docs:
+                    self._cond.notify_all()
+                    if self._stop:
+                        return
+                    continue
+            self._write(docs)
+            with self._cond:
+                self._inflight = 0
+                self._cond.notify_all()
+
+    def _write(self, docs):
+        # internal method to insert the records, called without ._cond
+        try:
+            self._collection.insert_many(docs, ordered=False)
+        except Exception:
+            with self._cond:
+                self.failed += len(docs)
+            self._error()
+        else:
+            with self._cond:
+                self.written += len(docs)
+
+    def _error(self):
+        # internal method to report handler errors to stderr, see
+        #   logging.Handler.handleError
+        if logging.raiseExceptions and sys.stderr:
+            sys.stderr.write("--- core4 logging error ---\n")
+            traceback.print_exc(file=sys.stderr)
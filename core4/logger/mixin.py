@@ -12,6 +12,7 @@ log messages occur.
 """
 import logging
 import logging.config
+import os
 
 import pymongo
 import time
@@ -98,16 +99,26 @@ class CoreLoggerMixin:
                         self.logger.warning("failed to create [sys.log]")
                 level = getattr(logging, mongodb)
                 write_concern = self.config.logging.write_concern
+                buffer = self.config.logging.buffer
+                spill = buffer["spill"] or os.path.join(
+                    self.config.folder.root, self.config.folder.temp,
+                    "log.spill")
                 handler = core4.logger.handler.MongoLoggingHandler(
                     conn.with_options(write_concern=pymongo.WriteConcern(
                         w=write_concern
-                    )))
+                    )),
+                    size=buffer["size"],
+                    batch=buffer["batch"],
+                    interval=buffer["interval"],
+                    overflow=buffer["overflow"],
+                    spill=spill)
                 handler.setLevel(level)
                 logger.addHandler(handler)
                 self._setup_tornado(handler, level)
                 self.logger.debug(
                     "mongodb logging setup complete, "
-                    "level [%s], write concern [%d]", mongodb, write_concern)
+                    "level [%s], write concern [%d], buffer [%d]", mongodb,
+                    write_concern, buffer["size"])
             else:
                 raise core4.error.Core4SetupError(
                     "config.logging.mongodb set, but config.sys.log is None")
@@ -0,0 +1,404 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the persistent per-project agent which replaces
+:meth:`.exec_project` subprocess round trips of core4 daemons.
+
+An agent is a long-running Python interpreter per project which has imported
+core4 and the project's packages. :class:`.CoreAgentPool` spawns the agent
+with the Python interpreter of the project's virtual environment below
+``folder.home`` and sends requests. The agent serves each request in a forked
+child process. This saves the startup cost of the interpreter and the imports
+for each request. The agent itself does not load core4 configuration and does
+not connect to MongoDB to keep forking safe.
+
+The agent serves the following commands:
+
+* ``execute`` - fork and run a job with :meth:`.CoreWorkerProcess.start`,
+  see ``worker.execution: zygote``
+* ``enqueue`` - enqueue a job with :meth:`.CoreQueue.enqueue`
+* ``kill`` - kill a job with :meth:`.CoreQueue._exec_kill`
+* ``restart`` - restart a stopped job with
+  :meth:`.CoreQueue._restart_stopped`
+* ``iterate`` - collect project meta data with :meth:`.CoreIntrospector.run`
+  in the passed working directory
+* ``ping`` - health check
+
+Job children have their own PID which is registered in ``locked.pid``, their
+``STDOUT`` is captured and they can be killed by the worker exactly like jobs
+started with ``worker.execution: spawn``.
+
+The agent communicates with the daemon through its ``STDIN`` and ``STDOUT``
+with one JSON document per line. The agent terminates if the daemon closes
+the pipe. The daemon health-checks its agents with each heartbeat and
+restarts agents of upgraded projects and of projects with changed source
+files, see :func:`.project_stamp`.
+"""
+
+import hashlib
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import traceback
+
+import core4.error
+import core4.service.introspect.main
+from core4.base import CoreBase
+from core4.service.introspect.command import AGENT
+
+#: number of bytes to read from the response pipe at once
+READ_SIZE = 65536
+
+
+def _enqueue(qual_name, args=None):
+    from core4.queue.main import CoreQueue
+    return str(CoreQueue().enqueue(name=qual_name, **(args or {}))._id)
+
+
+def _kill(job_id):
+    from core4.queue.main import CoreQueue
+    CoreQueue()._exec_kill(job_id)
+
+
+def _restart(job_id):
+    from bson.objectid import ObjectId
+    from core4.queue.main import CoreQueue
+    ret = CoreQueue()._restart_stopped(ObjectId(job_id))
+    if ret is not None:
+        return str(ret)
+    return None
+
+
+def _iterate(cwd=None):
+    # the forked child changes into the project folder like the fallback
+    #   with exec_project
+    if cwd is not None:
+        os.chdir(cwd)
+    from core4.service.introspect.main import CoreIntrospector
+    return CoreIntrospector().run(dump=True)
+
+
+#: commands served by the agent in a forked child with a response
+COMMAND = {
+    "enqueue": _enqueue,
+    "kill": _kill,
+    "restart": _restart,
+    "iterate": _iterate
+}
+
+
+def serve(project):
+    """
+    Runs the agent main loop in the project's Python interpreter. This
+    function is called by :class:`.CoreAgentPool` with
+    :data:`AGENT <core4.service.introspect.command.AGENT>`.
+
+    :param project: name of the project to preload
+    """
+    channel_in = os.fdopen(os.dup(sys.stdin.fileno()), "r")
+    channel_out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    import core4.queue.process
+    preload(project)
+    stamp = project_stamp(project)
+
+    def reply(**kwargs):
+        channel_out.write(json.dumps(kwargs) + "\n")
+        channel_out.flush()
+
+    reply(pid=os.getpid())
+    for line in channel_in:
+        request = json.loads(line)
+        cmd = request.get("cmd")
+        if cmd == "ping":
+            reply(pid=os.getpid(), stale=project_stamp(project) != stamp)
+            continue
+        if cmd != "execute" and cmd not in COMMAND:
+            reply(error="unknown command [{}]".format(cmd))
+            continue
+        if cmd == "execute":
+            preload(request["name"].rpartition(".")[0])
+        try:
+            (read, write) = os.pipe()
+            pid = os.fork()
+        except OSError as exc:
+            reply(error=repr(exc))
+            continue
+        if pid == 0:
+            channel_in.close()
+            channel_out.close()
+            os.close(read)
+            if cmd == "execute":
+                os.close(write)
+                execute(request["job_id"])
+            call(cmd, request.get("args", {}), write)
+        os.close(write)
+        if cmd == "execute":
+            os.close(read)
+            reply(pid=pid)
+            continue
+        with os.fdopen(read, "rb") as fh:
+            body = fh.read()
+        if body:
+            reply(**json.loads(body.decode("utf-8")))
+        else:
+            reply(error="command [{}] died".format(cmd))
+
+
+def preload(module):
+    """
+    Imports the passed module into the agent. Import errors are ignored.
+    They surface with job execution in the forked child.
+
+    :param module: module name
+    """
+    try:
+        importlib.import_module(module)
+    except Exception:
+        pass
+
+
+def project_stamp(project):
+    """
+    Identifies the installed release and source of the project by the
+    location and modification time of all source files of the project
+    package, see :func:`.source_stamp`. The stamp changes if the project is
+    upgraded or if any job module preloaded into the agent is edited, e.g.
+    in a source checkout or an editable install.
+
+    :param project: project name
+    :return: str or ``None`` if the project is not installed
+    """
+    importlib.invalidate_caches()
+    try:
+        origin = importlib.util.find_spec(project).origin
+        if os.path.basename(origin) == "__init__.py":
+            stamp = core4.service.introspect.main.source_stamp(
+                os.path.dirname(origin))
+        else:
+            stamp = [[origin, os.stat(origin).st_mtime]]
+    except Exception:
+        return None
+    return hashlib.sha1(json.dumps([origin, stamp]).encode(
+        "utf-8")).hexdigest()
+
+
+def _reset():
+    # forked children must not share MongoDB connections with the agent
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    import core4.base.connector.mongo
+    for cache in core4.base.connector.mongo.CACHE.values():
+        cache.clear()
+
+
+def execute(job_id):
+    """
+    Executes the job in the forked child and terminates the child.
+
+    :param job_id: str representing the job's
+                   :class:`bson.objectid.ObjectId`
+    """
+    exit_code = 1
+    try:
+        _reset()
+        from core4.queue.process import CoreWorkerProcess
+        CoreWorkerProcess().start(job_id)
+        exit_code = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        logging.shutdown()
+        os._exit(exit_code)
+
+
+def call(cmd, args, fd):
+    """
+    Executes the passed command in the forked child, writes the JSON response
+    to the passed file descriptor and terminates the child.
+
+    :param cmd: command, see :data:`COMMAND`
+    :param args: dict of command arguments
+    :param fd: file descriptor of the response pipe
+    """
+    exit_code = 1
+    try:
+        _reset()
+        try:
+            response = {"result": COMMAND[cmd](**args)}
+        except Exception as exc:
+            response = {
+                "error": str(exc) or repr(exc),
+                "exception": exc.__class__.__name__
+            }
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(json.dumps(response).encode("utf-8"))
+        exit_code = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        logging.shutdown()
+        os._exit(exit_code)
+
+
+class CoreAgentPool(CoreBase):
+    """
+    Manages one agent per project and sends requests. The pool is created by
+    :class:`.CoreDaemon` with config setting ``daemon.agent`` and used by
+    :class:`.CoreWorker` with ``worker.execution: zygote``.
+
+    Agents are spawned with their first request and health-checked with
+    :meth:`.check`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.agent = {}
+        self.timeout = self.config.daemon.agent_timeout
+
+    def launch(self, name, job_id):
+        """
+        Forks the job from the agent of the job's project.
+
+        :param name: job :meth:`.qual_name`
+        :param job_id: str representing the job's
+                       :class:`bson.objectid.ObjectId`
+        :return: PID of the job process
+        """
+        return self.request(name, cmd="execute", name=name,
+                            job_id=job_id)["pid"]
+
+    def call(self, name, cmd, **kwargs):
+        """
+        Executes a command in the agent of the project.
+
+        :param name: job :meth:`.qual_name` or project name
+        :param cmd: command, see :data:`COMMAND`
+        :param kwargs: command arguments
+        :return: command result
+        """
+        return self.request(name, cmd=cmd, args=kwargs).get("result")
+
+    def request(self, name, **kwargs):
+        """
+        Sends the passed request to the agent of the project. The agent is
+        spawned if it does not exist or died. Errors reported by core4 are
+        raised with their :mod:`core4.error` exception class, all other errors
+        are raised as ``RuntimeError``.
+
+        :param name: job :meth:`.qual_name` or project name
+        :param kwargs: request
+        :return: dict response
+        """
+        project = name.split(".")[0]
+        proc = self.agent.get(project, None)
+        if proc is None or proc.poll() is not None:
+            proc = self.spawn(project)
+        try:
+            proc.stdin.write(json.dumps(kwargs) + "\n")
+            proc.stdin.flush()
+            response = self.receive(proc)
+        except Exception:
+            self.terminate(project)
+            raise
+        if "error" in response:
+            exc = getattr(core4.error, response.get("exception") or "", None)
+            if not (isinstance(exc, type) and issubclass(exc, Exception)):
+                exc = RuntimeError
+            raise exc("agent [{}] failed with [{}]: {}".format(
+                project, kwargs["cmd"], response["error"]))
+        return response
+
+    def spawn(self, project):
+        """
+        Spawns the agent of the passed project.
+
+        :param project: project name
+        :return: :class:`subprocess.Popen` of the agent
+        """
+        intro = core4.service.introspect.main.CoreIntrospector()
+        python_path = intro.get_python(project)
+        proc = subprocess.Popen(
+            [python_path, "-c", AGENT.format(project=project)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, env=os.environ.copy(),
+            universal_newlines=True)
+        self.agent[project] = proc
+        try:
+            pid = self.receive(proc)["pid"]
+        except Exception:
+            self.terminate(project)
+            raise
+        self.logger.info("spawned agent [%s] with [%s]", project, pid)
+        return proc
+
+    def receive(self, proc):
+        """
+        Reads the agent response.
+
+        :param proc: :class:`subprocess.Popen` of the agent
+        :return: dict response
+        """
+        (ready, _, _) = select.select([proc.stdout], [], [], self.timeout)
+        if not ready:
+            raise RuntimeError("agent timeout after [{}] sec.".format(
+                self.timeout))
+        line = proc.stdout.readline()
+        if not line:
+            raise RuntimeError("agent died")
+        return json.loads(line)
+
+    def check(self):
+        """
+        Health-checks all agents. Dead agents and agents of upgraded projects
+        are restarted. Unresponsive agents are stopped.
+        """
+        for project in list(self.agent.keys()):
+            try:
+                response = self.request(project, cmd="ping")
+            except Exception as exc:
+                self.logger.error("agent [%s] failed health check: %s",
+                                  project, exc)
+                continue
+            if response.get("stale"):
+                self.logger.info("project [%s] upgraded, restart agent",
+                                 project)
+                self.terminate(project)
+                self.spawn(project)
+
+    def terminate(self, project):
+        """
+        Stops the agent of the passed project. Running jobs are not affected.
+
+        :param project: project name
+        """
+        proc = self.agent.pop(project, None)
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+            proc.wait(timeout=self.timeout)
+        except Exception:
+            proc.kill()
+        self.logger.info("stopped agent [%s]", project)
+
+    def stop(self):
+        """
+        Stops all agents.
+        """
+        for project in list(self.agent.keys()):
+            self.terminate(project)
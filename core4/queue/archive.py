@@ -0,0 +1,224 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements :class:`.CoreArchive`, the cold storage tier of
+``sys.journal``.
+
+Journaled jobs older than ``archive.age`` days are moved from
+``sys.journal`` into compressed files below ``folder.archive`` /
+``archive.folder``. Files are partitioned by the month of the job ``_id``,
+i.e. the month the job has been enqueued::
+
+    <archive.folder>/<year>/<month>/<first _id>.bson.z
+
+Each archive run appends zlib compressed blocks of ``archive.block`` BSON
+encoded job documents to one file per month. Collection ``sys.archive``
+keeps a small index of all archived jobs with ``_id``, ``name``, ``state``,
+``finished_at`` and the ``file``, ``offset`` and ``length`` of the block.
+
+:meth:`.CoreQueue.find_job`, :meth:`.QueryMixin.job_detail` and the job
+details of :class:`.JobHandler` fall back to the archive if the job is
+neither found in ``sys.queue`` nor in ``sys.journal``. Use
+:meth:`.CoreArchive.archive` or :class:`.JournalArchiveJob` to archive jobs.
+"""
+
+import asyncio
+import datetime
+import os
+import zlib
+
+import bson
+import pymongo.errors
+from bson.objectid import ObjectId
+
+import core4.util.node
+from core4.base.main import CoreBase
+
+#: job attributes saved in the ``sys.archive`` index
+INDEX_ATTRIBUTES = ("name", "state", "finished_at")
+
+
+def partition(_id):
+    """
+    :param _id: job ``_id``
+    :return: the month partition ``<year>/<month>`` of the passed job
+    """
+    t = _id.generation_time
+    return "{:04d}/{:02d}".format(t.year, t.month)
+
+
+def encode_block(docs):
+    """
+    :param docs: list of job documents
+    :return: zlib compressed BSON documents
+    """
+    return zlib.compress(b"".join(bson.BSON.encode(d) for d in docs))
+
+
+def decode_block(data):
+    """
+    :param data: block created with :func:`encode_block`
+    :return: list of job documents
+    """
+    return bson.decode_all(zlib.decompress(data))
+
+
+class CoreArchive(CoreBase):
+    """
+    Moves journaled jobs into the compressed archive and retrieves archived
+    jobs.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._file = {}
+        self._block = (None, None)
+
+    @property
+    def root(self):
+        """
+        :return: archive folder of ``sys.journal``
+        """
+        return os.path.join(self.config.get_folder("archive"),
+                            self.config.archive.folder)
+
+    def archive(self, age=None):
+        """
+        Moves the journaled jobs enqueued more than ``age`` days ago from
+        ``sys.journal`` into the archive. Jobs are written to the archive
+        file and to the ``sys.archive`` index before they are deleted from
+        ``sys.journal``.
+
+        :param age: days, defaults to config ``archive.age``
+        :return: number of archived jobs
+        """
+        if age is None:
+            age = self.config.archive.age
+        if not age:
+            return 0
+        cutoff = ObjectId.from_datetime(
+            core4.util.node.mongo_now() - datetime.timedelta(days=age))
+        size = self.config.archive.block
+        self._file = {}
+        n = 0
+        block = []
+        month = None
+        cur = self.config.sys.journal.find(
+            {"_id": {"$lt": cutoff}}, sort=[("_id", 1)])
+        for doc in cur:
+            this = partition(doc["_id"])
+            if block and (this != month or len(block) >= size):
+                n += self._flush(month, block)
+                block = []
+            month = this
+            block.append(doc)
+        if block:
+            n += self._flush(month, block)
+        self.logger.info("archived [%d] jobs", n)
+        return n
+
+    def _flush(self, month, docs):
+        # internal method used by .archive to write a block, index and delete
+        #   the archived jobs
+        if month not in self._file:
+            self._file[month] = os.path.join(
+                month, "{}.bson.z".format(docs[0]["_id"]))
+        filename = os.path.join(self.root, self._file[month])
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        data = encode_block(docs)
+        with open(filename, "ab") as fh:
+            offset = fh.tell()
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        index = []
+        for doc in docs:
+            entry = dict([(k, doc.get(k)) for k in INDEX_ATTRIBUTES])
+            entry.update({
+                "_id": doc["_id"],
+                "file": self._file[month],
+                "offset": offset,
+                "length": len(data)
+            })
+            index.append(entry)
+        try:
+            self.config.sys.archive.insert_many(index, ordered=False)
+        except pymongo.errors.BulkWriteError as exc:
+            # jobs archived before, but not deleted from sys.journal
+            if any(e["code"] != 11000 for e in exc.details["writeErrors"]):
+                raise
+        self.config.sys.journal.delete_many(
+            {"_id": {"$in": [d["_id"] for d in docs]}})
+        self.logger.debug("archived [%d] jobs into [%s] at [%d]", len(docs),
+                          self._file[month], offset)
+        return len(docs)
+
+    def read_block(self, entry):
+        """
+        Reads the block of the passed ``sys.archive`` index entry.
+
+        :param entry: dict with ``file``, ``offset`` and ``length``
+        :return: list of job documents
+        """
+        key = (entry["file"], entry["offset"])
+        if self._block[0] != key:
+            with open(os.path.join(self.root, entry["file"]), "rb") as fh:
+                fh.seek(entry["offset"])
+                data = fh.read(entry["length"])
+            self._block = (key, decode_block(data))
+        return self._block[1]
+
+    def find_one(self, _id):
+        """
+        Retrieves the archived job with the passed ``_id``.
+
+        :param _id: job ``_id``
+        :return: job document or ``None`` if the job has not been archived
+        """
+        entry = self.config.sys.archive.find_one({"_id": _id})
+        if entry is None:
+            return None
+        for doc in self.read_block(entry):
+            if doc["_id"] == _id:
+                return doc
+        self.logger.error("archived job [%s] not found in [%s]", _id,
+                          entry["file"])
+        return None
+
+    async def find_one_async(self, _id):
+        """
+        Asynchronous version of :meth:`find_one` running in the default
+        executor of the event loop.
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.find_one, _id)
+
+    def find(self, name=None, start=None, end=None):
+        """
+        Retrieves archived jobs by job name and enqueue date/time.
+
+        :param name: job :meth:`.qual_name`
+        :param start: jobs enqueued at or after this date/time
+        :param end: jobs enqueued before this date/time
+        :return: generator of job documents sorted by ``_id``
+        """
+        query = {}
+        if name is not None:
+            query["name"] = name
+        if start is not None or end is not None:
+            query["_id"] = {}
+            if start is not None:
+                query["_id"]["$gte"] = ObjectId.from_datetime(start)
+            if end is not None:
+                query["_id"]["$lt"] = ObjectId.from_datetime(end)
+        cur = self.config.sys.archive.find(query, sort=[("_id", 1)])
+        for entry in cur:
+            for doc in self.read_block(entry):
+                if doc["_id"] == entry["_id"]:
+                    yield doc
+                    break
@@ -13,7 +13,10 @@ This module implements :class:`.CoreDaemon` which is the base class for
 import datetime
 import time
 
+import core4.base.connector.mongo
+import core4.queue.agent
 import core4.queue.main
+import core4.queue.metric
 import core4.util.node
 from core4.base.main import CoreBase
 from core4.service.introspect.main import CoreIntrospector
@@ -35,12 +38,26 @@ class CoreDaemon(CoreBase):
     #. **shutdown** - again some housekeeping and unregistering the daemon
     #. **exit** - quit daemon
 
+    With config setting ``daemon.agent`` the daemon serves calls into the
+    Python virtual environment of other projects with persistent project
+    agents (see :mod:`core4.queue.agent`) instead of spawning a new Python
+    interpreter for each call. The agents are health-checked with each
+    heartbeat.
+
+    Each cycle of the main loop and the MongoDB commands it issues are timed
+    with :class:`.CoreMetric`. The daemon publishes the timings into
+    ``sys.worker`` every ``daemon.metric`` seconds, see
+    :mod:`core4.queue.metric`.
+
     .. warning:: The daemon ``.identifier`` must be unique.
     """
 
     kind = "daemon"
 
     def __init__(self, name=None):
+        # time all MongoDB commands of the daemon, see core4.queue.metric
+        core4.base.connector.mongo.add_listener(
+            core4.queue.metric.COMMAND_TIMER)
         super().__init__()
         name = name or self.kind
         self.identifier = "@".join([name, core4.util.node.get_hostname()])
@@ -57,6 +74,9 @@ class CoreDaemon(CoreBase):
         self.queue = core4.queue.main.CoreQueue()
         self.jobs = {}
         self.wait_time = None
+        self.agent = None
+        self.metric = core4.queue.metric.CoreMetric()
+        self.metric_at = None
 
     def start(self):
         """
@@ -83,6 +103,17 @@ class CoreDaemon(CoreBase):
         self.enter_phase("startup")
         self.create_env()
         self.cleanup()
+        if self.config.daemon.agent:
+            self.start_agent()
+
+    def start_agent(self):
+        """
+        Creates the pool of project agents, see :class:`.CoreAgentPool`, and
+        attaches it to the daemon's :class:`.CoreQueue`.
+        """
+        if self.agent is None:
+            self.agent = core4.queue.agent.CoreAgentPool()
+            self.queue.agent = self.agent
 
     def cleanup(self):
         """
@@ -140,6 +171,10 @@ class CoreDaemon(CoreBase):
         method :meth:`cleanup`.
         """
         self.enter_phase("shutdown")
+        if self.agent is not None:
+            self.agent.stop()
+            self.queue.agent = None
+            self.agent = None
         self.cleanup()
 
     def create_env(self):
@@ -184,7 +219,7 @@ class CoreDaemon(CoreBase):
         as indicated in collection ``sys.worker``, too.
         """
         self.offset = None
-        time.sleep(self.wait_time)  # start with cycle 1
+        self.wait()  # start with cycle 1
         self.enter_phase("loop")
         in_maintenance = False
         heartbeat = None
@@ -193,22 +228,34 @@ class CoreDaemon(CoreBase):
         while not self.exit:
             self.cycle["total"] += 1
             self.logger.debug("cycle [%d]", self.cycle["total"])
-            if self.queue.halt(at=self.phase["startup"]):
-                return
-            if self.queue.maintenance():
-                if not in_maintenance:
-                    in_maintenance = True
-                    self.logger.info("entering maintenance")
-            else:
-                if in_maintenance:
-                    in_maintenance = False
-                    self.logger.info("leaving maintenance")
-                self.at = core4.util.node.mongo_now().replace(microsecond=0)
-                if heartbeat is None or self.at > heartbeat:
-                    self.heartbeat()
-                    heartbeat = self.at + heartbeat_delta
-                self.run_step()
-            time.sleep(self.wait_time)
+            with self.metric.timer("loop"):
+                if self.queue.halt(at=self.phase["startup"]):
+                    return
+                if self.queue.maintenance():
+                    if not in_maintenance:
+                        in_maintenance = True
+                        self.logger.info("entering maintenance")
+                else:
+                    if in_maintenance:
+                        in_maintenance = False
+                        self.logger.info("leaving maintenance")
+                    self.at = core4.util.node.mongo_now().replace(
+                        microsecond=0)
+                    if heartbeat is None or self.at > heartbeat:
+                        with self.metric.timer("heartbeat"):
+                            self.heartbeat()
+                        heartbeat = self.at + heartbeat_delta
+                    self.run_step()
+            self.publish_metric()
+            self.wait()
+
+    def wait(self):
+        """
+        Sleeps ``.wait_time`` seconds between two cycles of the main
+        :meth:`.loop`. Derived classes may overwrite this method to wake up
+        earlier.
+        """
+        time.sleep(self.wait_time)
 
     def heartbeat(self):
         """
@@ -224,6 +271,39 @@ class CoreDaemon(CoreBase):
         )
         if ret.raw_result["n"] != 1:
             raise RuntimeError("failed to update heartbeat")
+        if self.agent is not None:
+            self.agent.check()
+
+    def publish_metric(self):
+        """
+        Publishes the main loop timings of :class:`.CoreMetric` into
+        ``sys.worker`` attribute ``metric`` every ``daemon.metric`` seconds
+        and resets the histograms. Set ``daemon.metric`` to ``0`` or ``None``
+        to disable publishing.
+
+        :return: ``True`` if the metrics have been published
+        """
+        interval = self.config.daemon.metric
+        if not interval:
+            return False
+        now = core4.util.node.mongo_now()
+        if self.metric_at is None:
+            self.metric_at = now + datetime.timedelta(seconds=interval)
+            return False
+        if now < self.metric_at:
+            return False
+        self.config.sys.worker.update_one(
+            {"_id": self.identifier},
+            update={
+                "$set": {
+                    "metric": self.metric.to_doc(),
+                    "metric_at": now
+                }
+            }
+        )
+        self.metric.reset()
+        self.metric_at = now + datetime.timedelta(seconds=interval)
+        return True
 
     def run_step(self):
         """
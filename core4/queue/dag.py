@@ -0,0 +1,269 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the helpers of the job dependency and chain engine of
+:class:`.CoreQueue` and :class:`.CoreWorker`.
+
+Job property ``dependency`` lists the job :meth:`.qual_name` or job ``_id``
+the job has to wait for. The dependencies are resolved into the ``_id`` of
+the matching jobs in ``sys.queue`` when the job is enqueued:
+
+* ``wait_for`` - the list of resolved job ``_id``
+* ``blocked`` - the list of resolved job ``_id`` which did not complete, yet
+
+Jobs with ``blocked`` dependencies are not claimed by the worker. Upon
+completion of a job, the job ``_id`` is removed from the ``blocked``
+attribute of all dependants with the same transaction which moves the job
+into ``sys.journal``. Dependants of removed jobs are removed, too.
+
+Job property ``chain`` lists the job :meth:`.qual_name` to be enqueued after
+successful completion of the job. Chained jobs carry the ``_id`` of their
+predecessor in ``enqueued.parent_id``.
+
+Use :class:`.JobGraph` to retrieve and render the graph of a running job.
+
+The synchronous :class:`.CoreQueue` and the asynchronous :class:`.JobHandler`
+resolve and verify dependencies with the filters of
+:func:`dependency_filter`, :func:`alive_filter` and :func:`removed_filter`.
+"""
+
+import bson.objectid
+
+from core4.queue.job import STATE_COMPLETE
+
+#: maximum number of jobs collected into a :class:`.JobGraph`
+GRAPH_LIMIT = 1000
+
+#: job attributes retrieved to build a :class:`.JobGraph`
+GRAPH_PROJECTION = ["_id", "name", "state", "wait_for", "blocked",
+                    "enqueued", "prog", "removed_at", "killed_at"]
+
+#: Graphviz fill colors of job states
+STATE_COLOR = {
+    "pending": "white",
+    "running": "lightblue",
+    "complete": "palegreen",
+    "deferred": "lightyellow",
+    "failed": "orange",
+    "inactive": "lightgrey",
+    "error": "tomato",
+    "killed": "tomato"
+}
+
+
+def split_dependency(dependency):
+    """
+    Splits the passed ``dependency`` job property into job names and job
+    ``_id``.
+
+    :param dependency: list of job :meth:`.qual_name` and job ``_id``
+                       (:class:`bson.objectid.ObjectId` or str)
+    :return: tuple of list of job names and list of
+             :class:`bson.objectid.ObjectId`
+    """
+    names = []
+    oids = []
+    for dep in dependency or []:
+        if isinstance(dep, bson.objectid.ObjectId):
+            oids.append(dep)
+        elif bson.objectid.ObjectId.is_valid(dep) and "." not in dep:
+            oids.append(bson.objectid.ObjectId(dep))
+        else:
+            names.append(dep)
+    return names, oids
+
+
+def dependency_filter(dependency):
+    """
+    Delivers the ``sys.queue`` filter of the jobs matching the passed
+    ``dependency`` job property which are not requested to be removed. The
+    matching jobs are to be sorted by ``_id``.
+
+    :param dependency: list of job :meth:`.qual_name` and job ``_id``
+    :return: dict with MongoDB filter statement or ``None`` without any
+             dependency
+    """
+    (names, oids) = split_dependency(dependency)
+    cond = []
+    if names:
+        cond.append({"name": {"$in": names}})
+    if oids:
+        cond.append({"_id": {"$in": oids}})
+    if not cond:
+        return None
+    return {"$or": cond, "removed_at": None}
+
+
+def alive_filter(_id):
+    """
+    Delivers the ``sys.queue`` filter of the passed dependencies. Jobs which
+    are not found in ``sys.queue`` have left the queue.
+
+    :param _id: list of job ``_id``
+    :return: dict with MongoDB filter statement
+    """
+    return {"_id": {"$in": list(_id)}}
+
+
+def removed_filter(_id):
+    """
+    Delivers the ``sys.journal`` filter of the passed dependencies which
+    left ``sys.queue`` without completion. Dependencies missing in
+    ``sys.journal`` have never been enqueued.
+
+    :param _id: list of job ``_id`` not found in ``sys.queue``
+    :return: dict with MongoDB filter statement
+    """
+    return {"_id": {"$in": list(_id)}, "state": {"$ne": STATE_COMPLETE}}
+
+
+def find_cycle(graph):
+    """
+    Identifies a cycle in the passed directed graph.
+
+    :param graph: dict of node (key) and iterable of successors (value)
+    :return: list of nodes forming the cycle or ``None``
+    """
+    white, grey, black = 0, 1, 2
+    color = dict.fromkeys(graph, white)
+    for start in graph:
+        if color[start] != white:
+            continue
+        path = [start]
+        stack = [iter(graph.get(start, ()))]
+        color[start] = grey
+        while stack:
+            for succ in stack[-1]:
+                state = color.get(succ, white)
+                if state == grey:
+                    return path[path.index(succ):] + [succ]
+                if state == white:
+                    color[succ] = grey
+                    path.append(succ)
+                    stack.append(iter(graph.get(succ, ())))
+                    break
+            else:
+                color[path.pop()] = black
+                stack.pop()
+    return None
+
+
+def graph_filter(frontier):
+    """
+    Delivers the ``sys.queue`` filter of the passed jobs and their
+    dependants and successors.
+
+    :param frontier: list of job ``_id``
+    :return: dict with MongoDB filter statement
+    """
+    return {
+        "$or": [
+            {"_id": {"$in": frontier}},
+            {"wait_for": {"$in": frontier}},
+            {"enqueued.parent_id": {"$in": frontier}}
+        ]
+    }
+
+
+class JobGraph:
+    """
+    Collects the jobs of a running dependency and chain graph. Jobs are added
+    with :meth:`.add`, which delivers the job ``_id`` to visit next. See
+    :meth:`.QueryMixin.get_job_graph`.
+    """
+
+    def __init__(self, limit=GRAPH_LIMIT):
+        """
+        :param limit: maximum number of jobs
+        """
+        self.limit = limit
+        self.node = {}
+        self.truncated = False
+
+    def add(self, docs, journal=False):
+        """
+        Adds the passed jobs.
+
+        :param docs: job documents projected with :data:`GRAPH_PROJECTION`
+        :param journal: ``True`` if the documents are from ``sys.journal``
+        :return: list of referenced job ``_id`` not collected, yet
+        """
+        refer = []
+        for doc in docs:
+            if doc["_id"] in self.node:
+                continue
+            if len(self.node) >= self.limit:
+                self.truncated = True
+                break
+            doc["journal"] = journal
+            self.node[doc["_id"]] = doc
+            enqueued = doc.get("enqueued") or {}
+            refer += list(doc.get("wait_for") or [])
+            refer += [enqueued.get(k) for k in ("parent_id", "child_id")]
+        return [i for i in set(refer) if i is not None and i not in self.node]
+
+    def edges(self):
+        """
+        :return: list of tuples ``(source, target, kind)`` of the collected
+                 jobs with kind ``dependency``, ``chain`` or ``restart``
+        """
+        ret = []
+        for _id, doc in self.node.items():
+            for dep in doc.get("wait_for") or []:
+                if dep in self.node:
+                    ret.append((dep, _id, "dependency"))
+            parent_id = (doc.get("enqueued") or {}).get("parent_id")
+            if parent_id in self.node:
+                parent = self.node[parent_id].get("enqueued") or {}
+                if parent.get("child_id") == _id:
+                    ret.append((parent_id, _id, "restart"))
+                else:
+                    ret.append((parent_id, _id, "chain"))
+        return ret
+
+    def to_doc(self):
+        """
+        :return: dict with ``nodes``, ``edges`` and ``truncated`` flag
+        """
+        nodes = []
+        for _id, doc in sorted(self.node.items()):
+            nodes.append({
+                "_id": _id,
+                "name": doc["name"],
+                "state": doc["state"],
+                "blocked": list(doc.get("blocked") or []),
+                "journal": doc["journal"],
+                "removed": doc.get("removed_at") is not None,
+                "killed": doc.get("killed_at") is not None,
+                "progress": (doc.get("prog") or {}).get("value")
+            })
+        return {
+            "nodes": nodes,
+            "edges": [{"source": s, "target": t, "kind": k}
+                      for (s, t, k) in self.edges()],
+            "truncated": self.truncated
+        }
+
+    def to_dot(self):
+        """
+        Renders the graph in Graphviz DOT format, e.g. for
+        ``dot -Tsvg -o graph.svg``.
+
+        :return: str
+        """
+        lines = ["digraph job {", '  node [shape=box, style=filled];']
+        for _id, doc in sorted(self.node.items()):
+            lines.append('  "{}" [label="{}\\n{}\\n{}", fillcolor={}];'.format(
+                _id, doc["name"], _id, doc["state"],
+                STATE_COLOR.get(doc["state"], "white")))
+        for (source, target, kind) in self.edges():
+            style = "dashed" if kind == "dependency" else "solid"
+            lines.append('  "{}" -> "{}" [label="{}", style={}];'.format(
+                source, target, kind, style))
+        lines.append("}")
+        return "\n".join(lines)
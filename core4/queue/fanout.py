@@ -0,0 +1,128 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements :class:`.MapResult` which delivers the outcome of the
+child jobs launched with :meth:`.CoreJob.map`.
+
+The parent job carries the completion counter of its children in attribute
+``children``:
+
+* ``total`` - the number of children enqueued
+* ``complete`` - the number of children completed
+* ``failed`` - the number of children stopped (``error``, ``killed``,
+  ``inactive``) or removed
+* ``sealed`` - ``True`` if all children have been enqueued
+* ``waiting`` - ``True`` as long as the parent waits for its children
+
+Each child increments the counter of its parent atomically when the child
+completes or stops. The child which finishes last wakes up the parent, see
+:meth:`.CoreQueue.count_children`. The parent is not claimed by any worker
+while ``waiting``.
+"""
+
+import itertools
+
+import core4.queue.job
+
+
+def chunked(iterable, size):
+    """
+    Splits the passed iterable into lists of ``size`` elements.
+
+    :param iterable: to split
+    :param size: number of elements per list
+    :return: generator of lists
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class MapResult:
+    """
+    Delivers the results and errors of the children of a job launched with
+    :meth:`.CoreJob.map`. Results are the return values of the child's
+    :meth:`.execute <.CoreJob.execute>` method.
+
+    Usage::
+
+        result = self.map(ChildJob, [{"i": i} for i in range(100)])
+        for args, value in result:
+            ...
+        for doc in result.errors():
+            self.logger.error("child [%s] failed: %s", doc["_id"],
+                              doc["last_error"])
+    """
+
+    def __init__(self, job):
+        """
+        :param job: parent :class:`.CoreJob`
+        """
+        self.job = job
+        doc = job.config.sys.queue.find_one(
+            {"_id": job._id}, projection=["children"])
+        self.children = (doc or {}).get("children") or {}
+
+    @property
+    def total(self):
+        """
+        :return: number of children
+        """
+        return self.children.get("total", 0)
+
+    @property
+    def complete(self):
+        """
+        :return: number of completed children
+        """
+        return self.children.get("complete", 0)
+
+    @property
+    def failed(self):
+        """
+        :return: number of failed or removed children
+        """
+        return self.children.get("failed", 0)
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        return self.results()
+
+    def results(self):
+        """
+        :return: generator of tuples with job ``args`` and ``result`` of all
+                 completed children in enqueue order
+        """
+        cur = self.job.config.sys.journal.find(
+            {"enqueued.parent_id": self.job._id,
+             "state": core4.queue.job.STATE_COMPLETE},
+            projection=["args", "result"], sort=[("_id", 1)])
+        for doc in cur:
+            yield doc["args"], doc.get("result")
+
+    def errors(self):
+        """
+        :return: generator of job documents with ``_id``, ``name``, ``args``,
+                 ``state``, ``removed_at`` and ``last_error`` of all children
+                 which did not complete
+        """
+        for collection in (self.job.config.sys.queue,
+                           self.job.config.sys.journal):
+            cur = collection.find(
+                {"enqueued.parent_id": self.job._id,
+                 "state": {"$ne": core4.queue.job.STATE_COMPLETE}},
+                projection=["name", "args", "state", "removed_at",
+                            "last_error"],
+                sort=[("_id", 1)])
+            for doc in cur:
+                yield doc
@@ -12,6 +12,7 @@ functions :func:`enqueue` and :func:`execute`.
 
 import core4.logger
 import core4.queue.main
+import core4.queue.query
 import core4.queue.worker
 import core4.service.introspect.main
 import core4.service.setup
@@ -92,7 +93,11 @@ def execute(job, **kwargs):
     worker.at = core4.util.node.mongo_now()
     worker.start_job(job.serialise(), run_async=False)
     doc = worker.queue.job_detail(job._id)
-    worker.config.sys.queue.delete_one(filter={"_id": job._id})
+    ret = worker.config.sys.queue.find_one_and_delete(
+        filter={"_id": job._id},
+        projection=core4.queue.query.SUMMARY_PROJECTION)
+    if ret is not None:
+        queue.update_summary(src=core4.queue.query.summary_bucket(ret))
     worker.config.sys.journal.delete_one(filter={"_id": job._id})
     return doc
 
@@ -0,0 +1,28 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements :class:`.JournalArchiveJob` which moves journaled
+jobs older than ``archive.age`` days into the archive.
+"""
+
+from core4.queue.archive import CoreArchive
+from core4.queue.job import CoreJob
+
+
+class JournalArchiveJob(CoreJob):
+    """
+    Moves journaled jobs from ``sys.journal`` into the compressed archive
+    below ``folder.archive``. See :meth:`.CoreArchive.archive`.
+    """
+    author = 'mra'
+    schedule = '30 2 * * *'
+    max_cluster = 1
+
+    def execute(self, *args, **kwargs):
+        n = CoreArchive().archive()
+        self.logger.info("archived [%d] journaled jobs", n)
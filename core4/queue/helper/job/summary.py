@@ -0,0 +1,28 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements :class:`.QueueSummaryJob` which reconciles the job
+state summary in ``sys.summary`` with ``sys.queue``.
+"""
+
+from core4.queue.job import CoreJob
+from core4.queue.main import CoreQueue
+
+
+class QueueSummaryJob(CoreJob):
+    """
+    Rebuilds the incrementally maintained job state counts in collection
+    ``sys.summary`` from ``sys.queue``. See
+    :meth:`.CoreQueue.reconcile_summary`.
+    """
+    author = 'mra'
+    schedule = '*/15 * * * *'
+
+    def execute(self, *args, **kwargs):
+        n = CoreQueue().reconcile_summary()
+        self.logger.info("reconciled summary of [%d] jobs", n)
@@ -0,0 +1,193 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the queue history rollups of
+:class:`.QueueHistoryHandler`.
+
+Each job state change snapshots the job state counts into ``sys.event``, see
+:meth:`.CoreQueue.make_stat`. The queue history delivers the snapshot with
+the maximum total number of jobs per minute, hour or day. Instead of
+aggregating the raw events with each request, the snapshots are rolled up
+incrementally into collection ``sys.queue_history``. Each document covers
+one ``minute``, ``hour`` or ``day`` ``period`` starting ``at``:
+
+* ``created`` - the creation date/time of the snapshot
+* ``total`` - the total number of jobs of the snapshot
+* ``queue`` - the number of jobs by state of the snapshot
+
+A snapshot replaces the rollup of its period only if its total exceeds the
+total of the rollup. Hence the rollup keeps the first snapshot with the
+maximum total. :meth:`.CoreQueue.backfill_history` builds the rollups from
+existing ``sys.event`` documents. Minute rollups expire after
+``queue.history_ttl`` seconds.
+
+:func:`.write_history` and :func:`.write_history_async` execute the update
+statements of a snapshot. A snapshot with the same total in the same minute
+as the last snapshot written by the caller does not change any rollup and is
+skipped.
+"""
+
+import pymongo.errors
+from pymongo import UpdateOne
+
+#: job states summed up into the ``total`` number of jobs
+HISTORY_STATE = ("pending", "deferred", "failed", "running", "error",
+                 "inactive", "killed")
+
+#: rollup periods from coarse to fine
+HISTORY_PERIOD = ("day", "hour", "minute")
+
+#: date/time parts from coarse to fine
+DATE_PART = ("year", "month", "day", "hour", "minute", "second")
+
+
+def floor_period(timestamp, period):
+    """
+    :param timestamp: :class:`datetime.datetime`
+    :param period: ``minute``, ``hour`` or ``day``
+    :return: the passed timestamp truncated to the start of the period
+    """
+    timestamp = timestamp.replace(second=0, microsecond=0)
+    if period in ("hour", "day"):
+        timestamp = timestamp.replace(minute=0)
+    if period == "day":
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def history_period(precision):
+    """
+    Delivers the coarsest rollup period which satisfies the passed precision.
+
+    :param precision: date/time part, e.g. ``hour``
+    :return: ``minute``, ``hour``, ``day`` or ``None`` if the precision is
+             finer than a minute
+    """
+    if precision not in DATE_PART:
+        return None
+    for period in HISTORY_PERIOD:
+        if DATE_PART.index(period) >= DATE_PART.index(precision):
+            return period
+    return None
+
+
+def history_total(queue):
+    """
+    :param queue: dict of state (key) and number of jobs (value)
+    :return: the total number of jobs in :data:`HISTORY_STATE`
+    """
+    return sum(queue.get(state, 0) for state in HISTORY_STATE)
+
+
+def history_ops(created, queue):
+    """
+    Delivers the ``sys.queue_history`` update statements of a job state
+    snapshot. The statements upsert the rollups with a lower ``total`` only.
+    Rollups with a higher or equal ``total`` raise a duplicate key error
+    which is to be ignored.
+
+    :param created: :class:`datetime.datetime` of the snapshot
+    :param queue: dict of state (key) and number of jobs (value)
+    :return: list of :class:`pymongo.UpdateOne`
+    """
+    total = history_total(queue)
+    return [_upsert(period, floor_period(created, period), created, total,
+                    queue) for period in HISTORY_PERIOD]
+
+
+def history_key(created, queue):
+    """
+    :param created: :class:`datetime.datetime` of the snapshot
+    :param queue: dict of state (key) and number of jobs (value)
+    :return: tuple of the snapshot's minute and total number of jobs
+    """
+    return floor_period(created, "minute"), history_total(queue)
+
+
+def write_history(collection, created, queue, last=None):
+    """
+    Rolls up the passed job state snapshot into ``sys.queue_history``, see
+    :func:`.history_ops`. Duplicate key errors of rollups with a higher or
+    equal total are ignored.
+
+    :param collection: ``sys.queue_history`` collection
+    :param created: :class:`datetime.datetime` of the snapshot
+    :param queue: dict of state (key) and number of jobs (value)
+    :param last: :func:`.history_key` of the last snapshot written, the
+                 write is skipped if unchanged
+    :return: :func:`.history_key` of the snapshot
+    """
+    key = history_key(created, queue)
+    if key != last:
+        bulk_write_history(collection, history_ops(created, queue))
+    return key
+
+
+async def write_history_async(collection, created, queue, last=None):
+    """
+    Asynchronous version of :func:`.write_history`.
+
+    :param collection: async ``sys.queue_history`` collection
+    """
+    key = history_key(created, queue)
+    if key != last:
+        try:
+            await collection.bulk_write(
+                history_ops(created, queue), ordered=False)
+        except pymongo.errors.BulkWriteError as exc:
+            _raise_error(exc)
+    return key
+
+
+def bulk_write_history(collection, ops):
+    """
+    Executes the passed ``sys.queue_history`` update statements. Duplicate
+    key errors of rollups with a higher or equal total are ignored.
+
+    :param collection: ``sys.queue_history`` collection
+    :param ops: list of :class:`pymongo.UpdateOne`
+    """
+    if not ops:
+        return
+    try:
+        collection.bulk_write(ops, ordered=False)
+    except pymongo.errors.BulkWriteError as exc:
+        _raise_error(exc)
+
+
+def _raise_error(exc):
+    # internal function to re-raise all errors but duplicate keys
+    if any(e["code"] != 11000 for e in exc.details["writeErrors"]):
+        raise exc
+
+
+def _upsert(period, at, created, total, queue):
+    return UpdateOne(
+        filter={"period": period, "at": at, "total": {"$lt": total}},
+        update={"$set": {"created": created, "total": total, "queue": queue}},
+        upsert=True)
+
+
+def history_backfill(events):
+    """
+    Rolls up the passed ``sys.event`` documents.
+
+    :param events: iterable of dict with ``created`` and ``data.queue``,
+                   sorted by ``created``
+    :return: list of :class:`pymongo.UpdateOne`
+    """
+    best = {}
+    for doc in events:
+        queue = (doc.get("data") or {}).get("queue") or {}
+        total = history_total(queue)
+        for period in HISTORY_PERIOD:
+            key = (period, floor_period(doc["created"], period))
+            if key not in best or best[key][0] < total:
+                best[key] = (total, doc["created"], queue)
+    return [_upsert(period, at, created, total, queue)
+            for (period, at), (total, created, queue) in best.items()]
@@ -19,6 +19,7 @@ import core4.config.map
 import core4.config.tag
 import core4.error
 import core4.logger.mixin
+import core4.queue.semaphore
 import core4.util
 import core4.util.node
 import core4.util.tool
@@ -49,7 +50,10 @@ JOB_ARGS = {
     "attempts": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "attempts_left": (SERIALISE,),
     "author": (PROPERTY,),
+    "blocked": (SERIALISE,),
     "chain": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
+    "children": (SERIALISE,),
+    "cpu": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "defer_max": (ENQUEUE, CONFIG, PROPERTY, SERIALISE),
     "defer_time": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "dependency": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
@@ -61,22 +65,30 @@ JOB_ARGS = {
     "killed_at": (SERIALISE,),
     "last_error": (SERIALISE,),
     "locked": (SERIALISE,),
+    "max_cluster": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "max_parallel": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
+    "memory": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "name": (SERIALISE,),
     "priority": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "progress_interval": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "prog": (SERIALISE,),
     "query_at": (SERIALISE,),
     "removed_at": (SERIALISE,),
+    "resource": (CONFIG, PROPERTY,),
+    "result": (SERIALISE,),
     "runtime": (SERIALISE,),
     "schedule": (CONFIG, PROPERTY,),
+    "semaphore": (SERIALISE,),
+    "slots": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "sources": (SERIALISE,),
     "started_at": (SERIALISE,),
     "state": (SERIALISE,),
     "tag": (CONFIG, PROPERTY,),
     "trial": (SERIALISE,),
+    "usage": (SERIALISE,),
     "wall_at": (SERIALISE,),
     "wall_time": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
+    "wait_for": (SERIALISE,),
     "worker": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
     "zombie_at": (SERIALISE,),
     "zombie_time": (ENQUEUE, CONFIG, PROPERTY, SERIALISE,),
@@ -99,15 +111,20 @@ JOB_VALIDATION = {
     "attempts": is_int_gt0,
     "author": is_str,
     "chain": is_job,
+    "cpu": is_int_gt0_null,
     "defer_max": is_int_gt0,
     "defer_time": is_int_gt0,
     "dependency": is_job,
     "error_time": is_int_gt0,
     "force": is_bool_null,
+    "max_cluster": is_int_gt0_null,
     "max_parallel": is_int_gt0_null,
+    "memory": is_int_gt0_null,
     "priority": is_int,
     "progress_interval": is_int_gt0,
+    "resource": is_str_list_null,
     "schedule": is_cron,
+    "slots": is_int_gt0,
     "tag": is_str_list_null,
     "wall_time": is_int_gt0_null,
     "worker": is_str_null,
@@ -142,16 +159,23 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
       before the job enters the final ``error`` state
     * ``attempts_left`` -  number of attempts left after failure
     * ``author`` - the author(s) of the job
+    * ``blocked`` - list of job ids in ``wait_for`` which did not complete,
+      yet
     * ``defer_max`` - maximum number of seconds to defer the job before the job
       turns inactive
     * ``defer_time`` - seconds to wait before restart after defer
-    * ``dependency`` - list of jobs which need complete before execution
+    * ``dependency`` - list of job names or job ids which need complete
+      before execution, see :mod:`core4.queue.dag`
     * ``chain`` - list of jobs to be enqueued after successful job completion
+    * ``children`` - completion counter of the children launched with
+      :meth:`.map`, see :mod:`core4.queue.fanout`
+    * ``cpu`` - expected number of CPU cores used by the job, see
+      :mod:`core4.queue.placement`
     * ``enqueued`` - dict with information about job enqueuing
     * ``enqueued.at`` - datetime when the job has been enqueued
     * ``enqueued.hostname`` - from where the job has been enqueued
     * ``enqueued.parent_id`` - job id of the precursing job which has been
-      journaled and restarted
+      journaled and restarted or which chained the job
     * ``enqueued.child_id`` - job id of the follow-up job which has been
       launched
     * ``enqueued.username`` - user who enqueued the job
@@ -171,7 +195,11 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
     * ``locked.pid`` - of the process executing the job
     * ``locked.worker`` - which locked the job
     * ``locked.username`` - running the worker which locked the job
+    * ``max_cluster`` - max. number of jobs to run in parallel across the
+      cluster, see :mod:`core4.queue.semaphore`
     * ``max_parallel`` - max. number jobs to run in parallel on the same node
+    * ``memory`` - expected peak memory of the job in MB, see
+      :mod:`core4.queue.placement`
     * ``name`` - short fully qualified name of the job
     * ``priority`` - to execute the job with >0 higher and <0 lower priority
     * ``prog.message`` - last progress message
@@ -179,12 +207,21 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
     * ``query_at`` - datetime to query the job, derived from ``error_time`` or
       ``defer_time``
     * ``removed_at`` - datetime when the job has been requested to remove
+    * ``resource`` - list of named resources with cluster-wide concurrency
+      limits, see :mod:`core4.queue.semaphore`
+    * ``result`` - return value of :meth:`.execute` if the job completed
     * ``runtime`` - total job execution time
     * ``schedule`` - job schedule in crontab format
+    * ``semaphore`` - list of cluster-wide semaphores resolved from
+      ``max_cluster``, ``tag`` and ``resource``
+    * ``slots`` - number of worker execution slots occupied by the job
     * ``sources`` - set of sources processed by the job
     * ``started_at`` - last job execution start-time
     * ``state`` - job state
     * ``tag`` - tag the job with freestyle string-argmuents
+    * ``usage`` - dict with the resources used by all job executions, see
+      :mod:`core4.queue.usage`
+    * ``wait_for`` - list of job ids resolved from ``dependency``
     * ``wall_at`` - datetime when a running job turns into a non-stopping job,
       determined by ``wall_time``
     * ``wall_time`` - number of seconds before a running job turns into a
@@ -224,7 +261,10 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
           attempts    True   True  True      True       1 int > 0
      attempts_left   False  False False      True      na
             author   False  False  True     False      na str
+           blocked   False  False False      True      na
              chain    True   True  True      True    ([]) list of jobs, None
+          children   False  False False      True      na
+               cpu    True   True  True      True    None int > 0, None
          defer_max    True   True  True      True     60' int > 0
         defer_time    True   True  True      True      5' int > 0
         dependency    True   True  True      True    ([]) list of jobs, None
@@ -236,18 +276,26 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
          killed_at   False  False False      True      na
         last_error   False  False False      True      na
             locked   False  False False      True      na
+       max_cluster    True   True  True      True    None int > 0, None
       max_parallel    True   True  True      True    None int > 0, None
+            memory    True   True  True      True    None int > 0, None
           priority    True   True  True      True       0 int
  progress_interval    True   True  True      True       5 int > 0
               name   False  False False      True      na
           query_at   False  False False      True      na
         removed_at   False  False False      True      na
+          resource   False   True  True     False    ([]) list of str, None
+            result   False  False False      True      na
            runtime   False  False False      True      na
           schedule   False   True  True     False    None crontab format, None
+         semaphore   False  False False      True      na
+             slots    True   True  True      True       1 int > 0
            sources   False  False False      True      na
         started_at   False  False False      True      na
              state   False  False False      True      na
                tag   False   True  True     False    ([]) list of str, None
+             usage   False  False False      True      na
+          wait_for   False  False False      True      na
            wall_at   False  False False      True      na
          wall_time    True   True  True      True    None int > 0, None
             worker    True   True  True      True    ([]) list of str, None
@@ -325,8 +373,13 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
     error_time = None
     force = None
     wall_time = None
+    max_cluster = None
     max_parallel = None
+    memory = None
+    cpu = None
+    resource = None
     schedule = None
+    slots = None
     progress_interval = None
     zombie_time = None
     manual = False
@@ -351,6 +404,8 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
         self._cookie = None
         self.args = {}
         self.attempts_left = None
+        self.blocked = []
+        self.children = None
         self.enqueued = None
         self.finished_at = None
         self.inactive_at = None
@@ -359,11 +414,15 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
         self.locked = None
         self.query_at = None
         self.removed_at = None
+        self.result = None
         self.runtime = None
+        self.semaphore = []
         self.sources = []
         self.started_at = None
         self.state = None
         self.trial = 0
+        self.usage = None
+        self.wait_for = []
         self.wall_at = None
         self.zombie_at = None
         self.prog = {
@@ -374,6 +433,7 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
         self.overload_property()
         self.overload_config()
         self.overload_args(**kwargs)
+        self.semaphore = core4.queue.semaphore.make_semaphore(self)
 
         if self.args:
             js = pformat(self.args)
@@ -563,6 +623,39 @@ class CoreJob(CoreBase, core4.logger.mixin.CoreExceptionLoggerMixin):
         message = self.format_args(*args, **kwargs)
         raise core4.error.CoreJobDeferred(message)
 
+    def map(self, cls, iterable, chunksize=1000):
+        """
+        Fans out the passed job arguments into child jobs of class ``cls``
+        and suspends the job until all children finished. The children are
+        enqueued in bulk and carry the ``_id`` of this job in
+        ``enqueued.parent_id``. Each child increments the completion counter
+        ``children`` of this job when it completes or stops. The job is
+        re-executed once when all children finished. With this second
+        execution :meth:`.map` returns the :class:`.MapResult`::
+
+            def execute(self, **kwargs):
+                result = self.map(ChildJob, ({"i": i} for i in range(1000)))
+                total = sum([value for args, value in result])
+
+        Each child job must be unique by its arguments. Children which already
+        exist in ``sys.queue`` are skipped. Launch one map per job execution.
+
+        :param cls: child job class or :meth:`.qual_name`
+        :param iterable: of dict with child job arguments
+        :param chunksize: number of children enqueued with one bulk insert
+        :return: :class:`.MapResult` after all children finished
+        :raises: :class:`.CoreJobWaiting` to suspend the job until all
+                 children finished
+        """
+        from core4.queue.fanout import MapResult
+        from core4.queue.main import CoreQueue
+        if self.children is None or self.children.get("waiting"):
+            total = CoreQueue().map_job(self, cls, iterable, chunksize)
+            if total > 0:
+                raise core4.error.CoreJobWaiting(
+                    "waiting for [{}] children".format(total))
+        return MapResult(self)
+
     def serialise(self):
         """
         Convert the job properties into a dict.
@@ -10,11 +10,13 @@ This module implements general methods of the core4 worker queue used for
 example by :mod:`core4.queue.worker` and :mod:`core4.queue.process`.
 """
 
+import collections
 import importlib
 import sys
 import traceback
 from datetime import timedelta
 
+import pymongo
 import pymongo.collection
 import pymongo.errors
 import pymongo.write_concern
@@ -27,10 +29,19 @@ import core4.service.setup
 import core4.util.node
 import core4.util.tool
 from core4.base import CoreBase
+from core4.queue.archive import CoreArchive
+from core4.queue.dag import alive_filter, dependency_filter, find_cycle
+from core4.queue.dag import removed_filter, split_dependency
+from core4.queue.fanout import chunked
+from core4.queue.history import bulk_write_history, history_backfill
+from core4.queue.history import write_history
+from core4.queue.placement import learn
+from core4.queue.rollup import floor_minute, rollup_update
 from core4.queue.helper.job.base import CoreAbstractJobMixin
-from core4.queue.job import STATE_PENDING
-from core4.queue.query import QueryMixin
-from core4.service.introspect.command import RESTART, KILL
+from core4.queue.job import STATE_COMPLETE, STATE_PENDING
+from core4.queue.query import QueryMixin, SUMMARY_PROJECTION
+from core4.queue.query import make_summary_state, summary_bucket, summary_ops
+from core4.service.introspect.command import ENQUEUE, RESTART, KILL
 
 STATE_WAITING = (core4.queue.job.STATE_DEFERRED,
                  core4.queue.job.STATE_FAILED)
@@ -68,16 +79,140 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
               queue.
     """
 
-    def enqueue(self, cls=None, name=None, by=None, **kwargs):
+    _transaction = None
+    #: :class:`.CoreAgentPool` attached by :class:`.CoreDaemon`
+    agent = None
+    #: :func:`.history_key` of the last queue history snapshot written
+    _history = None
+
+    def enqueue(self, cls=None, name=None, by=None, wait_for=None, **kwargs):
         """
         Enqueues the passed job identified by it's :meth:`.qual_name`. The job
         is represented by a document in MongoDB collection ``sys.queue``.
 
+        :param cls: job class
+        :param name: job :meth:`.qual_name`
+        :param by: dict with ``enqueued`` attributes, see :meth:`.prepare_job`
+        :param wait_for: list of job ``_id`` to wait for, see
+                         :meth:`.resolve_dependency`
         :param kwargs: dict
         :return: enqueued job object
         """
         core4.service.setup.CoreSetup().make_queue()
+        job = self.prepare_job(cls, name, by, wait_for, **kwargs)
+        # save
+        doc = job.serialise()
+        try:
+            ret = self.config.sys.queue.insert_one(doc)
+        except pymongo.errors.DuplicateKeyError:
+            raise core4.error.CoreJobExists(
+                "job [{}] exists with args {}".format(
+                    job.qual_name(), job.args))
+        except:
+            raise
+        job.__dict__["_id"] = ret.inserted_id
+        job.__dict__["identifier"] = ret.inserted_id
+        self.update_summary(dst=summary_bucket(doc))
+        self.settle_blocked([doc])
+        self.logger.info(
+            'successfully enqueued [%s] with [%s]', job.qual_name(), job._id)
+        self.make_stat('enqueue_job', str(job._id))
+        return job
+
+    def enqueue_many(self, jobs):
+        """
+        Enqueues the passed jobs prepared with :meth:`.prepare_job` with a
+        single ``insert_many``. Jobs which already exist in ``sys.queue`` are
+        reported with an error and skipped. Jobs with a ``dependency`` on the
+        name of a job enqueued before in the same batch wait for this job.
+
+        :param jobs: list of :class:`.CoreJob` objects
+        :return: list of enqueued job objects
+        """
+        if not jobs:
+            return []
+        core4.service.setup.CoreSetup().make_queue()
+        docs = [job.serialise() for job in jobs]
+        for i, doc in enumerate(docs):
+            doc.setdefault("_id", ObjectId())
+            (names, _) = split_dependency(jobs[i].dependency)
+            for prev in docs[:i]:
+                if prev["name"] in names:
+                    doc["wait_for"].append(prev["_id"])
+                    doc["blocked"].append(prev["_id"])
+        failed = set()
+        try:
+            self.config.sys.queue.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as exc:
+            for error in exc.details["writeErrors"]:
+                job = jobs[error["index"]]
+                failed.add(error["index"])
+                if error["code"] == 11000:
+                    self.logger.error("job [%s] exists with args %s",
+                                      job.qual_name(), job.args)
+                else:
+                    self.logger.error("failed to enqueue [%s]: %s",
+                                      job.qual_name(), error["errmsg"])
+        ret = []
+        for i, (job, doc) in enumerate(zip(jobs, docs)):
+            if i not in failed:
+                job.__dict__["_id"] = doc["_id"]
+                job.__dict__["identifier"] = doc["_id"]
+                ret.append(job)
+                self.logger.info('successfully enqueued [%s] with [%s]',
+                                 job.qual_name(), job._id)
+        if ret:
+            self.update_summary_many(
+                [(None, summary_bucket(docs[i])) for i in range(len(docs))
+                 if i not in failed])
+            self.settle_blocked(
+                [docs[i] for i in range(len(docs)) if i not in failed])
+            self.make_stat('enqueue_job', [str(job._id) for job in ret])
+        return ret
+
+    def exec_enqueue(self, name):
+        """
+        Enqueues the job with the Python virtual environment of the job's
+        project. Uses the project agent if attached (see
+        :class:`.CoreAgentPool`), else spawns a new Python interpreter.
+
+        :param name: job :meth:`.qual_name`
+        :return: ``_id`` of the enqueued job or ``None`` if the job has been
+                 enqueued with a new Python interpreter or failed
+        """
+        if self.agent is not None:
+            try:
+                return ObjectId(self.agent.call(
+                    name, "enqueue", qual_name=name))
+            except core4.error.CoreJobExists:
+                self.logger.error("job [%s] exists", name)
+                return None
+            except Exception as exc:
+                self.logger.error("failed to enqueue [%s] with agent: %s",
+                                  name, exc)
+        core4.service.introspect.main.exec_project(
+            name, ENQUEUE, qual_name=name)
+        return None
+
+    def prepare_job(self, cls=None, name=None, by=None, wait_for=None,
+                    **kwargs):
+        """
+        Instantiates and validates the job identified by the passed class or
+        :meth:`.qual_name` and sets the job properties for enqueuing.
+
+        :param cls: job class
+        :param name: job :meth:`.qual_name`
+        :param by: dict with ``enqueued`` attributes ``at``, ``hostname``,
+                   ``parent_id`` and ``username``, defaults to the current
+                   date/time, host and user
+        :param wait_for: list of job ``_id`` to wait for, defaults to the
+                         resolved job ``dependency``
+        :param kwargs: dict
+        :return: job object
+        """
         job = self.job_factory(name or cls, **kwargs)
+        self.check_cycle(job)
+        self.resolve_dependency(job, wait_for)
         # update job properties
         job.__dict__["attempts_left"] = getattr(job, "attempts")
         job.__dict__["state"] = STATE_PENDING
@@ -92,22 +227,344 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         job.__dict__["enqueued"] = {}
         for k in ("at", "hostname", "parent_id", "username"):
             job.__dict__["enqueued"][k] = by.get(k, enqueued_from[k]())
-        # save
-        doc = job.serialise()
+        return job
+
+    def check_cycle(self, job):
+        """
+        Raises :class:`.CoreJobCycle` if the ``dependency`` and ``chain``
+        properties of the passed job and of all jobs referenced form a cycle.
+        The graph leads from each job to its ``chain`` successors and from
+        each ``dependency`` to the dependant job.
+
+        :param job: :class:`.CoreJob` object
+        """
+        if not (job.chain or job.dependency):
+            return
+        graph = {}
+        seen = {job.qual_name()}
+        todo = [job]
+        while todo:
+            current = todo.pop()
+            name = current.qual_name()
+            graph.setdefault(name, set()).update(current.chain or [])
+            (names, _) = split_dependency(current.dependency)
+            for dep in names:
+                graph.setdefault(dep, set()).add(name)
+            for other in list(current.chain or []) + names:
+                if other not in seen:
+                    seen.add(other)
+                    try:
+                        todo.append(self.job_factory(other))
+                    except Exception:
+                        self.logger.debug("failed to load [%s]", other)
+        cycle = find_cycle(graph)
+        if cycle:
+            raise core4.error.CoreJobCycle(
+                "job [{}] in cycle [{}]".format(
+                    job.qual_name(), " > ".join(cycle)))
+
+    def resolve_dependency(self, job, wait_for=None):
+        """
+        Resolves the job ``dependency`` into the ``_id`` of all matching jobs
+        in ``sys.queue`` which are not requested to be removed. Sets job
+        attributes ``wait_for`` and ``blocked``, see :mod:`core4.queue.dag`.
+
+        :param job: :class:`.CoreJob` object
+        :param wait_for: list of job ``_id`` to wait for instead of the
+                         resolved ``dependency``, e.g. with
+                         :meth:`.restart_job`
+        """
+        if wait_for is None:
+            query = dependency_filter(job.dependency)
+            wait_for = []
+            if query is not None:
+                wait_for = [d["_id"] for d in self.config.sys.queue.find(
+                    query, projection=["_id"], sort=[("_id", 1)])]
+            blocked = list(wait_for)
+        elif wait_for:
+            alive = set([d["_id"] for d in self.config.sys.queue.find(
+                alive_filter(wait_for), projection=["_id"])])
+            blocked = [i for i in wait_for if i in alive]
+        else:
+            blocked = []
+        job.__dict__["wait_for"] = list(wait_for)
+        job.__dict__["blocked"] = blocked
+        if blocked:
+            self.logger.debug("job [%s] blocked by %s", job.qual_name(),
+                              blocked)
+
+    def settle_blocked(self, docs):
+        """
+        Verifies the ``blocked`` dependencies of the passed jobs after
+        insert into ``sys.queue``. Dependencies which left ``sys.queue``
+        before the insert completed are released. If the dependency has been
+        removed, then its dependants are removed, too.
+
+        :param docs: list of job documents inserted into ``sys.queue``
+        """
+        blocked = set([i for d in docs for i in d.get("blocked") or []])
+        if not blocked:
+            return
+        alive = set([d["_id"] for d in self.config.sys.queue.find(
+            alive_filter(blocked), projection=["_id"])])
+        gone = list(blocked - alive)
+        if gone:
+            removed = [d["_id"] for d in self.config.sys.journal.find(
+                removed_filter(gone), projection=["_id"])]
+            self.release_dependants([i for i in gone if i not in removed])
+            self.remove_dependants(removed)
+
+    def release_dependants(self, _id, session=None):
+        """
+        Releases all jobs in ``sys.queue`` waiting for the passed jobs to
+        complete.
+
+        :param _id: list of completed job ``_id``
+        :param session: :class:`pymongo.client_session.ClientSession`
+        """
+        if not _id:
+            return
+        ret = self.config.sys.queue.update_many(
+            {"blocked": {"$in": _id}},
+            update={"$pull": {"blocked": {"$in": _id}}},
+            session=session)
+        if ret.modified_count:
+            self.logger.debug("released [%d] dependants",
+                              ret.modified_count)
+
+    def remove_dependants(self, _id):
+        """
+        Requests to remove all jobs in ``sys.queue`` waiting for the passed
+        jobs, which will never complete. The dependants of the removed jobs
+        are removed with :meth:`.CoreWorker.remove_jobs`.
+
+        :param _id: list of removed job ``_id``
+        """
+        if not _id:
+            return
+        at = core4.util.node.now()
+        docs = list(self.config.sys.queue.find(
+            {"blocked": {"$in": _id}, "removed_at": None},
+            projection=SUMMARY_PROJECTION))
+        if not docs:
+            return
+        self.config.sys.queue.update_many(
+            {"_id": {"$in": [d["_id"] for d in docs]}, "removed_at": None},
+            update={"$set": {"removed_at": at}})
+        self.update_summary_many(
+            [(summary_bucket(d), summary_bucket(d, removed_at=at))
+             for d in docs])
+        self.logger.warning("flagged [%d] dependants of removed jobs to be "
+                            "removed at [%s]", len(docs), at)
+        self.make_stat('request_remove_job', [str(d["_id"]) for d in docs])
+
+    def enqueue_chain(self, job):
+        """
+        Enqueues the ``chain`` successors of the passed job, see
+        :mod:`core4.queue.dag`. The successors carry the ``_id`` of the
+        passed job in ``enqueued.parent_id``.
+
+        :param job: completed :class:`.CoreJob` object
+        :return: list of enqueued job objects
+        """
+        jobs = []
+        for name in job.chain or []:
+            try:
+                jobs.append(self.prepare_job(
+                    name=name, by={"parent_id": job._id}))
+            except ImportError:
+                self.exec_enqueue(name)
+            except Exception:
+                self.logger.error("failed to chain [%s] to [%s]", name,
+                                  job._id, exc_info=True)
+        return self.enqueue_many(jobs)
+
+    def map_job(self, parent, cls, iterable, chunksize=1000):
+        """
+        Enqueues the child jobs of the passed ``parent`` job with
+        :meth:`.enqueue_many` in chunks of ``chunksize`` jobs and initialises
+        the completion counter ``children`` of the parent, see
+        :mod:`core4.queue.fanout`. The children carry the ``_id`` of the
+        parent in ``enqueued.parent_id``. Children which already exist in
+        ``sys.queue`` are skipped.
+
+        :param parent: running :class:`.CoreJob` object
+        :param cls: child job class or :meth:`.qual_name`
+        :param iterable: of dict with child job arguments
+        :param chunksize: number of children enqueued at once
+        :return: number of enqueued children
+        """
+        core4.service.setup.CoreSetup().make_journal()
+        children = {
+            "total": 0,
+            "complete": 0,
+            "failed": 0,
+            "sealed": False,
+            "waiting": True
+        }
+        self.config.sys.queue.update_one(
+            {"_id": parent._id}, update={"$set": {"children": children}})
+        by = {"parent_id": parent._id}
+        total = 0
         try:
-            ret = self.config.sys.queue.insert_one(doc)
-        except pymongo.errors.DuplicateKeyError:
-            raise core4.error.CoreJobExists(
-                "job [{}] exists with args {}".format(
-                    job.qual_name(), job.args))
+            for chunk in chunked(iterable, chunksize):
+                jobs = [self.prepare_job(cls, by=by, **kwargs)
+                        for kwargs in chunk]
+                n = len(self.enqueue_many(jobs))
+                if n:
+                    self.config.sys.queue.update_one(
+                        {"_id": parent._id},
+                        update={"$inc": {"children.total": n}})
+                    total += n
         except:
+            self.config.sys.queue.update_one(
+                {"_id": parent._id}, update={"$unset": {"children": ""}})
             raise
-        job.__dict__["_id"] = ret.inserted_id
-        job.__dict__["identifier"] = ret.inserted_id
-        self.logger.info(
-            'successfully enqueued [%s] with [%s]', job.qual_name(), job._id)
-        self.make_stat('enqueue_job', str(job._id))
-        return job
+        self.config.sys.queue.update_one(
+            {"_id": parent._id},
+            update={"$set": {"children.sealed": True}})
+        children["total"] = total
+        children["sealed"] = True
+        parent.__dict__["children"] = children
+        self.logger.info("job [%s] mapped [%d] children", parent._id, total)
+        self.release_parent([parent._id])
+        return total
+
+    def count_children(self, docs, key):
+        """
+        Increments the completion counter of the parents of the passed child
+        jobs with a single ``bulk_write``. Parents with all children finished
+        are released with :meth:`.release_parent`.
+
+        :param docs: list of child job documents with ``enqueued``
+        :param key: counter to increment, ``complete`` or ``failed``
+        """
+        count = collections.Counter(
+            [(d.get("enqueued") or {}).get("parent_id") for d in docs])
+        count.pop(None, None)
+        if not count:
+            return
+        self.config.sys.queue.bulk_write(
+            [pymongo.UpdateOne(
+                {"_id": parent_id, "children": {"$ne": None}},
+                {"$inc": {"children." + key: n}})
+                for parent_id, n in count.items()],
+            ordered=False)
+        self.release_parent(list(count.keys()))
+
+    def release_parent(self, _id):
+        """
+        Releases the passed parent jobs if all their children finished. The
+        update matches only once per parent, so that the parent is woken up
+        exactly once.
+
+        :param _id: list of parent job ``_id``
+        """
+        ret = self.config.sys.queue.update_many(
+            {
+                "_id": {"$in": _id},
+                "children.waiting": True,
+                "children.sealed": True,
+                "$expr": {
+                    "$gte": [
+                        {"$add": ["$children.complete", "$children.failed"]},
+                        "$children.total"
+                    ]
+                }
+            },
+            update={
+                "$set": {
+                    "children.waiting": False,
+                    "query_at": core4.util.node.mongo_now()
+                }
+            })
+        if ret.modified_count:
+            self.logger.debug("released [%d] parents", ret.modified_count)
+
+    def acquire_semaphore(self, doc, identifier):
+        """
+        Acquires the cluster-wide semaphores of the passed job for the passed
+        worker, see :mod:`core4.queue.semaphore`. Each semaphore is acquired
+        with a single atomic update which fails if the number of holders
+        reached the job's limit. If any semaphore is exhausted, then all
+        semaphores acquired so far are released.
+
+        :param doc: job document with ``_id`` and ``semaphore``
+        :param identifier: of the worker claiming the job
+        :return: ``True`` if all semaphores have been acquired, else ``False``
+        """
+        acquired = []
+        for sem in doc.get("semaphore") or []:
+            try:
+                self.config.sys.semaphore.update_one(
+                    {
+                        "_id": sem["key"],
+                        "holder.{}".format(sem["limit"] - 1): {
+                            "$exists": False}
+                    },
+                    update={
+                        "$set": {"limit": sem["limit"]},
+                        "$push": {
+                            "holder": {
+                                "_id": doc["_id"],
+                                "worker": identifier,
+                                "at": core4.util.node.mongo_now()
+                            }
+                        }
+                    },
+                    upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                self.logger.debug("semaphore [%s] exhausted for job [%s]",
+                                  sem["key"], doc["_id"])
+                self.release_semaphore(doc["_id"], acquired)
+                return False
+            acquired.append(sem["key"])
+        return True
+
+    def release_semaphore(self, _id, key):
+        """
+        Releases the passed cluster-wide semaphores held by the passed job.
+
+        :param _id: job ``_id``
+        :param key: list of semaphore keys
+        """
+        if key:
+            self.config.sys.semaphore.update_many(
+                {"_id": {"$in": key}},
+                update={"$pull": {"holder": {"_id": _id}}})
+
+    def refresh_semaphore(self, identifier, _id):
+        """
+        Updates the heartbeat of all cluster-wide semaphores held by the
+        passed jobs of the passed worker. Holders of jobs no longer locked by
+        the worker are not refreshed and expire, see
+        :meth:`.expire_semaphore`.
+
+        :param identifier: of the worker
+        :param _id: list of job ``_id`` locked by the worker
+        """
+        if not _id:
+            return
+        self.config.sys.semaphore.update_many(
+            {"holder": {"$elemMatch": {"worker": identifier,
+                                       "_id": {"$in": _id}}}},
+            update={"$set": {"holder.$[h].at": core4.util.node.mongo_now()}},
+            array_filters=[{"h.worker": identifier, "h._id": {"$in": _id}}])
+
+    def expire_semaphore(self):
+        """
+        Releases all cluster-wide semaphores with a heartbeat older than
+        config ``semaphore.ttl`` seconds. These semaphores are held by jobs
+        of dead workers.
+        """
+        cutoff = core4.util.node.mongo_now() - timedelta(
+            seconds=self.config.semaphore.ttl)
+        ret = self.config.sys.semaphore.update_many(
+            {"holder.at": {"$lt": cutoff}},
+            update={"$pull": {"holder": {"at": {"$lt": cutoff}}}})
+        if ret.modified_count:
+            self.logger.warning("expired holders of [%d] semaphores",
+                                ret.modified_count)
 
     def job_factory(self, job, **kwargs):
         """
@@ -263,7 +720,7 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         :return: ``True`` if the request succeeded, else ``False``
         """
         at = core4.util.node.now()
-        ret = self.config.sys.queue.update_one(
+        doc = self.config.sys.queue.find_one_and_update(
             {
                 "_id": _id,
                 "removed_at": None
@@ -272,9 +729,12 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
                 "$set": {
                     "removed_at": at
                 }
-            }
+            },
+            projection=SUMMARY_PROJECTION
         )
-        if ret.raw_result["n"] == 1:
+        if doc is not None:
+            self.update_summary(summary_bucket(doc),
+                                summary_bucket(doc, removed_at=at))
             self.logger.warning(
                 "flagged job [%s] to be remove at [%s]", _id, at)
             self.make_stat('request_remove_job', str(_id))
@@ -297,7 +757,12 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         doc = self.config.sys.queue.find_one({"_id": _id})
         ret = self.config.sys.queue.delete_one({"_id": _id})
         if ret.raw_result["n"] == 1:
+            self.update_summary(src=summary_bucket(doc))
+            self.release_job(doc)
             self.journal(doc)
+            self.remove_dependants([_id])
+            if doc.get("state") not in STATE_STOPPED:
+                self.count_children([doc], "failed")
             self.logger.warning(
                 "hard removed and journaled job [%s]", _id)
             self.make_stat('hard_remove_job', str(_id))
@@ -335,8 +800,13 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
                 if doc is None:
                     raise core4.error.CoreJobNotFound(
                         "job [{}] not found".format(_id))
-                new_id, stderr = core4.service.introspect.main.exec_project(
-                    doc["name"], RESTART, job_id=str(doc["_id"]), comm=True)
+                if self.agent is not None:
+                    new_id = self.agent.call(
+                        doc["name"], "restart", job_id=str(doc["_id"]))
+                else:
+                    new_id, stderr = core4.service.introspect.main.exec_project(
+                        doc["name"], RESTART, job_id=str(doc["_id"]),
+                        comm=True)
             except:
                 raise
             if new_id:
@@ -376,17 +846,22 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
             if self.lock_job('__user__', _id):
                 ret = self.config.sys.queue.delete_one({"_id": _id})
                 if ret.raw_result["n"] == 1:
+                    self.update_summary(src=summary_bucket(job.serialise()))
                     enqueue = job.enqueued.copy()
                     enqueue["parent_id"] = job._id
                     enqueue["at"] = core4.util.node.mongo_now()
                     doc = dict([(k, v) for k, v in job.serialise().items() if
                                 k in core4.queue.job.ENQUEUE_ARGS])
                     new_job = self.enqueue(name=job.qual_name(), by=enqueue,
-                                           **doc)
+                                           wait_for=job.wait_for, **doc)
                     job.enqueued["child_id"] = new_job._id
+                    # dependants wait for the new job
+                    for attr in ("wait_for", "blocked"):
+                        self.config.sys.queue.update_many(
+                            {attr: _id},
+                            update={"$set": {attr + ".$": new_job._id}})
                     self.journal(job.serialise())
                     self.make_stat('restart_stopped', str(_id))
-                    self.unlock_job(_id)
                     return new_job._id
         return None
 
@@ -400,7 +875,7 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         :return: ``True`` if the request succeeded, else ``False``
         """
         at = core4.util.node.now()
-        ret = self.config.sys.queue.update_one(
+        doc = self.config.sys.queue.find_one_and_update(
             {
                 "_id": _id,
                 "killed_at": None,
@@ -410,43 +885,63 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
                 "$set": {
                     "killed_at": at
                 }
-            }
+            },
+            projection=SUMMARY_PROJECTION
         )
+        if doc is not None:
+            self.update_summary(summary_bucket(doc),
+                                summary_bucket(doc, killed_at=at))
         self.make_stat('request_kill_job', str(_id))
-        if ret.raw_result["n"] == 1:
+        if doc is not None:
             self.logger.warning(
                 "flagged job [%s] to be killed at [%s]", _id, at)
             return True
         self.logger.error("failed to flag job [%s] to be killed", _id)
         return False
 
+    def make_lock(self, identifier, at=None):
+        """
+        Creates the ``locked`` attribute of a job reserved by the passed
+        ``identifier``.
+
+        :param identifier: to assign to the reservation
+        :param at: reservation date/time, defaults to now
+        :return: dict
+        """
+        at = at or core4.util.node.mongo_now()
+        return {
+            "at": at,
+            "heartbeat": at,
+            "hostname": core4.util.node.get_hostname(),
+            "pid": None,
+            "worker": identifier
+        }
+
     def lock_job(self, identifier, _id):
         """
-        Reserve the job for exclusive processing. This method utililses
-        collection ``sys.lock``.
+        Reserve the job for exclusive processing. The reservation is embedded
+        in the job's ``locked`` attribute in ``sys.queue``.
 
         :param identifier: to assign to the reservation
         :param _id: job ``_id``
         :return: ``True`` if reservation succeeded, else ``False``
         """
-        try:
-            self.config.sys.lock.insert_one({"_id": _id, "owner": identifier})
-            return True
-        except pymongo.errors.DuplicateKeyError:
-            return False
-        except:
-            raise
+        ret = self.config.sys.queue.update_one(
+            {"_id": _id, "locked": None},
+            update={"$set": {"locked": self.make_lock(identifier)}})
+        return ret.modified_count == 1
 
     def unlock_job(self, _id):
         """
-        Release/unlock the job from ``sys.lock``.
+        Release/unlock the job by resetting its ``locked`` attribute.
 
-        :param _id: :class:`bson.object.ObjectId`
+        :param _id: :class:`bson.objectid.ObjectId`
         :return: ``True`` if the job has been successfully released, else
                  ``False``
         """
-        ret = self.config.sys.lock.delete_one({"_id": _id})
-        if ret.raw_result["n"] == 1:
+        ret = self.config.sys.queue.update_one(
+            {"_id": _id}, update={"$set": {"locked": None}})
+        if ret.matched_count == 1:
             self.logger.debug('successfully released [%s]', _id)
             return True
         self.logger.error('failed to release [%s]', _id)
@@ -468,6 +963,95 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
             raise
         return False
 
+    def journal_many(self, docs):
+        """
+        Moves the passed MongoDB documents from collection ``sys.queue`` into
+        ``sys.journal`` with a single ``insert_many`` and a single
+        ``delete_many``. Dependants of completed jobs are released with the
+        same transition, see :meth:`.release_dependants`. All statements run
+        in a multi-document transaction if supported by the MongoDB
+        deployment, see :meth:`.supports_transaction`. Documents which fail
+        to journal are not removed from ``sys.queue``. Dependants of journaled
+        jobs which did not complete are removed, see
+        :meth:`.remove_dependants`. Removed children count as ``failed`` for
+        their parent, see :meth:`.count_children`.
+
+        :param docs: list of dict (MongoDB documents)
+        :return: list of ``_id`` of the journaled documents
+        """
+        if not docs:
+            return []
+        journaled = None
+        if self.supports_transaction():
+            client = self.config.sys.queue.connection
+            try:
+                with client.start_session() as session:
+                    with session.start_transaction():
+                        journaled = self._journal_many(docs, session)
+            except pymongo.errors.PyMongoError as exc:
+                self.logger.warning(
+                    "failed to journal [%d] jobs in transaction, "
+                    "retry without: %s", len(docs), exc)
+                journaled = None
+        if journaled is None:
+            journaled = self._journal_many(docs)
+        done = set(journaled)
+        self.remove_dependants(
+            [d["_id"] for d in docs
+             if d["_id"] in done and d.get("state") != STATE_COMPLETE])
+        # stopped children have been counted before
+        self.count_children(
+            [d for d in docs if d["_id"] in done
+             and d.get("state") != STATE_COMPLETE
+             and d.get("state") not in STATE_STOPPED], "failed")
+        return journaled
+
+    def _journal_many(self, docs, session=None):
+        # internal method used by .journal_many, within a transaction
+        #   all documents must be journaled
+        failed = set()
+        try:
+            self.config.sys.journal.insert_many(
+                docs, ordered=False, session=session)
+        except pymongo.errors.BulkWriteError as exc:
+            if session is not None:
+                raise
+            for error in exc.details["writeErrors"]:
+                _id = docs[error["index"]]["_id"]
+                failed.add(_id)
+                self.logger.error("failed to journal job [%s]: %s", _id,
+                                  error["errmsg"])
+        journaled = [d["_id"] for d in docs if d["_id"] not in failed]
+        if journaled:
+            self.config.sys.queue.delete_many(
+                {"_id": {"$in": journaled}}, session=session)
+            self.release_dependants(
+                [d["_id"] for d in docs if d["_id"] not in failed
+                 and d.get("state") == STATE_COMPLETE], session)
+        return journaled
+
+    def supports_transaction(self):
+        """
+        Tests if the MongoDB deployment of ``sys.queue`` and ``sys.journal``
+        supports multi-document transactions. This requires both collections
+        to share the same connection to a replica set (MongoDB 4.0) or a
+        sharded cluster (MongoDB 4.2).
+
+        :return: ``True`` if transactions are supported, else ``False``
+        """
+        if self._transaction is None:
+            client = self.config.sys.queue.connection
+            if client is not self.config.sys.journal.connection:
+                self._transaction = False
+            else:
+                info = client.admin.command("ismaster")
+                wire = info.get("maxWireVersion", 0)
+                self._transaction = bool(
+                    ("setName" in info and wire >= 7)
+                    or (info.get("msg") == "isdbgrid" and wire >= 8))
+            self.logger.debug("transaction support [%s]", self._transaction)
+        return self._transaction
+
     def _find_job(self, _id, collection):
         # internal method used by .load_job and .find_job
         doc = collection.find_one({"_id": _id})
@@ -492,7 +1076,7 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         Queries the job with the passed ``_id`` from collection ``sys.queue``
         or ``sys.journal``. This method retrieves all known jobs including
         operating jobs from ``sys.queue`` as well as ceased jobs from
-        ``sys.journal``.
+        ``sys.journal`` and from the archive, see :mod:`core4.queue.archive`.
 
         :param _id: job ``_id``
         :return: :class:`.CoreJob` object
@@ -500,29 +1084,87 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         try:
             return self.load_job(_id)
         except core4.error.CoreJobNotFound:
+            pass
+        try:
             return self._find_job(_id, self.config.sys.journal)
-        except:
-            raise
+        except core4.error.CoreJobNotFound:
+            doc = CoreArchive().find_one(_id)
+            if doc is None:
+                raise
+        return self.job_factory(doc["name"]).deserialise(**doc)
 
     def _finish(self, job, state):
-        # internal method used to set the most relevant job attributes
+        # internal method used to set the most relevant job attributes, to
+        #   release the cluster-wide semaphores of the job and to count the
+        #   execution in sys.rollup
+        doc = {
+            "_id": job._id,
+            "name": job.qual_name(),
+            "semaphore": job.semaphore,
+            "locked": job.locked
+        }
         job.__dict__["state"] = state
         job.__dict__["finished_at"] = core4.util.node.mongo_now()
         runtime = (job.finished_at - job.started_at).total_seconds()
         job.__dict__["runtime"] = (job.runtime or 0.) + runtime
         job.__dict__["locked"] = None
+        self.release_job(doc, state, job.finished_at, runtime)
         return runtime
 
+    def release_job(self, doc, state=None, at=None, runtime=None):
+        """
+        Releases the cluster-wide semaphores held by the passed job and counts
+        the execution ending in the passed state in ``sys.rollup``. This
+        method is used with every transition of a claimed job.
+
+        :param doc: job document with ``_id``, ``name``, ``semaphore`` and
+                    ``locked``
+        :param state: the job state of the finished execution, ``None`` does
+                      not count the execution
+        :param at: date/time of the transition, defaults to now
+        :param runtime: the execution time in seconds
+        """
+        self.release_semaphore(
+            doc["_id"], [s["key"] for s in doc.get("semaphore") or []])
+        if state is not None:
+            self.update_rollup(
+                doc["name"], (doc.get("locked") or {}).get("worker"),
+                at or core4.util.node.mongo_now(), state=state,
+                runtime=runtime)
+
+    def update_rollup(self, name, worker, at, **kwargs):
+        """
+        Counts a job transition in the ``sys.rollup`` document of the passed
+        job name, worker and minute, see :mod:`core4.queue.rollup`.
+
+        :param name: job :meth:`.qual_name`
+        :param worker: identifier of the worker executing the job
+        :param at: date/time of the transition
+        :param kwargs: ``started``, ``wait``, ``state`` and ``runtime``, see
+                       :func:`.rollup_update`
+        """
+        key = {"minute": floor_minute(at), "name": name, "worker": worker}
+        update = rollup_update(**kwargs)
+        try:
+            self.config.sys.rollup.update_one(key, update=update, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # concurrent upsert of the same minute
+            self.config.sys.rollup.update_one(key, update=update)
+
     def _update_job(self, job, *args):
         # internal method used to update the most relevant and passed
         #   job attributes
-        ret = self.config.sys.queue.update_one(
+        update = dict([(k, getattr(job, k)) for k in args])
+        doc = self.config.sys.queue.find_one_and_update(
             filter={"_id": job._id},
-            update={"$set": dict([(k, getattr(job, k)) for k in args])})
-        if ret.raw_result["n"] != 1:
+            update={"$set": update},
+            projection=SUMMARY_PROJECTION)
+        if doc is None:
             raise RuntimeError(
-                "failed to update job [{}] state [%s]".format(
+                "failed to update job [{}] state [{}]".format(
                     job._id, job.state))
+        self.update_summary(summary_bucket(doc),
+                            summary_bucket(doc, **update))
 
     def _add_exception(self, job):
         # internal method used to add exception information to .last_error
@@ -533,42 +1175,73 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
             "traceback": traceback.format_exception(*exc_info)
         }
 
-    def set_complete(self, job, unlock=True):
+    def set_complete(self, job):
         """
         Set the passed ``job`` to state ``complete`` and move the job from
         ``sys.queue`` to ``sys.journal``.
 
         This process updates the job ``state``, ``finished_at`` timestamp, the
         ``runtime``, increases the number of ``trial``s and resets the
-        ``locked`` property.
-
-        Finally, the job lock is removed from ``sys.lock``
+        ``locked`` property which releases the job lock. The ``chain``
+        successors are enqueued before the job is journaled and its
+        dependants are released, see :mod:`core4.queue.dag`. The job's
+        ``result`` is saved and the completion counter of the parent job is
+        incremented, see :mod:`core4.queue.fanout`. The measured ``usage``
+        updates the learned requirement of the job, see
+        :meth:`.learn_requirement`.
 
         :param job: :class:`.CoreJob` object
         """
         self.logger.debug(
             "updating job [%s] to [%s]", job._id,
             core4.queue.job.STATE_COMPLETE)
+        state = job.state
         runtime = self._finish(job, core4.queue.job.STATE_COMPLETE)
-        self._update_job(job, "state", "finished_at", "runtime", "locked",
-                         "trial")
+        doc = self.config.sys.queue.find_one_and_update(
+            filter={"_id": job._id},
+            update={"$set": dict([
+                (k, getattr(job, k)) for k in (
+                    "state", "finished_at", "runtime", "locked", "trial",
+                    "result", "usage")])},
+            return_document=pymongo.ReturnDocument.AFTER)
+        if doc is None:
+            raise RuntimeError(
+                "failed to update job [{}] state [{}]".format(
+                    job._id, job.state))
+        self.update_summary(summary_bucket(doc, state=state),
+                            summary_bucket(doc))
+        self.enqueue_chain(job)
         self.logger.debug("journaling job [%s]", job._id)
-        job = self.load_job(job._id)
-        if self.journal(job.serialise()):
-            self.logger.debug("removing completed job [%s]", job._id)
-            ret = self.config.sys.queue.delete_one(filter={"_id": job._id})
-            if ret.deleted_count != 1:
-                raise RuntimeError(
-                    "failed to remove job [{}] from queue".format(job._id))
+        if self.journal_many([doc]):
+            self.count_children([doc], "complete")
+            self.learn_requirement(job)
             self.make_stat('complete_job', str(job._id))
-            if unlock:
-                self.unlock_job(job._id)
             job.logger.info("done execution with [complete] "
                             "after [%d] sec.", runtime)
         else:
             self.logger.error(
                 "failed to journal and set job [%s] complete", job._id)
 
+    def learn_requirement(self, job):
+        """
+        Updates the learned ``requirement`` of the passed job in ``sys.job``
+        with the measured ``usage`` of the job, see
+        :mod:`core4.queue.placement`. The learned value decays with config
+        ``worker.requirement_decay`` per execution.
+
+        :param job: completed :class:`.CoreJob` object
+        """
+        if not job.usage:
+            return
+        name = job.qual_name()
+        doc = self.config.sys.job.find_one(
+            {"_id": name}, projection=["requirement"])
+        requirement = learn((doc or {}).get("requirement"), job.usage,
+                            self.config.worker.requirement_decay)
+        self.config.sys.job.update_one(
+            {"_id": name}, update={"$set": {"requirement": requirement}},
+            upsert=True)
+
     def set_defer(self, job):
         """
         Set the passed ``job`` to state ``deferred`` and updates the next
@@ -579,9 +1252,7 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         The method updates the job ``state``, ``finished_at`` timestamp, the
         ``runtime``, increases the number of ``trial``s, the exception message
         in ``last_error``, the ``query_at`` timestamp and resets the ``locked``
-        property.
-
-        Finally, the job lock is removed from ``sys.lock``
+        property which releases the job lock.
 
         :param job: :class:`.CoreJob` object
         """
@@ -592,13 +1263,36 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         runtime = self._finish(job, state)
         self._add_exception(job)
         self._update_job(job, "state", "finished_at", "runtime", "locked",
-                         "last_error", "query_at", "trial")
+                         "last_error", "query_at", "trial", "usage")
         self.make_stat('defer_job', str(job._id))
-        self.unlock_job(job._id)
         job.logger.info("done execution with [deferred] "
                         "after [%d] sec. and [%s] to go: %s", runtime,
                         job.inactive_at - now, job.last_error["exception"])
 
+    def set_waiting(self, job):
+        """
+        Set the passed ``job`` waiting for its children launched with
+        :meth:`.CoreJob.map`. The job is in state ``deferred`` without
+        ``query_at`` and ``inactive_at`` and is not claimed until the last
+        child finished, see :meth:`.release_parent`.
+
+        :param job: :class:`.CoreJob` object
+        """
+        state = core4.queue.job.STATE_DEFERRED
+        job.__dict__["query_at"] = None
+        job.__dict__["inactive_at"] = None
+        self.logger.debug("updating job [%s] to [%s] waiting", job._id, state)
+        runtime = self._finish(job, state)
+        self._add_exception(job)
+        self._update_job(job, "state", "finished_at", "runtime", "locked",
+                         "last_error", "query_at", "inactive_at", "trial",
+                         "usage")
+        # children might have finished before the job released its lock
+        self.release_parent([job._id])
+        self.make_stat('defer_job', str(job._id))
+        job.logger.info("done execution with [deferred] after [%d] sec.: %s",
+                        runtime, job.last_error["exception"])
+
     def set_failed(self, job):
         """
         If the passed job has ``.attempts_left``, then set the job state to
@@ -607,10 +1301,9 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
 
         The method additionally updates the job ``state``, ``finished_at``
         timestamp, the ``runtime``, increases the number of ``trial``s, and
-        resets the  ``locked`` property. Furthermore, the ``last_error``
-        property carries exception information.
-
-        Finally, the job lock is removed from ``sys.lock``
+        resets the  ``locked`` property which releases the job lock.
+        Furthermore, the ``last_error`` property carries exception
+        information.
 
         :param job: :class:`.CoreJob` object
         """
@@ -624,9 +1317,11 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         runtime = self._finish(job, state)
         self._add_exception(job)
         self._update_job(job, "state", "finished_at", "runtime", "locked",
-                         "last_error", "attempts_left", "query_at", "trial")
+                         "last_error", "attempts_left", "query_at", "trial",
+                         "usage")
+        if state == core4.queue.job.STATE_ERROR:
+            self.count_children([job.serialise()], "failed")
         self.make_stat('{}_job'.format(state), str(job._id))
-        self.unlock_job(job._id)
         job.logger.critical("done execution with [%s] "
                             "after [%d] sec. and [%d] attempts to go: %s\n%s",
                             state, runtime, job.attempts_left,
@@ -637,13 +1332,22 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         """
         Kill the job of the passed MongoDB doc with a valid ``_id`` and
         ``name``. Uses :meth:`._exec_kill` directly or with the Python virtual
-        environment if :meth:`.exec_kill` raises an ``ImportError``.
+        environment if :meth:`.exec_kill` raises an ``ImportError``. The
+        project agent is used if attached (see :class:`.CoreAgentPool`).
 
         :param doc: valid ``sys.queue`` document of the job to be killed
         """
         try:
             self._exec_kill(doc["_id"])
         except ImportError:
+            if self.agent is not None:
+                try:
+                    self.agent.call(doc["name"], "kill",
+                                    job_id=str(doc["_id"]))
+                    return
+                except Exception as exc:
+                    self.logger.error("failed to kill job [%s] with agent: %s",
+                                      str(doc["_id"]), exc)
             core4.service.introspect.main.exec_project(
                 doc["name"], KILL, job_id=str(doc["_id"]))
         except Exception:
@@ -661,10 +1365,9 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
 
         The method updates the job ``state``, ``finished_at``
         timestamp, the ``runtime``, increases the number of ``trial``s, and
-        resets the  ``locked`` property. Furthermore, the ``last_error``
-        property carries a ``JobKilledByWorker`` flag.
-
-        Finally, the job lock is removed from ``sys.lock``
+        resets the  ``locked`` property which releases the job lock.
+        Furthermore, the ``last_error`` property carries a
+        ``JobKilledByWorker`` flag.
 
         :param job: :class:`.CoreJob` object
         """
@@ -680,15 +1383,75 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         job.__dict__["removed_at"] = None
         self._update_job(job, "state", "runtime", "locked",
                          "trial", "last_error", "removed_at")
+        self.count_children([job.serialise()], "failed")
         self.make_stat('kill_job', str(job._id))
-        self.unlock_job(job._id)
         job.logger.error("done execution with [%s] after [%d] sec.",
                          job.state, runtime)
 
+    def update_summary(self, src=None, dst=None):
+        """
+        Moves a job from the ``src`` to the ``dst`` bucket in
+        ``sys.summary``, see :func:`.summary_ops`.
+
+        :param src: tuple of job ``name``, ``state`` and ``flags`` before the
+                    change, ``None`` for new jobs
+        :param dst: tuple of job ``name``, ``state`` and ``flags`` after the
+                    change, ``None`` for removed jobs
+        """
+        ops = summary_ops(src, dst)
+        if ops:
+            self.config.sys.summary.bulk_write(ops, ordered=False)
+
+    def update_summary_many(self, moves):
+        """
+        Moves multiple jobs between ``sys.summary`` buckets with a single
+        ``bulk_write``, see :meth:`.update_summary`.
+
+        :param moves: list of tuples ``(src, dst)``
+        """
+        ops = []
+        for (src, dst), n in collections.Counter(moves).items():
+            ops += summary_ops(src, dst, n)
+        if ops:
+            self.config.sys.summary.bulk_write(ops, ordered=False)
+
+    def reconcile_summary(self):
+        """
+        Rebuilds ``sys.summary`` from ``sys.queue``. This repairs any drift
+        between the incrementally maintained counts and the actual job
+        states, e.g. after a process died between updating ``sys.queue``
+        and ``sys.summary``.
+
+        :return: number of jobs in ``sys.queue`` which are not complete
+        """
+        docs = {}
+        count = {}
+        for doc in self.config.sys.queue.aggregate(
+                self.pipeline_queue_state()):
+            flags = "".join([k[0].upper() if doc[k] else "."
+                             for k in ["zombie", "wall", "removed", "killed"]])
+            _id = "state:{}:{}:{}".format(doc["state"], flags, doc["name"])
+            docs[_id] = make_summary_state(
+                doc["name"], doc["state"], flags, doc["n"])
+            count[doc["state"]] = count.get(doc["state"], 0) + doc["n"]
+        for state, n in count.items():
+            docs["count:{}".format(state)] = {
+                "kind": "count", "state": state, "n": n}
+        ops = [pymongo.ReplaceOne({"_id": k}, v, upsert=True)
+               for k, v in docs.items()]
+        ops.append(pymongo.DeleteMany({"_id": {"$nin": list(docs.keys())}}))
+        self.config.sys.summary.bulk_write(ops, ordered=False)
+        total = sum(count.values())
+        self.logger.info("reconciled [%d] summary records of [%d] jobs",
+                         len(docs), total)
+        return total
+
     def make_stat(self, event, _id):
         """
-        Collects current job state counts from ``sys.queue`` and inserts a
-        record into ``sys.event``.
+        Collects current job state counts from ``sys.summary`` and inserts a
+        record into ``sys.event``. Pass a list of ``_id`` to insert a single
+        record for a batch of jobs. The record then carries the list of job
+        ``_id``.
 
         The following events are tracked in ``sys.event``:
 
@@ -708,6 +1471,41 @@ class CoreQueue(CoreBase, QueryMixin, metaclass=core4.util.tool.Singleton):
         * ``request_kill_job``
         * ``kill_job``
         * ``remove_job``
+
+        The job state counts are rolled up into ``sys.queue_history``, see
+        :func:`.write_history`.
         """
+        queue = self.get_queue_count()
+        if isinstance(_id, tuple):
+            _id = list(_id)
         self.trigger(name=event, channel=core4.const.QUEUE_CHANNEL,
-                     data={"_id": _id, "queue": self.get_queue_count()})
+                     data={"_id": _id, "queue": queue})
+        self._history = write_history(
+            self.config.sys.queue_history, core4.util.node.mongo_now(), queue,
+            self._history)
+
+    def update_history(self, ops):
+        """
+        Executes the passed ``sys.queue_history`` update statements, see
+        :func:`.history_ops`. Duplicate key errors of rollups with a higher
+        or equal total are ignored.
+
+        :param ops: list of :class:`pymongo.UpdateOne`
+        """
+        bulk_write_history(self.config.sys.queue_history, ops)
+
+    def backfill_history(self):
+        """
+        Rolls up the job state counts of all ``sys.event`` queue events into
+        ``sys.queue_history``, see :mod:`core4.queue.history`.
+
+        :return: number of rollups
+        """
+        cur = self.config.sys.event.find(
+            {"channel": core4.const.QUEUE_CHANNEL},
+            projection={"created": 1, "data.queue": 1},
+            sort=[("$natural", 1)])
+        ops = history_backfill(cur)
+        self.update_history(ops)
+        self.logger.info("backfilled [%d] queue history rollups", len(ops))
+        return len(ops)
@@ -0,0 +1,253 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the main loop instrumentation of :class:`.CoreDaemon`.
+
+Each daemon carries a :class:`.CoreMetric` object which times the steps of
+the main loop, e.g. :meth:`.CoreWorker.work_jobs`, into in-process
+:class:`.Histogram` objects. All MongoDB commands issued by the daemon's
+main thread are timed into a histogram per step and command name with the
+:class:`.CommandTimer` listener of :mod:`pymongo.monitoring`. The daemon
+attaches the listener to its MongoDB connections with
+:func:`core4.base.connector.mongo.add_listener`. Importing this module does
+not register any listener.
+
+The daemon publishes count, sum, maximum and the 50th, 95th and 99th
+percentile of all histograms into ``sys.worker`` attribute ``metric`` every
+``daemon.metric`` seconds and resets the histograms. Use
+:meth:`.QueryMixin.get_metric` to retrieve the published metrics and
+:func:`format_metric` to render them in Prometheus text format.
+
+Histograms use fixed buckets with a resolution of 19% from 10 microseconds
+to 2 minutes. Recording a value costs a binary search and three additions
+only. Percentiles are estimated with :func:`core4.queue.rollup.percentile`
+like the queue rollups.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+import pymongo.monitoring
+
+from core4.queue.rollup import PERCENTILE, percentile
+
+#: upper bounds of the histogram buckets in seconds
+BUCKET = tuple(1e-5 * 2 ** (i / 4.) for i in range(96))
+
+_local = threading.local()
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram of durations in seconds.
+    """
+
+    def __init__(self):
+        self.bucket = [0] * (len(BUCKET) + 1)
+        self.n = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        """
+        Records the passed duration.
+
+        :param value: duration in seconds
+        """
+        self.bucket[bisect.bisect_left(BUCKET, value)] += 1
+        self.n += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Estimates the passed percentile, see
+        :func:`core4.queue.rollup.percentile`.
+
+        :param p: percentile between 0 and 100
+        :return: duration in seconds or ``None`` if no duration has been
+                 recorded
+        """
+        return percentile(self.bucket, p, self.max, BUCKET)
+
+    def to_doc(self):
+        """
+        :return: dict with count ``n``, ``sum``, ``max`` and the
+                 :data:`PERCENTILE` as ``p50``, ``p95`` and ``p99``
+        """
+        doc = {"n": self.n, "sum": self.sum, "max": self.max}
+        for p in PERCENTILE:
+            doc["p{}".format(p)] = self.percentile(p)
+        return doc
+
+
+class CoreMetric:
+    """
+    Collects the step and MongoDB command histograms of a daemon.
+
+    Usage::
+
+        metric = CoreMetric()
+        with metric.timer("work_jobs"):
+            self.work_jobs()
+        doc = metric.to_doc()
+    """
+
+    def __init__(self):
+        self.step = {}
+        self.mongo = {}
+        self.since = time.time()
+
+    def reset(self):
+        """
+        Discards all histograms.
+        """
+        self.step = {}
+        self.mongo = {}
+        self.since = time.time()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Times the enclosed block into the histogram of step ``name``. MongoDB
+        commands issued by the current thread inside the block are timed into
+        the command histograms of step ``name``.
+
+        :param name: step name
+        """
+        previous = getattr(_local, "scope", None)
+        _local.scope = (self, name)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+            _local.scope = previous
+
+    def observe(self, name, value):
+        """
+        Records the passed duration into the histogram of step ``name``.
+
+        :param name: step name
+        :param value: duration in seconds
+        """
+        hist = self.step.get(name)
+        if hist is None:
+            hist = self.step[name] = Histogram()
+        hist.observe(value)
+
+    def observe_command(self, name, command, value):
+        """
+        Records the passed duration into the histogram of MongoDB ``command``
+        in step ``name``.
+
+        :param name: step name
+        :param command: MongoDB command name, e.g. ``find``
+        :param value: duration in seconds
+        """
+        step = self.mongo.get(name)
+        if step is None:
+            step = self.mongo[name] = {}
+        hist = step.get(command)
+        if hist is None:
+            hist = step[command] = Histogram()
+        hist.observe(value)
+
+    def to_doc(self):
+        """
+        :return: dict with ``step`` histograms by step name, ``mongo``
+                 histograms by step and command name and the ``interval`` in
+                 seconds covered by the histograms
+        """
+        return {
+            "interval": time.time() - self.since,
+            "step": dict((k, v.to_doc()) for k, v in self.step.items()),
+            "mongo": dict((k, dict((c, h.to_doc()) for c, h in v.items()))
+                          for k, v in self.mongo.items())
+        }
+
+
+class CommandTimer(pymongo.monitoring.CommandListener):
+    """
+    Times all MongoDB commands issued inside :meth:`.CoreMetric.timer` into
+    the command histograms of the current step. Commands of other threads
+    and outside of any step are ignored.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event)
+
+    def failed(self, event):
+        self._observe(event)
+
+    @staticmethod
+    def _observe(event):
+        scope = getattr(_local, "scope", None)
+        if scope is not None:
+            (metric, name) = scope
+            metric.observe_command(name, event.command_name,
+                                   event.duration_micros / 1e6)
+
+
+#: the command listener attached by :class:`.CoreDaemon`
+COMMAND_TIMER = CommandTimer()
+
+
+def _label(**kwargs):
+    return ",".join('{}="{}"'.format(k, v) for k, v in kwargs.items())
+
+
+def _format_histogram(lines, metric, hist, **kwargs):
+    for p in PERCENTILE:
+        if hist.get("p{}".format(p)) is not None:
+            lines.append("{}{{{}}} {:.6f}".format(
+                metric, _label(quantile="{:.2f}".format(p / 100.), **kwargs),
+                hist["p{}".format(p)]))
+    lines.append("{}_max{{{}}} {:.6f}".format(
+        metric, _label(**kwargs), hist["max"]))
+    lines.append("{}_sum{{{}}} {:.6f}".format(
+        metric, _label(**kwargs), hist["sum"]))
+    lines.append("{}_count{{{}}} {:d}".format(
+        metric, _label(**kwargs), hist["n"]))
+
+
+def format_metric(docs):
+    """
+    Renders the published metrics of the passed daemons in Prometheus text
+    exposition format with summaries ``core4_step_seconds`` and
+    ``core4_mongo_seconds``.
+
+    :param docs: list of dict with daemon ``_id`` and ``metric`` as
+                 delivered by :meth:`.QueryMixin.get_metric`
+    :return: str
+    """
+    step = []
+    mongo = []
+    for doc in docs:
+        metric = doc.get("metric") or {}
+        for name, hist in sorted((metric.get("step") or {}).items()):
+            _format_histogram(step, "core4_step_seconds", hist,
+                              daemon=doc["_id"], step=name)
+        for name, command in sorted((metric.get("mongo") or {}).items()):
+            for cmd, hist in sorted(command.items()):
+                _format_histogram(mongo, "core4_mongo_seconds", hist,
+                                  daemon=doc["_id"], step=name, command=cmd)
+    lines = [
+        "# HELP core4_step_seconds daemon main loop step duration",
+        "# TYPE core4_step_seconds summary"
+    ] + step + [
+        "# HELP core4_mongo_seconds MongoDB command duration by daemon step",
+        "# TYPE core4_mongo_seconds summary"
+    ] + mongo
+    return "\n".join(lines) + "\n"
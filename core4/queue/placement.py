@@ -0,0 +1,94 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the helpers of resource-aware job placement of
+:class:`.CoreWorker`.
+
+Jobs declare their expected resource requirements with job properties
+
+* ``memory`` - the expected peak memory in MB
+* ``cpu`` - the expected number of CPU cores
+
+Jobs without declared requirements use the requirements learned from
+previous executions. :class:`.CoreWorkerProcess` measures the peak memory and
+the average number of CPU cores used by each job and saves them in job
+attribute ``usage``, see :mod:`core4.queue.usage`. With each completion
+:meth:`.CoreQueue.learn_requirement` updates the learned ``requirement`` of
+the job in ``sys.job`` with :func:`learn`.
+
+The worker reserves the requirements of all jobs it runs. It claims only jobs
+which fit into its free capacity. The free memory is the lower of the
+measured free memory and the total memory less all reservations, both less
+``worker.min_free_ram``. The free CPU is the number of CPU cores less all
+reservations. Each claim reduces the free capacity of the next claim. Jobs
+with ``force`` ignore the free capacity.
+"""
+
+#: job properties with resource requirements
+REQUIREMENT = ("memory", "cpu")
+
+
+def learn(requirement, usage, decay):
+    """
+    Updates the passed learned requirement with the measured usage of a job
+    execution. The learned value follows the peak usage and decays with each
+    execution below the peak.
+
+    :param requirement: dict with learned ``memory`` and ``cpu`` or ``None``
+    :param usage: dict with measured ``memory`` and ``cpu``
+    :param decay: factor applied to the learned value with each execution
+    :return: dict with learned ``memory`` and ``cpu``
+    """
+    requirement = requirement or {}
+    ret = {}
+    for key in REQUIREMENT:
+        value = usage.get(key)
+        if value is None:
+            value = 0.
+        ret[key] = round(max(value, decay * (requirement.get(key) or 0.)), 3)
+    return ret
+
+
+def reserved_capacity(running, learned):
+    """
+    Sums up the requirements of the running jobs.
+
+    :param running: list of dict with the job name in ``_id``, the sum of
+                    declared requirements and the number of jobs without
+                    declared requirement per key, e.g. ``memory`` and
+                    ``memory_none``
+    :param learned: dict of job name (key) and learned requirement (value)
+    :return: dict with reserved ``memory`` and ``cpu``
+    """
+    ret = dict.fromkeys(REQUIREMENT, 0.)
+    for doc in running:
+        for key in REQUIREMENT:
+            ret[key] += doc.get(key) or 0.
+            ret[key] += (doc.get(key + "_none") or 0) * (
+                learned.get(doc["_id"], {}).get(key) or 0.)
+    return ret
+
+
+def capacity_filter(free, learned):
+    """
+    Delivers the ``sys.queue`` filter of jobs which fit into the passed free
+    capacity or have ``force``.
+
+    :param free: dict with free ``memory`` and ``cpu``
+    :param learned: dict of job name (key) and learned requirement (value)
+    :return: dict with MongoDB filter statement
+    """
+    fit = []
+    for key in REQUIREMENT:
+        exceed = sorted([name for name, req in learned.items()
+                         if (req.get(key) or 0.) > free[key]])
+        undeclared = {key: None}
+        if exceed:
+            undeclared["name"] = {"$nin": exceed}
+        fit.append({"$or": [{key: {"$lte": free[key]}}, undeclared]})
+    return {"$or": [{"force": True}, {"$and": fit}]}
@@ -9,14 +9,11 @@
 This module implements the core4 job process spawned by :class:`.CoreWorker`.
 """
 
-import ctypes
-import io
-import os
 import sys
-import tempfile
 import traceback
 
 import datetime
+import bson
 from bson.objectid import ObjectId
 
 import core4.base.main
@@ -25,10 +22,9 @@ import core4.logger.mixin
 import core4.queue.job
 import core4.queue.main
 import core4.util.node
-
-libc = ctypes.CDLL(None)
-c_stdout = ctypes.c_void_p.in_dll(libc, 'stdout')
-c_stderr = ctypes.c_void_p.in_dll(libc, 'stderr')
+from core4.queue.query import SUMMARY_PROJECTION, summary_bucket
+from core4.queue.stdout import StdoutCapture
+from core4.queue.usage import measure, snapshot
 
 
 class CoreWorkerProcess(core4.base.main.CoreBase,
@@ -38,11 +34,11 @@ class CoreWorkerProcess(core4.base.main.CoreBase,
     ``sys.queue``, drops user privileges,
     :meth:`.execute <core4.queue.job.CoreJob.execute>` the job, manages the
     final job state (``complete`` or ``failed``) and set the jobs' cookie
-    ``last_runtime``. Finally job output to ``STDOUT`` is saved into
-    ``sys.stdout``.
+    ``last_runtime``. Job output to ``STDOUT`` is streamed in chunks into
+    ``sys.stdout`` while the job is running, see :class:`.StdoutCapture`.
     """
 
-    def start(self, job_id, redirect=True, manual=False):
+    def start(self, job_id, redirect=True):
         """
         :param job_id: str representing a :class:`bson.objectid.ObjectId`
         """
@@ -73,15 +69,26 @@ class CoreWorkerProcess(core4.base.main.CoreBase,
         self.drop_privilege()
 
         if redirect:
-            self.original_stdout_fd = sys.stdout.fileno()
-            saved_stdout_fd = os.dup(self.original_stdout_fd)
-            tfile = tempfile.TemporaryFile(mode='w+b')
-            self._redirect_stdout(tfile.fileno())
+            capture = StdoutCapture(
+                self.config.sys.stdout, job._id,
+                chunk_size=self.config.worker.stdout_chunk,
+                interval=self.config.worker.stdout_interval,
+                compress=self.config.worker.stdout_compress,
+                stderr=self.config.worker.stdout_stderr,
+                logger=self.logger)
+            capture.start()
 
         self.queue.make_stat("start_job", str(job_id))
         job.add_exception_logger()
+        start = snapshot()
         try:
-            job.execute(**job.args)
+            try:
+                ret = job.execute(**job.args)
+            finally:
+                job.__dict__["usage"] = measure(start, job.usage)
+        except core4.error.CoreJobWaiting:
+            self.queue.set_waiting(job)
+            return False
         except core4.error.CoreJobDeferred:
             self.queue.set_defer(job)
             return False
@@ -92,44 +99,33 @@ class CoreWorkerProcess(core4.base.main.CoreBase,
             return False
         else:
             job.__dict__["attempts_left"] -= 1
-            self.queue.set_complete(job, unlock=not manual)
+            job.__dict__["result"] = self.encode_result(job, ret)
+            self.queue.set_complete(job)
             job.cookie.set("last_runtime", job.finished_at)
             job.progress(1.0, "execution end marker", force=True)
             return True
         finally:
             if redirect:
-                # todo: this one is a race condition in testing
-                self._redirect_stdout(saved_stdout_fd)
-                tfile.flush()
-                tfile.seek(0, io.SEEK_SET)
-                body = tfile.read()
-                try:
-                    u8body = body.decode('utf-8')
-                except:
-                    u8body = body
-                self.config.sys.stdout.update_one(
-                    filter={
-                        "_id": job._id,
-                    },
-                    update={
-                        "$set": {
-                            "timestamp": core4.util.node.mongo_now(),
-                            "stdout": u8body
-                        }
-                    },
-                    upsert=True
-                )
-                os.close(saved_stdout_fd)
-                tfile.close()
+                capture.stop()
 
-    def _redirect_stdout(self, to_fd):
+    def encode_result(self, job, result):
         """
-        Redirect stdout to the given file descriptor.
+        Verifies the passed return value of :meth:`.CoreJob.execute` can be
+        saved with the job in ``sys.journal``.
+
+        :param job: :class:`.CoreJob` object
+        :param result: return value
+        :return: the passed ``result`` or ``None`` if it cannot be encoded
+                 as BSON
         """
-        libc.fflush(c_stdout)
-        sys.stdout.close()
-        os.dup2(to_fd, self.original_stdout_fd)
-        sys.stdout = io.TextIOWrapper(os.fdopen(self.original_stdout_fd, 'wb'))
+        if result is None:
+            return None
+        try:
+            bson.BSON.encode({"result": result})
+        except Exception as exc:
+            job.logger.warning("failed to save result: %s", exc)
+            return None
+        return result
 
     def drop_privilege(self):
         # todo: requires impelmentation
@@ -149,11 +145,18 @@ class CoreWorkerProcess(core4.base.main.CoreBase,
                     "traceback": traceback.format_exception(*exc_info)
                 }
             }
-            ret = self.config.sys.queue.update_one(
-                filter={"_id": _id}, update={"$set": update})
-            if ret.raw_result["n"] != 1:
+            doc = self.config.sys.queue.find_one_and_update(
+                filter={"_id": _id}, update={"$set": update},
+                projection=SUMMARY_PROJECTION + [
+                    "semaphore", "locked", "enqueued"])
+            if doc is None:
                 raise RuntimeError(
                     "failed to update job [{}] state [starting]".format(_id))
+            self.queue.update_summary(
+                summary_bucket(doc),
+                summary_bucket(doc, state=core4.queue.job.STATE_ERROR))
+            self.queue.release_job(doc, core4.queue.job.STATE_ERROR)
+            self.queue.count_children([doc], "failed")
             self.logger.info("failed to start [%s]", _id)
             self.queue.make_stat("failed_start", str(_id))
             return None
@@ -7,15 +7,115 @@
 
 """
 This module delivers various MongoDB support methods retrieving information
-about collections ``sys.queue``, ``sys.journal``, ``sys.stdout`` and
-``sys.worker``. The main class :class:`QueryMixin` is to be mixed into a class
-based on :class:`.CoreBase`.
+about collections ``sys.queue``, ``sys.journal``, ``sys.stdout``,
+``sys.summary``, ``sys.semaphore`` and ``sys.worker``. The main class
+:class:`QueryMixin` is to be mixed into a class based on :class:`.CoreBase`.
+
+Collection ``sys.summary`` carries the job counts of ``sys.queue``. Each job
+state transition increments and decrements the counts in the affected
+documents with :func:`summary_ops`. There are two kinds of documents:
+
+* ``count`` - the number of jobs in the given ``state``
+* ``state`` - the number of jobs with the given ``name``, ``state`` and the
+  flags ``zombie``, ``wall``, ``removed`` and ``killed``
 """
 
 import datetime
 from collections import OrderedDict
 
+from pymongo import UpdateOne
+
+import core4.error
+import core4.queue.job
 import core4.util.node
+from core4.queue.archive import CoreArchive
+from core4.queue.dag import GRAPH_PROJECTION, JobGraph, graph_filter
+from core4.queue.stdout import decode_chunk, decode_output
+from core4.queue.rollup import PERIOD, rollup_doc, rollup_pipeline
+from core4.queue.usage import usage_pipeline
+
+#: job attributes flagging special job management
+SUMMARY_FLAGS = ("zombie_at", "wall_at", "removed_at", "killed_at")
+
+#: job attributes required to identify the summary bucket of a job
+SUMMARY_PROJECTION = ["name", "state"] + list(SUMMARY_FLAGS)
+
+
+def summary_bucket(doc, **kwargs):
+    """
+    Identifies the ``sys.summary`` bucket of the passed job document.
+
+    :param doc: job document with :data:`SUMMARY_PROJECTION` attributes
+    :param kwargs: job attributes which overwrite attributes of ``doc``
+    :return: tuple of job ``name``, ``state`` and ``flags``
+    """
+    data = dict(doc)
+    data.update(kwargs)
+    flags = "".join([k[0].upper() if data.get(k, None) else "."
+                     for k in SUMMARY_FLAGS])
+    return data["name"], data["state"], flags
+
+
+def summary_ops(src=None, dst=None, n=1):
+    """
+    Delivers the ``sys.summary`` update statements to move a job from the
+    ``src`` bucket to the ``dst`` bucket, see :func:`summary_bucket`. Pass
+    ``src=None`` for new jobs and ``dst=None`` for jobs removed from
+    ``sys.queue``. Completed jobs are not counted.
+
+    :param src: tuple of job ``name``, ``state`` and ``flags``
+    :param dst: tuple of job ``name``, ``state`` and ``flags``
+    :param n: number of jobs to move, defaults to 1
+    :return: list of :class:`pymongo.UpdateOne`
+    """
+    ops = []
+    if src == dst:
+        return ops
+    for bucket, inc in ((src, -n), (dst, n)):
+        if bucket is None or bucket[1] == core4.queue.job.STATE_COMPLETE:
+            continue
+        (name, state, flags) = bucket
+        other = dst if inc < 0 else src
+        if other is None or other[1] != state:
+            ops.append(UpdateOne(
+                {"_id": "count:{}".format(state)},
+                update={
+                    "$inc": {"n": inc},
+                    "$setOnInsert": {"kind": "count", "state": state}
+                },
+                upsert=True))
+        ops.append(UpdateOne(
+            {"_id": "state:{}:{}:{}".format(state, flags, name)},
+            update={
+                "$inc": {"n": inc},
+                "$setOnInsert": make_summary_state(name, state, flags)
+            },
+            upsert=True))
+    return ops
+
+
+def make_summary_state(name, state, flags, n=None):
+    """
+    Creates the ``sys.summary`` document of kind ``state``.
+
+    :param name: job name
+    :param state: job state
+    :param flags: job flags as returned by :func:`summary_bucket`
+    :param n: number of jobs, not set if ``None``
+    :return: dict
+    """
+    doc = {
+        "kind": "state",
+        "name": name,
+        "state": state,
+        "zombie": flags[0] != ".",
+        "wall": flags[1] != ".",
+        "removed": flags[2] != ".",
+        "killed": flags[3] != "."
+    }
+    if n is not None:
+        doc["n"] = n
+    return doc
 
 
 class QueryMixin:
@@ -33,6 +133,7 @@ class QueryMixin:
         * ``loop_time`` - the timedelta of the daemon looping
         * ``heartbeat`` - the timedelta of the last heartbeat
         * ``kind`` - worker or scheduler
+        * ``slots`` - total and used execution slots of workers
 
         .. note:: Daemons are considered alive, if their heartbeat is not older
                   then current date/time (all in UTC) plus the alive timeout.
@@ -80,6 +181,99 @@ class QueryMixin:
             data.append(doc)
         return data
 
+    def get_semaphore_usage(self):
+        """
+        Retrieves the number of holders of all cluster-wide semaphores held,
+        see :mod:`core4.queue.semaphore`.
+
+        :return: dict of semaphore key (key) and number of holders (value)
+        """
+        cur = self.config.sys.semaphore.aggregate([
+            {"$match": {"holder.0": {"$exists": True}}},
+            {"$project": {"n": {"$size": "$holder"}}}
+        ])
+        return dict([(doc["_id"], doc["n"]) for doc in cur])
+
+    def get_semaphore(self):
+        """
+        Retrieves all cluster-wide semaphores with
+
+        * ``_id`` - the semaphore key
+        * ``limit`` - the limit of the last job acquiring the semaphore
+        * ``n`` - the number of holders
+        * ``holder`` - the list of holding jobs with ``_id``, ``worker`` and
+          heartbeat ``at``
+
+        :return: list of dict
+        """
+        return [self._semaphore_doc(doc) for doc in
+                self.config.sys.semaphore.find(sort=[("_id", 1)])]
+
+    async def get_semaphore_async(self):
+        """
+        Asynchronous version of :meth:`get_semaphore`.
+        """
+        cur = self.config.sys.semaphore.find(sort=[("_id", 1)])
+        return [self._semaphore_doc(doc) async for doc in cur]
+
+    def _semaphore_doc(self, doc):
+        # internal method used by .get_semaphore and .get_semaphore_async
+        holder = doc.get("holder") or []
+        return {
+            "_id": doc["_id"],
+            "limit": doc.get("limit"),
+            "n": len(holder),
+            "holder": holder
+        }
+
+    def get_metric(self, **kwargs):
+        """
+        Retrieves the main loop timings published by all daemons alive, see
+        :mod:`core4.queue.metric`, with
+
+        * ``_id`` - the identifier of the daemon
+        * ``kind`` - worker or scheduler
+        * ``metric_at`` - the date/time when the timings have been published
+        * ``metric`` - the ``step`` and ``mongo`` command histograms
+
+        :param kwargs: query filter
+        :return: list of dict
+        """
+        return list(self.config.sys.worker.aggregate(
+            self.pipeline_metric(**kwargs)))
+
+    async def get_metric_async(self, **kwargs):
+        """
+        Asynchronous version of :meth:`get_metric`.
+        """
+        cur = self.config.sys.worker.aggregate(
+            self.pipeline_metric(**kwargs))
+        return [doc async for doc in cur]
+
+    def pipeline_metric(self, **kwargs):
+        """
+        Delivers aggregation pipeline of :meth:`get_metric` and
+        :meth:`get_metric_async`.
+
+        :param kwargs: optional aggregation match criteria
+        :return: list of MongoDB aggregation pipeline statements
+        """
+        return self._match_daemon(**kwargs) + [
+            {
+                "$match": {
+                    "metric": {"$exists": True}
+                }
+            },
+            {
+                "$project": {
+                    "kind": 1,
+                    "metric_at": 1,
+                    "metric": 1
+                }
+            },
+            {"$sort": {"kind": 1, "_id": 1}}
+        ]
+
     def pipeline_daemon(self, **kwargs):
         """
         Delivers aggregation pipeline of :meth:`get_daemon` and
@@ -88,6 +282,26 @@ class QueryMixin:
         :param kwargs: optional aggregation match criteria
         :return: list of MongoDB aggregation pipeline statements
         """
+        return self._match_daemon(**kwargs) + [
+            {
+                "$project": {
+                    "heartbeat": 1,
+                    "loop": "$phase.loop",
+                    "kind": 1,
+                    "pid": 1,
+                    "hostname": 1,
+                    "port": 1,
+                    "protocol": 1,
+                    "routing": 1,
+                    "slots": 1
+                }
+            },
+            {"$sort": {"kind": 1, "_id": 1}}
+        ]
+
+    def _match_daemon(self, **kwargs):
+        # internal method used by .pipeline_daemon and .pipeline_metric to
+        #   match the daemons alive
         timeout = self.config.daemon.alive_timeout
         pipeline = []
         if kwargs:
@@ -112,47 +326,114 @@ class QueryMixin:
                         }
                     ]
                 },
-            },
-            {
-                "$project": {
-                    "heartbeat": 1,
-                    "loop": "$phase.loop",
-                    "kind": 1,
-                    "pid": 1,
-                    "hostname": 1,
-                    "port": 1,
-                    "protocol": 1,
-                    "routing": 1
-                }
-            },
-            {"$sort": {"kind": 1, "_id": 1}}
+            }
         ]
         return pipeline
 
     def get_queue_state(self):
         """
-        Retrieves aggregated information about ``sys.queue`` state. This is
+        Retrieves aggregated information about ``sys.queue`` state from
+        ``sys.summary``. This is
 
         * ``n`` - the number of jobs in the given state
         * ``state`` - job state
         * ``flags`` - job flags ``zombie``, ``wall``, ``removed`` and
           ``killed``
         * ``name`` - job :meth:`.qual_name``
+        * ``progress`` - the average progress of running jobs
 
         :return: dict
         """
-        cur = self.config.sys.queue.aggregate(self.pipeline_queue_state())
+        cur = self.config.sys.summary.find(**self.query_summary_state())
+        state = list(cur)
+        progress = list(self.config.sys.queue.aggregate(
+            self.pipeline_queue_progress()))
         data = []
-        for doc in cur:
+        for doc in self.merge_queue_progress(state, progress):
             doc["flags"] = "".join(
                 [k[0].upper() if doc[k] else "."
                  for k in ["zombie", "wall", "removed", "killed"]])
             data.append(doc)
         return data
 
+    async def get_queue_state_async(self):
+        """
+        Asynchronous version of :meth:`get_queue_state` without ``flags``.
+        """
+        coll = self.config.sys.summary.connect_async()
+        state = await coll.find(**self.query_summary_state()).to_list(
+            length=None)
+        queue = self.config.sys.queue.connect_async()
+        progress = await queue.aggregate(
+            self.pipeline_queue_progress()).to_list(length=None)
+        return self.merge_queue_progress(state, progress)
+
+    def query_summary_state(self):
+        """
+        Delivers the ``sys.summary`` query arguments of
+        :meth:`get_queue_state` and :meth:`get_queue_state_async`.
+
+        :return: dict of ``filter``, ``projection`` and ``sort``
+        """
+        return dict(
+            filter={"kind": "state", "n": {"$gt": 0}},
+            projection={"_id": 0, "kind": 0},
+            sort=[("state", 1), ("name", 1)])
+
+    def pipeline_queue_progress(self):
+        """
+        Delivers aggregation pipeline of the average progress of running jobs
+        by job name and flags.
+
+        :return: list of MongoDB aggregation pipeline statements
+        """
+        return [
+            {
+                '$match': {
+                    'state': core4.queue.job.STATE_RUNNING
+                },
+            },
+            {
+                '$group': {
+                    '_id': {
+                        'name': '$name',
+                        'zombie': {"$ne": ["$zombie_at", None]},
+                        'wall': {"$ne": ["$wall_at", None]},
+                        'removed': {"$ne": ["$removed_at", None]},
+                        'killed': {"$ne": ["$killed_at", None]},
+                    },
+                    'progress': {'$avg': "$prog.value"}
+                }
+            }
+        ]
+
+    @staticmethod
+    def merge_queue_progress(state, progress):
+        """
+        Merges the average progress of running jobs into the ``sys.summary``
+        documents of kind ``state``.
+
+        :param state: list of ``sys.summary`` documents
+        :param progress: result of :meth:`.pipeline_queue_progress`
+        :return: list of dict
+        """
+        keys = ("name", "zombie", "wall", "removed", "killed")
+        lookup = dict([
+            (tuple(p["_id"][k] for k in keys), p["progress"])
+            for p in progress])
+        for doc in state:
+            doc["progress"] = None
+            if doc["state"] == core4.queue.job.STATE_RUNNING:
+                doc["progress"] = lookup.get(
+                    tuple(doc[k] for k in keys), None)
+        return state
+
     def pipeline_queue_state(self):
         """
-        Delivers aggregation pipeline of :meth:`get_queue_state`.
+        Delivers aggregation pipeline of the information about ``sys.queue``
+        state as returned by :meth:`get_queue_state`. The pipeline is used
+        to reconcile ``sys.summary``, see
+        :meth:`.CoreQueue.reconcile_summary`.
 
         :return: list of MongoDB aggregation pipeline statements
         """
@@ -247,7 +528,8 @@ class QueryMixin:
 
     def job_detail(self, _id):
         """
-        full job details from ``sys.queue`` or ``sys.journal``.
+        full job details from ``sys.queue``, ``sys.journal`` or the archive,
+        see :mod:`core4.queue.archive`.
 
         :param _id: :class:`bson.objectid.ObjectId`
         :return: dict
@@ -257,10 +539,141 @@ class QueryMixin:
         if doc is None:
             doc = self.config.sys.journal.find_one(
                 filter={"_id": _id})
+            if doc is None:
+                doc = CoreArchive().find_one(_id)
+                if doc is not None:
+                    doc["archived"] = True
             if doc is not None:
                 doc["journaled"] = True
         return doc
 
+    def get_job_usage(self, name=None, start=None, end=None, period=None):
+        """
+        Aggregates the resource ``usage`` of journaled jobs per job name and
+        optional period, see :mod:`core4.queue.usage`. The aggregation
+        delivers for each job name
+
+        * ``n`` - the number of jobs
+        * ``wall``, ``user``, ``system`` and ``cpu_time`` - the total
+          execution, CPU user, CPU system and CPU time in seconds
+        * ``cpu`` - the average number of CPU cores
+        * ``memory`` and ``memory_avg`` - the maximum and average peak
+          memory in MB
+        * ``read`` and ``write`` - the total bytes read and written
+        * ``voluntary`` and ``involuntary`` - the total number of context
+          switches
+
+        Job names are sorted by descending ``cpu_time``.
+
+        :param name: list of job :meth:`.qual_name`, defaults to all jobs
+        :param start: jobs finished at or after this date/time
+        :param end: jobs finished before this date/time
+        :param period: aggregate by ``hour``, ``day`` or ``month`` of
+                       ``finished_at``
+        :return: list of dict
+        """
+        return list(self.config.sys.journal.aggregate(
+            self.pipeline_job_usage(name, start, end, period)))
+
+    async def get_job_usage_async(self, name=None, start=None, end=None,
+                                  period=None):
+        """
+        Asynchronous version of :meth:`get_job_usage`.
+        """
+        cur = self.config.sys.journal.aggregate(
+            self.pipeline_job_usage(name, start, end, period))
+        return [doc async for doc in cur]
+
+    def pipeline_job_usage(self, name=None, start=None, end=None,
+                           period=None):
+        """
+        Delivers aggregation pipeline of :meth:`get_job_usage` and
+        :meth:`get_job_usage_async`.
+        """
+        match = {}
+        if name:
+            match["name"] = {"$in": list(name)}
+        if start is not None or end is not None:
+            match["finished_at"] = {}
+            if start is not None:
+                match["finished_at"]["$gte"] = start
+            if end is not None:
+                match["finished_at"]["$lt"] = end
+        return usage_pipeline(match, period)
+
+    def get_queue_metric(self, name=None, worker=None, start=None, end=None,
+                         by_worker=False, period=None, filter=None):
+        """
+        Aggregates the queue latency and throughput rollups per job name and
+        optional worker and period, see :mod:`core4.queue.rollup`. The
+        aggregation delivers for each job name
+
+        * ``started`` - the number of job starts
+        * ``complete``, ``deferred``, ``failed``, ``error``, ``killed`` and
+          ``inactive`` - the number of job executions ending in the
+          respective state
+        * ``throughput`` - the number of completed jobs per minute
+        * ``wait`` and ``runtime`` - dict with count ``n``, ``avg``, ``max``
+          and the percentiles ``p50``, ``p95`` and ``p99`` of the waiting
+          time and the execution time in seconds
+
+        :param name: list of job :meth:`.qual_name`, defaults to all jobs
+        :param worker: list of worker identifiers, defaults to all workers
+        :param start: start date/time, defaults to one hour before ``end``
+        :param end: end date/time, defaults to now
+        :param by_worker: aggregate by ``worker``, too
+        :param period: aggregate by ``minute``, ``hour`` or ``day``
+        :param filter: additional MongoDB filter, e.g. the job permissions
+                       of the user, see :meth:`.CoreRole.job_filter`
+        :return: list of dict
+        """
+        (pipeline, minutes) = self.pipeline_queue_metric(
+            name, worker, start, end, by_worker, period, filter)
+        return [rollup_doc(doc, minutes)
+                for doc in self.config.sys.rollup.aggregate(pipeline)]
+
+    async def get_queue_metric_async(self, name=None, worker=None,
+                                     start=None, end=None, by_worker=False,
+                                     period=None, filter=None):
+        """
+        Asynchronous version of :meth:`get_queue_metric`.
+        """
+        (pipeline, minutes) = self.pipeline_queue_metric(
+            name, worker, start, end, by_worker, period, filter)
+        cur = self.config.sys.rollup.aggregate(pipeline)
+        return [rollup_doc(doc, minutes) async for doc in cur]
+
+    def pipeline_queue_metric(self, name=None, worker=None, start=None,
+                              end=None, by_worker=False, period=None,
+                              filter=None):
+        """
+        Delivers aggregation pipeline of :meth:`get_queue_metric` and
+        :meth:`get_queue_metric_async`. The optional ``filter`` is combined
+        with the ``minute``, ``name`` and ``worker`` match.
+
+        :return: tuple of list of MongoDB aggregation pipeline statements
+                 and the length of the aggregation period in minutes
+        """
+        if period is not None and period not in PERIOD:
+            raise core4.error.Core4UsageError(
+                "period must be one of {}".format(sorted(PERIOD)))
+        if end is None:
+            end = core4.util.node.mongo_now()
+        if start is None:
+            start = end - datetime.timedelta(hours=1)
+        match = {"minute": {"$gte": start, "$lt": end}}
+        if name:
+            match["name"] = {"$in": list(name)}
+        if worker:
+            match["worker"] = {"$in": list(worker)}
+        if filter is not None:
+            match = {"$and": [match, filter]}
+        if period is None:
+            minutes = (end - start).total_seconds() / 60.
+        else:
+            minutes = PERIOD[period][1]
+        return rollup_pipeline(match, by_worker, period), minutes
+
     def project_job_listing(self):
         """
         Returns the ``sys.queue`` attributes to be projected in a job listing.
@@ -285,25 +698,72 @@ class QueryMixin:
             'name': 1,
             'state': 1,
             'locked': 1,
-            'prog': 1
+            'prog': 1,
+            'blocked': 1,
+            'children': 1,
+            'usage': 1
         }
 
     def get_job_stdout(self, _id):
         """
-        Returns the job STDOUT filtered.
+        Returns the job STDOUT assembled from all chunks in ``sys.stdout``.
 
         .. note:: The STDOUT of jobs have a time-to-live and is purged after
                   7 days. You can configure this TTL with config setting
-                  ``worker.stdout.ttl``.
+                  ``worker.stdout_ttl``.
 
         :param _id: :class:`bson.object.ObjectId`
-        :return: str
+        :return: str, bytes if the output is not UTF-8 encoded, or ``None``
         """
-        doc = self.config.sys.stdout.find_one({"_id": _id})
-        if doc:
-            return doc["stdout"]
+        chunks = self.get_job_stdout_chunk(_id)
+        if chunks:
+            return decode_output(b"".join([c["data"] for c in chunks]))
         return None
 
+    def get_job_stdout_chunk(self, _id, n=0, limit=0):
+        """
+        Returns the job STDOUT chunks from ``sys.stdout`` starting with chunk
+        sequence number ``n``. Use :func:`.stdout_tail` to follow the output
+        of a running job.
+
+        :param _id: :class:`bson.object.ObjectId`
+        :param n: first chunk sequence number, defaults to ``0``
+        :param limit: maximum number of chunks, defaults to ``0`` (all)
+        :return: list of chunks decoded with :func:`.decode_chunk`
+        """
+        cur = self.config.sys.stdout.find(
+            filter={"job_id": _id, "n": {"$gte": n}},
+            sort=[("n", 1)], limit=limit)
+        return [decode_chunk(doc) for doc in cur]
+
+    def get_job_graph(self, _id):
+        """
+        Collects the graph of the passed job, i.e. all jobs connected through
+        ``dependency`` (``wait_for``), ``chain`` or restart
+        (``enqueued.parent_id``). Jobs in ``sys.queue`` are searched in both
+        directions, jobs in ``sys.journal`` are collected if referenced.
+
+        :param _id: :class:`bson.object.ObjectId`
+        :return: :class:`.JobGraph`, use :meth:`.JobGraph.to_doc` or
+                 :meth:`.JobGraph.to_dot` to render
+        """
+        graph = JobGraph()
+        frontier = [_id]
+        seen = {_id}
+        while frontier and not graph.truncated:
+            docs = list(self.config.sys.queue.find(
+                graph_filter(frontier), projection=GRAPH_PROJECTION))
+            refer = graph.add(docs)
+            found = set([d["_id"] for d in docs])
+            missing = [i for i in frontier if i not in found]
+            if missing:
+                refer += graph.add(self.config.sys.journal.find(
+                    {"_id": {"$in": missing}}, projection=GRAPH_PROJECTION),
+                    journal=True)
+            frontier = [i for i in set(refer) if i not in seen]
+            seen.update(frontier)
+        return graph
+
     def pipeline_queue_count(self):
         """
         Returns the pipeline commands to count jobs in different states.
@@ -340,15 +800,12 @@ class QueryMixin:
 
     def get_queue_count(self):
         """
-        Retrieves aggregated information about ``sys.queue`` state. This is
+        Retrieves the number of jobs in ``sys.queue`` by state from
+        ``sys.summary``.
 
-        * ``n`` - the number of jobs in the given state
-        * ``state`` - job state
-        * ``flags`` - job flags ``zombie``, ``wall``, ``removed`` and
-          ``killed``
-
-        :return: dict
+        :return: dict of state (key) and number of jobs (value)
         """
-        cur = self.config.sys.queue.aggregate(self.pipeline_queue_count())
-        data = list(cur)
-        return dict([(s["state"], s["n"]) for s in data])
+        cur = self.config.sys.summary.find(
+            {"kind": "count", "n": {"$gt": 0}},
+            projection=["state", "n"])
+        return dict([(s["state"], s["n"]) for s in cur])
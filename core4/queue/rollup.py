@@ -0,0 +1,211 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the queue latency and throughput rollups of
+:class:`.CoreQueue` and :class:`.CoreWorker`.
+
+The rollups are maintained incrementally with each job transition in
+collection ``sys.rollup``. Each document covers one ``minute`` of one job
+``name`` executed by one ``worker``:
+
+* ``started`` - number of job starts
+* ``wait`` - the time between job eligibility and job start, i.e. between
+  ``enqueued.at`` or the ``query_at`` of a deferred or failed job and
+  ``started_at``
+* ``runtime`` - the execution time of finished job executions
+* ``complete``, ``deferred``, ``failed``, ``error``, ``killed`` and
+  ``inactive`` - number of job executions ending in the respective state
+
+``wait`` and ``runtime`` carry the count ``n``, the ``sum``, the ``max`` and
+a histogram ``bucket`` with the count by :data:`BUCKET` index. Histograms
+are merged at query time to deliver the :data:`PERCENTILE` across minutes
+and workers with :func:`percentile`, see
+:meth:`.QueryMixin.get_queue_metric`. The rollups expire after
+``queue.rollup_ttl`` seconds.
+"""
+
+import bisect
+import math
+
+#: upper bounds of the histogram buckets in seconds
+BUCKET = tuple(0.01 * 2 ** (i / 4.) for i in range(100))
+
+#: percentiles delivered by :meth:`.QueryMixin.get_queue_metric` and
+#: published with :meth:`.Histogram.to_doc`
+PERCENTILE = (50, 95, 99)
+
+#: job states counted in the rollups
+ROLLUP_STATE = ("complete", "deferred", "failed", "error", "killed",
+                "inactive")
+
+#: aggregation periods and their length in minutes
+PERIOD = {
+    "minute": ("%Y-%m-%dT%H:%M", 1),
+    "hour": ("%Y-%m-%dT%H", 60),
+    "day": ("%Y-%m-%d", 1440)
+}
+
+
+def floor_minute(timestamp):
+    """
+    :param timestamp: :class:`datetime.datetime`
+    :return: the passed timestamp truncated to the minute
+    """
+    return timestamp.replace(second=0, microsecond=0)
+
+
+def observe(key, value):
+    """
+    Delivers the ``sys.rollup`` update statements to record the passed
+    duration.
+
+    :param key: ``wait`` or ``runtime``
+    :param value: duration in seconds
+    :return: tuple of dict with ``$inc`` and dict with ``$max`` statements
+    """
+    value = max(0., value)
+    index = bisect.bisect_left(BUCKET, value)
+    inc = {
+        key + ".n": 1,
+        key + ".sum": value,
+        "{}.bucket.{}".format(key, index): 1
+    }
+    return inc, {key + ".max": value}
+
+
+def rollup_update(started=None, wait=None, state=None, runtime=None):
+    """
+    Delivers the ``sys.rollup`` update statement of a job transition.
+
+    :param started: ``True`` for a job start
+    :param wait: the waiting time of a job start in seconds
+    :param state: the job state of a finished job execution
+    :param runtime: the execution time of a finished job in seconds
+    :return: dict with MongoDB update statement
+    """
+    inc = {}
+    mx = {}
+    if started:
+        inc["started"] = 1
+    if wait is not None:
+        (i, m) = observe("wait", wait)
+        inc.update(i)
+        mx.update(m)
+    if state is not None:
+        inc[state] = 1
+    if runtime is not None:
+        (i, m) = observe("runtime", runtime)
+        inc.update(i)
+        mx.update(m)
+    update = {"$inc": inc}
+    if mx:
+        update["$max"] = mx
+    return update
+
+
+def percentile(counts, p, mx, bucket):
+    """
+    Estimates the passed percentile of a fixed-bucket histogram with the
+    upper bound of the bucket which holds the percentile. The estimate does
+    not exceed the maximum recorded duration. This estimator is shared by
+    the rollups and the daemon :class:`.Histogram`.
+
+    :param counts: list of counts by bucket index, the last index counts
+                   durations above the upper bound of the last bucket
+    :param p: percentile between 0 and 100
+    :param mx: maximum recorded duration
+    :param bucket: upper bounds of the histogram buckets
+    :return: duration in seconds or ``None`` if no duration has been recorded
+    """
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = max(1, math.ceil(total * p / 100.))
+    seen = 0
+    for index, n in enumerate(counts):
+        seen += n
+        if seen >= rank:
+            if index < len(bucket):
+                return min(bucket[index], mx)
+            break
+    return mx
+
+
+def merge_bucket(buckets):
+    """
+    Merges the histograms of multiple rollups.
+
+    :param buckets: list of dict with count by :data:`BUCKET` index
+    :return: list of counts by :data:`BUCKET` index
+    """
+    count = [0] * (len(BUCKET) + 1)
+    for bucket in buckets:
+        for index, n in (bucket or {}).items():
+            count[int(index)] += n
+    return count
+
+
+def rollup_pipeline(match, worker=False, period=None):
+    """
+    Delivers the ``sys.rollup`` aggregation pipeline of
+    :meth:`.QueryMixin.get_queue_metric`.
+
+    :param match: filter statement
+    :param worker: group by ``worker``, too
+    :param period: optional aggregation period ``minute``, ``hour`` or
+                   ``day``
+    :return: list of MongoDB aggregation pipeline statements
+    """
+    key = {"name": "$name"}
+    if worker:
+        key["worker"] = "$worker"
+    if period is not None:
+        key["period"] = {"$dateToString": {
+            "format": PERIOD[period][0], "date": "$minute"}}
+    group = {"_id": key, "started": {"$sum": "$started"}}
+    for state in ROLLUP_STATE:
+        group[state] = {"$sum": "$" + state}
+    for metric in ("wait", "runtime"):
+        group[metric + "_n"] = {"$sum": "$" + metric + ".n"}
+        group[metric + "_sum"] = {"$sum": "$" + metric + ".sum"}
+        group[metric + "_max"] = {"$max": "$" + metric + ".max"}
+        group[metric + "_bucket"] = {"$push": "$" + metric + ".bucket"}
+    return [
+        {"$match": match},
+        {"$group": group},
+        {"$sort": {"_id.period": 1, "_id.name": 1, "_id.worker": 1}}
+    ]
+
+
+def rollup_doc(doc, minutes):
+    """
+    Translates the aggregated ``sys.rollup`` document of
+    :func:`rollup_pipeline` into the metrics of
+    :meth:`.QueryMixin.get_queue_metric`.
+
+    :param doc: aggregated document
+    :param minutes: length of the aggregation period in minutes
+    :return: dict
+    """
+    ret = dict(doc["_id"])
+    ret["started"] = doc["started"]
+    for state in ROLLUP_STATE:
+        ret[state] = doc[state]
+    ret["throughput"] = doc["complete"] / minutes if minutes else None
+    for metric in ("wait", "runtime"):
+        n = doc[metric + "_n"]
+        mx = doc[metric + "_max"]
+        ret[metric] = {
+            "n": n,
+            "avg": doc[metric + "_sum"] / n if n else None,
+            "max": mx
+        }
+        count = merge_bucket(doc[metric + "_bucket"])
+        for p in PERCENTILE:
+            ret[metric]["p{}".format(p)] = percentile(count, p, mx, BUCKET)
+    return ret
@@ -29,14 +29,21 @@ To stop the worker start a new Python interpreter and go with::
 """
 
 import datetime
+import heapq
 
 from croniter import croniter
 
 import core4.const
+import core4.error
 import core4.service.introspect.main
 import core4.util.node
 from core4.queue.daemon import CoreDaemon
-from core4.service.introspect.command import ENQUEUE
+
+#: enqueue jobs with missed schedules once
+CATCH_UP_ONCE = "once"
+#: skip schedules missed while the scheduler was down
+CATCH_UP_SKIP = "skip"
+CATCH_UP = (CATCH_UP_ONCE, CATCH_UP_SKIP)
 
 
 class CoreScheduler(CoreDaemon):
@@ -49,8 +56,17 @@ class CoreScheduler(CoreDaemon):
     https://en.wikipedia.org/wiki/Cron). core4 uses :mod:`croniter` to parse
     and to calculate schedules.
 
+    The scheduler keeps a priority queue (:mod:`heapq`) of all scheduled jobs
+    keyed by their next fire time. Each step pops the due jobs and computes
+    the next fire time of these jobs only. The job collection is refreshed
+    every ``scheduler.refresh`` seconds and the priority queue is updated for
+    new and changed schedules.
+
     Note that the scheduler keeps track of the last scheduling time and catches
-    up with all missed enqueuing, e.g. if the scheduler was down.
+    up with missed enqueuing, e.g. if the scheduler was down. With
+    ``scheduler.catch_up: once`` (default) each job with missed schedules is
+    enqueued once. With ``scheduler.catch_up: skip`` the schedules missed
+    while the scheduler was down are skipped.
     """
     kind = "scheduler"
 
@@ -60,6 +76,10 @@ class CoreScheduler(CoreDaemon):
         self.next = None
         self.previous = None
         self.job = None
+        self.heap = []
+        self.heap_at = None
+        self.due = {}
+        self.refresh_at = None
 
     def startup(self):
         """
@@ -67,9 +87,45 @@ class CoreScheduler(CoreDaemon):
         on :class:`.CoreDaemon` implementation and additionally spawns
         :meth:`.collect_job`.
         """
+        if self.config.scheduler.catch_up not in CATCH_UP:
+            raise core4.error.Core4ConfigurationError(
+                "scheduler.catch_up must be one of {}".format(CATCH_UP))
         super().startup()
+        self.collect_job()
+
+    def collect_job(self):
+        """
+        Collects all scheduled jobs with :meth:`.CoreIntrospector.collect_job`
+        and updates the priority queue with :meth:`.update_job`.
+        """
         intro = core4.service.introspect.main.CoreIntrospector()
-        self.job = intro.collect_job()
+        self.update_job(intro.collect_job(agent=self.agent))
+        if self.config.scheduler.refresh:
+            self.refresh_at = core4.util.node.mongo_now() + datetime.timedelta(
+                seconds=self.config.scheduler.refresh)
+
+    def update_job(self, job):
+        """
+        Replaces the scheduled jobs and pushes new and changed schedules into
+        the priority queue. Entries of removed and changed schedules are
+        discarded when they are due.
+
+        :param job: dict of scheduled jobs with ``schedule`` attribute as
+                    delivered by :meth:`.CoreIntrospector.collect_job`
+        :return: number of new and changed schedules
+        """
+        previous = self.job or {}
+        self.job = job
+        if self.heap_at is None:
+            return len(job)
+        n = 0
+        for name, doc in job.items():
+            if previous.get(name, {}).get("schedule") != doc["schedule"]:
+                self.logger.info("update schedule [%s] at [%s]", name,
+                                 doc["schedule"])
+                self.push(name, doc["schedule"], self.heap_at)
+                n += 1
+        return n
 
     def loop(self):
         """
@@ -77,35 +133,52 @@ class CoreScheduler(CoreDaemon):
         """
         self.wait_time = 1
         self.previous = None
-        doc = self.config.sys.job.find_one({"_id": "__schedule__"})
-        if doc:
-            self.previous = doc.get("schedule_at", None)
+        if self.config.scheduler.catch_up == CATCH_UP_ONCE:
+            doc = self.config.sys.job.find_one({"_id": "__schedule__"})
+            if doc:
+                self.previous = doc.get("schedule_at", None)
         super().loop()
 
     def run_step(self):
         """
         The scheduler consists of one step. This time interval of this step
         can be configured by core4 config setting ``scheduler.interval`` and
-        defaults to 1 second.
-        :return:
+        defaults to 1 second. Due jobs are enqueued with a single
+        :meth:`.CoreQueue.enqueue_many`. Job collection and enqueuing are
+        timed as steps ``collect_job`` and ``enqueue``, see
+        :mod:`core4.queue.metric`.
+
+        :return: number of enqueued jobs
+        """
+        if self.refresh_at is not None and self.at >= self.refresh_at:
+            with self.metric.timer("collect_job"):
+                self.collect_job()
+        with self.metric.timer("enqueue"):
+            return self.enqueue_due()
+
+    def enqueue_due(self):
+        """
+        Enqueues the jobs due between the previous and the current cycle.
+
+        :return: number of enqueued jobs
         """
         jobs = self.get_next(self.previous, self.at)
         n = 0
+        prepared = []
         for job, schedule in jobs:
             self.logger.info("enqueue [%s] at [%s]", job, schedule)
-            # todo: improve no try/except required if functool.enqueue used
             try:
-                self.queue.enqueue(name=job)._id
+                prepared.append(self.queue.prepare_job(name=job))
             except ImportError:
-                core4.service.introspect.main.exec_project(
-                    job, ENQUEUE, qual_name=job)
-            except core4.error.CoreJobExists:
-                self.logger.error("job [%s] exists", job)
+                self.queue.exec_enqueue(job)
             except Exception:
                 self.logger.critical("failed to enqueue [%s]", job,
                                      exc_info=True)
-            else:
-                n += 1
+        try:
+            n += len(self.queue.enqueue_many(prepared))
+        except Exception:
+            self.logger.critical("failed to enqueue [%d] jobs", len(prepared),
+                                 exc_info=True)
         self.previous = self.at
         self.config.sys.job.update_one(
             {
@@ -123,7 +196,11 @@ class CoreScheduler(CoreDaemon):
     def get_next(self, start, end):
         """
         Returns the jobs to be enqueued between ``start`` and ``end``
-        date/time.
+        date/time. Jobs with multiple schedules in this period are returned
+        once.
+
+        The priority queue is rebuilt if ``start`` does not continue the
+        previous call.
 
         :param start: :class:`datetime.datetime` when last scheduling has been
                       executed. Pass ``None`` for the very first schedule.
@@ -133,9 +210,42 @@ class CoreScheduler(CoreDaemon):
         ret = []
         if start is None:
             start = end
-        for job_name, doc in self.job.items():
-            cron = croniter(doc["schedule"], start)
-            next_time = cron.get_next(datetime.datetime)
-            if next_time <= end:
-                ret.append((job_name, doc["schedule"]))
+        if self.heap_at != start:
+            self.build_heap(start)
+        while self.heap and self.heap[0][0] <= end:
+            (next_time, name, schedule) = heapq.heappop(self.heap)
+            if (name not in self.job
+                    or self.due.get(name) != (next_time, schedule)):
+                # removed or changed schedule
+                continue
+            ret.append((name, schedule))
+            self.push(name, schedule, end)
+        self.heap_at = end
         return ret
+
+    def build_heap(self, start):
+        """
+        Builds the priority queue with the next fire time after ``start`` of
+        all scheduled jobs.
+
+        :param start: :class:`datetime.datetime`
+        """
+        self.heap = []
+        self.due = {}
+        for name, doc in self.job.items():
+            self.push(name, doc["schedule"], start)
+        self.heap_at = start
+
+    def push(self, name, schedule, start):
+        """
+        Pushes the next fire time after ``start`` of the passed job into the
+        priority queue.
+
+        :param name: job :meth:`.qual_name`
+        :param schedule: job ``schedule`` in cron format
+        :param start: :class:`datetime.datetime`
+        """
+        cron = croniter(schedule, start)
+        next_time = cron.get_next(datetime.datetime)
+        self.due[name] = (next_time, schedule)
+        heapq.heappush(self.heap, (next_time, name, schedule))
@@ -0,0 +1,79 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the helpers of cluster-wide concurrency limits of
+:class:`.CoreQueue` and :class:`.CoreWorker`.
+
+Job property ``max_parallel`` limits the number of concurrent jobs with the
+same :meth:`.qual_name` on a single worker. Cluster-wide semaphores limit the
+number of concurrent jobs across all workers. Semaphores are keyed by
+
+* ``name:<qual_name>`` - with job property ``max_cluster``
+* ``tag:<tag>`` - with config ``semaphore.tag`` listing the limits by job
+  ``tag``
+* ``resource:<resource>`` - with job property ``resource`` listing the named
+  resources used by the job and config ``semaphore.resource`` listing the
+  limits by resource. Resources without a configured limit are exclusive.
+
+The semaphores of a job are resolved into job attribute ``semaphore`` when
+the job is instantiated. Each semaphore is a document in ``sys.semaphore``
+with ``_id`` key, the ``limit`` and the list of ``holder`` with job ``_id``,
+``worker`` and heartbeat ``at``.
+
+The worker acquires all semaphores of a job when it claims the job with
+:meth:`.CoreQueue.acquire_semaphore`. The job is released if any semaphore
+is exhausted. Semaphores are released with every state transition of the
+running job. Holders of dead workers expire after ``semaphore.ttl``
+seconds, see :meth:`.CoreQueue.expire_semaphore`.
+"""
+
+
+def make_semaphore(job):
+    """
+    Resolves the cluster-wide semaphores of the passed job.
+
+    :param job: :class:`.CoreJob` object
+    :return: list of dict with semaphore ``key`` and ``limit``
+    """
+    config = job.config.semaphore
+    ret = []
+    if job.max_cluster:
+        ret.append({"key": "name:" + job.qual_name(),
+                    "limit": job.max_cluster})
+    limit = config.tag or {}
+    for tag in job.tag or []:
+        if tag in limit:
+            ret.append({"key": "tag:" + tag, "limit": limit[tag]})
+    limit = config.resource or {}
+    for resource in job.resource or []:
+        ret.append({"key": "resource:" + resource,
+                    "limit": limit.get(resource, 1)})
+    return ret
+
+
+def semaphore_filter(used):
+    """
+    Delivers the ``sys.queue`` filter of jobs not blocked by an exhausted
+    semaphore.
+
+    :param used: dict of semaphore key (key) and number of holders (value)
+    :return: dict with MongoDB filter statement or ``None`` if no semaphore
+             is held
+    """
+    if not used:
+        return None
+    return {
+        "semaphore": {
+            "$not": {
+                "$elemMatch": {
+                    "$or": [{"key": key, "limit": {"$lte": n}}
+                            for key, n in sorted(used.items())]
+                }
+            }
+        }
+    }
@@ -0,0 +1,262 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements :class:`.StdoutCapture` which streams the ``STDOUT``
+of a job process in chunks into collection ``sys.stdout`` while the job is
+running.
+
+Each job owns a sequence of chunk documents in ``sys.stdout``:
+
+* ``job_id`` - the job ``_id``
+* ``n`` - the chunk sequence number, starting with ``0``
+* ``offset`` - the byte offset of the chunk in the job output
+* ``size`` - the number of (uncompressed) bytes in the chunk
+* ``data`` - the chunk bytes, zlib compressed if ``compressed is True``
+* ``timestamp`` - the time of the last chunk update, used for TTL
+
+All chunks but the last have a size of ``worker.stdout_chunk`` bytes. The
+last chunk is updated every ``worker.stdout_interval`` seconds until it is
+full. This enables live tailing of the job output with
+:func:`.stdout_tail`.
+"""
+
+import ctypes
+import io
+import os
+import select
+import sys
+import threading
+import time
+import zlib
+
+import pymongo.errors
+
+import core4.util.node
+
+libc = ctypes.CDLL(None)
+
+#: number of bytes to read from the pipe at once
+READ_SIZE = 65536
+
+
+def encode_chunk(data, compress=False):
+    """
+    Encodes the chunk bytes for storage in ``sys.stdout``.
+
+    :param data: chunk bytes
+    :param compress: zlib compress the chunk, defaults to ``False``
+    :return: tuple of encoded bytes and the compression flag
+    """
+    if compress:
+        return zlib.compress(data), True
+    return data, False
+
+
+def decode_chunk(doc):
+    """
+    Decodes a chunk document from ``sys.stdout``.
+
+    :param doc: chunk document
+    :return: dict with chunk ``n``, ``offset``, ``size``, ``timestamp`` and
+             the uncompressed ``data`` (bytes)
+    """
+    data = bytes(doc["data"])
+    if doc.get("compressed", False):
+        data = zlib.decompress(data)
+    return {
+        "n": doc["n"],
+        "offset": doc["offset"],
+        "size": doc["size"],
+        "timestamp": doc["timestamp"],
+        "data": data
+    }
+
+
+def decode_output(body):
+    """
+    Decodes the job output as UTF-8. Binary output is returned unchanged.
+
+    :param body: bytes
+    :return: str or bytes
+    """
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError:
+        return body
+
+
+def stdout_tail(chunks, pos):
+    """
+    Extracts the job output following byte position ``pos`` from the passed
+    chunks. Use the returned position and chunk sequence number for the next
+    request to follow the output of a running job.
+
+    :param chunks: list of chunks decoded with :func:`.decode_chunk`,
+                   ordered by ``n``
+    :param pos: byte position already consumed
+    :return: tuple of output bytes, the new byte position and the chunk
+             sequence number to continue with
+    """
+    data = b""
+    n = None
+    for chunk in chunks:
+        n = chunk["n"]
+        end = chunk["offset"] + chunk["size"]
+        if end > pos:
+            data += chunk["data"][max(0, pos - chunk["offset"]):]
+            pos = end
+    return data, pos, n
+
+
+class StdoutCapture:
+    """
+    Redirects the passed file descriptors of the current process into a pipe
+    and writes the pipe's content in chunks into ``sys.stdout`` with a
+    background thread. The redirect applies to Python, C libraries and child
+    processes.
+
+    Usage::
+
+        capture = StdoutCapture(collection, job_id)
+        capture.start()
+        try:
+            ...
+        finally:
+            capture.stop()
+    """
+
+    def __init__(self, collection, job_id, chunk_size=261120, interval=1.,
+                 compress=False, stderr=False, logger=None):
+        """
+        :param collection: ``sys.stdout`` collection
+        :param job_id: :class:`bson.objectid.ObjectId` of the job
+        :param chunk_size: chunk size in bytes
+        :param interval: seconds between updates of the last chunk
+        :param compress: zlib compress each chunk
+        :param stderr: capture ``STDERR`` into the same chunk sequence
+        :param logger: to report write failures
+        """
+        self.collection = collection
+        self.job_id = job_id
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.compress = compress
+        self.logger = logger
+        self.stream = ["stdout"]
+        if stderr:
+            self.stream.append("stderr")
+        self.buffer = bytearray()
+        self.n = 0
+        self.offset = 0
+        self.written = False
+        self.dirty = False
+        self.saved = {}
+        self._read = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Removes the chunks of a previous job execution, redirects the file
+        descriptors and starts the writer thread.
+        """
+        self.collection.delete_many({"job_id": self.job_id})
+        self._read, write = os.pipe()
+        for name in self.stream:
+            fd = getattr(sys, name).fileno()
+            self.saved[name] = (fd, os.dup(fd))
+            self._redirect(name, fd, write)
+        os.close(write)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Restores the file descriptors, writes the remaining output and stops
+        the writer thread. Output of orphaned child processes which still
+        hold the pipe is written for another ``interval`` seconds.
+        """
+        for name, (fd, saved) in self.saved.items():
+            self._redirect(name, fd, saved)
+            os.close(saved)
+        self.saved = {}
+        self._stop.set()
+        self._thread.join()
+        os.close(self._read)
+
+    def _redirect(self, name, fd, to_fd):
+        # flushes Python and C buffers and redirects the stream, STDERR is
+        # kept in place since logging handlers hold a reference
+        libc.fflush(None)
+        if name == "stdout":
+            sys.stdout.close()
+            os.dup2(to_fd, fd)
+            sys.stdout = io.TextIOWrapper(
+                os.fdopen(fd, "wb"), line_buffering=True)
+        else:
+            getattr(sys, name).flush()
+            os.dup2(to_fd, fd)
+
+    def _run(self):
+        # writer thread, reads the pipe until EOF or stop
+        last = time.time()
+        deadline = None
+        while True:
+            timeout = max(0., last + self.interval - time.time())
+            (ready, _, _) = select.select([self._read], [], [], timeout)
+            if ready:
+                data = os.read(self._read, READ_SIZE)
+                if not data:
+                    break
+                self.buffer += data
+                self.dirty = True
+                if len(self.buffer) >= self.chunk_size:
+                    self._write()
+            if self._stop.is_set():
+                if deadline is None:
+                    deadline = time.time() + self.interval
+                if not ready or time.time() > deadline:
+                    break
+            if time.time() >= last + self.interval:
+                self._write()
+                last = time.time()
+        self._write(final=True)
+
+    def _write(self, final=False):
+        # writes full chunks and updates the last partial chunk
+        try:
+            while len(self.buffer) >= self.chunk_size:
+                self._upsert(bytes(self.buffer[:self.chunk_size]))
+                del self.buffer[:self.chunk_size]
+                self.offset += self.chunk_size
+                self.n += 1
+                self.dirty = bool(self.buffer)
+            if self.dirty or (final and not self.written):
+                self._upsert(bytes(self.buffer))
+                self.dirty = False
+        except pymongo.errors.PyMongoError:
+            if self.logger:
+                self.logger.error("failed to write chunk [%d] of [%s]",
+                                  self.n, self.job_id, exc_info=True)
+
+    def _upsert(self, data):
+        (body, compressed) = encode_chunk(data, self.compress)
+        self.collection.update_one(
+            filter={"job_id": self.job_id, "n": self.n},
+            update={
+                "$set": {
+                    "offset": self.offset,
+                    "size": len(data),
+                    "data": body,
+                    "compressed": compressed,
+                    "timestamp": core4.util.node.mongo_now()
+                }
+            },
+            upsert=True
+        )
+        self.written = True
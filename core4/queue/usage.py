@@ -0,0 +1,141 @@
+#
+# Copyright 2018 Plan.Net Business Intelligence GmbH & Co. KG
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+This module implements the resource accounting of job executions.
+
+:class:`.CoreWorkerProcess` measures the resources used by the job process
+and its terminated child processes with :func:`resource.getrusage` and saves
+them in job attribute ``usage`` with each execution end. The figures add up
+across all execution trials of the job:
+
+* ``wall`` - execution time in seconds
+* ``user`` - CPU user time in seconds
+* ``system`` - CPU system time in seconds
+* ``cpu`` - average number of CPU cores, i.e. ``(user + system) / wall``
+* ``memory`` - peak resident set size in MB
+* ``read`` - bytes read from the file system
+* ``write`` - bytes written to the file system
+* ``voluntary`` - number of voluntary context switches
+* ``involuntary`` - number of involuntary context switches
+
+Use :meth:`.QueryMixin.get_job_usage` to aggregate the usage of journaled
+jobs per job name.
+"""
+
+import resource
+import time
+
+#: usage figures which add up across execution trials
+USAGE_COUNTER = ("wall", "user", "system", "read", "write", "voluntary",
+                 "involuntary")
+
+#: bytes per block of ``ru_inblock`` and ``ru_oublock``
+BLOCK_SIZE = 512
+
+#: aggregation periods of :func:`usage_pipeline`
+PERIOD = {
+    "hour": "%Y-%m-%dT%H",
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m"
+}
+
+
+def snapshot():
+    """
+    Takes the resource usage of the current process and its terminated child
+    processes.
+
+    :return: tuple of timestamp and list of :func:`resource.getrusage`
+             results
+    """
+    return (time.time(), [resource.getrusage(who) for who in
+                          (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)])
+
+
+def measure(start, previous=None):
+    """
+    Measures the resource usage since the passed ``start`` and adds the
+    ``previous`` usage of the job.
+
+    :param start: tuple taken with :func:`snapshot`
+    :param previous: dict with the usage of previous execution trials
+    :return: dict with usage figures
+    """
+    (t0, before) = snapshot()
+    (t1, after) = start
+    ret = dict.fromkeys(USAGE_COUNTER, 0.)
+    ret["wall"] = t0 - t1
+    memory = 0.
+    for now, prev in zip(before, after):
+        ret["user"] += now.ru_utime - prev.ru_utime
+        ret["system"] += now.ru_stime - prev.ru_stime
+        ret["read"] += (now.ru_inblock - prev.ru_inblock) * BLOCK_SIZE
+        ret["write"] += (now.ru_oublock - prev.ru_oublock) * BLOCK_SIZE
+        ret["voluntary"] += now.ru_nvcsw - prev.ru_nvcsw
+        ret["involuntary"] += now.ru_nivcsw - prev.ru_nivcsw
+        # ru_maxrss is in kB on Linux
+        memory = max(memory, now.ru_maxrss / 2. ** 10)
+    previous = previous or {}
+    for key in USAGE_COUNTER:
+        ret[key] += previous.get(key) or 0
+    for key in ("read", "write", "voluntary", "involuntary"):
+        ret[key] = int(ret[key])
+    ret["memory"] = max(memory, previous.get("memory") or 0.)
+    if ret["wall"] > 0:
+        ret["cpu"] = (ret["user"] + ret["system"]) / ret["wall"]
+    else:
+        ret["cpu"] = 0.
+    for key in ("wall", "user", "system", "cpu", "memory"):
+        ret[key] = round(ret[key], 3)
+    return ret
+
+
+def usage_pipeline(match=None, period=None):
+    """
+    Delivers the ``sys.journal`` aggregation pipeline of
+    :meth:`.QueryMixin.get_job_usage`.
+
+    :param match: optional filter statement
+    :param period: optional aggregation period ``hour``, ``day`` or
+                   ``month`` of ``finished_at``
+    :return: list of MongoDB aggregation pipeline statements
+    """
+    match = dict(match or {})
+    match["usage"] = {"$ne": None}
+    key = {"name": "$name"}
+    if period is not None:
+        key["period"] = {"$dateToString": {
+            "format": PERIOD[period], "date": "$finished_at"}}
+    group = {
+        "_id": key,
+        "n": {"$sum": 1},
+        "memory": {"$max": "$usage.memory"},
+        "memory_avg": {"$avg": "$usage.memory"}
+    }
+    for counter in USAGE_COUNTER:
+        group[counter] = {"$sum": "$usage." + counter}
+    project = {
+        "_id": 0,
+        "name": "$_id.name",
+        "cpu": {"$cond": [
+            {"$gt": ["$wall", 0]},
+            {"$divide": [{"$add": ["$user", "$system"]}, "$wall"]},
+            0]},
+        "cpu_time": {"$add": ["$user", "$system"]}
+    }
+    if period is not None:
+        project["period"] = "$_id.period"
+    for field in group:
+        if field != "_id":
+            project[field] = 1
+    return [
+        {"$match": match},
+        {"$group": group},
+        {"$project": project},
+        {"$sort": {"cpu_time": -1, "name": 1}}
+    ]
@@ -25,17 +25,15 @@ def is_int_gt0(key, val, msg=None):
 
 def is_job(key, val):
     """
-    Check this is a :class:`.CoreJob`.
+    Check list of :class:`.CoreJob` :meth:`.qual_name` or job ``_id``
+    (:class:`bson.objectid.ObjectId`) or ``None``.
     """
     if val is None:
         return
-    msg = "[{}] expected list of CoreJob".format(key)
+    msg = "[{}] expected list of CoreJob qual_name or _id".format(key)
     assert isinstance(val, list), msg
-    if val == []:
-        return
-    assert set(str) == set([type[d] for d in val]), msg
-    # todo: verify job exists
-    # todo: decide if dependency is really a str, or can be a job class, too!?
+    for d in val:
+        assert isinstance(d, (str, bson.objectid.ObjectId)), msg
 
 
 def is_int_gt0_null(key, val):
@@ -97,9 +95,7 @@ def is_str_list_null(key, val):
         return
     msg = "[{}] expected list of str or None".format(key)
     assert isinstance(val, list), msg
-    if val == []:
-        return
-    assert set(str) == set([type[d] for d in val]), msg
+    assert all(isinstance(d, str) for d in val), msg
 
 
 def is_objectid(key, val):
@@ -28,21 +28,54 @@ To stop the worker start a new Python interpreter and go with::
 
     $ coco --worker
     $ coco --halt
+
+By default the worker polls ``sys.queue`` for the next job with the interval
+configured in ``worker.execution_plan.work_jobs``. With config setting
+``worker.dispatch: watch`` the worker listens to a MongoDB change stream on
+``sys.queue`` instead and queries for the next job only if a job has been
+enqueued or changed its state. As a safety net the worker still queries
+``sys.queue`` every ``worker.watch_poll`` seconds. Change streams require a
+MongoDB replica set. If they are not supported, the worker falls back to
+polling.
+
+By default the worker launches each job in a new Python interpreter. With
+config setting ``worker.execution: zygote`` the worker forks jobs from the
+pre-loaded agent per project, see :mod:`core4.queue.agent`.
+
+Each worker has a number of execution slots configured with
+``worker.slots`` which defaults to the number of CPU cores. Jobs occupy the
+number of slots specified in their ``slots`` property while they are locked
+by the worker. The worker claims only jobs which fit into its free slots. The
+slot usage is published in ``sys.worker``.
+
+Jobs declare their expected peak ``memory`` and ``cpu`` cores or use the
+requirements learned from previous executions. The worker claims only jobs
+which fit into its free memory and CPU capacity, see
+:mod:`core4.queue.placement`.
 """
 
 import collections
+import re
 import signal
+import threading
+import time
 from datetime import timedelta
 
 import psutil
 import pymongo
+import pymongo.errors
 
+import core4.error
 import core4.queue.job
 import core4.queue.process
 import core4.queue.query
 import core4.service.introspect.main
 import core4.util.node
 from core4.queue.daemon import CoreDaemon
+from core4.queue.query import SUMMARY_FLAGS, SUMMARY_PROJECTION
+from core4.queue.query import summary_bucket
+from core4.queue.placement import capacity_filter, reserved_capacity
+from core4.queue.semaphore import semaphore_filter
 from core4.service.introspect.command import EXECUTE
 
 #: processing steps in the main loop of :class:`.CoreWorker`
@@ -52,6 +85,38 @@ STEPS = (
     "flag_jobs",
     "collect_stats")
 
+#: job attributes retrieved with the claim of a job, see
+#: :meth:`.CoreWorker.get_next_job`
+CLAIM_PROJECTION = [
+    "_id", "name", "state", "priority", "force", "inactive_at", "started_at",
+    "query_at", "trial", "enqueued", "semaphore"
+] + list(SUMMARY_FLAGS)
+
+#: job dispatch modes of :class:`.CoreWorker`
+DISPATCH_POLL = "poll"
+DISPATCH_WATCH = "watch"
+
+#: job execution modes of :class:`.CoreWorker`
+EXECUTION_SPAWN = "spawn"
+EXECUTION_ZYGOTE = "zygote"
+
+#: change stream filter on ``sys.queue`` changes which might turn a job
+#: eligible for execution
+WATCH_PIPELINE = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": {"$in": ["insert", "replace", "delete"]}},
+                {"updateDescription.updatedFields.state": {"$exists": True}},
+                {"updateDescription.updatedFields.query_at": {
+                    "$exists": True}},
+                {"updateDescription.updatedFields.locked": {"$exists": True}},
+                {"updateDescription.updatedFields.blocked": {"$exists": True}}
+            ]
+        }
+    }
+]
+
 
 class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
     """
@@ -76,6 +141,19 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
             (min(psutil.cpu_percent(percpu=True)),
              psutil.virtual_memory()[4] / 2. ** 20))
         self.job = None
+        self.dispatch = self.config.worker.dispatch
+        self.watcher = None
+        self.pending = threading.Event()
+        self.alarm = threading.Event()
+        self.next_poll = None
+        self.execution = self.config.worker.execution
+        self.slots = self.config.worker.slots or psutil.cpu_count()
+        self.slots_used = None
+        self.capacity = {
+            "memory": psutil.virtual_memory().total / 2. ** 20,
+            "cpu": psutil.cpu_count()
+        }
+        self.learned = {}
         self.handle_signal()
 
     def handle_signal(self):
@@ -90,15 +168,130 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         """
         super().startup()
         intro = core4.service.introspect.main.CoreIntrospector()
-        self.job = intro.collect_job()
+        self.job = intro.collect_job(agent=self.agent)
+        self.load_learned()
+        if self.dispatch == DISPATCH_WATCH:
+            self.start_watch()
+        elif self.dispatch != DISPATCH_POLL:
+            raise core4.error.Core4ConfigurationError(
+                "unknown worker.dispatch [{}]".format(self.dispatch))
+        if self.execution == EXECUTION_ZYGOTE:
+            self.start_agent()
+        elif self.execution != EXECUTION_SPAWN:
+            raise core4.error.Core4ConfigurationError(
+                "unknown worker.execution [{}]".format(self.execution))
+        if not (isinstance(self.slots, int) and self.slots > 0):
+            raise core4.error.Core4ConfigurationError(
+                "worker.slots must be int > 0")
+
+    def shutdown(self):
+        """
+        Stops the change stream listener (see :meth:`.start_watch`) and shuts
+        down the worker.
+        """
+        self.stop_watch()
+        super().shutdown()
+
+    def start_watch(self):
+        """
+        Opens a change stream on ``sys.queue`` and launches a background
+        thread listening to changes (see :meth:`.watch`). If the MongoDB
+        deployment does not support change streams, then the worker falls back
+        to polling.
+
+        :return: ``True`` if the change stream has been opened, else ``False``
+        """
+        try:
+            stream = self.open_watch()
+        except pymongo.errors.PyMongoError as exc:
+            self.logger.warning(
+                "change stream on [sys.queue] not available, "
+                "fall back to polling: %s", exc)
+            return False
+        self.next_poll = core4.util.node.mongo_now()
+        self.pending.set()
+        self.watcher = threading.Thread(
+            target=self.watch, args=(stream,), daemon=True)
+        self.watcher.start()
+        self.logger.info("dispatch jobs from change stream on [sys.queue]")
+        return True
+
+    def open_watch(self):
+        """
+        :return: change stream on ``sys.queue`` filtered by
+                 :data:`WATCH_PIPELINE`
+        """
+        return self.config.sys.queue.watch(
+            pipeline=WATCH_PIPELINE,
+            max_await_time_ms=int(1000 * self.wait_time))
+
+    def watch(self, stream):
+        """
+        Listens to the passed change stream and wakes up the main loop with
+        each change. If the change stream dies, it is reopened.
+
+        :param stream: :class:`pymongo.change_stream.ChangeStream`
+        """
+        while self.watcher is not None:
+            try:
+                with stream:
+                    while stream.alive and self.watcher is not None:
+                        if stream.try_next() is not None:
+                            self.notify()
+            except pymongo.errors.PyMongoError:
+                self.logger.error("change stream on [sys.queue] failed",
+                                  exc_info=True)
+            # changes might have been missed
+            self.notify()
+            while self.watcher is not None:
+                time.sleep(self.wait_time)
+                try:
+                    stream = self.open_watch()
+                except pymongo.errors.PyMongoError:
+                    continue
+                break
+
+    def stop_watch(self):
+        """
+        Stops the change stream listener launched by :meth:`.start_watch`.
+        """
+        if self.watcher is not None:
+            watcher = self.watcher
+            self.watcher = None
+            self.alarm.set()
+            watcher.join(timeout=5 * self.wait_time + 1)
+            self.logger.info("stopped change stream on [sys.queue]")
+
+    def notify(self):
+        """
+        Flags a change of ``sys.queue`` and wakes up the main loop.
+        """
+        self.pending.set()
+        self.alarm.set()
+
+    def wait(self):
+        """
+        With ``worker.dispatch: watch`` the worker sleeps until the next cycle
+        or until woken up by a change in ``sys.queue``.
+        """
+        if self.watcher is None:
+            return super().wait()
+        self.alarm.wait(self.wait_time)
+        self.alarm.clear()
 
     def cleanup(self):
         """
-        General housekeeping method of the worker.
+        General housekeeping method of the worker. Releases all locks of jobs
+        reserved by this worker which are not running.
         """
-        ret = self.config.sys.lock.delete_many({"owner": self.identifier})
+        ret = self.config.sys.queue.update_many(
+            {
+                "locked.worker": self.identifier,
+                "state": {"$ne": core4.queue.job.STATE_RUNNING}
+            },
+            update={"$set": {"locked": None}})
         self.logger.info(
-            "cleanup removed [%d] sys.lock records", ret.raw_result["n"])
+            "cleanup released [%d] job locks", ret.modified_count)
 
     def create_plan(self):
         """
@@ -134,15 +327,18 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
 
     def run_step(self):
         """
-        This method implements the steps of the worker.
-        See :meth:`.create_plan` for further details.
+        This method implements the steps of the worker. Each step is timed
+        with the daemon's :class:`.CoreMetric`. See :meth:`.create_plan` for
+        further details.
         """
         for step in self.plan:
             interval = timedelta(seconds=step["interval"])
-            if step["next"] <= self.at:
+            if step["next"] <= self.at or (
+                    step["name"] == "work_jobs" and self.pending.is_set()):
                 self.logger.debug("enter [%s] at cycle [%s]",
                                   step["name"], self.cycle["total"])
-                step["call"]()
+                with self.metric.timer(step["name"]):
+                    step["call"]()
                 self.logger.debug("exit [%s] at cycle [%s]",
                                   step["name"], self.cycle["total"])
                 step["next"] = self.at + interval
@@ -152,83 +348,148 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         This method is part of the main
         :meth:`loop <core4.queue.daemon.CoreDaemon.loop>` phase of the worker.
 
-        The step queries and handles the best next job from ``sys.queue`` (see
-        :meth:`.get_next_job` and :meth:`.start_job`). Furthermore this method
-        *inactivates* jobs.
+        The step claims and handles the best next job from ``sys.queue`` (see
+        :meth:`.get_next_job` and :meth:`.launch_job`). Furthermore this
+        method *inactivates* jobs.
+
+        With ``worker.dispatch: watch`` the step skips querying ``sys.queue``
+        unless a change has been flagged (see :meth:`.notify`) or the safety
+        net poll interval ``worker.watch_poll`` has passed.
         """
+        if self.watcher is not None:
+            if not (self.pending.is_set() or self.at >= self.next_poll):
+                return
+            self.pending.clear()
+            self.next_poll = self.at + timedelta(
+                seconds=self.config.worker.watch_poll)
         doc = self.get_next_job()
         if doc is None:
             return
+        if self.watcher is not None:
+            # more jobs might be waiting
+            self.notify()
         if not self.inactivate(doc):
-            self.start_job(doc)
+            self.launch_job(doc)
 
     def inactivate(self, doc):
         """
         This method is called by :meth:`.work_jobs` to mark jobs which have
         reached ``inactive_at`` as ``inactive``.
 
+        The passed document is the job state *before* it has been claimed by
+        :meth:`.get_next_job`. Inactivated jobs are reset to this state and
+        released.
+
         :param doc: job document to inactivate
         """
         if doc["state"] == core4.queue.job.STATE_DEFERRED:
             if doc.get("inactive_at", None):
                 if doc["inactive_at"] <= self.at:
                     update = {
-                        "state": core4.queue.job.STATE_INACTIVE
+                        "state": core4.queue.job.STATE_INACTIVE,
+                        "started_at": doc["started_at"],
+                        "query_at": doc["query_at"],
+                        "trial": doc["trial"],
+                        "locked": None
                     }
                     ret = self.config.sys.queue.update_one(
                         filter={"_id": doc["_id"]}, update={"$set": update})
                     if ret.raw_result["n"] != 1:
                         raise RuntimeError(
                             "failed to inactivate job [{}]".format(doc["_id"]))
-                    self.queue.unlock_job(doc["_id"])
+                    self.queue.update_summary(
+                        summary_bucket(
+                            doc, state=core4.queue.job.STATE_RUNNING),
+                        summary_bucket(
+                            doc, state=core4.queue.job.STATE_INACTIVE))
+                    self.queue.release_semaphore(
+                        doc["_id"],
+                        [s["key"] for s in doc.get("semaphore") or []])
+                    self.queue.count_children([doc], "failed")
+                    self.queue.update_rollup(
+                        doc["name"], self.identifier, self.at,
+                        state=core4.queue.job.STATE_INACTIVE)
                     self.queue.make_stat('inactivate_job', str(doc["_id"]))
                     self.logger.error("done execution with [inactive] - [%s] "
                                       "with [%s]", doc["name"], doc["_id"])
                     return True
         return False
 
+    def claim_update(self):
+        """
+        Delivers the ``sys.queue`` update statement to claim a job. The job
+        is set to state ``running``, the job lock is embedded in the
+        ``locked`` attribute and the number of ``trial`` is increased.
+
+        :return: dict with MongoDB update statement
+        """
+        return {
+            "$set": {
+                "state": core4.queue.job.STATE_RUNNING,
+                "started_at": self.at,
+                "query_at": None,
+                "locked": self.queue.make_lock(self.identifier, self.at)
+            },
+            "$inc": {
+                "trial": 1
+            }
+        }
+
     def start_job(self, doc, run_async=True):
         """
-        This method is called by :meth:`.work_jobs` and encapsulated for
-        testing purposes, only.
+        Claims and launches the passed job. This method is used for testing
+        and manual job execution, only. :meth:`.work_jobs` claims jobs
+        with :meth:`.get_next_job`.
 
         :param doc: job document to launch
         :param run_async: run asynchronous (default) wait for process to
                           complete
         """
-        now = self.at
-        update = {
-            "state": core4.queue.job.STATE_RUNNING,
-            "started_at": now,
-            "query_at": None,
-            "trial": doc["trial"] + 1,
-            "locked": {
-                "at": now,
-                "heartbeat": now,
-                "hostname": core4.util.node.get_hostname(),
-                "pid": None,
-                "worker": self.identifier
-            }
-        }
-        ret = self.config.sys.queue.update_one(
-            filter={"_id": doc["_id"]}, update={"$set": update})
-        if ret.raw_result["n"] != 1:
+        before = self.config.sys.queue.find_one_and_update(
+            filter={"_id": doc["_id"], "locked": None},
+            update=self.claim_update(),
+            projection=CLAIM_PROJECTION)
+        if before is None:
             raise RuntimeError(
                 "failed to update job [{}] state [starting]".format(
                     doc["_id"]))
+        self.claimed(before)
+        self.started(before)
+        self.launch_job(doc, run_async)
+
+    def launch_job(self, doc, run_async=True):
+        """
+        Launches the job claimed with :meth:`.get_next_job` or
+        :meth:`.start_job`.
+
+        :param doc: job document to launch
+        :param run_async: run asynchronous (default) wait for process to
+                          complete
+        """
         self.queue.make_stat('request_start_job', str(doc["_id"]))
         self.logger.info("launching [%s] with _id [%s]", doc["name"],
                          doc["_id"])
         if run_async:
+            if self.execution == EXECUTION_ZYGOTE and self.agent is not None:
+                try:
+                    pid = self.agent.launch(doc["name"], str(doc["_id"]))
+                except Exception as exc:
+                    self.logger.error(
+                        "failed to fork [%s] from agent, spawning: %s",
+                        doc["_id"], exc)
+                else:
+                    self.logger.debug(
+                        "forked [%s] with pid [%s]", doc["_id"], pid)
+                    return
             core4.service.introspect.main.exec_project(
                 doc["name"], EXECUTE, wait=False, job_id=str(doc["_id"]))
         else:
             from core4.queue.process import CoreWorkerProcess
-            CoreWorkerProcess().start(doc["_id"], redirect=False, manual=True)
+            CoreWorkerProcess().start(doc["_id"], redirect=False)
 
     def get_next_job(self):
         """
-        Queries the best next job from collection ``sys.queue``. This method
+        Claims the best next job from collection ``sys.queue``. This method
         filters and orders jobs with the following properties:
 
         **filter:**
@@ -239,7 +500,17 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         * eligable for this or all worker (``.identifier``)
         * not removed, yet (``.removed_at``)
         * not killed, yet (``.killed_at``)
+        * not ``blocked`` by dependencies (see :mod:`core4.queue.dag`)
+        * not waiting for ``children`` (see :mod:`core4.queue.fanout`)
+        * not blocked by an exhausted cluster-wide ``semaphore`` (see
+          :mod:`core4.queue.semaphore`)
         * with no or past query time (``.query_at``)
+        * not in project maintenance
+        * not exceeding ``max_parallel`` on this worker
+        * not exceeding the free execution ``slots`` on this worker
+        * not exceeding the free ``memory`` and ``cpu`` capacity of this
+          worker (see :mod:`core4.queue.placement`)
+        * with ``force`` if the worker lacks resources
 
         **sort order:**
 
@@ -247,15 +518,129 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         * ``.priority``
         * enqueue date/time (job ``.id`` sort order)
 
+        The job is claimed atomically with a single
+        :meth:`find_one_and_update <pymongo.collection.Collection.find_one_and_update>`
+        which sets the job ``running`` and embeds the lock in the ``locked``
+        attribute (see :meth:`.claim_update`).
+
         The method memorises an ``offset`` attribute to ensure all jobs have a
         chance to get queries across multiple workers. If all jobs have been
         checked, then the offset is reset and querying starts from top.
 
-        In order to handle high priority jobs, the existence of a job *below*
-        the current offset is checked. If a job with a higher priority exists
-        below the ``offset``, then this high-priority job is returned.
+        In order to handle high priority jobs, the highest priority *below*
+        the current ``offset`` is checked. If a job with a higher priority
+        exists below the ``offset``, then this high-priority job is claimed.
 
-        :return: job document from collection ``sys.queue``
+        :return: job document from collection ``sys.queue`` before claim,
+                 projected to :data:`CLAIM_PROJECTION`
+        """
+        query = self.claim_filter()
+        if query is None:
+            return None
+        order = [
+            ('force', pymongo.DESCENDING),
+            ('priority', pymongo.DESCENDING),
+            ('_id', pymongo.ASCENDING)
+        ]
+        data = None
+        if self.offset:
+            top = self.config.sys.queue.find_one(
+                filter={'$and': query + [{"_id": {"$lte": self.offset}}]},
+                projection={"_id": 0, "priority": 1},
+                sort=order)
+            bottom = [{"_id": {"$gt": self.offset}}]
+            if top is not None:
+                bottom.append({"priority": {"$gte": top["priority"]}})
+            data = self._claim(query + bottom, order)
+            if data is not None:
+                self.logger.debug(
+                    "next job from bottom chunk [%s]", data["_id"])
+        if data is None:
+            data = self._claim(query, order)
+            if data is None:
+                self.offset = None
+                return None
+            self.logger.debug("next job from top chunk [%s]", data["_id"])
+        self.offset = data["_id"]
+        self.logger.debug('successfully reserved [%s]', data["_id"])
+        return data
+
+    def _claim(self, query, order):
+        # internal method used by .get_next_job to claim the job
+        doc = self.config.sys.queue.find_one_and_update(
+            filter={'$and': query},
+            update=self.claim_update(),
+            projection=CLAIM_PROJECTION,
+            sort=order,
+            return_document=pymongo.ReturnDocument.BEFORE)
+        if doc is not None:
+            self.claimed(doc)
+            if not self.queue.acquire_semaphore(doc, self.identifier):
+                self.unclaim(doc)
+                return None
+            self.started(doc)
+        return doc
+
+    def unclaim(self, doc):
+        """
+        Releases the claimed job which failed to acquire its cluster-wide
+        semaphores, see :mod:`core4.queue.semaphore`. The job is reset to its
+        state before the claim.
+
+        :param doc: job document before claim
+        """
+        update = {
+            "state": doc["state"],
+            "started_at": doc["started_at"],
+            "query_at": doc["query_at"],
+            "trial": doc["trial"],
+            "locked": None
+        }
+        ret = self.config.sys.queue.update_one(
+            filter={"_id": doc["_id"], "locked.worker": self.identifier},
+            update={"$set": update})
+        if ret.raw_result["n"] != 1:
+            raise RuntimeError(
+                "failed to release job [{}]".format(doc["_id"]))
+        self.queue.update_summary(
+            summary_bucket(doc, state=core4.queue.job.STATE_RUNNING),
+            summary_bucket(doc))
+        self.logger.debug("released job [%s] with exhausted semaphore",
+                          doc["_id"])
+
+    def claimed(self, doc):
+        """
+        Moves the claimed job into state ``running`` in ``sys.summary``.
+
+        :param doc: job document before claim
+        """
+        self.queue.update_summary(
+            summary_bucket(doc),
+            summary_bucket(doc, state=core4.queue.job.STATE_RUNNING))
+
+    def started(self, doc):
+        """
+        Counts the start and the waiting time of the claimed job in
+        ``sys.rollup``, see :mod:`core4.queue.rollup`. The waiting time
+        starts with ``query_at`` of deferred and failed jobs and with
+        ``enqueued.at`` otherwise.
+
+        :param doc: job document before claim
+        """
+        ready = doc.get("query_at") or (doc.get("enqueued") or {}).get("at")
+        wait = None
+        if ready is not None:
+            wait = (self.at - ready).total_seconds()
+        self.queue.update_rollup(doc["name"], self.identifier, self.at,
+                                 started=True, wait=wait)
+
+    def claim_filter(self):
+        """
+        Delivers the ``sys.queue`` filter of jobs eligible for execution by
+        this worker, see :meth:`.get_next_job`.
+
+        :return: list of MongoDB filter statements or ``None`` if the worker
+                 cannot claim any jobs
         """
         query = [
             {'locked': None},
@@ -270,83 +655,109 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
                      {'worker': None}]},
             {'removed_at': None},
             {'killed_at': None},
+            {'blocked.0': {'$exists': False}},
+            {'children.waiting': {'$ne': True}},
             {'$or': [{'query_at': {'$lte': self.at}},
                      {'query_at': None}]},
         ]
-        order = [
-            ('force', pymongo.DESCENDING),
-            ('priority', pymongo.DESCENDING),
-            ('_id', pymongo.ASCENDING)
+        # skip projects in maintenance
+        project = self.queue.maintenance(project=True)
+        if project:
+            query.append({"name": {"$not": re.compile(
+                r"^(" + "|".join(re.escape(p) for p in project) + r")\.")}})
+        # check system resources
+        cur_stats = self.avg_stats()
+        if ((cur_stats[0] > self.config.worker.max_cpu)
+                or (cur_stats[1] < self.config.worker.min_free_ram)):
+            self.logger.info(
+                'not enough resources available: cpu [%1.1f], '
+                'memory [%1.1f], claim forced jobs only', *cur_stats[:2])
+            query.append({"force": True})
+        # check cluster-wide semaphores
+        semaphore = semaphore_filter(self.queue.get_semaphore_usage())
+        if semaphore:
+            query.append(semaphore)
+        # check max_parallel, slots and capacity
+        running = list(self.config.sys.queue.aggregate([
+            {"$match": {"locked.worker": self.identifier}},
+            {"$group": {
+                "_id": "$name", "n": {"$sum": 1},
+                "slots": {"$sum": {"$ifNull": ["$slots", 1]}},
+                "memory": {"$sum": "$memory"},
+                "cpu": {"$sum": "$cpu"},
+                "memory_none": {"$sum": {"$cond": [
+                    {"$gt": ["$memory", None]}, 0, 1]}},
+                "cpu_none": {"$sum": {"$cond": [
+                    {"$gt": ["$cpu", None]}, 0, 1]}}}}
+        ]))
+        used = sum([doc["slots"] for doc in running])
+        self.publish_slots(used)
+        free = self.slots - used
+        if free <= 0:
+            self.logger.debug("no free slots, [%d] of [%d] used", used,
+                              self.slots)
+            return None
+        if used > 0:
+            # jobs exceeding all slots of the worker wait for an idle worker
+            query.append({"$or": [{"slots": {"$lte": free}},
+                                  {"slots": None}]})
+        query.append(capacity_filter(
+            self.free_capacity(running), self.learned))
+        parallel = [
+            {"name": doc["_id"], "max_parallel": {"$gt": doc["n"]}}
+            for doc in running
         ]
-        if self.offset:
-            cur2 = self.config.sys.queue.find(
-                filter={'$and': query + [{"_id": {"$lte": self.offset}}]},
-                sort=order)
-            query.append({'_id': {'$gt': self.offset}})
+        if parallel:
+            query.append({"$or": parallel + [
+                {"name": {"$nin": [p["name"] for p in parallel]}}]})
+        return query
+
+    def free_capacity(self, running):
+        """
+        Calculates the free memory and CPU capacity of the worker, see
+        :mod:`core4.queue.placement`.
+
+        :param running: list of dict with requirements of the running jobs
+                        grouped by job name, see :meth:`.claim_filter`
+        :return: dict with free ``memory`` in MB and ``cpu`` cores
+        """
+        reserved = reserved_capacity(running, self.learned)
+        memory = min(self.avg_stats()[1],
+                     self.capacity["memory"] - reserved["memory"])
+        if running:
+            cpu = max(0., self.capacity["cpu"] - reserved["cpu"])
         else:
-            cur2 = None
-        cur1 = self.config.sys.queue.find(
-            filter={'$and': query}, sort=order)
-        while True:
-            try:
-                data = cur1.next()
-            except StopIteration:
-                data = None
-            if cur2 is not None:
-                try:
-                    data2 = cur2.next()
-                except StopIteration:
-                    data2 = None
-            else:
-                data2 = None
-            if data is None:
-                if data2 is None:
-                    self.offset = None
-                    return None
-                self.logger.debug(
-                    "next job from top chunk [%s]", data2["_id"])
-                data = data2
-            else:
-                self.logger.debug(
-                    "next job from bottom chunk [%s]", data["_id"])
-                if data2 is not None and data2["priority"] > data["priority"]:
-                    data = data2
-                    self.logger.debug(
-                        "next job from prioritised top chunk [%s]",
-                        data["_id"])
-            project = data["name"].split(".")[0]
-            if self.queue.maintenance(project):
-                self.logger.debug(
-                    "skipped job [%s] in maintenance", data["_id"])
-                continue
-
-            # check system resources
-            cur_stats = self.avg_stats()
-            if ((cur_stats[0] > self.config.worker.max_cpu)
-                    or (cur_stats[1] < self.config.worker.min_free_ram)):
-                if not data["force"]:
-                    self.logger.info(
-                        'skipped job [%s] with _id [%s]: '
-                        'not enough resources available: '
-                        'cpu [%1.1f], memory [%1.1f]',
-                        data["name"], data["_id"], *cur_stats[:2])
-                    return None
-
-            # check max_parallel
-            count = self.config.sys.queue.count_documents(
-                filter={'name': data["name"],
-                        "locked.worker": self.identifier})
-            if count >= data["max_parallel"]:
-                continue
-            # acquire lock
-            if not self.queue.lock_job(self.identifier, data["_id"]):
-                self.logger.debug('skipped job [%s] due to lock failure',
-                                  data["_id"])
-                continue
-
-            self.offset = data["_id"]
-            self.logger.debug('successfully reserved [%s]', data["_id"])
-            return data
+            # an idle worker claims jobs exceeding its CPU cores
+            cpu = float("inf")
+        return {
+            "memory": max(0., memory - self.config.worker.min_free_ram),
+            "cpu": cpu
+        }
+
+    def load_learned(self):
+        """
+        Loads the learned requirements of all jobs from ``sys.job``, see
+        :meth:`.CoreQueue.learn_requirement`.
+        """
+        self.learned = dict([
+            (doc["_id"], doc["requirement"])
+            for doc in self.config.sys.job.find(
+                {"requirement": {"$ne": None}},
+                projection=["requirement"])])
+
+    def publish_slots(self, used):
+        """
+        Publishes the total and used execution slots of the worker in
+        ``sys.worker`` if the slot usage changed.
+
+        :param used: number of occupied slots
+        """
+        if used != self.slots_used:
+            self.slots_used = used
+            self.config.sys.worker.update_one(
+                {"_id": self.identifier},
+                update={"$set": {"slots": {"total": self.slots,
+                                           "used": used}}})
 
     def remove_jobs(self):
         """
@@ -354,35 +765,51 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         :meth:`loop <core4.queue.daemon.CoreDaemon.loop>` phase of the worker.
 
         The processing step queries all jobs with a specified ``removed_at``
-        attribute. After successful job lock, the job is moved from
-        ``sys.queue`` into ``sys.journal``.
-
-        .. note:: This method does not unlock the job from ``sys.lock``. This
-                  special behavior is required to prevent race conditions
-                  between multiple workers simultaneously removing *and*
-                  locking the job between ``sys.queue`` and ``sys.lock``.
-        """
-
-        cur = self.config.sys.queue.find(
-            {"removed_at": {"$ne": None}}
-        )
-        for doc in cur:
-            if self.queue.lock_job(self.identifier, doc["_id"]):
-                if self.queue.journal(doc):
-                    ret = self.config.sys.queue.delete_one({"_id": doc["_id"]})
-                    if ret.raw_result["n"] != 1:
-                        raise RuntimeError(
-                            "failed to re<move job [{}]".format(doc["_id"]))
-                    self.queue.make_stat('remove_job', str(doc["_id"]))
-                    self.logger.info(
-                        "successfully journaled and removed job [%s]",
-                        doc["_id"])
-                    # note: we will not unlock the job to prevent race
-                    # conditions with other workds; this will be settled
-                    # with .cleanup
-                    continue
-                self.logger.error(
-                    "failed to journal and remove job [%s]", doc["_id"])
+        attribute in batches of ``worker.remove_batch``. The batch is locked
+        with a single update and moved from ``sys.queue`` into
+        ``sys.journal`` with :meth:`.CoreQueue.journal_many`. Since the lock
+        is embedded in the job document, it is released together with the
+        removal of the job.
+        """
+        batch = self.config.worker.remove_batch
+        failed = set()
+        while True:
+            _id = [d["_id"] for d in self.config.sys.queue.find(
+                {
+                    "removed_at": {"$ne": None},
+                    "locked": None,
+                    "_id": {"$nin": list(failed)}
+                },
+                projection=["_id"]).limit(batch)]
+            if not _id:
+                break
+            self.config.sys.queue.update_many(
+                {"_id": {"$in": _id}, "locked": None},
+                update={"$set": {"locked": self.queue.make_lock(
+                    self.identifier)}})
+            docs = list(self.config.sys.queue.find(
+                {"_id": {"$in": _id}, "locked.worker": self.identifier}))
+            for doc in docs:
+                doc["locked"] = None
+            journaled = set(self.queue.journal_many(docs))
+            moves = []
+            for doc in docs:
+                if doc["_id"] in journaled:
+                    moves.append((summary_bucket(doc), None))
+                else:
+                    self.logger.error(
+                        "failed to journal and remove job [%s]", doc["_id"])
+                    self.queue.unlock_job(doc["_id"])
+                    failed.add(doc["_id"])
+            if journaled:
+                self.queue.update_summary_many(moves)
+                self.queue.make_stat(
+                    'remove_job', [str(i) for i in journaled])
+                self.logger.info(
+                    "successfully journaled and removed [%d] jobs",
+                    len(journaled))
+            if len(_id) < batch:
+                break
 
     def flag_jobs(self):
         """
@@ -397,6 +824,10 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         #. identify and handle died jobs (see :meth:`.check_pid`), and to
         #. manage jobs requested to be kill (see :meth:`.kill_pid` and
            :meth:`.check_kill`)
+
+        Finally the heartbeat of all cluster-wide semaphores held by running
+        jobs locked by the worker is updated and semaphores held by jobs of dead workers
+        expire (see :meth:`.CoreQueue.expire_semaphore`).
         """
         cur = self.config.sys.queue.find(
             {
@@ -409,12 +840,16 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
                 "name"
             ]
         )
+        locked = []
         for doc in cur:
+            locked.append(doc["_id"])
             self.flag_nonstop(doc)
             self.flag_zombie(doc)
             self.check_pid(doc)
             self.kill_pid(doc)
         self.check_kill()
+        self.queue.refresh_semaphore(self.identifier, locked)
+        self.queue.expire_semaphore()
 
     def check_kill(self):
         """
@@ -458,12 +893,18 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         if doc["wall_time"] and not doc["wall_at"]:
             if doc["started_at"] < (self.at
                                     - timedelta(seconds=doc["wall_time"])):
-                ret = self.config.sys.queue.update_one(
+                at = core4.util.node.mongo_now()
+                before = self.config.sys.queue.find_one_and_update(
                     filter={
-                        "_id": doc["_id"]
+                        "_id": doc["_id"],
+                        "wall_at": None
                     },
-                    update={"$set": {"wall_at": core4.util.node.mongo_now()}})
-                if ret.raw_result["n"] == 1:
+                    update={"$set": {"wall_at": at}},
+                    projection=SUMMARY_PROJECTION)
+                if before is not None:
+                    self.queue.update_summary(
+                        summary_bucket(before),
+                        summary_bucket(before, wall_at=at))
                     self.logger.warning(
                         "successfully set non-stop job [%s]", doc["_id"])
                 self.queue.make_stat('flag_nonstop', str(doc["_id"]))
@@ -487,15 +928,21 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         if not doc["zombie_at"]:
             if doc["locked"]["heartbeat"] < (self.at - timedelta(
                     seconds=doc["zombie_time"])):
-                ret = self.config.sys.queue.update_one(
+                at = core4.util.node.mongo_now()
+                before = self.config.sys.queue.find_one_and_update(
                     filter={
-                        "_id": doc["_id"]
+                        "_id": doc["_id"],
+                        "zombie_at": None
                     },
                     update={
-                        "$set": {"zombie_at": core4.util.node.mongo_now()}
-                    }
+                        "$set": {"zombie_at": at}
+                    },
+                    projection=SUMMARY_PROJECTION
                 )
-                if ret.raw_result["n"] == 1:
+                if before is not None:
+                    self.queue.update_summary(
+                        summary_bucket(before),
+                        summary_bucket(before, zombie_at=at))
                     self.logger.warning(
                         "successfully set zombie job [%s]", doc["_id"])
                 self.queue.make_stat('flag_zombie', str(doc["_id"]))
@@ -549,13 +996,14 @@ class CoreWorker(CoreDaemon, core4.queue.query.QueryMixin):
         """
         Collects cpu and memory, inserts it as tuple into self.stats_collector.
         CPU is computed via CPU-Utilization/(idle-time+io-wait) free RAM is in
-        MB.
+        MB. Reloads the learned job requirements, see :meth:`.load_learned`.
         """
         # psutil already accounts for idle and io-wait (idle and waiting for
         # IO), we are not interested in both.
         self.stats_collector.append(
             (min(psutil.cpu_percent(percpu=True)),
              psutil.virtual_memory()[4] / 2. ** 20))
+        self.load_learned()
 
     def avg_stats(self):
         """
@@ -29,6 +29,12 @@ Usage:
   coco --info
   coco --listing [STATE]...
   coco --detail (ID | QUAL_NAME)...
+  coco --graph ID [--dot]
+  coco --semaphore
+  coco --usage [NAME]... [--period=PERIOD] [--days=DAYS]
+  coco --metric [IDENTIFIER]
+  coco --latency [NAME]... [--period=PERIOD] [--days=DAYS] [--by-worker]
+  coco --archive [--age=AGE]
   coco --remove (ID | QUAL_NAME)...
   coco --remove-hard (ID | QUAL_NAME)...
   coco --restart [ID | QUAL_NAME]...
@@ -38,7 +44,7 @@ Usage:
   coco --build
   coco --release
   coco --who
-  coco --jobs [--introspect]
+  coco --jobs [--introspect] [--refresh]
   coco --home
   coco --container
   coco --version
@@ -51,12 +57,24 @@ Options:
   -i --info        job state summary
   -l --listing     job listing
   -d --detail      job details
+  -g --graph       job dependency and chain graph, JSON or Graphviz --dot
+  --semaphore      cluster-wide semaphores and their holders
+  -u --usage       resource usage of journaled jobs by job name
+  --period=PERIOD  aggregate usage by hour, day or month and latency by
+                   minute, hour or day
+  --days=DAYS      aggregate usage and latency of the last days [default: 7]
+  --metric         main loop timings of daemons in Prometheus text format
+  --latency        job waiting time, execution time and throughput
+  --by-worker      aggregate latency by worker
+  --archive        move journaled jobs into the archive
+  --age=AGE        archive jobs older than days, defaults to archive.age
   -x --halt        immediate system halt
   -h --help        show this screen.
   -v --version     show version.
   -o --who         show system information
   -j --jobs        enumerate available jobs
   -n --introspect  register available jobs in sys.job
+  -r --refresh     rebuild job introspection cache and register jobs
   -c --container   enumerate available API container
   -m --home        enumerate available core4 projects in home folder
   -y --yes         Assume yes on all requests.
@@ -85,6 +103,8 @@ import core4.service.project
 import core4.util.data
 import core4.util.node
 from core4.service.operation import build, release
+from core4.queue.archive import CoreArchive
+from core4.queue.metric import format_metric
 
 QUEUE = core4.queue.main.CoreQueue()
 
@@ -117,20 +137,25 @@ def scheduler(name):
 def alive():
     rec = []
     mx = 0
-    cols = ["loop", "loop_time", "heartbeat", "kind", "_id"]
+    cols = ["loop", "loop_time", "heartbeat", "kind", "slots", "_id"]
     for doc in QUEUE.get_daemon():
         mx = max(0, len(doc["_id"]))
         doc["loop"] = doc["loop"].replace(microsecond=0)
         for t in ("loop_time", "heartbeat"):
             doc[t] = datetime.timedelta(seconds=int(doc[t].total_seconds()))
+        slots = doc.get("slots", None)
+        if slots:
+            doc["slots"] = "{}/{}".format(slots["used"], slots["total"])
+        else:
+            doc["slots"] = ""
         rec.append([str(doc[k]) for k in cols])
     if rec:
-        print("{:19s} {:19s} {:19s} {:9s} {:s}".format(*cols))
-        print(" ".join(["-" * i for i in [19, 19, 19, 9, mx]]))
+        print("{:19s} {:19s} {:19s} {:9s} {:7s} {:s}".format(*cols))
+        print(" ".join(["-" * i for i in [19, 19, 19, 9, 7, mx]]))
     else:
         print("no daemon.")
     for doc in rec:
-        print("{:19s} {:19s} {:19s} {:9s} {:s}".format(*doc))
+        print("{:19s} {:19s} {:19s} {:9s} {:7s} {:s}".format(*doc))
 
 
 def info():
@@ -285,6 +310,99 @@ def kill(*_id):
             print("failed to kill [{}]".format(oid))
 
 
+def graph(_id, dot=False):
+    graph = QUEUE.get_job_graph(ObjectId(_id))
+    if dot:
+        print(graph.to_dot())
+    else:
+        print(json.dumps(graph.to_doc(), indent=2, default=str))
+
+
+def semaphore():
+    rec = QUEUE.get_semaphore()
+    mx = max([len(doc["_id"]) for doc in rec] + [3])
+    if rec:
+        print("{:>5s} {:>5s} {:s}".format("n", "limit", "key"))
+        print(" ".join(["-" * i for i in [5, 5, mx]]))
+    else:
+        print("no semaphores.")
+    for doc in rec:
+        print("{:5d} {:>5s} {:s}".format(
+            doc["n"], str(doc["limit"]), doc["_id"]))
+        for holder in doc["holder"]:
+            print("{:11s} {:s} {:s} {:s}".format(
+                "", str(holder["_id"]), holder["worker"],
+                str(holder["at"].replace(microsecond=0))))
+
+
+def metric(identifier=None):
+    kwargs = {}
+    if identifier:
+        kwargs["_id"] = identifier
+    print(format_metric(QUEUE.get_metric(**kwargs)), end="")
+
+
+def latency(name, period=None, days=7, by_worker=False):
+    if period not in (None, "minute", "hour", "day"):
+        print("unknown period [%s]" % (period))
+        raise SystemExit
+    start = core4.util.node.mongo_now() - datetime.timedelta(days=days)
+    rec = QUEUE.get_queue_metric(name=name, start=start, period=period,
+                                 by_worker=by_worker)
+    if not rec:
+        print("no rollups.")
+        return
+
+    def sec(value):
+        return "-" if value is None else "{:.1f}".format(value)
+
+    cols = ["period", "started", "complete", "error", "rate/min",
+            "wait p50", "wait p99", "run p50", "run p99", "name"]
+    fmt = ("{:16s} {:>7s} {:>8s} {:>5s} {:>8s} {:>8s} {:>8s} {:>8s} "
+           "{:>8s} {:s}")
+    print(fmt.format(*cols))
+    print(" ".join(["-" * i for i in [16, 7, 8, 5, 8, 8, 8, 8, 8, 4]]))
+    for doc in rec:
+        name = doc["name"]
+        if by_worker:
+            name += " @ " + str(doc["worker"])
+        print(fmt.format(
+            doc.get("period", "-"), str(doc["started"]),
+            str(doc["complete"]), str(doc["error"]),
+            "{:.2f}".format(doc["throughput"]),
+            sec(doc["wait"]["p50"]), sec(doc["wait"]["p99"]),
+            sec(doc["runtime"]["p50"]), sec(doc["runtime"]["p99"]), name))
+
+
+def archive(age=None):
+    n = CoreArchive().archive(age)
+    print("archived [%d] jobs." % (n))
+
+
+def usage(name, period=None, days=7):
+    if period not in (None, "hour", "day", "month"):
+        print("unknown period [%s]" % (period))
+        raise SystemExit
+    start = core4.util.node.mongo_now() - datetime.timedelta(days=days)
+    rec = QUEUE.get_job_usage(name=name, start=start, period=period)
+    if not rec:
+        print("no usage.")
+        return
+    # memory, read and write in MB
+    cols = ["period", "n", "cpu_time", "cpu", "wall", "memory", "read",
+            "write", "name"]
+    fmt = "{:13s} {:>6s} {:>10s} {:>5s} {:>10s} {:>8s} {:>10s} {:>10s} {:s}"
+    print(fmt.format(*cols))
+    print(" ".join(["-" * i for i in [13, 6, 10, 5, 10, 8, 10, 10, 4]]))
+    for doc in rec:
+        print(fmt.format(
+            doc.get("period", "-"), str(doc["n"]),
+            "{:.1f}".format(doc["cpu_time"]), "{:.2f}".format(doc["cpu"]),
+            "{:.1f}".format(doc["wall"]), "{:.1f}".format(doc["memory"]),
+            "{:.1f}".format(doc["read"] / 2. ** 20),
+            "{:.1f}".format(doc["write"] / 2. ** 20), doc["name"]))
+
+
 def detail(*_id):
     _id = list(_id)
     while _id:
@@ -363,10 +481,10 @@ def init(name, description, yes):
     core4.service.project.make_project(name, description, yes)
 
 
-def jobs(introspect=False):
+def jobs(introspect=False, refresh=False):
     intro = core4.service.introspect.main.CoreIntrospector()
-    if introspect:
-        intro.collect_job()
+    if introspect or refresh:
+        intro.collect_job(refresh=refresh)
     seen = set()
     for project in intro.retrospect():
         if project["name"] not in seen:
@@ -478,6 +596,19 @@ def main():
         kill(*args["ID"])
     elif args["--detail"]:
         detail(*args["ID"])
+    elif args["--metric"]:
+        metric(args["IDENTIFIER"])
+    elif args["--latency"]:
+        latency(args["NAME"], args["--period"], int(args["--days"]),
+                args["--by-worker"])
+    elif args["--archive"]:
+        archive(int(args["--age"]) if args["--age"] else None)
+    elif args["--usage"]:
+        usage(args["NAME"], args["--period"], int(args["--days"]))
+    elif args["--semaphore"]:
+        semaphore()
+    elif args["--graph"]:
+        graph(args["ID"][0], args["--dot"])
     elif args["--mode"]:
         mode()
     elif args["--build"]:
@@ -487,7 +618,7 @@ def main():
     elif args["--who"]:
         who()
     elif args["--jobs"]:
-        jobs(args["--introspect"])
+        jobs(args["--introspect"], args["--refresh"])
     elif args["--home"]:
         home()
     elif args["--container"]:
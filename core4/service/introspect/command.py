@@ -36,6 +36,13 @@ from core4.queue.process import CoreWorkerProcess
 CoreWorkerProcess().start("{job_id:s}")
 """
 
+#: command used to start the agent of a project with
+#: :func:`core4.queue.agent.serve`
+AGENT = """
+from core4.queue.agent import serve
+serve("{project:s}")
+"""
+
 #: command used to kill a job with :meth:`.CoreQueue._exec_kill`
 KILL = """
 from core4.queue.main import CoreQueue
@@ -5,6 +5,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import concurrent.futures
+import glob
+import hashlib
 import importlib
 import inspect
 import io
@@ -15,6 +18,7 @@ import subprocess
 import sys
 import traceback
 
+import pymongo
 from pip import __version__ as pip_version
 
 import core4
@@ -28,7 +32,8 @@ import core4.queue.helper.job.base
 import core4.queue.query
 import core4.service.introspect.main
 import core4.util.node
-from core4.const import VENV_PYTHON
+from core4.config.main import CONFIG_EXTENSION, ENV_PREFIX
+from core4.const import VENV, VENV_PYTHON
 from core4.service.introspect.command import ITERATE
 
 try:
@@ -359,7 +364,7 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
                 )
         return home
 
-    def introspect(self, project=None):
+    def introspect(self, project=None, agent=None, refresh=False):
         """
         Retrieves meta information about the current or all projects. If
         ``config.folder.home`` is specified, then information about all
@@ -368,40 +373,174 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
         ``config.folder.home`` is not specified, then meta data about the
         current project is retrieved.
 
+        With config setting ``introspect.cache`` the results are cached per
+        project and reused as long as the project's :meth:`.fingerprint` is
+        unchanged. Projects without valid cache are introspected in parallel
+        with ``introspect.parallel`` threads.
+
+        :param project: name of the project, defaults to all projects
+        :param agent: :class:`.CoreAgentPool` to retrieve meta information
+                      from project agents instead of a new Python interpreter
+        :param refresh: ignore and rebuild the cache, defaults to ``False``
         :return:
         """
         home = self.get_home()
         if home:
-            data = []
-            currpath = os.curdir
+            todo = []
             for pro in sorted(os.listdir(home)):
                 if project is not None and pro != project:
                     continue
                 fullpath = os.path.abspath(os.path.join(home, pro))
                 if os.path.isdir(fullpath):
                     pypath = os.path.join(home, pro, VENV_PYTHON)
-                    os.chdir(fullpath)
-                    self.logger.info("listing [%s]", pypath)
                     if os.path.exists(pypath) and os.path.isfile(pypath):
                         # this is Python virtual environment:
-                        out, err = core4.service.introspect.main.exec_project(
-                            pro, ITERATE, comm=True)
-                        try:
-                            js = json.loads(out)
-                            data += js
-                        except Exception as exc:
-                            self.logger.error(
-                                "failed to load [%s]:\n%s\n%s\n%s",
-                                pro, exc, out, err)
+                        todo.append(pro)
                     else:
                         self.logger.error("failed to load [%s] due to"
                                           "missing Python virtual "
                                           "environment", pro)
-                os.chdir(currpath)
+            cache = self.config.introspect.cache
+            result = {}
+            fingerprint = {}
+            for pro in todo:
+                if cache:
+                    fingerprint[pro] = self.fingerprint(
+                        os.path.join(home, pro))
+                    if not refresh:
+                        js = self.read_cache(pro, fingerprint[pro])
+                        if js is not None:
+                            self.logger.debug("cache hit [%s]", pro)
+                            result[pro] = js
+            missing = [pro for pro in todo if pro not in result]
+            if missing:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.config.introspect.parallel) as pool:
+                    for pro, js in zip(missing, pool.map(
+                            lambda p: self._iterate(home, p, agent),
+                            missing)):
+                        if js is not None:
+                            result[pro] = js
+                            if cache:
+                                self.write_cache(pro, fingerprint[pro], js)
+            data = []
+            for pro in todo:
+                data += result.get(pro, [])
             return data
         else:
             return self.run()
 
+    def _iterate(self, home, project, agent=None):
+        # internal method used by .introspect to retrieve the meta data of
+        #   one project
+        fullpath = os.path.abspath(os.path.join(home, project))
+        self.logger.info("listing [%s]", fullpath)
+        if agent is not None:
+            try:
+                (out, err) = (agent.call(project, "iterate", cwd=fullpath),
+                              None)
+            except Exception as exc:
+                (out, err) = (None, str(exc))
+        else:
+            out, err = core4.service.introspect.main.exec_project(
+                project, ITERATE, comm=True, cwd=fullpath)
+        try:
+            return json.loads(out)
+        except Exception as exc:
+            self.logger.error(
+                "failed to load [%s]:\n%s\n%s\n%s", project, exc, out, err)
+        return None
+
+    def fingerprint(self, path):
+        """
+        Computes the fingerprint of the project installed in ``path``. The
+        fingerprint changes if packages are installed, upgraded or removed in
+        the project's Python virtual environment, if any Python source or
+        YAML file of the project (including the build stamp in the project's
+        ``__init__.py`` and the project configuration) changes, or if the
+        core4 configuration cascade changes, see :meth:`.config_stamp`.
+
+        :param path: project folder below ``folder.home``
+        :return: str
+        """
+        stamp = []
+        for site in sorted(glob.glob(os.path.join(
+                path, VENV, "lib", "python*", "site-packages"))):
+            stamp.append([site, os.stat(site).st_mtime])
+        stamp += source_stamp(path)
+        stamp.append(self.config_stamp())
+        return hashlib.sha1(json.dumps(stamp).encode("utf-8")).hexdigest()
+
+    def config_stamp(self):
+        """
+        Collects the state of the core4 configuration cascade, i.e. the
+        modification time of the standard and all local configuration files,
+        the ``CORE4_OPTION_`` environment variables and the hash of all
+        documents in ``sys.conf``.
+
+        :return: list
+        """
+        stamp = []
+        for filename in (self.config.standard_config,
+                         self.config._config_file, self.config.env_config,
+                         self.config.user_config, self.config.system_config):
+            if filename:
+                try:
+                    stamp.append([filename, os.stat(filename).st_mtime])
+                except OSError:
+                    stamp.append([filename, None])
+        stamp.append(sorted([k, v] for k, v in os.environ.items()
+                            if k.startswith(ENV_PREFIX)))
+        conf = self.config.sys.conf
+        if conf is not None:
+            sha1 = hashlib.sha1()
+            for doc in conf.find(sort=[("_id", 1)]):
+                sha1.update(json.dumps(
+                    doc, sort_keys=True, default=str).encode("utf-8"))
+            stamp.append(sha1.hexdigest())
+        return stamp
+
+    def _cache_file(self, project):
+        # internal method to locate the cache file of the project
+        return os.path.join(self.config.get_folder("temp"), "introspect",
+                            project + ".json")
+
+    def read_cache(self, project, fingerprint):
+        """
+        Reads the cached introspection result of the project.
+
+        :param project: project name
+        :param fingerprint: current project :meth:`.fingerprint`
+        :return: list of dict or ``None`` if the cache is missing or invalid
+        """
+        try:
+            with open(self._cache_file(project), "r", encoding="utf-8") as fh:
+                doc = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if doc.get("fingerprint") != fingerprint:
+            return None
+        return doc.get("data")
+
+    def write_cache(self, project, fingerprint, data):
+        """
+        Writes the introspection result of the project into the cache.
+
+        :param project: project name
+        :param fingerprint: current project :meth:`.fingerprint`
+        :param data: list of dict as delivered by :meth:`.run`
+        """
+        filename = self._cache_file(project)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmp = "{}.{}".format(filename, os.getpid())
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump({"fingerprint": fingerprint, "data": data}, fh)
+            os.replace(tmp, filename)
+        except OSError:
+            self.logger.warning("failed to write cache [%s]", filename,
+                                exc_info=True)
+
     def retrospect(self):
         """
         Same as :meth:`.introspect` but uses the meta data in collection
@@ -544,8 +683,30 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
             "daemon": list(self.iter_daemon())
         }
 
+    def get_python(self, name):
+        """
+        Returns the Python interpreter of the project's virtual environment.
+        Falls back to the current Python interpreter if the project has no
+        virtual environment.
+
+        :param name: qual_name to extract project name
+        :return: path to Python executable
+        """
+        project = name.split(".")[0]
+        home = self.get_home()
+        python_path = None
+        if home is not None:
+            python_path = os.path.join(home, project, VENV_PYTHON)
+            if not os.path.exists(python_path):
+                self.logger.warning("python not found at [%s]", python_path)
+                python_path = None
+        if python_path is None:
+            python_path = sys.executable
+        self.logger.debug("python found at [%s]", python_path)
+        return python_path
+
     def exec_project(self, name, command, wait=True, comm=False, replace=False,
-                     *args, **kwargs):
+                     *args, cwd=None, **kwargs):
         """
         Execute command using the Python interpreter of the project's virtual
         environment.
@@ -557,23 +718,14 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
         :param comm: wait and pass STDOUT (defaults to ``False``).
         :param replace: replace current process (defaults to ``False``).
         :param args: to be injected using Python method ``.format``
+        :param cwd: working directory of the process, defaults to the current
+                    working directory
         :param kwargs: to be injected using Python method ``.format``
 
         :return: STDOUT if ``wait is True``, else nothing is returned
         """
-        project = name.split(".")[0]
-        home = self.get_home()
-        python_path = None
-        currdir = os.path.abspath(os.curdir)
-        if home is not None:
-            python_path = os.path.join(home, project, VENV_PYTHON)
-            if not os.path.exists(python_path):
-                self.logger.warning("python not found at [%s]", python_path)
-                python_path = None
-        if python_path is None:
-            python_path = sys.executable
-        self.logger.debug("python found at [%s]", python_path)
-        # os.chdir(os.path.join(home, project))
+        python_path = self.get_python(name)
+        currdir = os.path.abspath(cwd or os.curdir)
         cmd = command.format(*args, **kwargs)
         if wait:
             if comm:
@@ -588,8 +740,7 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
         if replace:
             os.execve(python_path, [python_path, "-c", cmd], env)
         proc = subprocess.Popen([python_path, "-c", cmd], stdout=stdout,
-                                stderr=stdout, env=env)
-        os.chdir(currdir)
+                                stderr=stdout, env=env, cwd=currdir)
         if wait or comm:
             if comm:
                 (stdout, stderr) = proc.communicate()
@@ -608,7 +759,7 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
                 return stdout, stderr
             proc.wait()
 
-    def collect_job(self):
+    def collect_job(self, agent=None, refresh=False):
         """
         Collects meta data about all known jobs and inserts this information
         into ``sys.job``. The collection's primary use is to store the
@@ -631,6 +782,13 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
         * ``schedule`` - in cron format
         * ``tag`` - list of tags
         * ``valid`` - indicates if the job is valid
+
+        All jobs are written with one bulk write.
+
+        :param agent: :class:`.CoreAgentPool` passed to :meth:`.introspect`
+        :param refresh: rebuild the introspection cache, passed to
+                        :meth:`.introspect`
+        :return: dict of scheduled jobs
         """
         self.config.sys.job.update_many(
             filter={},
@@ -642,17 +800,20 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
         )
         now = core4.util.node.mongo_now()
         jobs = {}
+        seen = set()
+        ops = []
         self.logger.info("start registration")
-        for project in self.introspect():
+        for project in self.introspect(agent=agent, refresh=refresh):
             for job in project["jobs"]:
                 self.logger.debug("registering job [%s]", job["name"])
-                if job["name"] in jobs:
+                if job["name"] in seen:
                     self.logger.error("seen [%s]", job["name"])
+                seen.add(job["name"])
                 update = job.copy()
                 del update["name"]
                 update["updated_at"] = now
                 update["project"] = project["name"]
-                self.config.sys.job.update_one(
+                ops.append(pymongo.UpdateOne(
                     filter={
                         "_id": job["name"]
                     },
@@ -663,24 +824,51 @@ class CoreIntrospector(core4.base.CoreBase, core4.queue.query.QueryMixin):
                         },
                     },
                     upsert=True
-                )
+                ))
                 if job["valid"] and job["schedule"]:
-                    doc = self.config.sys.job.find_one(
-                        {"_id": job["name"]},
-                        projection=["created_at"])
                     jobs[job["name"]] = {
                         "updated_at": now,
                         "schedule": job["schedule"],
-                        "created_at": doc["created_at"]
+                        "created_at": None
                     }
                     self.logger.info("schedule [%s] at [%s]",
                                      job["name"], job["schedule"])
+        if ops:
+            self.config.sys.job.bulk_write(ops, ordered=False)
+        if jobs:
+            for doc in self.config.sys.job.find(
+                    {"_id": {"$in": list(jobs.keys())}},
+                    projection=["created_at"]):
+                jobs[doc["_id"]]["created_at"] = doc["created_at"]
         self.logger.info("registered [%d] jobs to schedule", len(jobs))
         return jobs
 
 
+def source_stamp(path):
+    """
+    Collects the modification time of all Python source and YAML files below
+    the passed folder. Python virtual environments and hidden folders are
+    skipped.
+
+    :param path: folder
+    :return: list of file name and modification time
+    """
+    stamp = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted([d for d in dirs
+                          if d != VENV and not d.startswith(".")])
+        for filename in sorted(files):
+            if filename.endswith((".py", CONFIG_EXTENSION)):
+                fullname = os.path.join(root, filename)
+                try:
+                    stamp.append([fullname, os.stat(fullname).st_mtime])
+                except OSError:
+                    continue
+    return stamp
+
+
 def exec_project(name, command, wait=True, comm=False, replace=False, *args,
-                 **kwargs):
+                 cwd=None, **kwargs):
     """
     helper method to spawn commands in the context of core4 project
     environment.
@@ -692,9 +880,10 @@ def exec_project(name, command, wait=True, comm=False, replace=False, *args,
     :param comm: wait and pass STDOUT (defaults to ``False``).
     :param replace: replace current process (defaults to ``False``).
     :param args: to be injected using Python method ``.format``
+    :param cwd: working directory of the process
     :param kwargs: to be injected using Python method ``.format``
     :return: STDOUT if ``wait is True``, else nothing is returned
     """
     intro = CoreIntrospector()
     return intro.exec_project(name, command, wait, comm, replace, *args,
-                              **kwargs)
+                              cwd=cwd, **kwargs)
@@ -42,7 +42,9 @@ class CoreSetup(CoreBase, metaclass=Singleton):
     * folders
     * users and roles
     * collection index of ``sys.queue``
+    * collection index of ``sys.journal``
     * collection TTL of ``sys.stdout``
+    * initial job state summary in ``sys.summary``
     """
 
     def make_all(self):
@@ -51,7 +53,12 @@ class CoreSetup(CoreBase, metaclass=Singleton):
         """
         self.make_folder()
         self.make_queue()
+        self.make_journal()
         self.make_stdout()
+        self.make_rollup()
+        self.make_archive()
+        self.make_summary()
+        self.make_history()
         self.make_role()
         self.make_user()
 
@@ -135,8 +142,16 @@ class CoreSetup(CoreBase, metaclass=Singleton):
         Creates collection ``sys.queue`` and its index on ``name`` and
         ``_hash``. The ``_hash`` attribute ensures that jobs are unique with
         regard to their :meth:`.qual_name` and job arguments.
+
+        Additionally the indices ``claim`` supporting the job sort order of
+        :meth:`.CoreWorker.get_next_job`, ``locked_worker`` supporting
+        the lookup of jobs reserved by a worker and ``state`` supporting the
+        progress of running jobs in :meth:`.QueryMixin.get_queue_state` are
+        created. The indices ``blocked``, ``wait_for`` and ``parent_id``
+        support the dependency and chain engine, see :mod:`core4.queue.dag`.
         """
-        if "job_args" not in self.config.sys.queue.index_information():
+        index = self.config.sys.queue.index_information()
+        if "job_args" not in index:
             self.config.sys.queue.create_index(
                 [
                     ("name", pymongo.ASCENDING),
@@ -146,14 +161,78 @@ class CoreSetup(CoreBase, metaclass=Singleton):
                 name="job_args"
             )
             self.logger.info("created index [job_args] on [sys.queue]")
+        if "claim" not in index:
+            self.config.sys.queue.create_index(
+                [
+                    ("force", pymongo.DESCENDING),
+                    ("priority", pymongo.DESCENDING),
+                    ("_id", pymongo.ASCENDING)
+                ],
+                name="claim"
+            )
+            self.logger.info("created index [claim] on [sys.queue]")
+        if "locked_worker" not in index:
+            self.config.sys.queue.create_index(
+                [
+                    ("locked.worker", pymongo.ASCENDING),
+                    ("name", pymongo.ASCENDING)
+                ],
+                name="locked_worker"
+            )
+            self.logger.info("created index [locked_worker] on [sys.queue]")
+        if "state" not in index:
+            self.config.sys.queue.create_index(
+                [
+                    ("state", pymongo.ASCENDING),
+                    ("name", pymongo.ASCENDING)
+                ],
+                name="state"
+            )
+            self.logger.info("created index [state] on [sys.queue]")
+        for name, key in (("blocked", "blocked"),
+                          ("wait_for", "wait_for"),
+                          ("parent_id", "enqueued.parent_id")):
+            if name not in index:
+                self.config.sys.queue.create_index(
+                    [(key, pymongo.ASCENDING)], name=name)
+                self.logger.info(
+                    "created index [%s] on [sys.queue]", name)
+
+    @once
+    def make_journal(self):
+        """
+        Creates the index ``parent_id`` on ``enqueued.parent_id`` and the
+        index ``finished_at`` of collection ``sys.journal``. The indices
+        support the retrieval of child job results (see
+        :mod:`core4.queue.fanout`) and the aggregation of job resource usage
+        (see :meth:`.QueryMixin.get_job_usage`).
+        """
+        index = self.config.sys.journal.index_information()
+        for name, key in (("parent_id", "enqueued.parent_id"),
+                          ("finished_at", "finished_at")):
+            if name not in index:
+                self.config.sys.journal.create_index(
+                    [(key, pymongo.ASCENDING)], name=name)
+                self.logger.info(
+                    "created index [%s] on [sys.journal]", name)
 
     @once
     def make_stdout(self):
         """
-        Creates collection ``sys.stdout`` and its TTL index on ``timestamp``.
-        If config ``worker.stdout_ttl`` is ``None``, then any existing index
-        is removed.
+        Creates collection ``sys.stdout`` with its chunk index on ``job_id``
+        and ``n`` and its TTL index on ``timestamp``. If config
+        ``worker.stdout_ttl`` is ``None``, then any existing TTL index is
+        removed.
         """
+        if "chunk" not in self.config.sys.stdout.index_information():
+            self.config.sys.stdout.create_index(
+                [
+                    ("job_id", pymongo.ASCENDING),
+                    ("n", pymongo.ASCENDING)
+                ],
+                name="chunk"
+            )
+            self.logger.info("created index [chunk] on [sys.stdout]")
         ttl = self.config.worker.stdout_ttl
         if ttl:
             if "ttl" not in self.config.sys.stdout.index_information():
@@ -167,6 +246,114 @@ class CoreSetup(CoreBase, metaclass=Singleton):
                 self.config.sys.stdout.drop_index(index_or_name="ttl")
                 self.logger.warning("removed index [ttl] from [sys.stdout]")
 
+    @once
+    def make_rollup(self):
+        """
+        Creates collection ``sys.rollup`` with its unique index on
+        ``minute``, ``name`` and ``worker`` and its TTL index on ``minute``,
+        see :mod:`core4.queue.rollup`. If config ``queue.rollup_ttl`` is
+        ``None``, then any existing TTL index is removed.
+        """
+        index = self.config.sys.rollup.index_information()
+        if "minute_name_worker" not in index:
+            self.config.sys.rollup.create_index(
+                [
+                    ("minute", pymongo.ASCENDING),
+                    ("name", pymongo.ASCENDING),
+                    ("worker", pymongo.ASCENDING)
+                ],
+                name="minute_name_worker",
+                unique=True
+            )
+            self.logger.info(
+                "created index [minute_name_worker] on [sys.rollup]")
+        ttl = self.config.queue.rollup_ttl
+        if ttl:
+            if "ttl" not in index:
+                self.config.sys.rollup.create_index(
+                    [("minute", pymongo.ASCENDING)],
+                    name="ttl",
+                    expireAfterSeconds=ttl)
+                self.logger.info("created index [ttl] on [sys.rollup]")
+        else:
+            if "ttl" in index:
+                self.config.sys.rollup.drop_index(index_or_name="ttl")
+                self.logger.warning("removed index [ttl] from [sys.rollup]")
+
+    @once
+    def make_archive(self):
+        """
+        Creates the index ``name_id`` on ``name`` and ``_id`` and the index
+        ``finished_at`` of the journal archive index ``sys.archive``, see
+        :mod:`core4.queue.archive`.
+        """
+        index = self.config.sys.archive.index_information()
+        if "name_id" not in index:
+            self.config.sys.archive.create_index(
+                [
+                    ("name", pymongo.ASCENDING),
+                    ("_id", pymongo.ASCENDING)
+                ],
+                name="name_id"
+            )
+            self.logger.info("created index [name_id] on [sys.archive]")
+        if "finished_at" not in index:
+            self.config.sys.archive.create_index(
+                [("finished_at", pymongo.ASCENDING)], name="finished_at")
+            self.logger.info("created index [finished_at] on [sys.archive]")
+
+    @once
+    def make_history(self):
+        """
+        Creates collection ``sys.queue_history`` with its unique index on
+        ``period`` and ``at`` and the TTL index on ``at`` of minute rollups,
+        see :mod:`core4.queue.history`. If config ``queue.history_ttl`` is
+        ``None``, then any existing TTL index is removed. The rollups are
+        backfilled from ``sys.event`` if they do not exist, yet.
+        """
+        index = self.config.sys.queue_history.index_information()
+        if "period_at" not in index:
+            self.config.sys.queue_history.create_index(
+                [
+                    ("period", pymongo.ASCENDING),
+                    ("at", pymongo.ASCENDING)
+                ],
+                name="period_at",
+                unique=True
+            )
+            self.logger.info(
+                "created index [period_at] on [sys.queue_history]")
+        ttl = self.config.queue.history_ttl
+        if ttl:
+            if "ttl" not in index:
+                self.config.sys.queue_history.create_index(
+                    [("at", pymongo.ASCENDING)],
+                    name="ttl",
+                    expireAfterSeconds=ttl,
+                    partialFilterExpression={"period": "minute"})
+                self.logger.info(
+                    "created index [ttl] on [sys.queue_history]")
+        else:
+            if "ttl" in index:
+                self.config.sys.queue_history.drop_index(index_or_name="ttl")
+                self.logger.warning(
+                    "removed index [ttl] from [sys.queue_history]")
+        if self.config.sys.queue_history.count_documents({}) == 0:
+            from core4.queue.main import CoreQueue
+            CoreQueue().backfill_history()
+
+    @once
+    def make_summary(self):
+        """
+        Initialises collection ``sys.summary`` from ``sys.queue`` if the
+        summary does not exist, yet. See :meth:`.CoreQueue.reconcile_summary`.
+        """
+        if self.config.sys.summary.count_documents({}) == 0:
+            if self.config.sys.queue.count_documents({}) > 0:
+                from core4.queue.main import CoreQueue
+                CoreQueue().reconcile_summary()
+                self.logger.info("initialised [sys.summary]")
+
     @once
     def make_role(self):
         """
@@ -8,13 +8,103 @@
 """
 Pagination support
 """
+import base64
+import binascii
 import collections
 
 import math
+from bson import json_util
+
+import core4.error
 
 PageResult = collections.namedtuple("PageResult",
                                     "code message page_count total_count "
-                                    "page body count per_page")
+                                    "page body count per_page next prev")
+PageResult.__new__.__defaults__ = (None, None)
+
+
+def encode_token(direction, values):
+    """
+    Encodes the opaque continuation token of keyset pagination.
+
+    :param direction: ``next`` or ``prev``
+    :param values: list of sort key values of the last or first record
+    :return: str
+    """
+    return base64.urlsafe_b64encode(
+        json_util.dumps([direction, values]).encode("utf-8")).decode("ascii")
+
+
+def decode_token(token):
+    """
+    Decodes the continuation token created with :func:`encode_token`.
+
+    :param token: str
+    :return: tuple of direction and list of sort key values
+    """
+    try:
+        (direction, values) = json_util.loads(
+            base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise core4.error.ArgumentParsingError(
+            "invalid continuation token [%s]", token) from None
+    if direction not in ("next", "prev") or not isinstance(values, list):
+        raise core4.error.ArgumentParsingError(
+            "invalid continuation token [%s]", token)
+    return direction, values
+
+
+def keyset_filter(sort_by, values):
+    """
+    Translates the passed sort order and sort key values into a MongoDB
+    filter which selects all records following the values in sort order.
+
+    :param sort_by: list of tuple with attribute and sort order
+    :param values: list of sort key values
+    :return: dict
+    """
+    clause = []
+    for i, (key, order) in enumerate(sort_by):
+        cond = dict((k, v) for (k, _), v in zip(sort_by[:i], values[:i]))
+        cond[key] = {"$gt" if order == 1 else "$lt": values[i]}
+        clause.append(cond)
+    if len(clause) == 1:
+        return clause[0]
+    return {"$or": clause}
+
+
+def sort_key(doc, sort_by):
+    """
+    :param doc: dict
+    :param sort_by: list of tuple with attribute and sort order
+    :return: list of sort key values of the passed record, supports dotted
+             attribute names
+    """
+    ret = []
+    for key, _ in sort_by:
+        value = doc
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        ret.append(value)
+    return ret
+
+
+async def count(collection, filter, limit=None):
+    """
+    Counts the documents in the passed :mod:`motor` collection. Counts
+    without a filter are estimated from the collection metadata. Counts with
+    a filter stop at ``limit``.
+
+    :param collection: :mod:`motor` collection
+    :param filter: MongoDB query dict
+    :param limit: maximum number of documents to count
+    :return: number of documents
+    """
+    if not filter:
+        return await collection.estimated_document_count()
+    if limit:
+        return await collection.count_documents(filter, limit=limit)
+    return await collection.count_documents(filter)
 
 
 class CorePager:
@@ -95,10 +185,31 @@ class CorePager:
     :class:`.PageResult` named tuple. This object type is automatically handled
     by :class:`.CoreRequestHandler` standard
     :meth:`.reply <core4.api.v1.request.main.CoreRequestHandler.reply>` method.
+
+    **Keyset pagination:**
+
+    With ``keyset=True`` or a continuation ``token`` the pager does not skip
+    records. Instead it passes a MongoDB ``filter`` which selects the records
+    following the sort key of the last record of the previous page and
+    ``skip=0`` to the ``_query`` method. The cost of a page does not depend
+    on its position. This requires
+
+    * a dict ``filter``,
+    * a ``_query`` method which applies the passed ``sort_by`` list of
+      tuples and returns the sort attributes with each record and
+    * sort attributes which exist in all records.
+
+    The pager appends ``_id`` to the sort order to identify each record.
+    :class:`.PageResult` carries the ``next`` and ``prev`` continuation
+    tokens. Pass one of them as ``token`` to retrieve the next or previous
+    page. With ``count=False`` the pager skips counting and returns
+    ``total_count`` and ``page_count`` ``None``. Use :func:`count` in the
+    ``_length`` method to estimate the total and to cap counting.
     """
 
     PAGE_ATTR = (
-        "per_page", "current_page", "filter", "sort_by")
+        "per_page", "current_page", "filter", "sort_by", "keyset", "token",
+        "count")
 
     def __init__(self, length=None, query=None, *args, **kwargs):
         """
@@ -115,12 +226,19 @@ class CorePager:
                        documents
         :param sort_by: tuple of attribute and sort order (``1`` for ascending,
                         ``-1`` for descending)
+        :param keyset: use keyset pagination, defaults to ``False``
+        :param token: continuation token of keyset pagination
+        :param count: count the records in keyset pagination, defaults to
+                      ``True``
         """
         self.__dict__["paging"] = dict(
             per_page=10,
             current_page=0,
             sort_by=None,
             filter={},
+            keyset=False,
+            token=None,
+            count=True
         )
         self.initialise(*args, **kwargs)
         self._total_count = None
@@ -147,6 +265,9 @@ class CorePager:
         :param current_page: of the pager
         :param filter: dict with :mod:`motor` query filter
         :param sort_by: tuple of sort attribute and sort order
+        :param keyset: use keyset pagination
+        :param token: continuation token of keyset pagination
+        :param count: count the records in keyset pagination
         """
         for k in kwargs:
             if k in self.PAGE_ATTR:
@@ -186,6 +307,8 @@ class CorePager:
         """
         :return: :class:`.PageResult`
         """
+        if self.keyset or self.token:
+            return await self.keyset_page()
         page = page or self.current_page
         self.current_page = page
         if self.current_page < 0:
@@ -218,6 +341,68 @@ class CorePager:
             body=body
         )
 
+    def keyset_sort(self):
+        """
+        :return: list of tuple with sort attribute and sort order of keyset
+                 pagination ending with ``_id``
+        """
+        sort_by = self.sort_by or []
+        if sort_by and isinstance(sort_by[0], str):
+            sort_by = [sort_by]
+        sort_by = [(k, int(o)) for k, o in sort_by]
+        if "_id" not in [k for k, _ in sort_by]:
+            sort_by.append(("_id", sort_by[-1][1] if sort_by else 1))
+        return sort_by
+
+    async def keyset_page(self):
+        """
+        Retrieves the page following or preceding the continuation ``token``
+        or the first page if no token has been passed.
+
+        :return: :class:`.PageResult` with page ``None``
+        """
+        sort_by = self.keyset_sort()
+        if self.token:
+            (direction, values) = decode_token(self.token)
+            if len(values) != len(sort_by):
+                raise core4.error.ArgumentParsingError(
+                    "continuation token does not match sort order")
+        else:
+            (direction, values) = ("next", None)
+        if direction == "prev":
+            sort_by = [(k, -o) for k, o in sort_by]
+        query = self.filter
+        if values is not None:
+            cond = keyset_filter(sort_by, values)
+            query = {"$and": [query, cond]} if query else cond
+        limit = int(self.per_page)
+        body = list(await self._query(0, limit + 1, query, sort_by))
+        more = len(body) > limit
+        body = body[:limit]
+        if direction == "prev":
+            body.reverse()
+            sort_by = [(k, -o) for k, o in sort_by]
+        has_next = more if direction == "next" else values is not None
+        has_prev = more if direction == "prev" else values is not None
+        page_count = total_count = None
+        if self.count:
+            page_count = await self.page_count
+            total_count = await self.filtered_count
+        return PageResult(
+            code=200,
+            message="OK",
+            page_count=page_count,
+            total_count=total_count,
+            page=None,
+            count=len(body),
+            per_page=self.per_page,
+            body=body,
+            next=encode_token("next", sort_key(body[-1], sort_by))
+            if body and has_next else None,
+            prev=encode_token("prev", sort_key(body[0], sort_by))
+            if body and has_prev else None
+        )
+
     async def length(self, filter):
         """
         Needs to be implemented with every pager. The passed filter is
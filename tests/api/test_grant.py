@@ -2,6 +2,7 @@ import pytest
 import motor
 import pymongo.errors
 import time
+import datetime
 import core4.api.v1.request.role.field
 from tests.api.test_test import setup, mongodb, core4api
 
@@ -277,6 +278,12 @@ async def test_server_test(core4api):
     rv = await core4api.get("/core4/api/v1/system")
     assert rv.code == 200
 
+    rv = await core4api.get("/core4/api/v1/system/metrics")
+    assert rv.code == 200
+    rv = await core4api.get("/core4/api/v1/system/metrics?content_type=text")
+    assert rv.code == 200
+    assert "core4_step_seconds" in rv.body.decode("utf-8")
+
     rv = await core4api.post("/core4/api/v1/access")
     assert rv.code == 200
 
@@ -519,3 +526,67 @@ async def test_profile_cascade(core4api):
     assert data["is_active"]
     assert data["role"] == ['test_reg_role', 'test_reg_role2']
     assert data["token_expires"] is not None
+
+
+async def test_job_listing_keyset(core4api):
+    await core4api.login()
+    for i in range(0, 5):
+        rv = await core4api.post("/core4/api/v1/jobs/enqueue", json={
+            "name": "core4.queue.helper.job.example.DummyJob",
+            "id": i + 1
+        }, headers={"Content-Type": "application/json"})
+        assert rv.code == 200
+    for i in range(0, 3):
+        rv = await core4api.post("/core4/api/v1/jobs/enqueue", json={
+            "name": "tests.api.test_grant.MyJob",
+            "id": i + 1
+        }, headers={"Content-Type": "application/json"})
+        assert rv.code == 200
+    await add_job_user(core4api, "test_reg_user5", perm=[
+        "api://core4.api.v1.request.queue.job.*",
+        "job://tests.+/r"
+    ])
+    rv = await core4api.get("/core4/api/v1/jobs?keyset=true&per_page=2")
+    assert rv.code == 200
+    assert rv.json()["total_count"] == 3
+    data = rv.json()["data"]
+    rv = await core4api.get(
+        "/core4/api/v1/jobs?per_page=2&cursor=" + rv.json()["next"])
+    assert rv.code == 200
+    assert rv.json()["next"] is None
+    data += rv.json()["data"]
+    assert [d["args"]["id"] for d in data] == [1, 2, 3]
+    assert {d["name"] for d in data} == {"tests.api.test_grant.MyJob"}
+
+
+async def test_queue_metric_access(core4api, mongodb):
+    from core4.queue.rollup import floor_minute, rollup_update
+    now = floor_minute(datetime.datetime.utcnow())
+    for name in ("core4.queue.helper.job.example.DummyJob",
+                 "tests.api.test_grant.MyJob"):
+        mongodb.sys.rollup.update_one(
+            {"minute": now, "name": name, "worker": "worker-0"},
+            update=rollup_update(started=True, wait=1), upsert=True)
+    await core4api.login()
+    rv = await core4api.get("/core4/api/v1/queue/metric")
+    assert rv.code == 200
+    assert len(rv.json()["data"]) == 2
+    await add_job_user(core4api, "test_reg_user6", perm=[
+        "api://core4.api.v1.request.queue.metric.*",
+        "job://tests.+/r"
+    ])
+    rv = await core4api.get("/core4/api/v1/queue/metric")
+    assert rv.code == 200
+    assert [d["name"] for d in rv.json()["data"]] == [
+        "tests.api.test_grant.MyJob"]
+    rv = await core4api.post("/core4/api/v1/queue/metric", json={
+        "name": ["core4.queue.helper.job.example.DummyJob"]
+    })
+    assert rv.code == 200
+    assert rv.json()["data"] == []
+    await add_job_user(core4api, "test_reg_user7", perm=[
+        "api://core4.api.v1.request.queue.metric.*"
+    ])
+    rv = await core4api.get("/core4/api/v1/queue/metric")
+    assert rv.code == 200
+    assert rv.json()["data"] == []
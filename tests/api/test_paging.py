@@ -6,7 +6,8 @@ import pytest
 from core4.api.v1.application import CoreApiContainer
 from core4.api.v1.request.main import CoreRequestHandler
 from core4.api.v1.server import CoreApiServer
-from core4.util.pager import CorePager
+from core4.util.pager import CorePager, count, decode_token, \
+    encode_token, keyset_filter
 from tests.api.test_test import setup, mongodb, run
 
 _ = setup
@@ -60,10 +61,33 @@ class PagingHandler(CoreRequestHandler):
         self.reply(await pager.page())
 
 
+class KeysetHandler(CoreRequestHandler):
+
+    async def get(self):
+        coll = self.config.tests.data1_collection
+
+        async def _length(filter):
+            return await count(coll, filter)
+
+        async def _query(skip, limit, filter, sort_by):
+            return await coll.find(filter).sort(sort_by).skip(skip).limit(
+                limit).to_list(limit)
+
+        pager = CorePager(
+            per_page=self.get_argument("per_page", as_type=int, default=10),
+            length=_length, query=_query, sort_by=[("value", -1)],
+            filter=self.get_argument("filter", as_type=dict, default={}),
+            keyset=True,
+            token=self.get_argument("cursor", as_type=str, default=None),
+            count=self.get_argument("count", as_type=bool, default=True))
+        self.reply(await pager.page())
+
+
 class PageServer(CoreApiContainer):
     root = "/test"
     rules = [
-        (r"/pager", PagingHandler)
+        (r"/pager", PagingHandler),
+        (r"/keyset", KeysetHandler)
     ]
 
 
@@ -121,3 +145,50 @@ async def test_empty(page_server, data):
     assert rv.code == 200
     assert rv.json()["page_count"] == 0
     assert rv.json()["data"] == []
+
+
+def test_token():
+    token = encode_token("next", [3, "a"])
+    assert decode_token(token) == ("next", [3, "a"])
+    assert keyset_filter([("value", -1)], [3]) == {"value": {"$lt": 3}}
+    assert keyset_filter([("value", -1), ("_id", 1)], [3, 7]) == {"$or": [
+        {"value": {"$lt": 3}}, {"value": 3, "_id": {"$gt": 7}}]}
+
+
+async def test_keyset(page_server, data):
+    await page_server.login()
+    rv = await page_server.get("/test/keyset?per_page=7")
+    assert rv.code == 200
+    assert rv.json()["total_count"] == 60
+    assert rv.json()["page_count"] == 9
+    assert rv.json()["page"] is None
+    assert rv.json()["prev"] is None
+    pages = [rv.json()["data"]]
+    while rv.json()["next"] is not None:
+        rv = await page_server.get(
+            "/test/keyset?per_page=7&count=false&cursor=" + rv.json()["next"])
+        assert rv.code == 200
+        assert rv.json()["total_count"] is None
+        pages.append(rv.json()["data"])
+    assert [len(p) for p in pages] == [7] * 8 + [4]
+    docs = [d for p in pages for d in p]
+    assert sorted(d["idx"] for d in docs) == list(range(1, 61))
+    value = [d["value"] for d in docs]
+    assert value == sorted(value, reverse=True)
+    rv = await page_server.get(
+        "/test/keyset?per_page=7&cursor=" + rv.json()["prev"])
+    assert rv.code == 200
+    assert rv.json()["data"] == pages[-2]
+    assert rv.json()["next"] is not None
+    rv = await page_server.get("/test/keyset?cursor=invalid")
+    assert rv.code == 400
+
+
+async def test_keyset_filter(page_server, data):
+    await page_server.login()
+    url = "/test/keyset?per_page=100&filter={}".format(
+        json.dumps({"idx": {"$lte": 30}}))
+    rv = await page_server.get(url)
+    assert rv.code == 200
+    assert rv.json()["count"] == 30
+    assert rv.json()["next"] is None
@@ -412,3 +412,76 @@ async def test_queue_group_on_a_lot_of_data(core4api, mongodb):
     assert len(response_json["data"]) == 2
     assert response_json["data"][0]["total"] == 300
     assert response_json["data"][1]["total"] == 400
+
+
+async def test_queue_history_rollup(core4api, mongodb):
+    mongodb.sys.queue_history.insert_many([
+        {
+            "period": "day",
+            "at": datetime.datetime(2018, 1, 1),
+            "created": datetime.datetime(2018, 1, 1, 10),
+            "total": 5,
+            "queue": {"pending": 5}
+        },
+        {
+            "period": "day",
+            "at": datetime.datetime(2018, 1, 2),
+            "created": datetime.datetime(2018, 1, 2, 8),
+            "total": 7,
+            "queue": {"pending": 3, "error": 4}
+        },
+        {
+            "period": "hour",
+            "at": datetime.datetime(2018, 1, 1, 10),
+            "created": datetime.datetime(2018, 1, 1, 10),
+            "total": 5,
+            "queue": {"pending": 5}
+        }
+    ])
+
+    await core4api.login()
+
+    response = await core4api.get("/core4/api/v1/queue/history?"
+                                  "startDate=2017-01-01T00:00:00&"
+                                  "endDate=2019-01-01T00:00:00&"
+                                  "sort=1")
+
+    response_json = response.json()
+
+    assert response.ok
+    assert response_json["total_count"] == 2
+    assert [d["total"] for d in response_json["data"]] == [5, 7]
+    assert response_json["data"][1]["error"] == 4
+
+
+async def test_queue_metric(core4api, mongodb):
+    from core4.queue.rollup import floor_minute, rollup_update
+    coll = mongodb.sys.rollup
+    now = floor_minute(datetime.datetime.utcnow())
+    for i in range(10):
+        key = {"minute": now - datetime.timedelta(minutes=i % 2),
+               "name": "test.Job", "worker": "worker-%d" % (i % 2)}
+        coll.update_one(key, update=rollup_update(
+            started=True, wait=i), upsert=True)
+        coll.update_one(key, update=rollup_update(
+            state="complete", runtime=2 * i), upsert=True)
+    await core4api.login()
+    response = await core4api.get("/core4/api/v1/queue/metric")
+    assert response.ok
+    data = response.json()["data"]
+    assert len(data) == 1
+    assert data[0]["name"] == "test.Job"
+    assert data[0]["started"] == 10
+    assert data[0]["complete"] == 10
+    assert data[0]["wait"]["max"] == 9
+    assert data[0]["runtime"]["max"] == 18
+    assert 4 <= data[0]["wait"]["p50"] <= 5
+    response = await core4api.get(
+        "/core4/api/v1/queue/metric?by_worker=true&period=minute")
+    assert response.ok
+    data = response.json()["data"]
+    assert [d["worker"] for d in data] == ["worker-1", "worker-0"]
+    assert [d["complete"] for d in data] == [5, 5]
+    assert data[1]["throughput"] == 5
+    response = await core4api.get("/core4/api/v1/queue/metric?period=week")
+    assert response.code == 400
@@ -1,7 +1,10 @@
 import pytest
+from bson.objectid import ObjectId
 
 import core4.api.v1.request.role.field
+from core4.api.v1.request.role.cache import RoleCache, RoleGraph
 from core4.api.v1.request.role.main import CoreRole
+from core4.api.v1.request.role.matcher import PermMatcher
 from tests.api.test_test import setup, mongodb, core4api
 
 _ = setup
@@ -898,3 +901,139 @@ async def test_cookie_create(core4api):
     data["passwd"] = "test"
     rv = await core4api.post("/core4/api/v1/roles", headers=header, body=data)
     assert rv.json()["code"] == 200
+
+
+def test_role_cache_invalidate():
+    RoleCache.clear()
+    RoleCache.doc = {1: {"_id": 1}, 2: {"_id": 2}, 3: {"_id": 3}}
+    RoleCache.graph = {
+        (1,): RoleGraph(reach=frozenset([1, 2]), role=(), perm=frozenset(),
+                        name={}),
+        (3,): RoleGraph(reach=frozenset([3]), role=(), perm=frozenset(),
+                        name={})
+    }
+    RoleCache.on_change({"operationType": "update", "documentKey": {"_id": 2}})
+    assert sorted(RoleCache.doc) == [1, 3]
+    assert list(RoleCache.graph) == [(3,)]
+    RoleCache.on_change({"operationType": "invalidate"})
+    assert RoleCache.doc == {}
+    assert RoleCache.graph == {}
+
+
+async def test_role_cache(core4api):
+    await core4api.login()
+    rv = await core4api.post("/core4/api/v1/roles", body=dict(
+        name="test_role1", perm=["app://1"]))
+    assert rv.code == 200
+    r1 = rv.json()["data"]
+    rv = await core4api.post("/core4/api/v1/roles", body=dict(
+        name="test_role2", role=["test_role1"], perm=["app://2"]))
+    assert rv.code == 200
+    rv = await core4api.post("/core4/api/v1/roles", body=dict(
+        name="test_user", email="test@plan-net.com", passwd="hello world",
+        role=["test_role2"], perm=["app://3"]))
+    assert rv.code == 200
+
+    user = await CoreRole.find_one(name="test_user")
+    assert await user.casc_perm() == ["app://1", "app://2", "app://3"]
+    assert sorted(r.name for r in await user.casc_role()) == [
+        "test_role1", "test_role2"]
+    assert tuple(user.data["role"]._id) in RoleCache.graph
+
+    rv = await core4api.put("/core4/api/v1/roles/" + r1["_id"], body=dict(
+        perm=["app://4"], etag=r1["etag"]))
+    assert rv.code == 200
+    user = await CoreRole.find_one(name="test_user")
+    assert await user.casc_perm() == ["app://2", "app://3", "app://4"]
+
+    rv = await core4api.get("/core4/api/v1/roles/" + r1["_id"])
+    rv = await core4api.delete("/core4/api/v1/roles/{}?etag={}".format(
+        r1["_id"], rv.json()["data"]["etag"]))
+    assert rv.code == 200
+    user = await CoreRole.find_one(name="test_user")
+    assert await user.casc_perm() == ["app://2", "app://3"]
+    assert [r.name for r in await user.casc_role()] == ["test_role2"]
+
+
+async def test_role_cache_etag(core4api, mongodb, monkeypatch):
+    await core4api.login()
+    rv = await core4api.post("/core4/api/v1/roles", body=dict(
+        name="test_role1", perm=["app://1"]))
+    assert rv.code == 200
+    rv = await core4api.post("/core4/api/v1/roles", body=dict(
+        name="test_user", email="test@plan-net.com", passwd="hello world",
+        role=["test_role1"]))
+    assert rv.code == 200
+    monkeypatch.setattr(RoleCache, "change_stream", None)
+    user = await CoreRole.find_one(name="test_user")
+    assert await user.casc_perm() == ["app://1"]
+    mongodb.sys.role.update_one(
+        {"name": "test_role1"},
+        {"$set": {"perm": ["app://2"], "etag": ObjectId()}})
+    user = await CoreRole.find_one(name="test_user")
+    assert await user.casc_perm() == ["app://2"]
+    mongodb.sys.role.update_one(
+        {"name": "test_role1"},
+        {"$set": {"is_active": False, "etag": ObjectId()}})
+    user = await CoreRole.find_one(name="test_user")
+    assert await user.casc_perm() == []
+
+
+def test_perm_matcher():
+    matcher = PermMatcher([
+        "api://core4.api.v1.request.standard.*",
+        "api://project.api.main",
+        "job://project.job.*/r",
+        "job://project.job.special/x",
+        "app://client/test/one",
+        "mongodb://project"
+    ], size=3)
+    assert not matcher.is_admin
+    assert matcher.has_api_access("core4.api.v1.request.standard.info")
+    assert matcher.has_api_access("project.api.main.Handler")
+    assert not matcher.has_api_access("core4.api.v1.request.role.main")
+    assert matcher.has_job_access("project.job.any")
+    assert not matcher.has_job_access("project.job.any", "x")
+    assert matcher.has_job_access("project.job.special", "x")
+    assert not matcher.has_job_access("other.job.special")
+    assert matcher.has_client_access("test/one")
+    assert not matcher.has_client_access("test")
+    assert len(matcher._result) == 3
+    admin = PermMatcher(["cop"])
+    assert admin.is_admin
+    assert admin.has_api_access("core4.api.v1.request.role.main")
+    assert admin.has_job_access("other.job", "x")
+    assert admin.has_client_access("test")
+
+
+def test_perm_matcher_pattern():
+    matcher = PermMatcher(["api://(?i)project.api", "api://(invalid",
+                           "api://core4.api.v1.request.standard.*"])
+    assert len(matcher._api) == 2
+    assert matcher.has_api_access("PROJECT.api.main")
+    assert matcher.has_api_access("core4.api.v1.request.standard.info")
+    assert not matcher.has_api_access("(invalid")
+
+
+async def test_perm_matcher_role(core4api):
+    await core4api.login()
+    rv = await core4api.post("/core4/api/v1/roles", body=dict(
+        name="test_role1", perm=["api://project.api", "job://project.*/x"]))
+    assert rv.code == 200
+    for name in ("test_user1", "test_user2"):
+        rv = await core4api.post("/core4/api/v1/roles", body=dict(
+            name=name, email=name + "@plan-net.com", passwd="hello world",
+            role=["test_role1"]))
+        assert rv.code == 200
+    user1 = await CoreRole.find_one(name="test_user1")
+    user2 = await CoreRole.find_one(name="test_user2")
+    assert await user1.perm_matcher() is await user2.perm_matcher()
+    assert await user1.has_api_access("project.api.main")
+    assert not await user1.has_api_access("core4.api.v1.request.role.main")
+    assert await user1.has_job_exec_access("project.job")
+    assert await user1.job_filter() == {
+        "name": {"$regex": "^(?:(?:project.*))"}}
+    assert not await user1.is_admin()
+    admin = await CoreRole.find_one(name="admin")
+    assert await admin.is_admin()
+    assert await admin.job_filter() is None
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from bson.objectid import ObjectId
+
+from core4.queue.archive import decode_block, encode_block, partition
+
+
+def test_partition():
+    _id = ObjectId.from_datetime(datetime.datetime(2019, 3, 31, 23, 59))
+    assert partition(_id) == "2019/03"
+    _id = ObjectId.from_datetime(datetime.datetime(2019, 12, 1))
+    assert partition(_id) == "2019/12"
+
+
+def test_block():
+    docs = [{"_id": ObjectId(), "name": "a.b.Job", "args": {"i": i}}
+            for i in range(100)]
+    data = encode_block(docs)
+    assert decode_block(data) == docs
+    assert len(data) < len(b"".join(str(d).encode() for d in docs))
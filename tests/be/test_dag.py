@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from bson.objectid import ObjectId
+
+from core4.queue.dag import JobGraph, find_cycle, split_dependency, \
+    dependency_filter, removed_filter
+
+
+def test_find_cycle():
+    assert find_cycle({}) is None
+    assert find_cycle({"a": ["b"], "b": ["c"], "c": []}) is None
+    assert find_cycle({"a": ["b", "c"], "b": ["c"], "c": []}) is None
+    assert find_cycle({"a": ["a"]}) == ["a", "a"]
+    assert find_cycle({"a": ["b"], "b": ["c"], "c": ["b"]}) == [
+        "b", "c", "b"]
+
+
+def test_split_dependency():
+    oid = ObjectId()
+    assert split_dependency(None) == ([], [])
+    assert split_dependency(["a.b.Job", oid, str(oid)]) == (
+        ["a.b.Job"], [oid, oid])
+
+
+def test_dependency_filter():
+    oid = ObjectId()
+    assert dependency_filter([]) is None
+    assert dependency_filter(["a.b.Job", oid]) == {
+        "$or": [{"name": {"$in": ["a.b.Job"]}}, {"_id": {"$in": [oid]}}],
+        "removed_at": None}
+    assert removed_filter({oid}) == {
+        "_id": {"$in": [oid]}, "state": {"$ne": "complete"}}
+
+
+def test_graph_limit():
+    graph = JobGraph(limit=2)
+    docs = [{"_id": i, "name": "job", "state": "pending"} for i in range(3)]
+    graph.add(docs)
+    assert graph.truncated
+    assert len(graph.to_doc()["nodes"]) == 2
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import pymongo.errors
+import pytest
+
+from core4.queue.history import floor_period, history_period, \
+    history_total, history_key, write_history
+
+
+class Collection:
+
+    def __init__(self, code=None):
+        self.code = code
+        self.ops = []
+
+    def bulk_write(self, ops, ordered=True):
+        self.ops.append(ops)
+        if self.code is not None:
+            raise pymongo.errors.BulkWriteError(
+                {"writeErrors": [{"code": self.code}]})
+
+
+def test_floor_period():
+    t = datetime.datetime(2019, 3, 1, 10, 5, 59, 999)
+    assert floor_period(t, "minute") == datetime.datetime(2019, 3, 1, 10, 5)
+    assert floor_period(t, "hour") == datetime.datetime(2019, 3, 1, 10)
+    assert floor_period(t, "day") == datetime.datetime(2019, 3, 1)
+
+
+def test_history_period():
+    assert history_period("year") == "day"
+    assert history_period("day") == "day"
+    assert history_period("hour") == "hour"
+    assert history_period("minute") == "minute"
+    assert history_period("second") is None
+    assert history_period("millisecond") is None
+
+
+def test_history_total():
+    assert history_total({"pending": 2, "error": 1, "complete": 5}) == 3
+    assert history_total({}) == 0
+
+
+def test_write_history():
+    t = datetime.datetime(2019, 3, 1, 10, 5, 10)
+    coll = Collection()
+    last = write_history(coll, t, {"pending": 2})
+    assert last == history_key(t, {"pending": 2})
+    assert [len(ops) for ops in coll.ops] == [3]
+    last = write_history(coll, t + datetime.timedelta(seconds=20),
+                         {"pending": 1, "running": 1}, last)
+    assert len(coll.ops) == 1
+    last = write_history(coll, t + datetime.timedelta(seconds=30),
+                         {"pending": 3}, last)
+    assert len(coll.ops) == 2
+    write_history(coll, t + datetime.timedelta(seconds=60),
+                  {"pending": 3}, last)
+    assert len(coll.ops) == 3
+
+
+def test_write_history_error():
+    t = datetime.datetime(2019, 3, 1, 10, 5, 10)
+    write_history(Collection(11000), t, {"pending": 1})
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        write_history(Collection(121), t, {"pending": 1})
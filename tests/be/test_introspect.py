@@ -1,5 +1,6 @@
 import logging
 import os
+import pymongo
 import pytest
 from pprint import pprint
 import core4.logger.mixin
@@ -93,3 +94,48 @@ def test_container():
         print(project["name"])
         for container in project["api_containers"]:
             print(container["name"])
+
+
+def test_cache(tmpdir):
+    os.environ["CORE4_OPTION_folder__root"] = str(tmpdir.join("root"))
+    os.environ["CORE4_OPTION_folder__home"] = str(tmpdir.join("home"))
+    project = tmpdir.join("home", "project")
+    project.join(".venv", "bin", "python").write("", ensure=True)
+    source = project.join("project", "__init__.py")
+    source.write("__build__ = None\n", ensure=True)
+    intro = CoreIntrospector()
+    fingerprint = intro.fingerprint(str(project))
+    assert intro.read_cache("project", fingerprint) is None
+    data = [{"name": "project", "jobs": [], "api_containers": []}]
+    intro.write_cache("project", fingerprint, data)
+    assert intro.read_cache("project", fingerprint) == data
+    assert intro.introspect() == data
+    source.setmtime(source.mtime() + 10)
+    assert intro.fingerprint(str(project)) != fingerprint
+    assert intro.read_cache("project", intro.fingerprint(
+        str(project))) is None
+
+
+def test_cache_config(tmpdir):
+    os.environ["CORE4_OPTION_folder__root"] = str(tmpdir.join("root"))
+    os.environ["CORE4_OPTION_folder__home"] = str(tmpdir.join("home"))
+    os.environ["CORE4_OPTION_sys__conf"] = "!connect mongodb://sys.conf"
+    project = tmpdir.join("home", "project")
+    project.join(".venv", "bin", "python").write("", ensure=True)
+    project.join("project", "__init__.py").write(
+        "__build__ = None\n", ensure=True)
+    intro = CoreIntrospector()
+    fingerprint = intro.fingerprint(str(project))
+    assert intro.fingerprint(str(project)) == fingerprint
+    mongo = pymongo.MongoClient(MONGO_URL)[MONGO_DATABASE]
+    try:
+        mongo.sys.conf.insert_one({"introspect": {"parallel": 2}})
+        assert intro.fingerprint(str(project)) != fingerprint
+    finally:
+        mongo.sys.conf.drop()
+    assert intro.fingerprint(str(project)) == fingerprint
+    project.join("project", "project.yaml").write("project: {}\n")
+    assert intro.fingerprint(str(project)) != fingerprint
+    fingerprint = intro.fingerprint(str(project))
+    os.environ["CORE4_OPTION_introspect__parallel"] = "!!int 2"
+    assert intro.fingerprint(str(project)) != fingerprint
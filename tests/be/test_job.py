@@ -145,6 +145,22 @@ def test_validation():
     assert job.hidden is True
 
 
+def test_validation_str_list():
+    class MyJob(core4.queue.job.CoreJob):
+        author = 'mra'
+        tag = ['bli', 'bla']
+        resource = ['db']
+
+    MyJob().validate()
+
+    class BadJob(core4.queue.job.CoreJob):
+        author = 'mra'
+        resource = ['db', 1]
+
+    with pytest.raises(AssertionError):
+        BadJob().validate()
+
+
 def test_validation2():
     class MyJob(core4.queue.job.CoreJob):
         author = 'mra'
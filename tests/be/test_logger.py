@@ -1,8 +1,11 @@
 import glob
 import importlib
+import json
 import logging
 import os
 import sys
+import tempfile
+import threading
 import unittest
 
 import pymongo
@@ -422,6 +425,103 @@ class TestLogging(unittest.TestCase):
         assert info["capped"]
         assert mongo["core4test"]["sys.event"].count_documents({}) == 1
 
+    def test_buffer(self):
+        os.environ["CORE4_CONFIG"] = tests.be.util.asset("logger/simple.yaml")
+        os.environ["CORE4_OPTION_logging__buffer__size"] = "!!int 100"
+        os.environ["CORE4_OPTION_logging__buffer__batch"] = "!!int 10"
+        os.environ["CORE4_OPTION_logging__buffer__interval"] = "!!float 60"
+        b = LogOn()
+        for i in range(25):
+            b.logger.info("this is INFO %d", i)
+        handler = core4.logger.handler.MongoLoggingHandler()
+        handler.flush()
+        stats = handler.stats()
+        self.assertEqual(0, stats["depth"])
+        self.assertEqual(0, stats["dropped"])
+        data = list(self.mongo.core4test.sys.log.find(
+            {"message": {"$regex": "^this is INFO"}}))
+        self.assertEqual(25, len(data))
+
+    def test_buffer_critical(self):
+        os.environ["CORE4_CONFIG"] = tests.be.util.asset("logger/simple.yaml")
+        os.environ["CORE4_OPTION_logging__buffer__size"] = "!!int 100"
+        os.environ["CORE4_OPTION_logging__buffer__interval"] = "!!float 60"
+        b = LogOn()
+        b.logger.info("this is INFO")
+        b.logger.critical("this is CRITICAL")
+        data = list(self.mongo.core4test.sys.log.find(
+            {"message": {"$regex": "^this is"}}))
+        self.assertEqual(["INFO", "CRITICAL"], [d["level"] for d in data])
+
+    def test_buffer_drop(self):
+        coll = self.mongo.core4test["sys.log"]
+        handler = core4.logger.handler.MongoLoggingHandler(
+            coll, size=5, batch=5, interval=60, overflow="drop")
+        logger = logging.getLogger("test_buffer_drop")
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        for i in range(50):
+            logger.debug("this is DEBUG %d", i)
+            logger.error("this is ERROR %d", i)
+        handler.close()
+        stats = handler.stats()
+        self.assertEqual(0, stats["depth"])
+        self.assertEqual(100, stats["written"] + stats["dropped"])
+        self.assertEqual(50, coll.count_documents({"level": "ERROR"}))
+        self.assertEqual(stats["dropped"],
+                         50 - coll.count_documents({"level": "DEBUG"}))
+
+    def test_buffer_spill(self):
+        coll = self.mongo.core4test["sys.log"]
+        release = threading.Event()
+
+        class Blocked:
+            # blocks the background thread until all records are logged
+
+            def insert_many(self, *args, **kwargs):
+                release.wait()
+                return coll.insert_many(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            spill = os.path.join(tmp, "spill.json")
+            handler = core4.logger.handler.MongoLoggingHandler(
+                Blocked(), size=2, batch=2, interval=60, overflow="spill",
+                spill=spill)
+            logger = logging.getLogger("test_buffer_spill")
+            logger.setLevel(logging.INFO)
+            logger.addHandler(handler)
+            for i in range(20):
+                logger.info("this is INFO %d", i)
+            stats = handler.stats()
+            # at most one batch in flight and one in the buffer
+            self.assertGreaterEqual(stats["spilled"], 16)
+            with open(spill, "r", encoding="utf-8") as fh:
+                spilled = [json.loads(line) for line in fh]
+            self.assertEqual(stats["spilled"], len(spilled))
+            release.set()
+            handler.close()
+        stats = handler.stats()
+        self.assertEqual(0, stats["depth"])
+        self.assertEqual(0, stats["dropped"])
+        self.assertEqual(20, stats["written"] + stats["spilled"])
+        written = [d["message"] for d in coll.find(
+            {"message": {"$regex": "^this is INFO"}})]
+        self.assertEqual(stats["written"], len(written))
+        self.assertEqual(
+            sorted("this is INFO %d" % i for i in range(20)),
+            sorted(written + [d["message"] for d in spilled]))
+
+    def test_buffer_config(self):
+        self.assertRaises(
+            core4.error.Core4ConfigurationError,
+            lambda: core4.logger.handler.MongoLoggingHandler(
+                None, size=1, overflow="spill"))
+        self.assertRaises(
+            core4.error.Core4ConfigurationError,
+            lambda: core4.logger.handler.MongoLoggingHandler(
+                None, size=1, overflow="unknown"))
+
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from core4.queue.metric import BUCKET, CoreMetric, Histogram, format_metric
+
+
+def test_histogram():
+    hist = Histogram()
+    assert hist.percentile(50) is None
+    for i in range(1, 101):
+        hist.observe(i / 1000.)
+    doc = hist.to_doc()
+    assert doc["n"] == 100
+    assert round(doc["sum"], 6) == 5.05
+    assert doc["max"] == 0.1
+    for p in (50, 95, 99):
+        exact = p / 1000.
+        assert exact <= doc["p{}".format(p)] <= exact * 2 ** 0.25
+    assert doc["p99"] <= doc["max"]
+
+
+def test_histogram_overflow():
+    hist = Histogram()
+    hist.observe(BUCKET[-1] * 2)
+    assert hist.percentile(50) == BUCKET[-1] * 2
+
+
+def test_timer():
+    metric = CoreMetric()
+    with metric.timer("loop"):
+        with metric.timer("work_jobs"):
+            pass
+    metric.observe_command("work_jobs", "find", 0.002)
+    doc = metric.to_doc()
+    assert set(doc["step"]) == {"loop", "work_jobs"}
+    assert doc["step"]["loop"]["n"] == 1
+    assert doc["mongo"]["work_jobs"]["find"]["p50"] == 0.002
+    metric.reset()
+    assert metric.to_doc()["step"] == {}
+
+
+def test_format_metric():
+    metric = CoreMetric()
+    metric.observe("work_jobs", 0.001)
+    metric.observe_command("work_jobs", "find", 0.0005)
+    text = format_metric([{"_id": "worker@test", "metric": metric.to_doc()}])
+    lines = text.splitlines()
+    assert "# TYPE core4_step_seconds summary" in lines
+    assert 'core4_step_seconds_count{daemon="worker@test",' \
+           'step="work_jobs"} 1' in lines
+    assert 'core4_mongo_seconds{quantile="0.99",daemon="worker@test",' \
+           'step="work_jobs",command="find"} 0.000500' in lines
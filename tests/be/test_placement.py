@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from core4.queue.placement import capacity_filter, learn, reserved_capacity
+
+
+def test_learn():
+    assert learn(None, {"memory": 100, "cpu": 0.5}, 0.9) == {
+        "memory": 100, "cpu": 0.5}
+    assert learn({"memory": 100, "cpu": 1}, {"memory": 10, "cpu": 2},
+                 0.5) == {"memory": 50, "cpu": 2}
+    assert learn({"memory": 100}, {"memory": None}, 0.9) == {
+        "memory": 90, "cpu": 0}
+
+
+def test_reserved_capacity():
+    running = [
+        {"_id": "a", "memory": 100, "cpu": 0, "memory_none": 1,
+         "cpu_none": 2},
+        {"_id": "b", "memory": 0, "cpu": 1, "memory_none": 1, "cpu_none": 0}
+    ]
+    learned = {"a": {"memory": 50, "cpu": 1}}
+    assert reserved_capacity(running, learned) == {"memory": 150, "cpu": 3}
+
+
+def test_capacity_filter():
+    learned = {"a": {"memory": 500, "cpu": 1}, "b": {"memory": 50, "cpu": 4}}
+    assert capacity_filter({"memory": 100, "cpu": 2}, learned) == {
+        "$or": [
+            {"force": True},
+            {"$and": [
+                {"$or": [{"memory": {"$lte": 100}},
+                         {"memory": None, "name": {"$nin": ["a"]}}]},
+                {"$or": [{"cpu": {"$lte": 2}},
+                         {"cpu": None, "name": {"$nin": ["b"]}}]}
+            ]}
+        ]
+    }
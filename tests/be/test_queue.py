@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import logging
 import os
 import signal
@@ -185,3 +186,90 @@ def test_project_maintenance():
     assert not q.maintenance('project1')
 
 
+
+
+def test_summary():
+    q = core4.queue.main.CoreQueue()
+    j1 = q.enqueue(core4.queue.helper.job.example.DummyJob)
+    q.enqueue(core4.queue.helper.job.example.DummyJob, a=1)
+    assert q.get_queue_count() == {"pending": 2}
+    state = q.get_queue_state()
+    assert len(state) == 1
+    assert state[0]["n"] == 2
+    assert state[0]["flags"] == "...."
+    assert q.remove_job(j1._id)
+    state = q.get_queue_state()
+    assert [(s["flags"], s["n"]) for s in state] == [
+        ("....", 1), ("..R.", 1)]
+    assert q.get_queue_count() == {"pending": 2}
+    assert q.remove_hard(j1._id)
+    assert q.get_queue_count() == {"pending": 1}
+
+
+def test_summary_reconcile():
+    q = core4.queue.main.CoreQueue()
+    for i in range(5):
+        q.enqueue(core4.queue.helper.job.example.DummyJob, i=i)
+    q.config.sys.queue.update_many({}, {"$set": {"state": "failed"}})
+    q.config.sys.summary.insert_one(
+        {"_id": "count:error", "kind": "count", "state": "error", "n": 3})
+    assert q.get_queue_count() == {"pending": 5, "error": 3}
+    assert q.reconcile_summary() == 5
+    assert q.get_queue_count() == {"failed": 5}
+    state = q.get_queue_state()
+    assert len(state) == 1
+    assert state[0]["state"] == "failed"
+    assert state[0]["n"] == 5
+
+
+def test_summary_setup():
+    q = core4.queue.main.CoreQueue()
+    q.enqueue(core4.queue.helper.job.example.DummyJob)
+    q.config.sys.summary.delete_many({})
+    assert q.get_queue_count() == {}
+    core4.service.setup.CoreSetup().make_summary()
+    assert q.get_queue_count() == {"pending": 1}
+
+
+def test_history():
+    q = core4.queue.main.CoreQueue()
+    q.enqueue(core4.queue.helper.job.example.DummyJob, i=1)
+    q.enqueue(core4.queue.helper.job.example.DummyJob, i=2)
+    docs = list(q.config.sys.queue_history.find(sort=[("period", 1)]))
+    assert [d["period"] for d in docs] == ["day", "hour", "minute"]
+    assert all(d["total"] == 2 for d in docs)
+    assert all(d["queue"] == {"pending": 2} for d in docs)
+    q.config.sys.queue_history.delete_many({})
+    t = datetime.datetime(2019, 3, 1, 10, 5)
+    q.config.sys.event.insert_many([
+        {"created": t + datetime.timedelta(seconds=s), "channel": "queue",
+         "data": {"queue": queue}}
+        for s, queue in ((0, {"pending": 1}), (10, {"pending": 3}),
+                         (20, {"pending": 2, "running": 1}),
+                         (60, {"error": 1}))])
+    assert q.backfill_history() >= 7
+    assert q.config.sys.queue_history.count_documents(
+        {"at": {"$lt": datetime.datetime(2020, 1, 1)}}) == 4
+    minute = dict((d["at"], d) for d in q.config.sys.queue_history.find(
+        {"period": "minute"}))
+    assert minute[t]["total"] == 3
+    assert minute[t]["created"] == t + datetime.timedelta(seconds=10)
+    assert minute[t + datetime.timedelta(minutes=1)]["total"] == 1
+    hour = q.config.sys.queue_history.find_one({"period": "hour"})
+    assert hour["total"] == 3
+    assert hour["queue"] == {"pending": 3}
+
+
+def test_enqueue_many():
+    q = core4.queue.main.CoreQueue()
+    q.enqueue(core4.queue.helper.job.example.DummyJob, i=1)
+    jobs = [q.prepare_job(core4.queue.helper.job.example.DummyJob, i=i)
+            for i in range(1, 4)]
+    ret = q.enqueue_many(jobs)
+    assert [j.args["i"] for j in ret] == [2, 3]
+    assert all([j._id is not None for j in ret])
+    assert q.config.sys.queue.count_documents({}) == 3
+    assert q.get_queue_count() == {"pending": 3}
+    events = list(q.config.sys.event.find({"name": "enqueue_job"}))
+    assert [e["data"]["_id"] for e in events][1] == [str(j._id) for j in ret]
+    assert q.enqueue_many([]) == []
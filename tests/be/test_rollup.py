@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from core4.queue.rollup import BUCKET, floor_minute, merge_bucket, \
+    percentile, rollup_doc, rollup_update
+
+
+def test_floor_minute():
+    assert floor_minute(datetime.datetime(2019, 3, 1, 10, 5, 59, 999)) \
+           == datetime.datetime(2019, 3, 1, 10, 5)
+
+
+def test_rollup_update():
+    update = rollup_update(started=True, wait=1.5)
+    index = BUCKET.index(min(b for b in BUCKET if b >= 1.5))
+    assert update == {
+        "$inc": {"started": 1, "wait.n": 1, "wait.sum": 1.5,
+                 "wait.bucket.{}".format(index): 1},
+        "$max": {"wait.max": 1.5}
+    }
+    update = rollup_update(state="error", runtime=-1)
+    assert update["$inc"]["error"] == 1
+    assert update["$inc"]["runtime.bucket.0"] == 1
+    assert update["$max"] == {"runtime.max": 0.}
+    assert rollup_update(state="inactive") == {"$inc": {"inactive": 1}}
+
+
+def test_percentile():
+    assert percentile(merge_bucket([]), 50, None, BUCKET) is None
+    count = merge_bucket([{}, {"10": 2}, None, {"10": 1, "20": 1}])
+    assert count[10] == 3
+    assert count[20] == 1
+    assert percentile(count, 50, 10., BUCKET) == BUCKET[10]
+    assert percentile(count, 99, 0.05, BUCKET) == 0.05
+    assert percentile(merge_bucket([{str(len(BUCKET)): 1}]), 50, 1e6,
+                      BUCKET) == 1e6
+
+
+def test_rollup_doc():
+    doc = {
+        "_id": {"name": "a.b.Job", "period": "2019-03-01T10"},
+        "started": 3, "complete": 120, "deferred": 0, "failed": 0,
+        "error": 1, "killed": 0, "inactive": 0,
+        "wait_n": 3, "wait_sum": 3., "wait_max": 2.,
+        "wait_bucket": [{"5": 3}],
+        "runtime_n": 0, "runtime_sum": 0, "runtime_max": None,
+        "runtime_bucket": []
+    }
+    ret = rollup_doc(doc, 60)
+    assert ret["name"] == "a.b.Job"
+    assert ret["period"] == "2019-03-01T10"
+    assert ret["throughput"] == 2.
+    assert ret["wait"] == {"n": 3, "avg": 1., "max": 2., "p50": BUCKET[5],
+                           "p95": BUCKET[5], "p99": BUCKET[5]}
+    assert ret["runtime"]["avg"] is None
+    assert ret["runtime"]["p50"] is None
@@ -8,6 +8,7 @@ import pytest
 import threading
 import time
 
+import core4.error
 import core4.logger.mixin
 import core4.queue.job
 import core4.util
@@ -232,6 +233,70 @@ def test_gap(mongodb):
             {'name': re.compile(e)}) == c
 
 
+def test_update_schedule(mongodb):
+    s = CoreScheduler()
+    s.startup()
+    name = 'tests.be.test_scheduler.ValidSchedule1'
+    s.at = datetime.datetime(2018, 1, 1, 0, 0, 0)
+    s.run_step()
+    job = dict(s.job)
+    job[name] = dict(job[name], schedule="1 * * * *")
+    assert s.update_job(job) == 1
+    s.at = datetime.datetime(2018, 1, 1, 0, 1, 0)
+    s.run_step()
+    assert mongodb.core4test.sys.queue.count_documents({"name": name}) == 1
+    mongodb.core4test.sys.queue.delete_many({})
+    s.at = datetime.datetime(2018, 1, 1, 0, 5, 0)
+    s.run_step()
+    assert mongodb.core4test.sys.queue.count_documents({"name": name}) == 0
+    mongodb.core4test.sys.queue.delete_many({})
+    del job[name]
+    assert s.update_job(job) == 0
+    s.at = datetime.datetime(2018, 1, 1, 1, 1, 0)
+    s.run_step()
+    assert mongodb.core4test.sys.queue.count_documents({"name": name}) == 0
+    assert mongodb.core4test.sys.queue.count_documents(
+        {"name": 'tests.be.test_scheduler.ValidSchedule4'}) == 1
+
+
+def test_heap(mongodb):
+    s = CoreScheduler()
+    s.startup()
+    start = datetime.datetime(2018, 1, 1, 0, 0, 0)
+    s.get_next(None, start)
+    assert len(s.heap) == len(s.job)
+    assert s.heap[0][0] == datetime.datetime(2018, 1, 1, 0, 1, 0)
+    ret = s.get_next(start, datetime.datetime(2018, 1, 1, 0, 1, 0))
+    assert ret == [('tests.be.test_scheduler.ValidSchedule4', '* * * * *')]
+    assert len(s.heap) == len(s.job)
+    # restart from another date/time rebuilds the heap
+    ret = s.get_next(datetime.datetime(2018, 1, 1, 0, 4, 0),
+                     datetime.datetime(2018, 1, 1, 2, 0, 0))
+    assert len(ret) == len(s.job)
+
+
+def test_catch_up(mongodb):
+    os.environ["CORE4_OPTION_scheduler__catch_up"] = "all"
+    s = CoreScheduler()
+    with pytest.raises(core4.error.Core4ConfigurationError):
+        s.startup()
+    mongodb.core4test.sys.job.insert_one(
+        {"_id": "__schedule__",
+         "schedule_at": datetime.datetime(2018, 1, 1, 0, 0, 0)})
+    os.environ["CORE4_OPTION_scheduler__catch_up"] = "once"
+    s = CoreScheduler()
+    s.startup()
+    s.exit = True
+    s.loop()
+    assert s.previous == datetime.datetime(2018, 1, 1, 0, 0, 0)
+    os.environ["CORE4_OPTION_scheduler__catch_up"] = "skip"
+    s = CoreScheduler()
+    s.startup()
+    s.exit = True
+    s.loop()
+    assert s.previous is None
+
+
 class ValidSchedule3(InvalidSchedule):
     author = "mra"
     schedule = "28 * * * *"
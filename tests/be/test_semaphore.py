@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+
+from core4.queue.semaphore import make_semaphore, semaphore_filter
+
+
+def _job(**kwargs):
+    config = SimpleNamespace(
+        semaphore=SimpleNamespace(tag={"api": 2}, resource={"db": 3}))
+    attr = dict(max_cluster=None, tag=None, resource=None)
+    attr.update(kwargs)
+    return SimpleNamespace(config=config, qual_name=lambda: "a.b.Job",
+                           **attr)
+
+
+def test_make_semaphore():
+    assert make_semaphore(_job()) == []
+    assert make_semaphore(_job(
+        max_cluster=4, tag=["api", "other"], resource=["db", "ftp"])) == [
+        {"key": "name:a.b.Job", "limit": 4},
+        {"key": "tag:api", "limit": 2},
+        {"key": "resource:db", "limit": 3},
+        {"key": "resource:ftp", "limit": 1}
+    ]
+
+
+def test_semaphore_filter():
+    assert semaphore_filter({}) is None
+    assert semaphore_filter({"tag:api": 2}) == {
+        "semaphore": {"$not": {"$elemMatch": {"$or": [
+            {"key": "tag:api", "limit": {"$lte": 2}}]}}}}
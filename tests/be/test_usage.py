@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from core4.queue.usage import USAGE_COUNTER, measure, snapshot, \
+    usage_pipeline
+
+
+def test_measure():
+    start = snapshot()
+    sum(i * i for i in range(200000))
+    usage = measure(start)
+    assert set(usage) == set(USAGE_COUNTER) | {"cpu", "memory"}
+    assert usage["wall"] > 0
+    assert usage["memory"] > 0
+    total = measure(start, previous=usage)
+    assert total["wall"] >= 2 * usage["wall"]
+    assert total["voluntary"] >= usage["voluntary"]
+    assert total["memory"] >= usage["memory"]
+
+
+def test_usage_pipeline():
+    pipeline = usage_pipeline({"name": "a.b.Job"}, period="day")
+    assert pipeline[0] == {
+        "$match": {"name": "a.b.Job", "usage": {"$ne": None}}}
+    assert pipeline[1]["$group"]["_id"] == {
+        "name": "$name", "period": {"$dateToString": {
+            "format": "%Y-%m-%d", "date": "$finished_at"}}}
+    assert pipeline[-1] == {"$sort": {"cpu_time": -1, "name": 1}}
@@ -9,16 +9,24 @@ import threading
 import time
 
 import psutil
+from bson.objectid import ObjectId
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
+import core4.base.connector.mongo
 import core4.base.main
+import core4.error
 import core4.logger.mixin
+import core4.queue.agent
+import core4.queue.archive
 import core4.queue.helper
 import core4.queue.helper.job
 import core4.queue.helper.job.example
 import core4.queue.job
 import core4.queue.main
+import core4.queue.stdout
+import core4.queue.metric
+import core4.queue.process
 import core4.queue.worker
 import core4.util.node
 
@@ -273,11 +281,18 @@ def test_halt():
 def test_enqueue_dequeue(queue):
     enqueued_job = queue.enqueue(core4.queue.helper.job.example.DummyJob)
     worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
     doc = worker.get_next_job()
-    dequeued_job = queue.job_factory(doc["name"]).deserialise(**doc)
+    assert set(doc.keys()) == set(core4.queue.worker.CLAIM_PROJECTION)
+    assert doc["state"] == "pending"
+    dequeued_job = queue.load_job(doc["_id"])
+    assert dequeued_job.state == "running"
+    assert dequeued_job.trial == 1
+    assert dequeued_job.locked["worker"] == worker.identifier
     assert enqueued_job.__dict__.keys() == dequeued_job.__dict__.keys()
     for k in enqueued_job.__dict__.keys():
-        if k not in ("logger", "config", "class_config"):
+        if k not in ("logger", "config", "class_config", "state", "trial",
+                     "locked", "started_at"):
             if enqueued_job.__dict__[k] != dequeued_job.__dict__[k]:
                 assert enqueued_job.__dict__[k] == dequeued_job.__dict__[k]
 
@@ -304,9 +319,84 @@ def test_lock():
     queue = core4.queue.main.CoreQueue()
     worker = core4.queue.worker.CoreWorker()
     queue.enqueue(core4.queue.helper.job.example.DummyJob)
+    worker.at = core4.util.node.mongo_now()
     job = worker.get_next_job()
-    assert queue.lock_job(job["_id"], worker.identifier)
-    assert queue.lock_job(job["_id"], worker.identifier) is False
+    assert queue.lock_job(worker.identifier, job["_id"]) is False
+    assert queue.unlock_job(job["_id"])
+    assert queue.config.sys.queue.count_documents(
+        {"locked": {"$ne": None}}) == 0
+    assert queue.lock_job(worker.identifier, job["_id"])
+    assert queue.lock_job(worker.identifier, job["_id"]) is False
+    assert queue.config.sys.queue.count_documents(
+        {"_id": job["_id"], "locked.worker": worker.identifier}) == 1
+
+
+def test_claim_once():
+    queue = core4.queue.main.CoreQueue()
+    queue.enqueue(core4.queue.helper.job.example.DummyJob)
+    w1 = core4.queue.worker.CoreWorker(name="worker-1")
+    w2 = core4.queue.worker.CoreWorker(name="worker-2")
+    w1.at = w2.at = core4.util.node.mongo_now()
+    assert w1.get_next_job() is not None
+    assert w2.get_next_job() is None
+    doc = queue.config.sys.queue.find_one()
+    assert doc["locked"]["worker"] == w1.identifier
+
+
+def test_claim_max_parallel():
+    queue = core4.queue.main.CoreQueue()
+    for i in range(0, 3):
+        queue.enqueue(core4.queue.helper.job.example.DummyJob, i=i,
+                      max_parallel=2)
+    worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
+    assert worker.get_next_job() is not None
+    assert worker.get_next_job() is not None
+    assert worker.get_next_job() is None
+
+
+def test_claim_slots(mongodb):
+    os.environ["CORE4_OPTION_worker__slots"] = "!!int 4"
+    queue = core4.queue.main.CoreQueue()
+    queue.enqueue(core4.queue.helper.job.example.DummyJob, i=1, slots=3)
+    queue.enqueue(core4.queue.helper.job.example.DummyJob, i=2, slots=2)
+    queue.enqueue(core4.queue.helper.job.example.DummyJob, i=3)
+    queue.enqueue(core4.queue.helper.job.example.DummyJob, i=4, slots=8)
+    worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
+    worker.register()
+    assert worker.get_next_job()["_id"] == queue.config.sys.queue.find_one(
+        {"args.i": 1})["_id"]
+    doc = worker.get_next_job()
+    assert queue.config.sys.queue.find_one(
+        {"_id": doc["_id"]})["args"]["i"] == 3
+    assert worker.get_next_job() is None
+    assert mongodb.core4test.sys.worker.find_one(
+        {"_id": worker.identifier})["slots"] == {"total": 4, "used": 4}
+    queue.config.sys.queue.delete_many({"args.i": {"$in": [1, 3]}})
+    worker.offset = None
+    doc = worker.get_next_job()
+    assert queue.config.sys.queue.find_one(
+        {"_id": doc["_id"]})["args"]["i"] == 2
+    assert worker.get_next_job() is None
+    queue.config.sys.queue.delete_many({"args.i": 2})
+    doc = worker.get_next_job()
+    assert queue.config.sys.queue.find_one(
+        {"_id": doc["_id"]})["args"]["i"] == 4
+    assert worker.get_next_job() is None
+    assert mongodb.core4test.sys.worker.find_one(
+        {"_id": worker.identifier})["slots"] == {"total": 4, "used": 8}
+
+
+def test_claim_maintenance():
+    queue = core4.queue.main.CoreQueue()
+    queue.enqueue(core4.queue.helper.job.example.DummyJob)
+    queue.enter_maintenance("core4")
+    worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
+    assert worker.get_next_job() is None
+    queue.leave_maintenance("core4")
+    assert worker.get_next_job() is not None
 
 
 
@@ -322,7 +412,41 @@ def test_remove(mongodb):
     assert 0 == mongodb.core4test.sys.queue.count_documents({})
     assert 1 == mongodb.core4test.sys.journal.count_documents({})
     worker.cleanup()
-    assert 0 == mongodb.core4test.sys.lock.count_documents({})
+    assert 0 == mongodb.core4test.sys.queue.count_documents(
+        {"locked": {"$ne": None}})
+
+
+def test_remove_batch(mongodb):
+    os.environ["CORE4_OPTION_worker__remove_batch"] = "!!int 10"
+    queue = core4.queue.main.CoreQueue()
+    worker = core4.queue.worker.CoreWorker()
+    for i in range(25):
+        job = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=i)
+        queue.remove_job(job._id)
+    worker.remove_jobs()
+    assert 0 == mongodb.core4test.sys.queue.count_documents({})
+    assert 25 == mongodb.core4test.sys.journal.count_documents({})
+    assert 0 == mongodb.core4test.sys.journal.count_documents(
+        {"locked": {"$ne": None}})
+    events = list(mongodb.core4test.sys.event.find({"name": "remove_job"}))
+    assert len(events) == 1
+    assert len(events[0]["data"]["_id"]) == 25
+    assert queue.get_queue_count() == {}
+
+
+def test_remove_batch_failed(mongodb):
+    queue = core4.queue.main.CoreQueue()
+    worker = core4.queue.worker.CoreWorker()
+    _id = [queue.enqueue(core4.queue.helper.job.example.DummyJob, i=i)._id
+           for i in range(3)]
+    for i in _id:
+        queue.remove_job(i)
+    mongodb.core4test.sys.journal.insert_one({"_id": _id[1]})
+    worker.remove_jobs()
+    assert 1 == mongodb.core4test.sys.queue.count_documents(
+        {"_id": _id[1], "locked": None})
+    assert 3 == mongodb.core4test.sys.journal.count_documents({})
+    assert queue.get_queue_count() == {"pending": 1}
 
 
 @pytest.mark.timeout(120)
@@ -439,6 +563,34 @@ def test_ok(queue, worker):
     worker.wait_queue()
 
 
+@pytest.mark.timeout(120)
+def test_watch_dispatch(queue, worker):
+    os.environ["CORE4_OPTION_worker__dispatch"] = "watch"
+    os.environ["CORE4_OPTION_worker__watch_poll"] = "!!float 1"
+    worker.start(1)
+    for i in range(0, 3):
+        queue.enqueue(core4.queue.helper.job.example.DummyJob, i=i, sleep=0)
+    worker.wait_queue()
+    assert queue.config.sys.journal.count_documents({}) == 3
+
+
+def test_watch_wait():
+    worker = core4.queue.worker.CoreWorker()
+    worker.watcher = threading.current_thread()
+    worker.next_poll = core4.util.node.mongo_now() + datetime.timedelta(
+        seconds=60)
+    worker.at = core4.util.node.mongo_now()
+    t0 = time.time()
+    worker.notify()
+    worker.wait()
+    assert time.time() - t0 < worker.wait_time
+    assert worker.pending.is_set()
+    assert not worker.alarm.is_set()
+    worker.work_jobs()
+    assert not worker.pending.is_set()
+    worker.watcher = None
+
+
 @pytest.mark.timeout(120)
 def test_error(queue, worker):
     import tests.project.work
@@ -460,6 +612,26 @@ def test_error(queue, worker):
     assert (delta[2] - delta[1]).total_seconds() >= 3
 
 
+@pytest.mark.timeout(120)
+def test_summary(queue, worker):
+    import tests.project.work
+    queue.enqueue(tests.project.work.ErrorJob, attempts=2)
+    queue.enqueue(core4.queue.helper.job.example.DummyJob, sleep=1)
+    assert queue.get_queue_count() == {"pending": 2}
+    worker.start(1)
+    while queue.config.sys.queue.count_documents({}) > 0:
+        time.sleep(0.25)
+        count = queue.get_queue_count()
+        assert sum(count.values()) <= 2
+        if queue.config.sys.queue.count_documents({"state": "error"}) > 0:
+            break
+    worker.stop()
+    assert queue.get_queue_count() == {"error": 1}
+    assert queue.get_queue_count() == dict(
+        [(d["state"], d["n"]) for d in queue.config.sys.queue.aggregate(
+            queue.pipeline_queue_count())])
+
+
 @pytest.mark.timeout(120)
 def test_defer(queue, worker):
     import tests.project.work
@@ -785,7 +957,8 @@ def test_restart_error(queue, worker):
     assert child.enqueued["parent_id"] == parent._id
     assert parent.enqueued["parent_id"] is None
     assert "child_id" not in child.enqueued
-    assert queue.config.sys.lock.count_documents({}) == 0
+    assert queue.config.sys.queue.count_documents(
+        {"locked": {"$ne": None}}) == 0
 
 
 def test_kill_running_only(queue):
@@ -880,12 +1053,51 @@ def test_stdout(queue, worker, mongodb):
     worker.wait_queue()
     assert mongodb.core4test.sys.stdout.count_documents({}) == 1
     doc = mongodb.core4test.sys.stdout.find_one()
-    print(doc)
-    assert doc["_id"] == job._id
+    assert doc["job_id"] == job._id
+    assert doc["n"] == 0
+    stdout = queue.get_job_stdout(job._id)
     assert ("this output comes from tests.be.test_worker.OutputTestJob"
-            in doc["stdout"])
-    assert ("this comes from echo" in doc["stdout"])
-    assert ("this comes from C" in doc["stdout"])
+            in stdout)
+    assert ("this comes from echo" in stdout)
+    assert ("this comes from C" in stdout)
+    assert ("this comes from stderr" not in stdout)
+
+
+class LargeOutputTestJob(core4.queue.job.CoreJob):
+    author = 'mra'
+
+    def execute(self, *args, **kwargs):
+        for i in range(1000):
+            print("line {:04d}".format(i))
+            if i == 500:
+                time.sleep(2)
+
+
+@pytest.mark.timeout(120)
+def test_stdout_chunk(queue, worker, mongodb):
+    os.environ["CORE4_OPTION_worker__stdout_chunk"] = "!!int 1000"
+    os.environ["CORE4_OPTION_worker__stdout_compress"] = "!!bool True"
+    os.environ["CORE4_OPTION_worker__stdout_stderr"] = "!!bool True"
+    job = queue.enqueue(LargeOutputTestJob)
+    worker.start(1)
+    while mongodb.core4test.sys.stdout.count_documents({}) == 0:
+        time.sleep(0.25)
+    # live output is visible while the job sleeps
+    assert mongodb.core4test.sys.queue.count_documents(
+        {"state": "running"}) == 1
+    worker.wait_queue()
+    expected = "".join(["line {:04d}\n".format(i) for i in range(1000)])
+    assert queue.get_job_stdout(job._id).startswith(expected)
+    assert mongodb.core4test.sys.stdout.count_documents(
+        {"compressed": False}) == 0
+    chunks = queue.get_job_stdout_chunk(job._id)
+    assert [c["n"] for c in chunks] == list(range(len(chunks)))
+    assert all([c["size"] == 1000 for c in chunks[:-1]])
+    assert chunks[-1]["offset"] == 1000 * (len(chunks) - 1)
+    (data, pos, n) = core4.queue.stdout.stdout_tail(chunks[2:], 2500)
+    assert data.decode("utf-8") == queue.get_job_stdout(job._id)[2500:]
+    assert n == chunks[-1]["n"]
+    assert queue.get_job_stdout_chunk(job._id, n=3, limit=2)[0]["n"] == 3
 
 
 class BinaryOutputTestJob(core4.queue.job.CoreJob):
@@ -901,9 +1113,91 @@ def test_binary_out(queue, worker, mongodb):
     worker.start(3)
     worker.wait_queue()
     assert mongodb.core4test.sys.stdout.count_documents({}) == 1
-    doc = mongodb.core4test.sys.stdout.find_one()
-    assert doc["_id"] == job._id
-    assert doc["stdout"] == b"evil payload \xDE\xAD\xBE\xEF."
+    assert (queue.get_job_stdout(job._id)
+            == b"evil payload \xDE\xAD\xBE\xEF.")
+
+
+@pytest.mark.timeout(120)
+def test_zygote(queue, worker, mongodb):
+    os.environ["CORE4_OPTION_worker__execution"] = "zygote"
+    jobs = [queue.enqueue(OutputTestJob, i=i) for i in range(3)]
+    worker.start(1)
+    worker.wait_queue()
+    assert worker.worker[0].agent is None
+    assert mongodb.core4test.sys.journal.count_documents(
+        {"state": "complete"}) == 3
+    for job in jobs:
+        stdout = queue.get_job_stdout(job._id)
+        assert ("this output comes from tests.be.test_worker.OutputTestJob"
+                in stdout)
+        assert ("this comes from C" in stdout)
+    data = list(mongodb.core4test.sys.log.find(
+        {"message": {"$regex": "^forked"}}))
+    assert len(data) == 3
+    assert len(set([d["message"] for d in data])) == 3
+
+
+@pytest.mark.timeout(120)
+def test_zygote_kill(queue, worker):
+    os.environ["CORE4_OPTION_worker__execution"] = "zygote"
+    job = queue.enqueue(ForeverJob)
+    worker.start(1)
+    while True:
+        job = queue.find_job(job._id)
+        if job.locked and job.locked["pid"]:
+            break
+    pid = job.locked["pid"]
+    assert pid != os.getpid()
+    queue.kill_job(job._id)
+    while True:
+        job = queue.find_job(job._id)
+        if job.state == "killed":
+            break
+    queue.remove_job(job._id)
+    worker.wait_queue()
+    assert not psutil.pid_exists(pid) or psutil.Process(
+        pid).status() == psutil.STATUS_ZOMBIE
+
+
+@pytest.mark.timeout(120)
+def test_agent(queue):
+    pool = core4.queue.agent.CoreAgentPool()
+    name = "core4.queue.helper.job.example.DummyJob"
+    try:
+        queue.agent = pool
+        _id = queue.exec_enqueue(name)
+        assert queue.config.sys.queue.count_documents({"_id": _id}) == 1
+        with pytest.raises(core4.error.CoreJobExists):
+            pool.call(name, "enqueue", qual_name=name)
+        assert queue.exec_enqueue(name) is None
+        pid = pool.agent["core4"].pid
+        pool.check()
+        assert pool.agent["core4"].pid == pid
+        pool.agent["core4"].kill()
+        pool.agent["core4"].wait()
+        pool.check()
+        assert pool.agent["core4"].pid != pid
+        with pytest.raises(RuntimeError):
+            pool.call(name, "unknown")
+        assert "core4" in pool.agent
+    finally:
+        queue.agent = None
+        pool.stop()
+    assert pool.agent == {}
+
+
+def test_project_stamp(tmpdir, monkeypatch):
+    package = tmpdir.join("stampproject")
+    package.join("__init__.py").write("", ensure=True)
+    module = package.join("job", "main.py")
+    module.write("", ensure=True)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    stamp = core4.queue.agent.project_stamp("stampproject")
+    assert stamp is not None
+    assert core4.queue.agent.project_stamp("stampproject") == stamp
+    module.setmtime(module.mtime() + 10)
+    assert core4.queue.agent.project_stamp("stampproject") != stamp
+    assert core4.queue.agent.project_stamp("unknownproject") is None
 
 
 @pytest.mark.timeout(120)
@@ -1012,3 +1306,380 @@ def test_project_process(queue):
     while queue.config.sys.queue.count_documents({}) > 0:
         print("waiting")
         time.sleep(1)
+
+
+class ChainTailJob(core4.queue.job.CoreJob):
+    author = "mra"
+
+    def execute(self, *args, **kwargs):
+        pass
+
+
+class ChainHeadJob(core4.queue.job.CoreJob):
+    author = "mra"
+    chain = ["tests.be.test_worker.ChainTailJob"]
+
+    def execute(self, *args, **kwargs):
+        pass
+
+
+class CycleJob(core4.queue.job.CoreJob):
+    author = "mra"
+    dependency = ["tests.be.test_worker.ChainTailJob"]
+    chain = ["tests.be.test_worker.ChainTailJob"]
+
+    def execute(self, *args, **kwargs):
+        pass
+
+
+def _complete(queue, worker):
+    worker.at = core4.util.node.mongo_now()
+    doc = worker.get_next_job()
+    queue.set_complete(queue.load_job(doc["_id"]))
+    return doc["_id"]
+
+
+def test_dependency(queue):
+    worker = core4.queue.worker.CoreWorker()
+    a = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=1)
+    b = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=2,
+                      dependency=[a._id])
+    c = queue.enqueue(ChainTailJob, dependency=[
+        "core4.queue.helper.job.example.DummyJob"])
+    assert b.blocked == [a._id]
+    assert c.wait_for == [a._id, b._id]
+    assert _complete(queue, worker) == a._id
+    doc = queue.config.sys.queue.find_one({"_id": c._id})
+    assert doc["blocked"] == [b._id]
+    assert doc["wait_for"] == [a._id, b._id]
+    assert _complete(queue, worker) == b._id
+    assert _complete(queue, worker) == c._id
+    assert queue.config.sys.journal.count_documents({}) == 3
+
+
+def test_dependency_remove(queue):
+    worker = core4.queue.worker.CoreWorker()
+    a = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=1)
+    b = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=2,
+                      dependency=[a._id])
+    c = queue.enqueue(ChainTailJob, dependency=[b._id])
+    queue.remove_job(a._id)
+    # dependants are removed with the following cycles
+    for _ in range(3):
+        worker.remove_jobs()
+    assert queue.config.sys.queue.count_documents({}) == 0
+    assert queue.config.sys.journal.count_documents(
+        {"_id": {"$in": [a._id, b._id, c._id]}}) == 3
+    assert queue.get_queue_count() == {}
+
+
+def test_dependency_restart(queue):
+    worker = core4.queue.worker.CoreWorker()
+    a = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=1)
+    b = queue.enqueue(ChainTailJob, dependency=[a._id])
+    worker.at = core4.util.node.mongo_now()
+    worker.get_next_job()
+    queue.set_killed(queue.load_job(a._id))
+    new_id = queue.restart_job(a._id)
+    doc = queue.config.sys.queue.find_one({"_id": b._id})
+    assert doc["blocked"] == [new_id]
+    assert doc["wait_for"] == [new_id]
+
+
+def test_chain(queue, worker):
+    head = queue.enqueue(ChainHeadJob)
+    worker.start(1)
+    worker.wait_queue()
+    tail = queue.config.sys.journal.find_one(
+        {"name": "tests.be.test_worker.ChainTailJob"})
+    assert tail["state"] == "complete"
+    assert tail["enqueued"]["parent_id"] == head._id
+
+
+def test_cycle(queue):
+    with pytest.raises(core4.error.CoreJobCycle):
+        queue.enqueue(CycleJob)
+    assert queue.config.sys.queue.count_documents({}) == 0
+
+
+def test_graph(queue):
+    a = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=1)
+    b = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=2,
+                      dependency=[a._id])
+    c = queue.enqueue(ChainTailJob, dependency=[a._id, str(b._id)])
+    graph = queue.get_job_graph(a._id)
+    doc = graph.to_doc()
+    assert [n["_id"] for n in doc["nodes"]] == [a._id, b._id, c._id]
+    assert sorted((e["source"], e["target"]) for e in doc["edges"]) == [
+        (a._id, b._id), (a._id, c._id), (b._id, c._id)]
+    assert not doc["truncated"]
+    assert '"{}" -> "{}"'.format(a._id, c._id) in graph.to_dot()
+
+
+class MapChildJob(core4.queue.job.CoreJob):
+    author = "mra"
+
+    def execute(self, i, **kwargs):
+        if i == 3:
+            raise RuntimeError("expected failure")
+        return i * 2
+
+
+class MapParentJob(core4.queue.job.CoreJob):
+    author = "mra"
+
+    def execute(self, n, **kwargs):
+        result = self.map(MapChildJob, ({"i": i} for i in range(n)),
+                          chunksize=4)
+        return {
+            "sum": sum(value for (args, value) in result),
+            "complete": result.complete,
+            "failed": len(list(result.errors()))
+        }
+
+
+def _wait_journal(queue, _id, timeout=60):
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        doc = queue.config.sys.journal.find_one({"_id": _id})
+        if doc is not None:
+            return doc
+        time.sleep(0.5)
+    assert False, "job [{}] not journaled".format(_id)
+
+
+@pytest.mark.timeout(120)
+def test_map(queue, worker):
+    parent = queue.enqueue(MapParentJob, n=10)
+    worker.start(1)
+    doc = _wait_journal(queue, parent._id)
+    worker.stop()
+    assert doc["state"] == "complete"
+    assert doc["trial"] == 2
+    assert doc["children"] == {"total": 10, "complete": 9, "failed": 1,
+                               "sealed": True, "waiting": False}
+    assert doc["result"] == {"sum": 2 * (45 - 3), "complete": 9, "failed": 1}
+    assert queue.config.sys.journal.count_documents(
+        {"enqueued.parent_id": parent._id}) == 9
+    child = queue.config.sys.queue.find_one(
+        {"enqueued.parent_id": parent._id})
+    assert child["state"] == "error"
+    assert child["args"] == {"i": 3}
+
+
+@pytest.mark.timeout(120)
+def test_map_empty(queue, worker):
+    parent = queue.enqueue(MapParentJob, n=0)
+    worker.start(1)
+    worker.wait_queue()
+    doc = queue.config.sys.journal.find_one({"_id": parent._id})
+    assert doc["state"] == "complete"
+    assert doc["trial"] == 1
+    assert doc["result"] == {"sum": 0, "complete": 0, "failed": 0}
+
+
+class SemaphoreJob(core4.queue.job.CoreJob):
+    author = "mra"
+    max_cluster = 1
+    resource = ["db"]
+
+    def execute(self, *args, **kwargs):
+        pass
+
+
+def test_semaphore(queue):
+    worker = core4.queue.worker.CoreWorker()
+    a = queue.enqueue(SemaphoreJob, i=1)
+    b = queue.enqueue(SemaphoreJob, i=2)
+    key = ["name:tests.be.test_worker.SemaphoreJob", "resource:db"]
+    assert [s["key"] for s in a.semaphore] == key
+    worker.at = core4.util.node.mongo_now()
+    assert worker.get_next_job()["_id"] == a._id
+    assert queue.get_semaphore_usage() == {k: 1 for k in key}
+    assert worker.get_next_job() is None
+    # lost race, the claim is released
+    assert worker._claim([{"_id": b._id}], [("_id", 1)]) is None
+    doc = queue.config.sys.queue.find_one({"_id": b._id})
+    assert doc["state"] == "pending"
+    assert doc["locked"] is None
+    assert doc["trial"] == 0
+    assert queue.get_semaphore_usage() == {k: 1 for k in key}
+    queue.set_complete(queue.load_job(a._id))
+    assert queue.get_semaphore_usage() == {}
+    assert _complete(queue, worker) == b._id
+    assert [d["n"] for d in queue.get_semaphore()] == [0, 0]
+
+
+def test_semaphore_expire(queue):
+    a = queue.enqueue(SemaphoreJob, i=1)
+    assert queue.acquire_semaphore(
+        {"_id": a._id, "semaphore": a.semaphore}, "dead")
+    queue.expire_semaphore()
+    assert len(queue.get_semaphore_usage()) == 2
+    queue.config.sys.semaphore.update_many(
+        {}, update={"$set": {"holder.0.at": core4.util.node.mongo_now()
+                             - datetime.timedelta(seconds=600)}})
+    queue.expire_semaphore()
+    assert queue.get_semaphore_usage() == {}
+
+
+def test_semaphore_release(queue):
+    worker = core4.queue.worker.CoreWorker()
+    a = queue.enqueue(SemaphoreJob, i=1)
+    b = queue.enqueue(SemaphoreJob, i=2)
+    worker.at = core4.util.node.mongo_now()
+    assert worker.get_next_job()["_id"] == a._id
+    assert queue.remove_hard(a._id)
+    assert queue.get_semaphore_usage() == {}
+    assert worker.get_next_job()["_id"] == b._id
+    # the job class cannot be loaded
+    queue.config.sys.queue.update_one(
+        {"_id": b._id}, update={"$set": {"name": "tests.be.NoJob"}})
+    proc = core4.queue.process.CoreWorkerProcess()
+    proc.queue = queue
+    assert proc.load_job(b._id) is None
+    assert queue.get_semaphore_usage() == {}
+    doc = queue.config.sys.rollup.find_one({"name": "tests.be.NoJob"})
+    assert doc["error"] == 1
+
+
+def test_semaphore_refresh(queue):
+    sem = [{"key": "test", "limit": 2}]
+    assert queue.acquire_semaphore({"_id": 1, "semaphore": sem}, "w")
+    assert queue.acquire_semaphore({"_id": 2, "semaphore": sem}, "w")
+    queue.config.sys.semaphore.update_many(
+        {}, update={"$set": {"holder.$[].at": core4.util.node.mongo_now()
+                             - datetime.timedelta(seconds=600)}})
+    # job 2 is no longer locked by the worker
+    queue.refresh_semaphore("w", [1])
+    queue.expire_semaphore()
+    assert [h["_id"] for h in queue.get_semaphore()[0]["holder"]] == [1]
+
+
+def test_capacity(queue):
+    worker = core4.queue.worker.CoreWorker()
+    min_free = worker.config.worker.min_free_ram
+    worker.capacity = {"memory": 1000. + min_free, "cpu": 4}
+    worker.stats_collector.clear()
+    worker.stats_collector.append((0., 1000. + min_free))
+    a = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=1,
+                      memory=600)
+    b = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=2,
+                      memory=600)
+    c = queue.enqueue(core4.queue.helper.job.example.DummyJob, i=3,
+                      memory=100, cpu=2)
+    worker.at = core4.util.node.mongo_now()
+    assert worker.get_next_job()["_id"] == a._id
+    assert worker.get_next_job()["_id"] == c._id
+    assert worker.get_next_job() is None
+    queue.config.sys.queue.update_one(
+        {"_id": b._id}, update={"$set": {"force": True}})
+    assert worker.get_next_job()["_id"] == b._id
+
+
+def test_learn_requirement(queue):
+    job = queue.enqueue(core4.queue.helper.job.example.DummyJob)
+    worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
+    worker.start_job(job.serialise(), run_async=False)
+    doc = queue.config.sys.journal.find_one({"_id": job._id})
+    assert doc["usage"]["memory"] > 0
+    learned = queue.config.sys.job.find_one({"_id": job.qual_name()})
+    assert learned["requirement"]["memory"] == doc["usage"]["memory"]
+    worker.load_learned()
+    assert job.qual_name() in worker.learned
+
+
+def test_job_usage(queue):
+    job = queue.enqueue(core4.queue.helper.job.example.DummyJob)
+    worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
+    worker.start_job(job.serialise(), run_async=False)
+    doc = queue.job_detail(job._id)
+    for key in ("wall", "user", "system", "cpu", "memory", "read", "write",
+                "voluntary", "involuntary"):
+        assert key in doc["usage"]
+    usage = queue.get_job_usage()
+    assert [d["name"] for d in usage] == [job.qual_name()]
+    assert usage[0]["n"] == 1
+    assert usage[0]["memory"] == doc["usage"]["memory"]
+    assert queue.get_job_usage(name=["unknown"]) == []
+    usage = queue.get_job_usage(period="day")
+    assert usage[0]["period"] == doc["finished_at"].strftime("%Y-%m-%d")
+
+
+def test_metric(queue):
+    worker = core4.queue.worker.CoreWorker()
+    assert core4.queue.metric.COMMAND_TIMER in \
+        core4.base.connector.mongo.LISTENER
+    worker.register()
+    worker.at = core4.util.node.mongo_now()
+    for step in worker.plan:
+        step["next"] = worker.at
+    worker.run_step()
+    doc = worker.metric.to_doc()
+    assert set(doc["step"]) == set(worker.steps)
+    assert "work_jobs" in doc["mongo"]
+    assert not worker.publish_metric()
+    worker.metric_at = core4.util.node.mongo_now()
+    assert worker.publish_metric()
+    assert worker.metric.to_doc()["step"] == {}
+    metric = queue.get_metric()
+    assert [d["_id"] for d in metric] == [worker.identifier]
+    assert set(metric[0]["metric"]["step"]) == set(worker.steps)
+    text = core4.queue.metric.format_metric(metric)
+    assert 'step="work_jobs"' in text
+
+
+def test_queue_metric(queue):
+    job = queue.enqueue(core4.queue.helper.job.example.DummyJob)
+    worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
+    worker.start_job(job.serialise(), run_async=False)
+    metric = queue.get_queue_metric(by_worker=True)
+    assert len(metric) == 1
+    assert metric[0]["name"] == job.qual_name()
+    assert metric[0]["worker"] == worker.identifier
+    assert metric[0]["started"] == 1
+    assert metric[0]["complete"] == 1
+    assert metric[0]["wait"]["n"] == 1
+    assert metric[0]["runtime"]["n"] == 1
+    assert metric[0]["runtime"]["p50"] is not None
+    assert queue.get_queue_metric(name=["unknown"]) == []
+    with pytest.raises(core4.error.Core4UsageError):
+        queue.get_queue_metric(period="week")
+
+
+def test_archive(queue):
+    job = queue.enqueue(core4.queue.helper.job.example.DummyJob)
+    worker = core4.queue.worker.CoreWorker()
+    worker.at = core4.util.node.mongo_now()
+    worker.start_job(job.serialise(), run_async=False)
+    doc = queue.config.sys.journal.find_one({"_id": job._id})
+    old = []
+    for days in (400, 399, 370):
+        copy = dict(doc)
+        copy["_id"] = ObjectId.from_datetime(
+            worker.at - datetime.timedelta(days=days))
+        old.append(copy)
+    queue.config.sys.journal.insert_many(old)
+    archive = core4.queue.archive.CoreArchive()
+    assert archive.archive() == 0
+    assert archive.archive(age=365) == 3
+    assert archive.archive(age=365) == 0
+    assert queue.config.sys.journal.count_documents({}) == 1
+    assert queue.config.sys.archive.count_documents({}) == 3
+    found = queue.find_job(old[0]["_id"])
+    assert found._id == old[0]["_id"]
+    assert found.state == "complete"
+    detail = queue.job_detail(old[1]["_id"])
+    assert detail["journaled"]
+    assert detail["archived"]
+    assert "archived" not in queue.job_detail(job._id)
+    assert [d["_id"] for d in archive.find(name=job.qual_name())] == [
+        d["_id"] for d in old]
+    assert [d["_id"] for d in archive.find(
+        end=worker.at - datetime.timedelta(days=380))] == [
+        d["_id"] for d in old[:2]]
+    with pytest.raises(core4.error.CoreJobNotFound):
+        queue.find_job(ObjectId())
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the job claim rate of :meth:`.CoreWorker.get_next_job` with many
+local worker processes against one MongoDB.
+
+Usage:
+  claim.py [--mongo=URL] [--database=DATABASE] [--jobs=JOBS] \
+[--worker=WORKER]...
+
+Options:
+  --mongo=URL          MongoDB url [default: mongodb://localhost:27017]
+  --database=DATABASE  MongoDB database, dropped before and after the run
+                       [default: core4bench]
+  --jobs=JOBS          number of jobs to enqueue [default: 10000]
+  --worker=WORKER      number of worker processes, repeat to compare multiple
+                       settings [default: 8]
+"""
+
+import multiprocessing
+import os
+import time
+
+import pymongo
+from docopt import docopt
+
+
+def setup_env(url, database):
+    os.environ["CORE4_OPTION_DEFAULT__mongo_url"] = url
+    os.environ["CORE4_OPTION_DEFAULT__mongo_database"] = database
+    os.environ["CORE4_OPTION_logging__mongodb"] = "~"
+    os.environ["CORE4_OPTION_logging__stderr"] = "~"
+    os.environ["CORE4_OPTION_worker__min_free_ram"] = "!!int 0"
+    os.environ["CORE4_OPTION_worker__max_cpu"] = "!!int 100"
+    os.environ["CORE4_OPTION_worker__slots"] = "!!int 1000000"
+
+
+def enqueue(jobs):
+    import core4.queue.main
+    import core4.util.node
+    from core4.queue.helper.job.example import DummyJob
+    queue = core4.queue.main.CoreQueue()
+    core4.service.setup.CoreSetup().make_queue()
+    docs = []
+    now = core4.util.node.mongo_now()
+    for i in range(jobs):
+        job = queue.job_factory(DummyJob, i=i, max_parallel=jobs)
+        job.__dict__["attempts_left"] = job.attempts
+        job.__dict__["state"] = core4.queue.job.STATE_PENDING
+        job.__dict__["enqueued"] = {
+            "at": now,
+            "hostname": core4.util.node.get_hostname(),
+            "parent_id": None,
+            "username": core4.util.node.get_username()
+        }
+        docs.append(job.serialise())
+    queue.config.sys.queue.insert_many(docs)
+
+
+def claim(number, url, database, start, result):
+    setup_env(url, database)
+    import core4.queue.worker
+    import core4.util.node
+    worker = core4.queue.worker.CoreWorker(name="bench-{}".format(number))
+    start.wait()
+    n = 0
+    t0 = time.time()
+    while True:
+        worker.at = core4.util.node.mongo_now()
+        if worker.get_next_job() is None:
+            break
+        n += 1
+    result.put((n, time.time() - t0))
+
+
+def run(url, database, jobs, worker):
+    mongo = pymongo.MongoClient(url)
+    mongo.drop_database(database)
+    setup_env(url, database)
+    enqueue(jobs)
+    start = multiprocessing.Event()
+    result = multiprocessing.Queue()
+    pool = [multiprocessing.Process(
+        target=claim, args=(i, url, database, start, result))
+        for i in range(worker)]
+    for proc in pool:
+        proc.start()
+    time.sleep(1)
+    t0 = time.time()
+    start.set()
+    stats = [result.get() for _ in pool]
+    elapsed = time.time() - t0
+    for proc in pool:
+        proc.join()
+    claimed = sum(n for n, _ in stats)
+    left = mongo[database].sys.queue.count_documents({"locked": None})
+    mongo.drop_database(database)
+    print("{:>6d} worker {:>8d} claims {:>8.2f} sec. {:>10.1f} claims/sec. "
+          "{:>6d} unclaimed".format(
+              worker, claimed, elapsed, claimed / elapsed, left))
+
+
+def main():
+    args = docopt(__doc__, help=True)
+    for worker in args["--worker"]:
+        run(args["--mongo"], args["--database"], int(args["--jobs"]),
+            int(worker))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the permission checks of :meth:`.EventHandler.on_queue` which masks
+the queue summary for each connected web socket client. The benchmark
+creates a synthetic summary of ``--lines`` job names and ``--clients``
+clients spread across ``--roles`` distinct permission sets. No MongoDB is
+required.
+
+The benchmark reports the seconds of the first (cold) and the following
+(warm) queue summaries. The baseline checks one uncompiled ``re.match`` per
+permission and line for one client per permission set and extrapolates the
+seconds to all clients.
+
+Usage:
+  permission.py [--lines=LINES] [--clients=CLIENTS] [--roles=ROLES] \
+[--perm=PERM] [--repeat=REPEAT]
+
+Options:
+  --lines=LINES      number of job names in the queue summary
+                     [default: 10000]
+  --clients=CLIENTS  number of connected clients [default: 200]
+  --roles=ROLES      number of distinct permission sets [default: 5]
+  --perm=PERM        number of api permissions per set [default: 20]
+  --repeat=REPEAT    number of warm queue summaries [default: 5]
+"""
+
+import re
+import time
+
+from docopt import docopt
+from tornado.ioloop import IOLoop
+
+import core4.const
+from core4.api.v1.request.role.matcher import PermMatcher
+from core4.api.v1.request.standard.event import EventHandler
+
+
+class User:
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+
+    async def perm_matcher(self):
+        return self.matcher
+
+
+class Waiter:
+
+    def __init__(self, matcher):
+        self.user = User(matcher)
+        self.last = []
+
+    def write_message(self, message):
+        pass
+
+
+def summary(lines):
+    return [{"name": "project{}.job.Job{}".format(i % 100, i),
+             "state": "pending", "n": 1} for i in range(lines)]
+
+
+def permission(roles, perm):
+    return [["api://project{}.job.Job{}.*".format((r + i) % 100, i)
+             for i in range(perm)] for r in range(roles)]
+
+
+def baseline(change, perms, clients):
+    t0 = time.time()
+    for perm in perms:
+        for line in change:
+            for p in perm:
+                (*proto, qn) = p.split("/")
+                if proto[0] == "api:" and re.match(qn, line["name"]):
+                    break
+    return (time.time() - t0) * clients / len(perms)
+
+
+def run(lines, clients, roles, perm, repeat):
+    change = summary(lines)
+    perms = permission(roles, perm)
+    matcher = [PermMatcher(p) for p in perms]
+    EventHandler.waiters = dict(
+        [(Waiter(matcher[c % roles]), [core4.const.QUEUE_CHANNEL])
+         for c in range(clients)])
+    loop = IOLoop.current()
+    t0 = time.time()
+    loop.run_sync(lambda: EventHandler.on_queue(change))
+    cold = time.time() - t0
+    warm = []
+    for _ in range(repeat):
+        for waiter in EventHandler.waiters:
+            waiter.last = []
+        t0 = time.time()
+        loop.run_sync(lambda: EventHandler.on_queue(change))
+        warm.append(time.time() - t0)
+    print("lines: {}, clients: {}, roles: {}, perm: {}".format(
+        lines, clients, roles, perm))
+    print("cold: {:.4f}s".format(cold))
+    print("warm: {:.4f}s (min), {:.4f}s (max)".format(min(warm), max(warm)))
+    print("baseline: {:.4f}s (extrapolated)".format(
+        baseline(change, perms, clients)))
+
+
+def main():
+    args = docopt(__doc__, help=True)
+    run(int(args["--lines"]), int(args["--clients"]), int(args["--roles"]),
+        int(args["--perm"]), int(args["--repeat"]))
+
+
+if __name__ == '__main__':
+    main()
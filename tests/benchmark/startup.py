@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares job startup latency and job throughput of worker execution modes
+``spawn`` (new Python interpreter per job) and ``zygote`` (fork per job from
+the pre-loaded project agent, see :mod:`core4.queue.agent`).
+
+Run from the repository root with ``python -m tests.benchmark.startup`` so
+that the benchmark job is importable by the job processes.
+
+Usage:
+  startup.py [--mongo=URL] [--database=DATABASE] [--jobs=JOBS] \
+[--mode=MODE]...
+
+Options:
+  --mongo=URL          MongoDB url [default: mongodb://localhost:27017]
+  --database=DATABASE  MongoDB database, dropped before and after the run
+                       [default: core4bench]
+  --jobs=JOBS          number of jobs to launch [default: 100]
+  --mode=MODE          execution mode, repeat to compare multiple modes
+                       [default: spawn zygote]
+"""
+
+import os
+import time
+
+import pymongo
+from docopt import docopt
+
+from core4.queue.job import CoreJob
+
+
+class NoopJob(CoreJob):
+    """
+    Does nothing, measures the startup overhead only.
+    """
+    author = "mra"
+
+    def execute(self, *args, **kwargs):
+        pass
+
+
+def setup_env(url, database, mode):
+    os.environ["CORE4_OPTION_DEFAULT__mongo_url"] = url
+    os.environ["CORE4_OPTION_DEFAULT__mongo_database"] = database
+    os.environ["CORE4_OPTION_logging__mongodb"] = "~"
+    os.environ["CORE4_OPTION_logging__stderr"] = "~"
+    os.environ["CORE4_OPTION_worker__min_free_ram"] = "!!int 0"
+    os.environ["CORE4_OPTION_worker__max_cpu"] = "!!int 100"
+    os.environ["CORE4_OPTION_worker__slots"] = "!!int 1000000"
+    os.environ["CORE4_OPTION_worker__execution"] = mode
+
+
+def run(url, database, jobs, mode):
+    from tests.benchmark.startup import NoopJob
+    import core4.queue.main
+    import core4.queue.worker
+    import core4.util.node
+    import core4.util.tool
+    mongo = pymongo.MongoClient(url)
+    mongo.drop_database(database)
+    setup_env(url, database, mode)
+    core4.util.tool.Singleton._instances = {}
+    queue = core4.queue.main.CoreQueue()
+    for i in range(jobs):
+        queue.enqueue(NoopJob, i=i, max_parallel=jobs)
+    worker = core4.queue.worker.CoreWorker(name="bench-{}".format(mode))
+    if mode == core4.queue.worker.EXECUTION_ZYGOTE:
+        worker.start_agent()
+        # spawn the agent outside of the measurement
+        worker.agent.spawn(NoopJob.qual_name().split(".")[0])
+    launched = {}
+    t0 = time.time()
+    while True:
+        worker.at = core4.util.node.mongo_now()
+        doc = worker.get_next_job()
+        if doc is None:
+            break
+        launched[doc["_id"]] = core4.util.node.mongo_now()
+        worker.launch_job(doc)
+    while queue.config.sys.queue.count_documents({}) > 0:
+        time.sleep(0.1)
+    elapsed = time.time() - t0
+    if worker.agent is not None:
+        worker.agent.stop()
+    latency = sorted(
+        (doc["finished_at"] - launched[doc["_id"]]).total_seconds()
+        for doc in queue.config.sys.journal.find(
+            {}, projection=["finished_at"]))
+    mongo.drop_database(database)
+    print("{:>6s} {:>6d} jobs {:>8.2f} sec. {:>8.1f} jobs/sec. "
+          "latency median {:>6.3f} sec. p95 {:>6.3f} sec.".format(
+              mode, len(latency), elapsed, len(latency) / elapsed,
+              latency[len(latency) // 2],
+              latency[int(len(latency) * 0.95)]))
+
+
+def main():
+    args = docopt(__doc__, help=True)
+    for mode in args["--mode"]:
+        run(args["--mongo"], args["--database"], int(args["--jobs"]), mode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the job queue throughput of multiple :class:`.CoreWorker` daemons
+on one machine. The benchmark starts a local ``mongod`` replica set member
+(or uses an existing MongoDB with ``--mongo``), launches the workers with
+distinct identifiers, enqueues a mix of synthetic jobs and waits until all
+jobs have been journaled.
+
+The job mix is specified with ``--mix=KIND:N[:ARG]``, e.g.
+``--mix=noop:500 --mix=sleep:50:0.5``. Supported kinds are
+
+* ``noop`` - does nothing
+* ``sleep`` - sleeps ``ARG`` seconds (default 0.1)
+* ``cpu`` - computes ``ARG`` squares (default 1000000)
+* ``log`` - writes ``ARG`` log records (default 1000)
+* ``stdout`` - prints ``ARG`` kB to stdout (default 1024)
+
+The benchmark reports
+
+* ``enqueue`` - number of jobs, seconds and jobs per second to enqueue
+* ``claim`` - number of claims, seconds between first and last claim and
+  claims per second
+* ``latency`` - percentiles of the time between ``enqueued.at`` and the
+  start of job execution in seconds, overall and per kind
+* ``runtime`` - percentiles of the job execution time per kind
+* ``throughput`` - completed jobs per second
+* ``mongo`` - MongoDB ``opcounters`` and ``metrics.document`` counts of the
+  run (with a local mongod these include all workers and jobs only)
+
+Results are printed and written as JSON with ``--output`` to compare runs
+over time. Run from the repository root with
+``python -m tests.benchmark.throughput`` so that the benchmark jobs are
+importable by the job processes.
+
+Usage:
+  throughput.py [--mongod=BINARY] [--port=PORT] [--mongo=URL] \
+[--database=DATABASE] [--worker=WORKER] [--mix=MIX]... \
+[--execution=MODE] [--dispatch=MODE] [--timeout=SECONDS] [--output=FILE]
+
+Options:
+  --mongod=BINARY      mongod binary to start [default: mongod]
+  --port=PORT          port of the local mongod [default: 27099]
+  --mongo=URL          use the existing MongoDB at URL instead of starting
+                       a local mongod
+  --database=DATABASE  MongoDB database, dropped before and after the run
+                       [default: core4bench]
+  --worker=WORKER      number of workers [default: 4]
+  --mix=MIX            job mix as KIND:N[:ARG], repeat for multiple kinds
+                       [default: noop:1000]
+  --execution=MODE     worker execution mode spawn or zygote
+                       [default: spawn]
+  --dispatch=MODE      worker dispatch mode poll or watch [default: poll]
+  --timeout=SECONDS    max. seconds to wait for job completion
+                       [default: 600]
+  --output=FILE        write JSON result to FILE
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import pymongo
+import pymongo.errors
+from docopt import docopt
+
+import core4
+import core4.util.node
+from core4.queue.job import CoreJob
+
+#: synthetic job kinds with their default argument
+KIND = {
+    "noop": None,
+    "sleep": 0.1,
+    "cpu": 1000000,
+    "log": 1000,
+    "stdout": 1024
+}
+
+#: percentiles reported
+PERCENTILE = (50, 90, 95, 99)
+
+
+class BenchJob(CoreJob):
+    """
+    Base class of the synthetic benchmark jobs. The job result carries the
+    date/time when job execution started.
+    """
+    author = "mra"
+
+    def execute(self, arg=None, **kwargs):
+        started_at = core4.util.node.mongo_now()
+        self.work(arg)
+        return {"started_at": started_at}
+
+    def work(self, arg):
+        pass
+
+
+class NoopJob(BenchJob):
+    """
+    Does nothing, measures the queue overhead only.
+    """
+
+
+class SleepJob(BenchJob):
+    """
+    Sleeps ``arg`` seconds.
+    """
+
+    def work(self, arg):
+        time.sleep(arg)
+
+
+class CpuJob(BenchJob):
+    """
+    Computes ``arg`` squares.
+    """
+
+    def work(self, arg):
+        sum(i * i for i in range(int(arg)))
+
+
+class LogJob(BenchJob):
+    """
+    Writes ``arg`` log records.
+    """
+
+    def work(self, arg):
+        for i in range(int(arg)):
+            self.logger.info("chatty log record [%d]", i)
+
+
+class StdoutJob(BenchJob):
+    """
+    Prints ``arg`` kB to stdout.
+    """
+
+    def work(self, arg):
+        line = "x" * 1023
+        for _ in range(int(arg)):
+            print(line)
+
+
+class LocalMongod:
+    """
+    Starts a single member replica set with a temporary data directory.
+    Replica sets support change streams and transactions, see
+    :meth:`.CoreQueue.supports_transaction`.
+    """
+
+    def __init__(self, binary, port):
+        self.binary = binary
+        self.port = port
+        self.path = None
+        self.proc = None
+
+    @property
+    def url(self):
+        return "mongodb://127.0.0.1:{}".format(self.port)
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix="core4bench-")
+        self.proc = subprocess.Popen(
+            [self.binary, "--dbpath", self.path, "--port", str(self.port),
+             "--bind_ip", "127.0.0.1", "--replSet", "core4bench",
+             "--logpath", os.path.join(self.path, "mongod.log")],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        kwargs = {"serverSelectionTimeoutMS": 1000}
+        if pymongo.version_tuple >= (3, 11):
+            # connect to the uninitiated member without discovery
+            kwargs["directConnection"] = True
+        client = pymongo.MongoClient(self.url, **kwargs)
+        self._wait(lambda: client.admin.command("ping"))
+        client.admin.command("replSetInitiate", {
+            "_id": "core4bench",
+            "members": [{"_id": 0, "host": "127.0.0.1:{}".format(self.port)}]
+        })
+        self._wait(lambda: client.admin.command("ismaster")["ismaster"])
+        client.close()
+        return self
+
+    def _wait(self, test, timeout=30):
+        t0 = time.time()
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError("mongod exited with [{}], see [{}]".format(
+                    self.proc.returncode,
+                    os.path.join(self.path, "mongod.log")))
+            try:
+                if test():
+                    return
+            except pymongo.errors.PyMongoError:
+                pass
+            if time.time() - t0 > timeout:
+                raise RuntimeError("mongod did not start")
+            time.sleep(0.2)
+
+    def __exit__(self, *args):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def setup_env(url, database, execution, dispatch):
+    os.environ["CORE4_OPTION_DEFAULT__mongo_url"] = url
+    os.environ["CORE4_OPTION_DEFAULT__mongo_database"] = database
+    os.environ["CORE4_OPTION_logging__mongodb"] = "INFO"
+    os.environ["CORE4_OPTION_logging__stderr"] = "~"
+    os.environ["CORE4_OPTION_worker__min_free_ram"] = "!!int 0"
+    os.environ["CORE4_OPTION_worker__max_cpu"] = "!!int 100"
+    os.environ["CORE4_OPTION_worker__execution"] = execution
+    os.environ["CORE4_OPTION_worker__dispatch"] = dispatch
+
+
+def parse_mix(mix):
+    """
+    :param mix: list of ``KIND:N[:ARG]``
+    :return: list of tuples ``(kind, n, arg)``
+    """
+    ret = []
+    for spec in mix:
+        for part in spec.split():
+            (kind, n, *arg) = part.split(":")
+            if kind not in KIND:
+                raise SystemExit("unknown job kind [{}]".format(kind))
+            ret.append((kind, int(n), float(arg[0]) if arg else KIND[kind]))
+    return ret
+
+
+def job_class(kind):
+    from tests.benchmark import throughput
+    return getattr(throughput, {
+        "noop": "NoopJob",
+        "sleep": "SleepJob",
+        "cpu": "CpuJob",
+        "log": "LogJob",
+        "stdout": "StdoutJob"
+    }[kind])
+
+
+def start_worker(number, url, database, execution, dispatch):
+    setup_env(url, database, execution, dispatch)
+    import core4.queue.worker
+    worker = core4.queue.worker.CoreWorker(name="bench-{}".format(number))
+    worker.start()
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile.
+
+    :param values: sorted list of values
+    :param p: percentile between 0 and 100
+    :return: value or ``None`` for an empty list
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(len(values) * p / 100.) - 1)]
+
+
+def summary(values):
+    values = sorted(values)
+    ret = {"n": len(values)}
+    ret["avg"] = sum(values) / len(values) if values else None
+    ret["max"] = values[-1] if values else None
+    for p in PERCENTILE:
+        ret["p{}".format(p)] = percentile(values, p)
+    return ret
+
+
+def server_status(mongo):
+    status = mongo.admin.command("serverStatus")
+    return {
+        "opcounters": dict(status["opcounters"]),
+        "document": dict(status.get("metrics", {}).get("document", {}))
+    }
+
+
+def status_delta(before, after):
+    return dict(
+        (section, dict((k, v - before[section].get(k, 0))
+                       for k, v in after[section].items()))
+        for section in after)
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(url, database, worker, mix, execution, dispatch, timeout):
+    import core4.queue.main
+    import core4.service.setup
+    import core4.util.tool
+    mongo = pymongo.MongoClient(url)
+    mongo.drop_database(database)
+    setup_env(url, database, execution, dispatch)
+    core4.util.tool.Singleton._instances = {}
+    queue = core4.queue.main.CoreQueue()
+    core4.service.setup.CoreSetup().make_all()
+    pool = [multiprocessing.Process(
+        target=start_worker,
+        args=(i, url, database, execution, dispatch))
+        for i in range(worker)]
+    for proc in pool:
+        proc.start()
+    # wait for all workers to enter the main loop
+    while queue.config.sys.worker.count_documents(
+            {"_id": {"$regex": "^bench-"}, "phase.loop": {"$ne": None}}) \
+            < worker:
+        time.sleep(0.1)
+    before = server_status(mongo)
+    prepared = []
+    for (kind, n, arg) in mix:
+        cls = job_class(kind)
+        for i in range(n):
+            prepared.append(queue.prepare_job(
+                cls, i=i, arg=arg, max_parallel=n, attempts=1))
+    now = core4.util.node.mongo_now()
+    for job in prepared:
+        job.__dict__["enqueued"]["at"] = now
+    t0 = time.time()
+    queue.enqueue_many(prepared)
+    enqueue_time = time.time() - t0
+    while queue.config.sys.queue.count_documents({}) > 0:
+        if time.time() - t0 > timeout:
+            break
+        time.sleep(0.1)
+    elapsed = time.time() - t0
+    after = server_status(mongo)
+    queue.halt(now=True)
+    for proc in pool:
+        proc.join(timeout=30)
+        if proc.is_alive():
+            proc.terminate()
+    latency = {}
+    runtime = {}
+    started = []
+    claims = 0
+    state = {}
+    for doc in queue.config.sys.journal.find(
+            {}, projection=["name", "state", "enqueued", "started_at",
+                            "runtime", "trial", "result"]):
+        kind = doc["name"].split(".")[-1]
+        state[doc["state"]] = state.get(doc["state"], 0) + 1
+        claims += doc["trial"]
+        started.append(doc["started_at"])
+        result = doc.get("result") or {}
+        if result.get("started_at"):
+            latency.setdefault(kind, []).append(
+                (result["started_at"] - doc["enqueued"]["at"]).total_seconds())
+        runtime.setdefault(kind, []).append(doc["runtime"])
+    span = ((max(started) - min(started)).total_seconds()
+            if started else 0.)
+    complete = state.get("complete", 0)
+    ret = {
+        "timestamp": core4.util.node.mongo_now().isoformat(),
+        "hostname": core4.util.node.get_hostname(),
+        "version": core4.__version__,
+        "revision": revision(),
+        "config": {
+            "worker": worker,
+            "mix": [{"kind": k, "n": n, "arg": a} for (k, n, a) in mix],
+            "execution": execution,
+            "dispatch": dispatch,
+            "cpu_count": multiprocessing.cpu_count()
+        },
+        "jobs": len(prepared),
+        "pending": queue.config.sys.queue.count_documents({}),
+        "state": state,
+        "elapsed": elapsed,
+        "enqueue": {
+            "n": len(prepared),
+            "sec": enqueue_time,
+            "rate": len(prepared) / enqueue_time if enqueue_time else None
+        },
+        "claim": {
+            "n": claims,
+            "sec": span,
+            "rate": claims / span if span else None
+        },
+        "latency": summary([v for l in latency.values() for v in l]),
+        "throughput": complete / elapsed,
+        "kind": dict(
+            (kind, {"latency": summary(latency.get(kind, [])),
+                    "runtime": summary(runtime[kind])})
+            for kind in sorted(runtime)),
+        "mongo": status_delta(before, after)
+    }
+    mongo.drop_database(database)
+    return ret
+
+
+def report(result):
+    print("{} worker, {} jobs, {} pending, {:.2f} sec.".format(
+        result["config"]["worker"], result["jobs"], result["pending"],
+        result["elapsed"]))
+    print("enqueue    {:>10.1f} jobs/sec.".format(
+        result["enqueue"]["rate"] or 0))
+    print("claim      {:>10.1f} claims/sec.".format(
+        result["claim"]["rate"] or 0))
+    print("throughput {:>10.1f} jobs/sec.".format(result["throughput"]))
+    print("latency    p50 {} p95 {} p99 {} max {}".format(*[
+        "-" if result["latency"][k] is None
+        else "{:.3f}".format(result["latency"][k])
+        for k in ("p50", "p95", "p99", "max")]))
+    print("mongo      {}".format(" ".join(
+        "{}={}".format(k, v)
+        for k, v in sorted(result["mongo"]["opcounters"].items()))))
+
+
+def main():
+    args = docopt(__doc__, help=True)
+    mix = parse_mix(args["--mix"])
+    kwargs = dict(
+        database=args["--database"],
+        worker=int(args["--worker"]),
+        mix=mix,
+        execution=args["--execution"],
+        dispatch=args["--dispatch"],
+        timeout=float(args["--timeout"]))
+    if args["--mongo"]:
+        result = run(args["--mongo"], **kwargs)
+    else:
+        with LocalMongod(args["--mongod"], int(args["--port"])) as mongod:
+            result = run(mongod.url, **kwargs)
+    report(result)
+    if args["--output"]:
+        with open(args["--output"], "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()